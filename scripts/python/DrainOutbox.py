@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+    deliver the requests which the Post* scripts left in an outbox (their --outbox, see utils/Outbox.py) to the
+    database, and inspect and requeue its dead letters. Run it after a run, from cron, or with --follow as a background
+    worker beside the pipeline, so that the pipeline's tasks never wait on the database
+    usage: DrainOutbox.py -d /path/to/outbox drain --post_cache /path/to/post_cache
+           DrainOutbox.py -d /path/to/outbox drain --follow --poll_interval 60 --concurrency 8 --rate_limit 20
+           DrainOutbox.py -d /path/to/outbox stats
+           DrainOutbox.py -d /path/to/outbox dead --url https://someaddress/QualityAssess/
+           DrainOutbox.py -d /path/to/outbox requeue
+    author: chase.mateusiak@gmail.com
+
+    output: stats prints url, pending, leased and dead letter messages as tab separated lines. dead prints each dead
+            letter as id, url, primary key value, attempts, status code and error
+    database_interaction: post, put or post or put each message of the outbox
+"""
+
+# standard library imports
+import sys
+import os
+import time
+import argparse
+from functools import partial
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from utils.StageMetrics import StageMetrics
+from utils.Outbox import DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, Outbox, drainOutbox
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+
+    with Outbox(args.outbox_dir) as outbox:
+        if args.command == 'stats':
+            for url, pending, leased, dead in outbox.stats():
+                print('%s\t%s\t%s\t%s' % (url, pending, leased, dead))
+        elif args.command == 'dead':
+            for dead_letter in outbox.deadLetters(args.url):
+                print('%s\t%s\t%s\t%s\t%s\t%s' % (dead_letter.id, dead_letter.url, dead_letter.primary_key_value,
+                                                  dead_letter.attempts, dead_letter.status_code, dead_letter.error))
+        elif args.command == 'requeue':
+            print('requeued %s messages' % outbox.requeueDeadLetters(args.url))
+        else:
+            drain(outbox, args)
+
+def drain(outbox, args):
+    """
+        drain the outbox once or, with --follow, until interrupted. Exits with an error if a drain which is not following
+        stops on an outage or dead letters messages
+    """
+    # imported here so that stats, dead and requeue do not load requests
+    from utils.DatabaseInteraction import createClient
+
+    metrics = StageMetrics('DrainOutbox', None, args.metrics_dir, args.prometheus_dir)
+    client_factory = partial(createClient, args.post_cache, args.force, metrics)
+    while True:
+        with metrics.stage('drain'):
+            summary = drainOutbox(outbox, client_factory, args.batch_size, args.concurrency, args.rate_limit,
+                                  args.max_attempts, args.lease)
+        if summary['batches']:
+            print('delivered %s, retrying %s, dead lettered %s%s' % (summary['delivered'], summary['retried'], summary['deadLettered'],
+                                                                     ', stopped: the database is not responding' if summary['outage'] else ''),
+                  file=sys.stderr if summary['outage'] or summary['deadLettered'] else sys.stdout)
+        if not args.follow:
+            break
+        # the messages of an outage wait out their retry delay, so the next poll does not hammer the database
+        time.sleep(args.poll_interval)
+
+    if summary['outage']:
+        sys.exit('DrainOutboxError: the database is not responding. The messages remain in the outbox and are retried by the next drain')
+    if summary['deadLettered']:
+        sys.exit('DrainOutboxError: %s messages were dead lettered. See DrainOutbox.py -d %s dead' % (summary['deadLettered'], args.outbox_dir))
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Deliver the requests in an outbox to the database, and inspect and requeue its dead letters.")
+    parser.add_argument("-d", "--outbox_dir", required=True,
+                        help="[REQUIRED] directory of the outbox, the --outbox of the Post* scripts")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    drain_parser = subparsers.add_parser('drain', help="deliver the messages which are due")
+    drain_parser.add_argument("--batch_size", type=int, default=100,
+                              help="messages claimed at a time. Default 100")
+    drain_parser.add_argument("--concurrency", type=int, default=8,
+                              help="maximum number of requests to the database in flight at once. Default 8")
+    drain_parser.add_argument("--rate_limit", type=float,
+                              help="maximum number of requests per second to the database host. Default is no limit")
+    drain_parser.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                              help="attempts of a message which gets no response or a 5xx before it is dead lettered. Default %s" % DEFAULT_MAX_ATTEMPTS)
+    drain_parser.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS,
+                              help="seconds before messages claimed by a drain which died may be claimed again. Default %s" % DEFAULT_LEASE_SECONDS)
+    drain_parser.add_argument("--follow", action='store_true',
+                              help="keep draining, every --poll_interval seconds, until interrupted")
+    drain_parser.add_argument("--poll_interval", type=float, default=60,
+                              help="with --follow, seconds between drains. Default 60")
+    drain_parser.add_argument("--post_cache",
+                              help="directory of the post cache. If set, payloads which were already sent are skipped and changed qc records are put directly")
+    drain_parser.add_argument("--force", action='store_true',
+                              help="send every payload even if the post cache shows it was already sent")
+    drain_parser.add_argument("--metrics_dir",
+                              help="directory to which to write the time and metrics of each drain as json lines, see utils/StageMetrics.py")
+    drain_parser.add_argument("--prometheus_dir",
+                              help="directory to which to write the time and metrics of each drain as a prometheus textfile")
+    subparsers.add_parser('stats', help="print the number of pending, leased and dead letter messages of each url")
+    for command, help_text in [('dead', "print the dead letters"), ('requeue', "move the dead letters back to the outbox to be delivered again")]:
+        command_parser = subparsers.add_parser(command, help=help_text)
+        command_parser.add_argument("--url",
+                                    help="only the dead letters of this url, eg https://someaddress/QualityAssess/")
+
+    args = parser.parse_args(argv[1:])
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+    coverage qc of every gene of a sample: the fraction of the bases of a feature type (default exon) covered, the mean
+    and median depth and the 5' to 3' bias of each gene, from the per base depth of GenomeCoverage.sh or from the bam, in
+    one sorted sweep against the cached annotation index (see utils/GeneCoverage.py)
+    usage: GeneCoverageQc.py -d sample_coverage.bed -a KN99_annotation.gff --annotation_cache /path/to/cache -n sample -o /path/to/output_dir
+           GeneCoverageQc.py -b sample_sorted.bam -a KN99_annotation.gff -n sample -f CDS
+    author: chase.mateusiak@gmail.com
+
+    output: ${sample}_gene_coverage.tsv with a row per gene: geneId, strand, biotype, length, fractionCovered, meanDepth,
+            medianDepth, fivePrimeDepth, threePrimeDepth, threePrimeBias (NA if the 5' end has no reads), and
+            ${sample}_gene_coverage_summary.json with the number of genes and of covered genes, the median fraction
+            covered and 3' bias of the covered genes, and the gene body profile of the sample
+"""
+
+# standard library imports
+import sys
+import os
+import csv
+import json
+import tempfile
+import argparse
+
+# third party imports
+import numpy as np
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from utils.StageMetrics import StageMetrics
+from utils.AnnotationIndex import loadAnnotationIndex
+from utils.CoverageSummary import readDepthChunks
+from utils.GeneCoverage import bamDepthChunks, geneCoverage
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+    metrics = StageMetrics('GeneCoverageQc', args.sample_name, args.metrics_dir, args.prometheus_dir)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    # without a cache the annotation index is built for this run only
+    with tempfile.TemporaryDirectory() as tmp_cache_dir:
+        try:
+            with metrics.stage('read'):
+                annotation_index = loadAnnotationIndex(args.annotation_file, args.annotation_cache or tmp_cache_dir)
+            with metrics.stage('coverage'):
+                if args.bam_file:
+                    gene_rows, gene_body_profile = geneCoverage(annotation_index, args.feature,
+                                                                bamDepthChunks(args.bam_file, annotation_index, args.feature, args.min_mapq),
+                                                                args.min_depth)
+                else:
+                    with (sys.stdin.buffer if args.depth_file == '-' else open(args.depth_file, 'rb')) as depth_file:
+                        gene_rows, gene_body_profile = geneCoverage(annotation_index, args.feature, readDepthChunks(depth_file),
+                                                                    args.min_depth)
+        except (KeyError, ValueError) as e:
+            sys.exit('GeneCoverageQcError: %s' % e.args[0])
+
+    summary = writeGeneCoverage(gene_rows, gene_body_profile, args.sample_name, args.feature, args.output_dir)
+    print('%s: %s of %s genes covered, median 3\' bias %s' % (args.sample_name, summary['genesCovered'], summary['genes'],
+                                                               formatValue(summary['medianThreePrimeBias'])))
+
+def writeGeneCoverage(gene_rows, gene_body_profile, sample_name, feature, output_dir):
+    """
+        write ${sample_name}_gene_coverage.tsv and ${sample_name}_gene_coverage_summary.json to output_dir
+        usage: summary = writeGeneCoverage(*geneCoverage(annotation_index, 'exon', depth_chunks), 'sample', 'exon', '.')
+        :params gene_rows: the gene rows of utils.GeneCoverage.geneCoverage
+        :params gene_body_profile: the gene body profile of utils.GeneCoverage.geneCoverage
+        :params sample_name: name of the sample, the prefix of the output files
+        :params feature: the feature type the coverage was calculated over
+        :params output_dir: directory to which to write the files
+        :returns: the summary dict
+    """
+    ################################ set name variables ###################################
+    gene_coverage_path = os.path.join(output_dir, '%s_gene_coverage.tsv' % sample_name)
+    summary_path = os.path.join(output_dir, '%s_gene_coverage_summary.json' % sample_name)
+    fieldnames = ['geneId', 'strand', 'biotype', 'length', 'fractionCovered', 'meanDepth', 'medianDepth',
+                  'fivePrimeDepth', 'threePrimeDepth', 'threePrimeBias']
+    #######################################################################################
+
+    with open(gene_coverage_path, 'w', newline='') as gene_coverage_file:
+        writer = csv.DictWriter(gene_coverage_file, fieldnames=fieldnames, delimiter='\t', lineterminator='\n')
+        writer.writeheader()
+        for row in gene_rows:
+            writer.writerow({field: formatValue(row[field]) for field in fieldnames})
+
+    covered_rows = [row for row in gene_rows if row['fractionCovered'] > 0]
+    three_prime_bias_list = [row['threePrimeBias'] for row in covered_rows if row['threePrimeBias'] is not None]
+    summary = {'sample': sample_name, 'feature': feature, 'genes': len(gene_rows), 'genesCovered': len(covered_rows),
+               'medianFractionCovered': float(np.median([row['fractionCovered'] for row in covered_rows])) if covered_rows else None,
+               'medianThreePrimeBias': float(np.median(three_prime_bias_list)) if three_prime_bias_list else None,
+               'geneBodyProfile': gene_body_profile}
+    with open(summary_path, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    return summary
+
+def formatValue(value):
+    """
+        :returns: NA for None, floats to 4 significant digits, anything else as is
+    """
+    if value is None:
+        return 'NA'
+    if isinstance(value, float):
+        return '%.4g' % value
+    return value
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Calculate the fraction covered, depth and 5' to 3' bias of every gene of a sample.")
+    depth_group = parser.add_mutually_exclusive_group(required=True)
+    depth_group.add_argument("-d", "--depth_file",
+                             help="per base depth, chrom, position and depth separated by tabs (the output of GenomeCoverage.sh). - reads stdin")
+    depth_group.add_argument("-b", "--bam_file",
+                             help="sorted, indexed alignment file (.bam), read through its index over the genes")
+    parser.add_argument("-a", "--annotation_file", required=True,
+                        help="[REQUIRED] annotation file (gtf or gff3)")
+    parser.add_argument("--annotation_cache",
+                        help="directory of parsed annotation indexes. If set, the annotation is parsed once and the index reused by every sample")
+    parser.add_argument("-n", "--sample_name", required=True,
+                        help="[REQUIRED] name of the sample, the prefix of the output files")
+    parser.add_argument("-f", "--feature", default='exon',
+                        help="feature type of which the bases of each gene are counted. Default exon")
+    parser.add_argument("--min_depth", type=int, default=1,
+                        help="minimum depth for a base to count as covered. Default 1")
+    parser.add_argument("--min_mapq", type=int, default=10,
+                        help="with --bam_file, minimum mapping quality of a read to be counted. Default 10, as GenomeCoverage.sh")
+    parser.add_argument("-o", "--output_dir", default='.',
+                        help="directory to which to write the gene table and summary. Default the current directory")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+
+    args = parser.parse_args(argv[1:])
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
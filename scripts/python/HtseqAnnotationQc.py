@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+    per gene assigned, ambiguous and no feature reads and the strandedness qc of a sample, from the XF tags of the bam
+    which the htseq_count module publishes (${sample}_sorted_aligned_reads_with_annote.bam), read a chunk of the genome
+    per worker (see utils/HtseqAnnotation.py). The fraction of reads on the strand of the gene they start in shows
+    whether the strandedness htseq was run with fits the library, without re-running htseq
+    usage: HtseqAnnotationQc.py -b sample_sorted_aligned_reads_with_annote.bam -a KN99_annotation.gff -n sample -s reverse -p 8
+           HtseqAnnotationQc.py -b sample_sorted_aligned_reads_with_annote.bam -a KN99_annotation.gff --annotation_cache /path/to/cache -n sample -s reverse --strict
+    author: chase.mateusiak@gmail.com
+
+    output: ${sample}_htseq_annotation.tsv with a row per gene: geneId, strand, assigned, ambiguous (reads which overlap
+            the gene and another) and noFeature (reads which start in the gene's features but were not counted to any
+            gene, eg on the other strand of a stranded library), and ${sample}_strandedness.json with the number of
+            reads of each XF category, the sense and antisense reads, the senseFraction and the inferred strandedness
+"""
+
+# standard library imports
+import sys
+import os
+import csv
+import json
+import tempfile
+import argparse
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from utils.StageMetrics import StageMetrics
+from utils.AnnotationIndex import loadAnnotationIndex
+from utils.HtseqAnnotation import (DEFAULT_CHUNK_SIZE, STRANDED_FRACTION, analyzeAnnotatedBam, geneTallyRows,
+                                   strandednessQc)
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+    metrics = StageMetrics('HtseqAnnotationQc', args.sample_name, args.metrics_dir, args.prometheus_dir)
+
+    if not os.path.exists(args.bam_file):
+        sys.exit('HtseqAnnotationQcError: %s does not exist' % args.bam_file)
+    os.makedirs(args.output_dir, exist_ok=True)
+    # without a cache the annotation index is built for this run only
+    with tempfile.TemporaryDirectory() as tmp_cache_dir:
+        try:
+            with metrics.stage('read'):
+                annotation_index = loadAnnotationIndex(args.annotation_file, args.annotation_cache or tmp_cache_dir)
+            with metrics.stage('tally'):
+                tally = analyzeAnnotatedBam(args.bam_file, annotation_index, args.feature, args.min_mapq, args.chunk_size, args.processes)
+        except (KeyError, ValueError) as e:
+            sys.exit('HtseqAnnotationQcError: %s' % e.args[0])
+        gene_rows = geneTallyRows(tally, annotation_index)
+
+    qc_dict = strandednessQc(tally, args.strandedness, args.stranded_fraction)
+    writeHtseqAnnotationQc(gene_rows, qc_dict, args.sample_name, args.output_dir)
+
+    print('%s: %s assigned, %s%% sense, inferred strandedness %s' % (args.sample_name, qc_dict['assigned'],
+                                                                     'NA' if qc_dict['senseFraction'] is None else round(100 * qc_dict['senseFraction'], 1),
+                                                                     qc_dict['inferredStrandedness']))
+    if qc_dict['strandednessConsistent'] is False:
+        message = 'HtseqAnnotationQcError: %s was counted with strandedness %s but its reads look %s' % (args.sample_name, args.strandedness,
+                                                                                                         qc_dict['inferredStrandedness'])
+        if args.strict:
+            sys.exit(message)
+        print(message, file=sys.stderr)
+
+def writeHtseqAnnotationQc(gene_rows, qc_dict, sample_name, output_dir):
+    """
+        write ${sample_name}_htseq_annotation.tsv and ${sample_name}_strandedness.json to output_dir
+        :params gene_rows: the rows of utils.HtseqAnnotation.geneTallyRows
+        :params qc_dict: the dict of utils.HtseqAnnotation.strandednessQc
+        :params sample_name: name of the sample, the prefix of the output files
+        :params output_dir: directory to which to write the files
+    """
+    ################################ set name variables ###################################
+    gene_tally_path = os.path.join(output_dir, '%s_htseq_annotation.tsv' % sample_name)
+    strandedness_path = os.path.join(output_dir, '%s_strandedness.json' % sample_name)
+    fieldnames = ['geneId', 'strand', 'assigned', 'ambiguous', 'noFeature']
+    #######################################################################################
+
+    with open(gene_tally_path, 'w', newline='') as gene_tally_file:
+        writer = csv.DictWriter(gene_tally_file, fieldnames=fieldnames, delimiter='\t', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(gene_rows)
+
+    with open(strandedness_path, 'w') as strandedness_file:
+        json.dump(dict({'sample': sample_name}, **qc_dict), strandedness_file, indent=2)
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Tally the htseq XF tags of a sample's bam per gene and check its strandedness.")
+    parser.add_argument("-b", "--bam_file", required=True,
+                        help="[REQUIRED] sorted, indexed bam with the htseq XF tags, ie ${sample}_sorted_aligned_reads_with_annote.bam")
+    parser.add_argument("-a", "--annotation_file", required=True,
+                        help="[REQUIRED] the annotation file (gtf or gff3) htseq counted against")
+    parser.add_argument("--annotation_cache",
+                        help="directory of parsed annotation indexes. If set, the annotation is parsed once and the index reused by every sample")
+    parser.add_argument("-n", "--sample_name", required=True,
+                        help="[REQUIRED] name of the sample, the prefix of the output files")
+    parser.add_argument("-s", "--strandedness", choices=['yes', 'reverse', 'no'],
+                        help="the strandedness htseq was run with (htseq-count -s). If set, it is checked against the reads")
+    parser.add_argument("--strict", action='store_true',
+                        help="exit with an error if the reads do not support --strandedness")
+    parser.add_argument("--stranded_fraction", type=float, default=STRANDED_FRACTION,
+                        help="fraction of reads on the gene's strand (or the other) at which a library is called yes (or reverse). Default %s" % STRANDED_FRACTION)
+    parser.add_argument("-f", "--feature", default='exon',
+                        help="feature type htseq counted (htseq-count -t). Default exon")
+    parser.add_argument("--min_mapq", type=int, default=10,
+                        help="minimum mapping quality of a read to count towards the strand statistics. Default 10")
+    parser.add_argument("--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="bases of the genome read by a worker at a time. Default %s" % DEFAULT_CHUNK_SIZE)
+    parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(),
+                        help="number of worker processes. Default is the number of cpus")
+    parser.add_argument("-o", "--output_dir", default='.',
+                        help="directory to which to write the gene table and strandedness qc. Default the current directory")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+
+    args = parser.parse_args(argv[1:])
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+    inspect, evict entries from and compact the post cache used by the Post*ToDatabase.py scripts (see utils/PostCache.py)
+    usage: ManagePostCache.py -c /path/to/post_cache stats
+           ManagePostCache.py -c /path/to/post_cache evict --older_than_days 30
+           ManagePostCache.py -c /path/to/post_cache evict --endpoint https://someaddress/QualityAssess/
+           ManagePostCache.py -c /path/to/post_cache compact
+    author: chase.mateusiak@gmail.com
+
+    output: stats prints endpoint, number of entries and last update as tab separated lines
+"""
+
+# standard library imports
+import sys
+import os
+import time
+import argparse
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from utils.PostCache import PostCache
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+
+    with PostCache(args.cache_dir) as post_cache:
+        if args.command == 'stats':
+            for endpoint, entries, updated_at in post_cache.stats():
+                print('%s\t%s\t%s' % (endpoint, entries, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(updated_at))))
+        elif args.command == 'evict':
+            older_than = args.older_than_days * 24 * 3600 if args.older_than_days is not None else None
+            evicted = post_cache.evict(older_than, args.endpoint)
+            print('evicted %s entries' % evicted)
+            if args.compact:
+                post_cache.compact()
+        elif args.command == 'compact':
+            post_cache.compact()
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Inspect, evict entries from and compact the post cache.")
+    parser.add_argument("-c", "--cache_dir", required=True,
+                        help="[REQUIRED] directory of the post cache, the --post_cache of the Post*ToDatabase.py scripts")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help="print the number of entries and last update of each endpoint")
+    evict_parser = subparsers.add_parser('evict', help="delete entries so that their records are sent again. Default deletes every entry")
+    evict_parser.add_argument("--older_than_days", type=float,
+                              help="only delete entries last updated more than this many days ago")
+    evict_parser.add_argument("--endpoint",
+                              help="only delete entries of this endpoint url, eg https://someaddress/QualityAssess/")
+    evict_parser.add_argument("--compact", action='store_true',
+                              help="compact the cache after evicting")
+    subparsers.add_parser('compact', help="reclaim the space of deleted entries")
+
+    args = parser.parse_args(argv[1:])
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
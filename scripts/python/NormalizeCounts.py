@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+    CPM, log2 CPM and, given the annotation, TPM of a run's count matrix store (see utils/CountNormalization.py). The
+    matrix is normalized a block of genes at a time and written as float32 .npy matrices next to the counts
+    usage: NormalizeCounts.py -d /path/to/run/count_matrix
+           NormalizeCounts.py -d /path/to/run/count_matrix -a KN99_annotation.gff --annotation_cache /path/to/cache -o /path/to/run/normalized
+    author: chase.mateusiak@gmail.com
+
+    output: cpm.npy, log2cpm.npy and, with --annotation_file, tpm.npy (genes x samples) and normalization.json with the
+            gene ids, sample names, library sizes and prior count, in ${count_matrix}/normalized by default
+"""
+
+# standard library imports
+import sys
+import os
+import tempfile
+import argparse
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from utils.StageMetrics import StageMetrics
+from utils.CountMatrixStore import CountMatrixStore
+from utils.CountNormalization import DEFAULT_PRIOR_COUNT, geneLengths, normalizeCountMatrix
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+    metrics = StageMetrics('NormalizeCounts', os.path.basename(os.path.normpath(args.count_matrix)), args.metrics_dir, args.prometheus_dir)
+
+    ################################ set name variables ###################################
+    output_dir = args.output_dir or os.path.join(args.count_matrix, 'normalized')
+    #######################################################################################
+
+    if not os.path.exists(os.path.join(args.count_matrix, 'manifest.json')):
+        sys.exit('NormalizeCountsError: %s is not a count matrix store' % args.count_matrix)
+    store = CountMatrixStore(args.count_matrix)
+
+    try:
+        gene_lengths = None
+        if args.annotation_file:
+            # imported here so that CPM alone does not load the annotation index
+            from utils.AnnotationIndex import loadAnnotationIndex
+            with tempfile.TemporaryDirectory() as tmp_cache_dir, metrics.stage('gene_lengths'):
+                annotation_index = loadAnnotationIndex(args.annotation_file, args.annotation_cache or tmp_cache_dir)
+                gene_lengths = geneLengths(annotation_index, store.gene_ids, args.feature)
+        with metrics.stage('normalize'):
+            manifest = normalizeCountMatrix(store, output_dir, args.prior_count, gene_lengths, block_rows=args.block_rows)
+    except (KeyError, ValueError) as e:
+        sys.exit(e.args[0])
+
+    print('normalized %s genes x %s samples to %s: %s' % (len(manifest['geneIds']), len(manifest['samples']), output_dir,
+                                                          ', '.join(manifest['measures'])))
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Calculate the CPM, log2 CPM and TPM of a run's count matrix store.")
+    parser.add_argument("-d", "--count_matrix", required=True,
+                        help="[REQUIRED] directory of the run's count matrix store, eg ${align_count_results}/${run_directory}/count_matrix")
+    parser.add_argument("-o", "--output_dir",
+                        help="directory to which to write the normalized matrices. Default ${count_matrix}/normalized")
+    parser.add_argument("--prior_count", type=float, default=DEFAULT_PRIOR_COUNT,
+                        help="average count added to each count before log2, scaled by library size as edgeR. Default 2")
+    parser.add_argument("-a", "--annotation_file",
+                        help="annotation file (gtf or gff3) the counts were made against. If set, TPM is also written, with the merged length of --feature of each gene")
+    parser.add_argument("--annotation_cache",
+                        help="directory of parsed annotation indexes. If set, the annotation is parsed once and the index reused")
+    parser.add_argument("-f", "--feature", default='exon',
+                        help="feature type whose merged length is the length of a gene for TPM. Default exon")
+    parser.add_argument("--block_rows", type=int,
+                        help="number of genes normalized at a time. Default as many as fit in 64MB of float64")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+
+    args = parser.parse_args(argv[1:])
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
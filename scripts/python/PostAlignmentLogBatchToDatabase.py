@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+    Parse every novoalign and novosort log of a run in parallel in a single interpreter, write one table and optionally
+    send to database. This is the batch version of PostAlignmentLogToDatabase.py
+    usage: PostAlignmentLogBatchToDatabase.py -d /path/to/run/logs -m fastq_file_list.csv -u https://someaddress/QualityAssess/
+           PostAlignmentLogBatchToDatabase.py -d /path/to/run/logs -o run_alignment_qc.csv --no-post
+    author: chase.mateusiak@gmail.com
+
+    input: the logs publishDir of a run, with ${sample_name}_novoalign.log and ${sample_name}_novosort.log files, and to
+           post, a manifest csv with (at least) the columns fastqFileName and fastqFileNumber, eg the fastq_file_list used by main.nf
+    output: one csv with a row per sample, the columns sampleName, fastqFileNumber (if a manifest is given) and the log metrics
+    database_interaction: post to url
+"""
+
+# standard library imports
+import sys
+import os
+import csv
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from utils.AlignmentLogParser import NOVOALIGN_METRICS, NOVOSORT_METRICS, findSampleLogs, parseSampleLogs
+from utils.AsyncUploader import AsyncUploader, UploadJob
+from utils.DatabaseInteraction import createClient
+from utils.Manifest import readManifest
+from utils.StageMetrics import StageMetrics
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+    metrics = StageMetrics('PostAlignmentLogBatchToDatabase', os.path.basename(os.path.normpath(args.log_dir)),
+                           args.metrics_dir, args.prometheus_dir)
+
+    ################################ set name variables ###################################
+    # for post data
+    primary_key = 'fastqFileNumber'
+    #######################################################################################
+
+    sample_log_list = findSampleLogs(args.log_dir)
+    if not sample_log_list:
+        sys.exit('PostAlignmentLogBatchToDatabaseError: no novoalign or novosort logs in %s' % args.log_dir)
+
+    # the fastqFileNumber is the foreign key of QualityAssess. It is only available from a manifest
+    try:
+        fastq_file_number_dict = {row['sampleName']: row['fastqFileNumber'] for row in readManifest(args.manifest)} if args.manifest else {}
+    except (OSError, ValueError) as e:
+        sys.exit(e)
+    if args.post and any(sample_name not in fastq_file_number_dict for sample_name, _, _ in sample_log_list):
+        sys.exit('PostAlignmentLogBatchToDatabaseError: every sample in the log directory must be in the manifest to post. Use --no-post to parse only')
+
+    # parse the logs across a process pool. results are returned in the order of sample_log_list
+    parse_failures = []
+    row_list = []
+    with metrics.stage('parse'), ProcessPoolExecutor(max_workers=args.processes) as executor:
+        futures = [executor.submit(parseSampleLogs, *sample_logs) for sample_logs in sample_log_list]
+        for (sample_name, _, _), future in zip(sample_log_list, futures):
+            try:
+                row = future.result()
+            except OSError as e:
+                parse_failures.append('%s: %s' % (sample_name, e))
+                continue
+            if sample_name in fastq_file_number_dict:
+                row[primary_key] = fastq_file_number_dict[sample_name]
+            row_list.append(row)
+
+    # write one tidy table, a row per sample. A sample without one of the logs has empty values for its metrics
+    fieldnames = ['sampleName'] + ([primary_key] if fastq_file_number_dict else []) + \
+                 [metric for metric, _ in NOVOALIGN_METRICS + NOVOSORT_METRICS]
+    with open(args.output_file, 'w', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=fieldnames, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(row_list)
+
+    # send the qc of each sample to database concurrently, record failure and continue if fail
+    post_failures = []
+    if args.post:
+        upload_jobs = [UploadJob(args.url, {metric: value for metric, value in row.items() if metric != 'sampleName'},
+                                 method='POST_OR_PUT', primary_key_value=row[primary_key]) for row in row_list]
+        if args.outbox:
+            # sent later by DrainOutbox.py
+            from utils.Outbox import enqueueJobs
+            with metrics.stage('enqueue'):
+                enqueueJobs(args.outbox, upload_jobs)
+        else:
+            uploader = AsyncUploader(concurrency=args.concurrency, requests_per_second=args.rate_limit,
+                                     client_factory=partial(createClient, args.post_cache, args.force, metrics))
+            with metrics.stage('post'):
+                upload_results = uploader.uploadAll(upload_jobs)
+            for result in upload_results:
+                if not result.ok:
+                    post_failures.append('fastqfilenumber %s failed to update %s for reason %s'
+                                         % (result.job.primary_key_value, result.job.url, result.error))
+
+    # report all failures at once so that one bad sample does not stop the batch
+    for failure in parse_failures:
+        print('PostAlignmentLogBatchToDatabaseParseError: %s' % failure, file=sys.stderr)
+    for failure in post_failures:
+        print('PostAlignmentLogBatchToDatabaseError: %s' % failure, file=sys.stderr)
+    if parse_failures or post_failures:
+        sys.exit('PostAlignmentLogBatchToDatabaseError: %s of %s samples failed to parse, %s requests failed'
+                 % (len(parse_failures), len(sample_log_list), len(post_failures)))
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Parse every novoalign and novosort log of a run in parallel and post the alignment qc to the database.")
+    parser.add_argument("-d", "--log_dir", required=True,
+                        help="[REQUIRED] the logs directory of a run, with ${sample_name}_novoalign.log and ${sample_name}_novosort.log files")
+    parser.add_argument("-m", "--manifest",
+                        help="csv with columns fastqFileName and fastqFileNumber, eg the fastq_file_list used by main.nf. Required to post")
+    parser.add_argument("-o", "--output_file", default='alignment_qc.csv',
+                        help="path to which to write the table of parsed logs. Default alignment_qc.csv")
+    parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(),
+                        help="number of worker processes. Default is the number of cpus")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="maximum number of requests to the database in flight at once. Default 8")
+    parser.add_argument("--rate_limit", type=float,
+                        help="maximum number of requests per second to the database host. Default is no limit")
+    parser.add_argument("-u", "--url",
+                        help="URL to which to post data (this is purpose built for alignment qc, so it should be https://someaddress/QualityAssess/")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+    parser.add_argument("--post_cache",
+                        help="directory of the post cache. If set, payloads which were already sent are skipped and changed qc records are put directly")
+    parser.add_argument("--outbox",
+                        help="directory of an outbox. If set, the requests are written to it, to be sent by DrainOutbox.py, rather than sent to the database")
+    parser.add_argument("--force", action='store_true',
+                        help="send every payload even if the post cache shows it was already sent")
+    parser.add_argument('--post', dest='post', action='store_true',
+                        help="[DEFAULT TRUE] default behavior is to post to the database -- no need to include this flag. set --no-post to avoid this")
+    parser.add_argument('--no-post', dest='post', action='store_false',
+                        help="See --post. Set --no-post to prevent posting the data to the url")
+
+    parser.set_defaults(post=True)
+    args = parser.parse_args(argv[1:])
+
+    if args.post and not (args.url and args.manifest):
+        parser.error("--url and --manifest are required unless --no-post is set")
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+    Parse many htseq count files in parallel in a single interpreter and output/send to database.
+    This is the batch version of PostCountsToDatabase.py
+    usage: PostCountsBatchToDatabase.py -m fastq_file_list.csv -d /path/to/run/count -cu https://someaddress/Counts/ -qu https://someaddress/QualityAssess/
+           PostCountsBatchToDatabase.py -d /path/to/run/count --no-post
+    author: chase.mateusiak@gmail.com
+
+    input: either a manifest csv with (at least) the columns fastqFileName and fastqFileNumber, eg the fastq_file_list
+           used by main.nf, and/or a directory of ${sample_name}_read_count.tsv files. If the manifest has a countFile column,
+           that path is used. Otherwise the count file is expected to be ${count_dir}/${sample_name}_read_count.tsv where
+           sample_name is the fastqFileName stripped of path and all extensions (as nextflow getSimpleName())
+    output: ${sample_name}_counts.csv, ${sample_name}_htseq_qc.csv for each sample in --output_dir
+    database_interaction: post to url
+"""
+
+# standard library imports
+import sys
+import os
+import glob
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from PostCountsToDatabase import parseCountFile
+from utils.CountMatrixStore import CountMatrixStore
+from utils.CountPayload import COMPRESSION_TYPES
+from utils.Manifest import readManifest as readManifestRows
+from utils.AsyncUploader import AsyncUploader, UploadJob
+from utils.DatabaseInteraction import createClient
+from utils.StageMetrics import StageMetrics
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+    # the batch is named for its manifest or count directory
+    metrics = StageMetrics('PostCountsBatchToDatabase', os.path.basename(os.path.normpath(args.manifest or args.count_dir)),
+                           args.metrics_dir, args.prometheus_dir)
+
+    ################################ set name variables ###################################
+    # suffix of the htseq count files in the count directory
+    count_file_suffix = "_read_count.tsv"
+    #######################################################################################
+
+    # create list of (count_file, sample_name, fastq_file_number) to parse
+    if args.manifest:
+        try:
+            sample_list = readManifest(args.manifest, args.count_dir, count_file_suffix)
+        except (OSError, ValueError) as e:
+            sys.exit('PostCountsBatchToDatabaseError: %s' % e)
+    else:
+        sample_list = [(count_file, os.path.basename(count_file)[:-len(count_file_suffix)], None)
+                       for count_file in sorted(glob.glob(os.path.join(args.count_dir, '*' + count_file_suffix)))]
+
+    # the fastqFileNumber is the foreign key of Counts. It is only available from a manifest
+    if args.post and any(fastq_file_number is None for _, _, fastq_file_number in sample_list):
+        sys.exit('PostCountsBatchToDatabaseError: a manifest with fastqFileNumber is required to post. Use --no-post to parse only')
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # parse the count files across a process pool. results are returned in the order of sample_list
+    parse_failures = []
+    upload_jobs = []
+    with metrics.stage('parse'), ProcessPoolExecutor(max_workers=args.processes) as executor:
+        futures = [executor.submit(parseCountFile, count_file, sample_name, fastq_file_number, args.output_dir,
+                                   args.payload_format, args.compression, args.gene_index_cache, args.annotation_file,
+                                   args.count_matrix)
+                   for count_file, sample_name, fastq_file_number in sample_list]
+        for (count_file, sample_name, fastq_file_number), future in zip(sample_list, futures):
+            try:
+                count_data, qc_dict = future.result()
+            except (OSError, ValueError) as e:
+                parse_failures.append('%s: %s' % (count_file, e))
+                continue
+            # the fastqFileNumber keys the payloads in the post cache
+            upload_jobs.append(UploadJob(args.counts_url, count_data, 'POST', fastq_file_number))
+            if args.qc_url:
+                upload_jobs.append(UploadJob(args.qc_url, qc_dict, 'POST', fastq_file_number))
+
+    # the samples were appended one chunk each. Rewrite them as one chunk for readers, if this batch is the last to append
+    if args.count_matrix and args.compact:
+        with metrics.stage('compact'):
+            CountMatrixStore(args.count_matrix).compact()
+
+    # send count and qc data to database concurrently, record failure and continue if fail
+    post_failures = []
+    if args.post and args.outbox:
+        # sent later by DrainOutbox.py
+        from utils.Outbox import enqueueJobs
+        with metrics.stage('enqueue'):
+            enqueueJobs(args.outbox, upload_jobs)
+    elif args.post:
+        uploader = AsyncUploader(concurrency=args.concurrency, requests_per_second=args.rate_limit,
+                                 client_factory=partial(createClient, args.post_cache, args.force, metrics))
+        with metrics.stage('post'):
+            upload_results = uploader.uploadAll(upload_jobs)
+        for result in upload_results:
+            if not result.ok:
+                post_failures.append('fastqfilenumber %s failed to update %s for reason %s'
+                                     % (result.job.data['fastqFileNumber'], result.job.url, result.error))
+
+    # report all failures at once so that one bad sample does not stop the batch
+    for failure in parse_failures:
+        print('PostCountsBatchToDatabaseParseError: %s' % failure, file=sys.stderr)
+    for failure in post_failures:
+        print('PostCountsBatchToDatabaseError: %s' % failure, file=sys.stderr)
+    if parse_failures or post_failures:
+        sys.exit('PostCountsBatchToDatabaseError: %s of %s samples failed to parse, %s requests failed'
+                 % (len(parse_failures), len(sample_list), len(post_failures)))
+
+def readManifest(manifest_path, count_dir, count_file_suffix):
+    """
+        read the (count_file, sample_name, fastq_file_number) for each sample out of a manifest csv
+        usage: sample_list = readManifest('fastq_file_list.csv', '/path/to/run/count', '_read_count.tsv')
+        :params manifest_path: path to a csv with at least the columns fastqFileName and fastqFileNumber, and optionally countFile
+        :params count_dir: directory with the htseq count files. Required if a row of the manifest has no countFile
+        :params count_file_suffix: suffix appended to the sample name to find the count file in count_dir
+        :throws: ValueError if a required column is missing, or a row has no countFile and there is no count_dir
+        :returns: a list of tuples (count_file, sample_name, fastq_file_number)
+    """
+    sample_list = []
+    # the header is line 1
+    for line_number, row in enumerate(readManifestRows(manifest_path), start=2):
+        count_file = row.get('countFile')
+        if not count_file:
+            if not count_dir:
+                raise ValueError('ManifestError: row %s of %s has no countFile and no count directory was given'
+                                 % (line_number, manifest_path))
+            count_file = os.path.join(count_dir, row['sampleName'] + count_file_suffix)
+        sample_list.append((count_file, row['sampleName'], row['fastqFileNumber']))
+
+    return sample_list
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Parse many htseq count files in parallel and post the counts and htseq qc to the database.")
+    parser.add_argument("-m", "--manifest",
+                        help="csv with columns fastqFileName, fastqFileNumber and optionally countFile, eg the fastq_file_list used by main.nf")
+    parser.add_argument("-d", "--count_dir",
+                        help="directory of ${sample_name}_read_count.tsv files. Without --manifest, every count file in the directory is parsed")
+    parser.add_argument("-o", "--output_dir", default='.',
+                        help="directory to which to write the parsed csvs. Default is the current directory")
+    parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(),
+                        help="number of worker processes. Default is the number of cpus")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="maximum number of requests to the database in flight at once. Default 8")
+    parser.add_argument("--rate_limit", type=float,
+                        help="maximum number of requests per second to the database host. Default is no limit")
+    parser.add_argument("-cu", "--counts_url",
+                        help="URL to which to post data (this is purpose built for counts, so it should be https://someaddress/Counts/")
+    parser.add_argument("-qu", "--qc_url",
+                        help="URL to which to post the htseq qc, eg https://someaddress/QualityAssess/. If not set, only the counts are posted")
+    parser.add_argument("--payload_format", choices=['json', 'packed'], default='json',
+                        help="[DEFAULT json] json sends rawCounts as {sample_name: [counts]}. packed sends compressed uint32 counts with a checksum and geneIndex")
+    parser.add_argument("--compression", choices=COMPRESSION_TYPES, default='gzip',
+                        help="[DEFAULT gzip] compression of the packed counts. zstd requires the zstandard package")
+    parser.add_argument("--gene_index_cache",
+                        help="directory of the gene index manifest cache. If set, the counts are written as ${sample_name}_counts.json with only the count vector and the geneIndex. Requires --annotation_file")
+    parser.add_argument("-a", "--annotation_file",
+                        help="the annotation file htseq counted against. Required with --gene_index_cache")
+    parser.add_argument("--count_matrix",
+                        help="directory of the run's count matrix store. If set, every sample is appended to it")
+    parser.add_argument("--compact", action='store_true',
+                        help="after appending, rewrite the count matrix store as one chunk. Set it on the last batch of a run, as other appends wait for it")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+    parser.add_argument("--post_cache",
+                        help="directory of the post cache. If set, payloads which were already sent are skipped and changed qc records are put directly")
+    parser.add_argument("--outbox",
+                        help="directory of an outbox. If set, the requests are written to it, to be sent by DrainOutbox.py, rather than sent to the database")
+    parser.add_argument("--force", action='store_true',
+                        help="send every payload even if the post cache shows it was already sent")
+    parser.add_argument('--post', dest='post', action='store_true',
+                        help="[DEFAULT TRUE] default behavior is to post to the database -- no need to include this flag. set --no-post to avoid this")
+    parser.add_argument('--no-post', dest='post', action='store_false',
+                        help="See --post. Set --no-post to prevent posting the data to the url")
+
+    parser.set_defaults(post=True)
+    args = parser.parse_args(argv[1:])
+
+    if not (args.manifest or args.count_dir):
+        parser.error("at least one of --manifest or --count_dir is required")
+    if args.gene_index_cache and not args.annotation_file:
+        parser.error("--annotation_file is required with --gene_index_cache")
+    if args.compact and not args.count_matrix:
+        parser.error("--count_matrix is required with --compact")
+    if args.post and not args.counts_url:
+        parser.error("--counts_url is required unless --no-post is set")
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
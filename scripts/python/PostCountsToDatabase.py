@@ -16,17 +16,16 @@ import sys
 import os
 from json import dumps as json_dumps
 import argparse
-import requests
-from urllib.request import HTTPError
+from functools import partial
 
 # extend python path to include utils dir
 sys.path.extend([os.path.join(sys.path[0], 'utils')])
 
-# third party imports
-import pandas as pd
-
 # local imports
-from utils.DatabaseInteraction import postData
+from utils.StageMetrics import StageMetrics
+from utils.CountPayload import COMPRESSION_TYPES, encodeCounts
+from utils.GeneIndexCache import GeneIndexCache, writeCountVector
+from utils.HtseqCountParser import QC_COLUMN_DICT, parseHtseqCounts
 
 def main(argv):
     """[summary]
@@ -37,79 +36,121 @@ def main(argv):
 
     # parse cmd line arguments
     args = parseArgs(argv)
-
+    metrics = StageMetrics('PostCountsToDatabase', args.sample_name, args.metrics_dir, args.prometheus_dir)
+
+    # parse the count file, write out the counts and htseq qc csvs and build the request bodies
+    try:
+        with metrics.stage('parse'):
+            count_data, qc_dict = parseCountFile(args.count_file, args.sample_name, args.fastq_file_number,
+                                                 payload_format=args.payload_format, compression=args.compression,
+                                                 gene_index_cache_dir=args.gene_index_cache, annotation_file=args.annotation_file,
+                                                 count_matrix_dir=args.count_matrix)
+    except ValueError as e:
+        sys.exit(e)
+
+    # send count and qc data to database concurrently, exit with error message if either fails. Without a qc url, the
+    # htseq qc is left to PostSampleQcToDatabase.py, which posts it with the rest of the sample's qc
+    if args.post:
+        # the http client is only imported to post, so that --no-post starts without requests and asyncio
+        from utils.AsyncUploader import AsyncUploader, UploadJob
+        from utils.DatabaseInteraction import createClient
+        upload_jobs = [UploadJob(args.counts_url, count_data, 'POST', args.fastq_file_number)]
+        if args.qc_url:
+            upload_jobs.append(UploadJob(args.qc_url, qc_dict, 'POST', args.fastq_file_number))
+        if args.outbox:
+            # sent later by DrainOutbox.py
+            from utils.Outbox import enqueueJobs
+            with metrics.stage('enqueue'):
+                enqueueJobs(args.outbox, upload_jobs)
+            return
+        uploader = AsyncUploader(concurrency=2, client_factory=partial(createClient, args.post_cache, args.force, metrics))
+        with metrics.stage('post'):
+            failures = ['could not post %s to %s for reason %s' %(args.fastq_file_number, result.job.url, result.error)
+                        for result in uploader.uploadAll(upload_jobs) if not result.ok]
+        if failures:
+            exit('PostCountsToDatabaseError: %s' % '; '.join(failures))
+
+def parseCountFile(count_file, sample_name, fastq_file_number, output_dir='.', payload_format='json', compression='gzip',
+                   gene_index_cache_dir=None, annotation_file=None, count_matrix_dir=None):
+    """
+        parse a single htseq count file, write ${sample_name}_counts.csv and ${sample_name}_htseq_qc.csv
+        to output_dir and create the bodies of the counts and qc requests
+        usage: count_data, qc_dict = parseCountFile('sample_read_count.tsv', 'sample', 1)
+        :params count_file: path to the htseq-count output
+        :params sample_name: should be unique, eg the fastq name stripped of path and file extension
+        :params fastq_file_number: fastqFileNumber, the foreign key of Counts and QualityAssess
+        :params output_dir: directory in which to write the parsed csvs. Default is the current directory
+        :params payload_format: 'json' sends rawCounts as {sample_name: [counts]}. 'packed' sends the counts as compressed
+                                uint32 with a checksum and the geneIndex, see utils/CountPayload.py
+        :params compression: compression of the packed counts, one of gzip or zstd. Ignored if payload_format is json
+        :params gene_index_cache_dir: if set (with annotation_file), the counts are written as ${sample_name}_counts.json with
+                                      only the count vector and the geneIndex of the annotation's manifest in this cache
+                                      (see utils/GeneIndexCache.py) instead of ${sample_name}_counts.csv, and the payload
+                                      carries the geneIndex
+        :params annotation_file: the annotation htseq counted against. Required with gene_index_cache_dir
+        :params count_matrix_dir: if set, the sample is also appended to the run's count matrix store in this directory
+                                  (see utils/CountMatrixStore.py)
+        :throws: ValueError if the count file is malformed, has an unrecognized qc metric or its genes are not in
+                 the order of the annotation's manifest or of the count matrix store
+        :returns: a tuple (count_data, qc_dict), the request bodies for the counts and qc urls
+    """
     ################################ set name variables ###################################
-    # name for the first of the two columns in the htseq output. The first column contains
-    # the gene ids, but also a number of rows at the bottom that start with __ and contain
-    # qc metrics
-    htseq_output_first_col_name = "gene_id"
-    # the htseq identifier of qc metric rows (bottom of first column)
-    qc_metric_identifier = "__"
     # suffix to append to the sample_name to output qc file
     qc_suffix = "htseq_qc"
     # suffix to append to count file output
     count_suffix = "counts"
-    # count_file_df column names
-    col_names=[htseq_output_first_col_name, args.sample_name]\
-    # for parsing the qc metrics
-    qc_column_dict = {'__no_feature': 'noFeature', '__ambiguous': 'ambiguous',
-                    '__too_low_aQual': 'tooLowAqual', '__not_aligned': 'notAligned', 
-                    '__alignment_not_unique': 'alignmentNotUnique'}
     # for post data
     primary_key = 'fastqFileNumber'
     data_column = 'rawCounts'
     #######################################################################################
 
-    # read in count file
-    count_file_df = pd.read_csv(args.count_file, sep='\t', names=col_names)
-
-    # remove the htseq qc info at the bottom of the file (it starts with __, eg __ambiguous)
-    gene_counts = count_file_df[~count_file_df[htseq_output_first_col_name].str.startswith(qc_metric_identifier)]
-    # write out the counts
-    gene_counts.to_csv("%s_%s.csv" %(args.sample_name, count_suffix), index=False)
-
-    # extract the qc rows
-    htseq_qc_data = count_file_df[count_file_df[htseq_output_first_col_name].str.startswith(qc_metric_identifier)]
-    # write out the qc data
-    htseq_qc_data.to_csv("%s_%s.csv" %(args.sample_name, qc_suffix), index=False)
-
-    # get the count dict in structure {fastqFileName: [counts]}
-    gene_count_dict = gene_counts.drop([htseq_output_first_col_name], axis=1).to_dict(orient="list")
+    # read the count file once, writing the gene counts and the htseq qc rows out as they are read. With a gene index
+    # cache, the gene ids are in the manifest and only the count vector is written
+    counts_output_path = None if gene_index_cache_dir else os.path.join(output_dir, "%s_%s.csv" %(sample_name, count_suffix))
+    gene_counts, htseq_qc_rows, gene_index, gene_ids = parseHtseqCounts(count_file, sample_name, counts_output_path,
+                                                                        os.path.join(output_dir, "%s_%s.csv" %(sample_name, qc_suffix)))
+    if gene_index_cache_dir:
+        manifest = GeneIndexCache(gene_index_cache_dir).getOrCreate(annotation_file)
+        if manifest['geneIndex'] != gene_index:
+            raise ValueError('GeneIndexError: the genes in %s are not in the order of the manifest of %s' % (count_file, annotation_file))
+        writeCountVector(os.path.join(output_dir, "%s_%s.json" %(sample_name, count_suffix)), sample_name, gene_index, gene_counts)
+    if count_matrix_dir:
+        # numpy is only needed for the count matrix
+        from utils.CountMatrixStore import CountMatrixStore
+        CountMatrixStore(count_matrix_dir).append(sample_name, gene_ids, gene_counts)
 
     # this is the body of the request. fastqFileNumber is the foreign key of Counts
-    count_data = {primary_key: str(args.fastq_file_number), data_column: json_dumps(gene_count_dict)}
-
-    # try to send count data to database, exit with error message if fail
-    if args.post:
-        try:
-            postData(args.counts_url, count_data)
-        except Exception as e:
-            exit('PostCountsToDatabaseError: fastqfilenumber %s failed to update %s for reason %s' %(args.fastq_file_number, args.counts_url, e))
+    if payload_format == 'packed':
+        count_data = {primary_key: str(fastq_file_number)}
+        count_data.update(encodeCounts(gene_counts, gene_index, compression))
+    else:
+        # get the count dict in structure {fastqFileName: [counts]}
+        gene_count_dict = {sample_name: gene_counts}
+        count_data = {primary_key: str(fastq_file_number), data_column: json_dumps(gene_count_dict)}
+        if gene_index_cache_dir:
+            count_data['geneIndex'] = gene_index
 
     # parse qc rows into a dict
-    qc_dict = qcMetricsToDict(htseq_qc_data, qc_column_dict, args.fastq_file_number)
+    qc_dict = qcMetricsToDict(htseq_qc_rows, QC_COLUMN_DICT, fastq_file_number)
 
-    # try to send qc to database, exit with error if fail
-    if args.post:
-        try:
-            r = requests.post(args.qc_url, data=qc_dict)
-            r.raise_for_status()
-        except requests.HTTPError as e:
-            exit('PostCountsToDatabaseError: could not post or put %s to %s for reason %s' %(args.fastq_file_number, args.qc_url, e))
+    return count_data, qc_dict
 
-def qcMetricsToDict(htseq_qc_data, qc_column_dict, sample_number):
+def qcMetricsToDict(htseq_qc_rows, qc_column_dict, sample_number):
     """
-    parsed from the htseq counts, this has headings the same as the counts df
-    :params htseq_qc_data: the qc rows parsed from the bottom of the htseq output
+    parsed from the htseq counts, these are the rows at the bottom of the file which start with __
+    :params htseq_qc_rows: the (qc_metric, count) tuples parsed from the bottom of the htseq output
+    :params qc_column_dict: map of htseq qc metric to database column, eg {'__no_feature': 'noFeature'}
+    :params sample_number: the fastqFileNumber of the sample
+    :throws: ValueError if a qc metric is not in qc_column_dict
+    :returns: the qc dict, eg {'fastqFileNumber': '1', 'noFeature': 101, ...}
     """
     qc_dict = {'fastqFileNumber': str(sample_number)}
 
-    for index, row in htseq_qc_data.iterrows():
-        qc_metric = row[0]
+    for qc_metric, count in htseq_qc_rows:
         try:
-            qc_dict.setdefault(qc_column_dict[qc_metric], row[1])
+            qc_dict.setdefault(qc_column_dict[qc_metric], count)
         except KeyError:
-            sys.exit("HtseqQualityMetricParsingError: QC metric not in database columns")
+            raise ValueError("HtseqQualityMetricParsingError: QC metric %s not in database columns" % qc_metric)
     
     return qc_dict
 
@@ -118,15 +159,35 @@ def qcMetricsToDict(htseq_qc_data, qc_column_dict, sample_number):
 def parseArgs(argv):
     parser = argparse.ArgumentParser(description="This script summarizes the output from pipeline wrapper.")
     parser.add_argument("-c", "--count_file", required=True,
-                        help="[REQUIRED] Directory with files in the following subdirectories: align, count, logs. Output from raw_count.py and log2cpm.R must be in count directory.")
+                        help="[REQUIRED] htseq count file of the sample. See NormalizeCounts.py for the CPM and log2 CPM of a run's --count_matrix")
     parser.add_argument("-n", "--sample_name", required=True,
                         help="[REQUIRED] Should be unique. Suggestion: use the fastq name stripped of path and file extension")
     parser.add_argument("-i", "--fastq_file_number", required=True,
                         help="[REQUIRED] fastqFileNumber, the foreign key of QualityAssessment table which links back to FastqFiles table")
     parser.add_argument("-cu", "--counts_url", required=True,
                         help="[REQUIRED] URL to which to post data (this is purpose built for counts, so it should be https://someaddress/Counts/")
-    parser.add_argument("-qu", "--qc_url", required=True,
-                        help="[REQUIRED] URL to which to post data (this is purpose built for counts, so it should be https://someaddress/QualityAssess/")
+    parser.add_argument("-qu", "--qc_url",
+                        help="URL to which to post the htseq qc, eg https://someaddress/QualityAssess/. If not set, only the counts are posted")
+    parser.add_argument("--payload_format", choices=['json', 'packed'], default='json',
+                        help="[DEFAULT json] json sends rawCounts as {sample_name: [counts]}. packed sends compressed uint32 counts with a checksum and geneIndex")
+    parser.add_argument("--compression", choices=COMPRESSION_TYPES, default='gzip',
+                        help="[DEFAULT gzip] compression of the packed counts. zstd requires the zstandard package")
+    parser.add_argument("--gene_index_cache",
+                        help="directory of the gene index manifest cache. If set, the counts are written as ${sample_name}_counts.json with only the count vector and the geneIndex. Requires --annotation_file")
+    parser.add_argument("-a", "--annotation_file",
+                        help="the annotation file htseq counted against. Required with --gene_index_cache")
+    parser.add_argument("--count_matrix",
+                        help="directory of the run's count matrix store, eg ${align_count_results}/${run_directory}/count_matrix. If set, the sample is appended to it")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+    parser.add_argument("--post_cache",
+                        help="directory of the post cache. If set, payloads which were already sent are skipped and changed qc records are put directly")
+    parser.add_argument("--outbox",
+                        help="directory of an outbox. If set, the requests are written to it, to be sent by DrainOutbox.py, rather than sent to the database")
+    parser.add_argument("--force", action='store_true',
+                        help="send every payload even if the post cache shows it was already sent")
     parser.add_argument('--post', dest='post', action='store_true',
                         help="[DEFAULT TRUE] default behavior is to post to the database -- no need to include this flag. set --no-post to avoid this")
     parser.add_argument('--no-post', dest='post', action='store_false',
@@ -134,6 +195,9 @@ def parseArgs(argv):
     
     parser.set_defaults(post=True)
     args = parser.parse_args(argv[1:])
+
+    if args.gene_index_cache and not args.annotation_file:
+        parser.error("--annotation_file is required with --gene_index_cache")
     
     return args
 
@@ -1,73 +1,143 @@
 #!/usr/bin/env python
 
 """
-    parse coverage .bed into a json and post to database
-    usage:
+    calculate the fraction of the CDS of each perturbed locus (and optionally of the NAT and G418 markers) covered by at
+    least --min_depth reads, in one pass over the bam, and post them to database as one record
+    usage: PostGenotypeCoverageToDatabase.py -b sample_sorted.bam -a KN99_annotation.gff -l CKF44_00001 CKF44_00002:exon --markers -i 1 -u https://someaddress/QualityAssess/
+    output: genotype1Coverage, genotype2Coverage, ... in the order the loci are given, and natCoverage and g418Coverage if --markers
     author: chase.mateusiak@gmail.com
 
     database_interaction: post to url
 """
 
-# SYSTEM DEPENDENCIES
-# gff2bed, samtools, grep, bedtools
-
 # standard library imports
 import sys
 import os
-from json import dumps as json_dumps
 import argparse
 
 # extend python path to include utils dir
-sys.path.extend([os.path.join(os.path.realpath(__file__), 'utils')])
-
-# third party imports
-import pandas as pd
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
 
 # local imports
-from utils.DatabaseInteraction import postData
+from utils.StageMetrics import StageMetrics
+from utils.FeatureCoverage import calculateRegionCoverage
 
 def main(argv):
 
     # parse cmd line arguments
     args = parseArgs(argv)
+    metrics = StageMetrics('PostGenotypeCoverageToDatabase', args.fastq_file_number, args.metrics_dir, args.prometheus_dir)
 
     ################################ set name variables ###################################
-    # names of the columns (there are three)
-    col_names = ['chr', 'bp', 'depth']
     # for post data
     primary_key = 'fastqFileNumber'
-    feature = "CDS"
-    column = "genotype1Coverage"
     #######################################################################################
 
-    # calculate feature
-    nat_coverfeature_coverageage = self.calculatePercentFeatureCoverage(feature, args.locus, args.annotation_file, args.bam_file)
+    # calculate the coverage of every locus (and the markers) in one pass over the annotation and the bam
+    try:
+        with metrics.stage('coverage'):
+            coverage_column_dict = genotypeCoverage(args.bam_file, args.annotation_file, args.locus, args.feature, args.markers,
+                                                    args.annotation_cache, args.min_depth, args.min_mapq)
+    except ValueError as e:
+        sys.exit(e)
+
+    data = {primary_key: args.fastq_file_number}
+    data.update({column: str(coverage) for column, coverage in coverage_column_dict.items()})
+
+    # try to send data to database, put to the existing record if the post is rejected. exit with error message if fail
+    if args.post and args.outbox:
+        # sent later by DrainOutbox.py
+        from utils.Outbox import enqueueJobs
+        with metrics.stage('enqueue'):
+            enqueueJobs(args.outbox, [(args.url, data, 'POST_OR_PUT', args.fastq_file_number)])
+    elif args.post:
+        # imported here so that --no-post does not load requests
+        from utils.DatabaseInteraction import DatabaseInteractionError, createClient
+        with createClient(args.post_cache, args.force, metrics) as client, metrics.stage('post'):
+            try:
+                client.postOrPut(args.url, args.fastq_file_number, data)
+            except DatabaseInteractionError as e:
+                exit('PostGenotypeCoverageToDatabaseError: could not post or put %s to %s for reason %s' %(args.fastq_file_number, args.url, e))
+
+def genotypeCoverage(bam_file, annotation_file, loci, default_feature, markers, annotation_cache_dir=None, min_depth=1, min_mapq=10):
+    """
+        the coverage of each perturbed locus and, if markers, of the NAT and G418 markers, in one pass over the bam
+        usage: coverage_column_dict = genotypeCoverage('sample_sorted.bam', 'KN99_annotation.gff', ['CKF44_00001'], 'CDS', True)
+        :params bam_file: a sorted, indexed alignment file (.bam)
+        :params annotation_file: annotation file (gtf or gff3)
+        :params loci: list of gene_id or gene_id:feature_type
+        :params default_feature: feature type of the loci which do not name one, eg CDS
+        :params markers: if True, also calculate the coverage of the CNAG_NAT and CNAG_G418 CDS
+        :params annotation_cache_dir: directory of parsed annotation indexes, or None
+        :params min_depth: minimum depth for a base to count as covered. Default 1
+        :params min_mapq: minimum mapping quality of a read to be counted. Default 10
+        :throws: ValueError if a locus cannot be parsed or a gene has no features of the type in the annotation
+        :returns: a dict of column (genotype1Coverage, genotype2Coverage, ..., natCoverage, g418Coverage) to fraction covered
+    """
+    ################################ set name variables ###################################
+    genotype_column = "genotype%sCoverage"
+    marker_column_dict = {'CNAG_NAT': 'natCoverage', 'CNAG_G418': 'g418Coverage'}
+    marker_feature = "CDS"
+    #######################################################################################
 
-    data = {primary_key: args.fastq_file_number, column: feature_coverage}
+    # map each column to its (gene id, feature type) region
+    column_dict = {genotype_column % (i + 1): parseLocus(locus, default_feature) for i, locus in enumerate(loci)}
+    if markers:
+        column_dict.update({column: (marker, marker_feature) for marker, column in marker_column_dict.items()})
+    if not column_dict:
+        return {}
 
+    coverage_dict = calculateRegionCoverage(column_dict.values(), annotation_file, bam_file, min_depth=min_depth, min_mapq=min_mapq,
+                                            annotation_cache_dir=annotation_cache_dir)
+    return {column: coverage_dict[region] for column, region in column_dict.items()}
 
-    # try to send count data to database, exit with error message if fail
-    if args.post:
-        try:
-	    r = requests.post(args.url, data=data)
-	    r.raise_for_status()
-        except requests.HTTPError as exception:
-	    try:
-	        r = requests.put(args.qc_url+str(args.fastq_file_number.)+'/', data=data)
-	        r.raise_for_status()
-	    except requests.HTTPError as e:
-	        exit('PostCountsToDatabaseError: could not post or put %s to %s for reason %s' %(args.fastq_file_number, args.qc_url, e))
+def parseLocus(locus, default_feature):
+    """
+        parse a locus argument, a gene id optionally followed by :feature_type
+        usage: parseLocus('CKF44_00001:exon', 'CDS') returns ('CKF44_00001', 'exon')
+        :params locus: eg CKF44_00001 or CKF44_00001:exon
+        :params default_feature: feature type used when the locus does not name one
+        :throws: ValueError if the gene id or feature type is empty
+        :returns: (gene id, feature type)
+    """
+    gene_id, _, feature = locus.partition(':')
+    if not gene_id or (':' in locus and not feature):
+        raise ValueError('PostGenotypeCoverageToDatabaseError: could not parse locus %s. Expected gene_id or gene_id:feature_type' % locus)
+    return gene_id, feature or default_feature
 
 def parseArgs(argv):
     parser = argparse.ArgumentParser(description="This script summarizes the output from pipeline wrapper.")
-    parser.add_argument("-c", "--coverage_file", required=True,
-                        help="[REQUIRED] Directory with files in the following subdirectories: align, count, logs. Output from raw_count.py and log2cpm.R must be in count directory.")
-    parser.add_argument("-l", "--locus", required=True,
-                        help="[REQUIRED] Should be unique. Suggestion: use the fastq name stripped of path and file extension")
+    parser.add_argument("-b", "--bam_file", required=True,
+                        help="[REQUIRED] sorted, indexed alignment file (.bam)")
+    parser.add_argument("-a", "--annotation_file", required=True,
+                        help="[REQUIRED] annotation file (gtf or gff3)")
+    parser.add_argument("-l", "--locus", required=True, nargs='+',
+                        help="[REQUIRED] gene id of each perturbed locus, exactly as in the annotation file, eg CKF44_00001. "
+                             "Optionally append the feature type, eg CKF44_00001:exon. Columns are genotype1Coverage, genotype2Coverage... in this order")
+    parser.add_argument("-f", "--feature", default="CDS",
+                        help="feature type over which to take coverage of loci which do not name one. Default CDS")
+    parser.add_argument("--markers", action='store_true',
+                        help="also calculate natCoverage and g418Coverage, the coverage of the CNAG_NAT and CNAG_G418 CDS, in the same pass")
+    parser.add_argument("--min_depth", type=int, default=1,
+                        help="minimum depth for a base to count as covered. Default 1")
+    parser.add_argument("--min_mapq", type=int, default=10,
+                        help="minimum mapping quality of a read to be counted. Default 10, as GenomeCoverage.sh")
+    parser.add_argument("--annotation_cache",
+                        help="directory of parsed annotation indexes. If set, the annotation is parsed once and the index reused by every sample")
     parser.add_argument("-i", "--fastq_file_number", required=True,
                         help="[REQUIRED] fastqFileNumber, the foreign key of QualityAssessment table which links back to FastqFiles table")
     parser.add_argument("-u", "--url", required=True,
                         help="[REQUIRED] URL to which to post data (this is purpose built for counts, so it should be https://someaddress/Counts/")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+    parser.add_argument("--post_cache",
+                        help="directory of the post cache. If set, payloads which were already sent are skipped and changed qc records are put directly")
+    parser.add_argument("--outbox",
+                        help="directory of an outbox. If set, the requests are written to it, to be sent by DrainOutbox.py, rather than sent to the database")
+    parser.add_argument("--force", action='store_true',
+                        help="send every payload even if the post cache shows it was already sent")
     parser.add_argument('--post', dest='post', action='store_true',
                         help="[DEFAULT TRUE] default behavior is to post to the database. set --no-post to avoid this")
     parser.add_argument('--no-post', dest='post', action='store_false',
@@ -80,26 +150,3 @@ def parseArgs(argv):
 
 if __name__ == "__main__":
     main(sys.argv)
-
-
-def calculatePercentFeatureCoverage(feature, genotype, annotation_path, bam_file, num_bases_in_region=None):
-    """
-        Calculate percent of given feature (regions summed, so all exon in gene, eg) of a gene (exon, CDS, etc) covered by 1 or more reads
-        :param feature: annotation feature over which to take percentage, eg all exons in gene, or all CDS
-        :param genotype: gene in annotation file
-        :param annotation_path: path to annotation file
-        :param bam_file: a SORTED, indexed alignment file (.bam)
-        :param num_bases_in_region: pass number of bases in the region directly, this will skip the step of calculating this number from the annotation file
-        :returns: the fraction of bases in the (summed over the number of features in the gene) feature region covered by at least one read
-    """
-    if not num_bases_in_region:
-        # extract number of bases in CDS of given gene. Credit: https://www.biostars.org/p/68283/#390427
-        num_bases_in_region_cmd = "grep %s %s | grep %s | bedtools merge | awk -F\'\t\' \'BEGIN{SUM=0}{ SUM+=$3-$2 }END{print SUM}\'" % (
-            genotype, annotation_path, feature)
-        num_bases_in_region = int(subprocess.getoutput(num_bases_in_region_cmd))
-    # extract number of bases with depth != 0
-    num_bases_depth_not_zero_cmd = "grep %s %s | grep %s | gff2bed | samtools depth -aa -Q 10 -b - %s | cut -f3 | grep -v 0 | wc -l" % (
-        genotype, annotation_path, feature, bam_file)
-    num_bases_in_cds_with_one_or_more_read = int(subprocess.getoutput(num_bases_depth_not_zero_cmd))
-
-    return num_bases_in_cds_with_one_or_more_read / float(num_bases_in_region)
\ No newline at end of file
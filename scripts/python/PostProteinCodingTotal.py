@@ -1,78 +1,193 @@
 #!/usr/bin/env python
 
 """
-    parse coverage .bed into a json and post to database
-    usage:
+    total the protein coding (and every other biotype's) counts of any number of samples and post proteinCodingCounted
+    to database. The biotype of each gene is taken from the annotation and the totals of all samples are one matrix
+    product, see utils/BiotypeMask.py
+    usage: PostProteinCodingTotal.py -c sample1_counts.csv sample2_counts.csv -i 1 2 -a KN99_annotation.gff -u https://someaddress/QualityAssess/
+           PostProteinCodingTotal.py -c /path/to/run/count/*_counts.json --gene_index_cache /path/to/cache -a KN99_annotation.gff --no-post
     author: chase.mateusiak@gmail.com
 
+    input: ${sample_name}_counts.csv (gene_id,${sample_name}) written by PostCountsToDatabase.py, or ${sample_name}_counts.json
+           count vectors with --gene_index_cache. All samples must have the same genes in the same order
+    output: a csv with a row per sample: sampleName, fastqFileNumber, totalCounted and the count and fraction of each biotype
     database_interaction: post to url
 """
 
 # standard library imports
 import sys
 import os
-from json import dumps as json_dumps
+import csv
 import argparse
+from functools import partial
 
 # extend python path to include utils dir
-sys.path.extend([os.path.join(os.path.realpath(__file__), 'utils')])
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
 
 # third party imports
-import pandas as pd
+import numpy as np
 
 # local imports
-from utils.DatabaseInteraction import postData
+from utils.StageMetrics import StageMetrics
+from utils.BiotypeMask import PROTEIN_CODING_BIOTYPE, biotypeTotals, loadBiotypeMasks
+from utils.GeneIndexCache import GeneIndexCache, readCountVector
 
 def main(argv):
 
     # parse cmd line arguments
     args = parseArgs(argv)
+    # the batch is named for its output file
+    metrics = StageMetrics('PostProteinCodingTotal', os.path.splitext(os.path.basename(args.output_file))[0],
+                           args.metrics_dir, args.prometheus_dir)
 
     ################################ set name variables ###################################
-    # names of the columns (there are three)
-    locus_identifier = 'gene_id'
     primary_key = 'fastqFileNumber'
     data_column = 'proteinCodingCounted'
     #######################################################################################
 
-    counts_df = pd.read_csv(args.count_file)
-
-    protein_coding_counts_df = counts_df[counts_df[locus_identifier].str.startswith("CKF44_")]
-    protein_coding_counted = protein_coding_counts_df.iloc[:,1].sum()
-
-    # this is the body of the request. fastqFileNumber is the foreign key of Counts
-    data = {primary_key: args.fastq_file_number, data_column: str(protein_coding_counted)}
-
-    # try to send count data to database, exit with error message if fail
+    # read every sample into one (samples x genes) matrix, then total each biotype of every sample at once
+    try:
+        with metrics.stage('read'):
+            sample_names, gene_ids, count_matrix = readCountMatrix(args.count_file, args.gene_index_cache)
+        with metrics.stage('biotype_masks'):
+            biotype_list, masks = loadBiotypeMasks(args.annotation_file, args.annotation_cache, gene_ids)
+    except (OSError, ValueError, KeyError) as e:
+        sys.exit('PostProteinCodingTotalError: %s' % e)
+    with metrics.stage('biotype_totals'):
+        biotype_totals = biotypeTotals(count_matrix, masks)
+        total_counted = count_matrix.sum(axis=1)
+    # samples with no counts have fractions of 0 rather than nan
+    biotype_fractions = biotype_totals / np.maximum(total_counted, 1)[:, np.newaxis]
+
+    fastq_file_numbers = args.fastq_file_number or [''] * len(sample_names)
+    with open(args.output_file, 'w', newline='') as output_file:
+        writer = csv.writer(output_file, lineterminator='\n')
+        writer.writerow(['sampleName', primary_key, 'totalCounted'] + biotype_list + ['%s_fraction' % biotype for biotype in biotype_list])
+        for row, sample_name in enumerate(sample_names):
+            writer.writerow([sample_name, fastq_file_numbers[row], int(total_counted[row])] + biotype_totals[row].tolist() +
+                            ['%.6g' % fraction for fraction in biotype_fractions[row]])
+
+    # send the protein coding total of each sample to database, put to the existing record if the post is rejected
     if args.post:
-        try:
-	    r = requests.post(args.url, data=data)
-	    r.raise_for_status()
-        except requests.HTTPError as exception:
-	    try:
-	        r = requests.put(args.qc_url+str(args.fastq_file_number.)+'/', data=data)
-	        r.raise_for_status()
-	    except requests.HTTPError as e:
-	        exit('PostCountsToDatabaseError: could not post or put %s to %s for reason %s' %(args.fastq_file_number, args.qc_url, e))
+        # the http client is only needed to post
+        from utils.AsyncUploader import AsyncUploader, UploadJob
+        from utils.DatabaseInteraction import createClient
+        if PROTEIN_CODING_BIOTYPE in biotype_list:
+            protein_coding_counted = biotype_totals[:, biotype_list.index(PROTEIN_CODING_BIOTYPE)]
+        else:
+            protein_coding_counted = np.zeros(len(sample_names), dtype=np.int64)
+        upload_jobs = [UploadJob(args.url, {primary_key: fastq_file_number, data_column: str(int(total))},
+                                 method='POST_OR_PUT', primary_key_value=fastq_file_number)
+                       for fastq_file_number, total in zip(fastq_file_numbers, protein_coding_counted)]
+        if args.outbox:
+            # sent later by DrainOutbox.py
+            from utils.Outbox import enqueueJobs
+            with metrics.stage('enqueue'):
+                enqueueJobs(args.outbox, upload_jobs)
+            return
+        uploader = AsyncUploader(concurrency=args.concurrency, client_factory=partial(createClient, args.post_cache, args.force, metrics))
+        with metrics.stage('post'):
+            failures = ['could not post or put %s to %s for reason %s' %(result.job.primary_key_value, result.job.url, result.error)
+                        for result in uploader.uploadAll(upload_jobs) if not result.ok]
+        if failures:
+            exit('PostProteinCodingTotalError: %s' % '; '.join(failures))
+
+def readCountMatrix(count_file_list, gene_index_cache_dir=None):
+    """
+        read the gene counts of many samples into one matrix
+        usage: sample_names, gene_ids, count_matrix = readCountMatrix(['sample1_counts.csv', 'sample2_counts.csv'])
+        :params count_file_list: paths to ${sample_name}_counts.csv (gene_id,${sample_name}) or, with gene_index_cache_dir,
+                                 ${sample_name}_counts.json count vectors
+        :params gene_index_cache_dir: directory of the gene index manifest cache, required to read .json count vectors
+        :throws: ValueError if a file is malformed or the samples do not have the same genes in the same order, KeyError if
+                 the manifest of a count vector is not in the cache
+        :returns: a tuple (sample_names, gene_ids, count_matrix) where count_matrix is an int64 array (samples x genes)
+    """
+    cache = GeneIndexCache(gene_index_cache_dir) if gene_index_cache_dir else None
+    sample_names = []
+    gene_ids = None
+    count_rows = []
+    for count_file in count_file_list:
+        if count_file.endswith('.json'):
+            if cache is None:
+                raise ValueError('%s is a count vector, which requires --gene_index_cache' % count_file)
+            sample_name, file_gene_ids, counts = readCountVector(count_file, cache)
+        else:
+            sample_name, file_gene_ids, counts = readCountCsv(count_file)
+        if gene_ids is None:
+            gene_ids = file_gene_ids
+        elif file_gene_ids != gene_ids:
+            raise ValueError('the genes of %s are not those of %s' % (count_file, count_file_list[0]))
+        sample_names.append(sample_name)
+        count_rows.append(counts)
+
+    return sample_names, gene_ids or [], np.asarray(count_rows, dtype=np.int64).reshape(len(count_rows), len(gene_ids or []))
+
+def readCountCsv(count_file):
+    """
+        :params count_file: a ${sample_name}_counts.csv with the header gene_id,${sample_name}
+        :throws: ValueError if the file does not have two columns or a count is not an integer
+        :returns: a tuple (sample_name, gene_ids, counts)
+    """
+    with open(count_file, 'r', newline='') as count_csv:
+        reader = csv.reader(count_csv)
+        header = next(reader, None)
+        if header is None or len(header) != 2:
+            raise ValueError('%s does not have the header gene_id,sample_name' % count_file)
+        gene_ids = []
+        counts = []
+        for line_number, row in enumerate(reader, start=2):
+            try:
+                gene_id, count = row
+                counts.append(int(count))
+            except ValueError:
+                raise ValueError('line %s of %s is not gene_id,count' % (line_number, count_file))
+            gene_ids.append(gene_id)
+
+    return header[1], gene_ids, counts
 
 def parseArgs(argv):
-    parser = argparse.ArgumentParser(description="This script summarizes the output from pipeline wrapper.")
-    parser.add_argument("-c", "--count_file", required=True,
-                        help="[REQUIRED] htseq output as csv PARSED so only gene counts (no qc) are included")
-    parser.add_argument("-i", "--fastq_file_number", required=True,
-                        help="[REQUIRED] fastqFileNumber, the foreign key of QualityAssessment table which links back to FastqFiles table")
-    parser.add_argument("-u", "--url", required=True,
-                        help="[REQUIRED] URL to which to post data (this is purpose built for counts, so it should be https://someaddress/Counts/")
+    parser = argparse.ArgumentParser(description="Total the protein coding and other biotype counts of many samples and post proteinCodingCounted to the database.")
+    parser.add_argument("-c", "--count_file", required=True, nargs='+',
+                        help="[REQUIRED] one or more ${sample_name}_counts.csv (htseq output PARSED so only gene counts are included) or ${sample_name}_counts.json")
+    parser.add_argument("-i", "--fastq_file_number", nargs='+',
+                        help="fastqFileNumber of each count file, in the same order. Required to post")
+    parser.add_argument("-a", "--annotation_file", required=True,
+                        help="[REQUIRED] the annotation htseq counted against. The biotype of each gene is taken from it")
+    parser.add_argument("--annotation_cache",
+                        help="directory of parsed annotation indexes. If set, the index and biotype masks are built once and reused")
+    parser.add_argument("--gene_index_cache",
+                        help="directory of the gene index manifest cache. Required to read ${sample_name}_counts.json count vectors")
+    parser.add_argument("-o", "--output_file", default='biotype_totals.csv',
+                        help="path to which to write the table of biotype totals and fractions. Default biotype_totals.csv")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="maximum number of requests to the database in flight at once. Default 8")
+    parser.add_argument("-u", "--url",
+                        help="URL to which to post data (this is purpose built for qc, so it should be https://someaddress/QualityAssess/")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+    parser.add_argument("--post_cache",
+                        help="directory of the post cache. If set, payloads which were already sent are skipped and changed qc records are put directly")
+    parser.add_argument("--outbox",
+                        help="directory of an outbox. If set, the requests are written to it, to be sent by DrainOutbox.py, rather than sent to the database")
+    parser.add_argument("--force", action='store_true',
+                        help="send every payload even if the post cache shows it was already sent")
     parser.add_argument('--post', dest='post', action='store_true',
                         help="[DEFAULT TRUE] default behavior is to post to the database. set --no-post to avoid this")
     parser.add_argument('--no-post', dest='post', action='store_false',
                         help="See --post. Set --no-post to prevent posting the data to the url")
-    
+
     parser.set_defaults(post=True)
     args = parser.parse_args(argv[1:])
-    
+
+    if args.fastq_file_number and len(args.fastq_file_number) != len(args.count_file):
+        parser.error("--fastq_file_number must have one value per --count_file")
+    if args.post and not (args.url and args.fastq_file_number):
+        parser.error("--url and --fastq_file_number are required unless --no-post is set")
+
     return args
 
 if __name__ == "__main__":
     main(sys.argv)
-
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+    collect all of the qc of a sample -- the htseq qc and protein coding total, the novoalign and novosort log metrics,
+    and the coverage of the perturbed loci and markers -- in memory and upsert them to database as one QualityAssess record.
+    This replaces posting the same record piecemeal from PostCountsToDatabase.py (with -qu), PostProteinCodingTotal.py,
+    PostAlignmentLogToDatabase.py, PostMarkerCoverageToDatabase.py and PostGenotypeCoverageToDatabase.py. Each input is
+    optional and read once; only the columns of the inputs given are in the record
+    usage: PostSampleQcToDatabase.py -n sample -i 1 -c sample_read_count.tsv -l sample_novoalign.log -s sample_novosort.log
+                                     -b sample_sorted.bam -a KN99_annotation.gff --locus CKF44_00001 --markers -u https://someaddress/QualityAssess/
+    author: chase.mateusiak@gmail.com
+
+    output: ${sample_name}_sample_qc.csv, the record as a one row csv
+    database_interaction: post to url, or put if the record exists
+"""
+
+# standard library imports
+import sys
+import os
+import csv
+import argparse
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from PostCountsToDatabase import qcMetricsToDict
+from utils.AlignmentLogParser import parseSampleLogs
+from utils.StageMetrics import StageMetrics
+from utils.HtseqCountParser import QC_COLUMN_DICT, QC_METRIC_IDENTIFIER, readHtseqLines
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+    metrics = StageMetrics('PostSampleQcToDatabase', args.sample_name, args.metrics_dir, args.prometheus_dir)
+
+    ################################ set name variables ###################################
+    # for post data
+    primary_key = 'fastqFileNumber'
+    # suffix to append to the sample_name to output qc file
+    qc_suffix = "sample_qc"
+    #######################################################################################
+
+    # the record, filled in by each of the inputs given
+    qc_record = {primary_key: args.fastq_file_number}
+    try:
+        if args.count_file:
+            with metrics.stage('htseq_qc'):
+                qc_record.update(htseqQc(args.count_file, args.fastq_file_number, args.annotation_file, args.annotation_cache))
+        if args.novoalign_log or args.novosort_log:
+            with metrics.stage('alignment_qc'):
+                alignment_qc_dict = parseSampleLogs(args.sample_name, args.novoalign_log, args.novosort_log)
+            qc_record.update({metric: value for metric, value in alignment_qc_dict.items() if metric != 'sampleName'})
+        if args.bam_file:
+            # pysam and numpy are only loaded for the coverage
+            from PostGenotypeCoverageToDatabase import genotypeCoverage
+            with metrics.stage('coverage'):
+                qc_record.update(genotypeCoverage(args.bam_file, args.annotation_file, args.locus, args.feature, args.markers,
+                                                  args.annotation_cache))
+    except OSError as e:
+        sys.exit('PostSampleQcToDatabaseError: could not read input for reason %s' % e)
+    except ValueError as e:
+        sys.exit(e)
+    except KeyError as e:
+        # eg a gene which is not in the annotation
+        sys.exit('PostSampleQcToDatabaseError: %s' % e.args[0])
+
+    # write the record as a one row csv
+    qc_output_path = os.path.join(args.output_dir, '%s_%s.csv' % (args.sample_name, qc_suffix))
+    with open(qc_output_path, 'w', newline='') as qc_output:
+        writer = csv.DictWriter(qc_output, fieldnames=list(qc_record), lineterminator='\n')
+        writer.writeheader()
+        writer.writerow(qc_record)
+
+    # send the whole record in one request, put to the existing record if the post is rejected. exit with error message if fail
+    if args.post and args.outbox:
+        # sent later by DrainOutbox.py
+        from utils.Outbox import enqueueJobs
+        with metrics.stage('enqueue'):
+            enqueueJobs(args.outbox, [(args.url, {column: str(value) for column, value in qc_record.items()}, 'POST_OR_PUT',
+                                       args.fastq_file_number)])
+    elif args.post:
+        from utils.DatabaseInteraction import DatabaseInteractionError, createClient
+        with createClient(args.post_cache, args.force, metrics) as client, metrics.stage('post'):
+            try:
+                client.postOrPut(args.url, args.fastq_file_number, {column: str(value) for column, value in qc_record.items()})
+            except DatabaseInteractionError as e:
+                exit('PostSampleQcToDatabaseError: could not post or put %s to %s for reason %s' %(args.fastq_file_number, args.url, e))
+
+def htseqQc(count_file, fastq_file_number, annotation_file=None, annotation_cache_dir=None):
+    """
+        the htseq qc metrics and, given the annotation, the total of the protein coding counts, in one pass over the htseq output
+        usage: htseq_qc_dict = htseqQc('sample_read_count.tsv', 1, 'KN99_annotation.gff')
+        :params count_file: path to the htseq-count output (eg ${sample_name}_read_count.tsv)
+        :params fastq_file_number: fastqFileNumber of the sample
+        :params annotation_file: the annotation htseq counted against, from which the protein coding genes are taken. If
+                                 None, proteinCodingCounted is not calculated
+        :params annotation_cache_dir: directory of parsed annotation indexes, or None
+        :throws: ValueError if the count file is malformed or has an unrecognized qc metric
+        :returns: a dict of the htseq qc columns (see QC_COLUMN_DICT) and proteinCodingCounted
+    """
+    ################################ set name variables ###################################
+    data_column = 'proteinCodingCounted'
+    #######################################################################################
+
+    htseq_qc_rows = []
+    gene_ids = []
+    gene_counts = []
+    with open(count_file, 'r') as count_file_handle:
+        for locus, count in readHtseqLines(count_file_handle, count_file):
+            if locus.startswith(QC_METRIC_IDENTIFIER):
+                htseq_qc_rows.append((locus, count))
+            else:
+                gene_ids.append(locus)
+                gene_counts.append(count)
+
+    htseq_qc_dict = qcMetricsToDict(htseq_qc_rows, QC_COLUMN_DICT, fastq_file_number)
+    if annotation_file:
+        from utils.BiotypeMask import PROTEIN_CODING_BIOTYPE, biotypeTotals, loadBiotypeMasks
+        biotype_list, masks = loadBiotypeMasks(annotation_file, annotation_cache_dir, gene_ids)
+        biotype_totals = biotypeTotals(gene_counts, masks)
+        htseq_qc_dict[data_column] = int(biotype_totals[biotype_list.index(PROTEIN_CODING_BIOTYPE)]) \
+            if PROTEIN_CODING_BIOTYPE in biotype_list else 0
+    return htseq_qc_dict
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Collect the qc of a sample and upsert it to the database as one record.")
+    parser.add_argument("-n", "--sample_name", required=True,
+                        help="[REQUIRED] Should be unique. Suggestion: use the fastq name stripped of path and file extension")
+    parser.add_argument("-i", "--fastq_file_number", required=True,
+                        help="[REQUIRED] fastqFileNumber, the foreign key of QualityAssessment table which links back to FastqFiles table")
+    parser.add_argument("-c", "--count_file",
+                        help="htseq-count output, eg ${sample_name}_read_count.tsv. Adds the htseq qc and, with --annotation_file, proteinCodingCounted")
+    parser.add_argument("-l", "--novoalign_log",
+                        help="${sample_name}_novoalign.log. Adds the novoalign metrics")
+    parser.add_argument("-s", "--novosort_log",
+                        help="${sample_name}_novosort.log. Adds the novosort duplicate metrics")
+    parser.add_argument("-b", "--bam_file",
+                        help="sorted, indexed alignment file (.bam). Adds the coverage of --locus and --markers. Requires --annotation_file")
+    parser.add_argument("-a", "--annotation_file",
+                        help="annotation file (gtf or gff3). The protein coding genes are those with the protein_coding biotype in it")
+    parser.add_argument("--annotation_cache",
+                        help="directory of parsed annotation indexes. If set, the annotation is parsed once and the index reused by every sample")
+    parser.add_argument("--locus", nargs='+', default=[],
+                        help="gene id of each perturbed locus, optionally with :feature_type. Columns are genotype1Coverage, genotype2Coverage... in this order")
+    parser.add_argument("-f", "--feature", default="CDS",
+                        help="feature type over which to take coverage of loci which do not name one. Default CDS")
+    parser.add_argument("--markers", action='store_true',
+                        help="also calculate natCoverage and g418Coverage, the coverage of the CNAG_NAT and CNAG_G418 CDS")
+    parser.add_argument("-o", "--output_dir", default='.',
+                        help="directory to which to write the record as csv. Default is the current directory")
+    parser.add_argument("-u", "--url",
+                        help="URL to which to post data (this is purpose built for qc, so it should be https://someaddress/QualityAssess/")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+    parser.add_argument("--post_cache",
+                        help="directory of the post cache. If set, payloads which were already sent are skipped and changed qc records are put directly")
+    parser.add_argument("--outbox",
+                        help="directory of an outbox. If set, the requests are written to it, to be sent by DrainOutbox.py, rather than sent to the database")
+    parser.add_argument("--force", action='store_true',
+                        help="send every payload even if the post cache shows it was already sent")
+    parser.add_argument('--post', dest='post', action='store_true',
+                        help="[DEFAULT TRUE] default behavior is to post to the database. set --no-post to avoid this")
+    parser.add_argument('--no-post', dest='post', action='store_false',
+                        help="See --post. Set --no-post to prevent posting the data to the url")
+
+    parser.set_defaults(post=True)
+    args = parser.parse_args(argv[1:])
+
+    if args.bam_file and not args.annotation_file:
+        parser.error("--annotation_file is required with --bam_file")
+    if (args.locus or args.markers) and not args.bam_file:
+        parser.error("--locus/--markers require --bam_file")
+    if args.post and not args.url:
+        parser.error("--url is required unless --no-post is set")
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
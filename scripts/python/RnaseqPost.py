@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+    one entry point for the post processing scripts. Each subcommand runs the main() of its script with the remaining
+    arguments, and only that script is imported, so a subcommand pays only for its own dependencies (eg counts --no-post
+    imports neither requests nor numpy). Run from the checkout; `pip install scripts/python` installs only the
+    dependencies
+    usage: RnaseqPost.py counts -c sample_read_count.tsv -n sample -i 1 -cu https://someaddress/Counts/
+           RnaseqPost.py marker-coverage -b sample.bam -a KN99_annotation.gff -i 1 -u https://someaddress/QualityAssess/
+           RnaseqPost.py counts --help
+    author: chase.mateusiak@gmail.com
+"""
+
+# standard library imports
+import sys
+import os
+import argparse
+import importlib
+
+# extend python path to include utils dir. sys.path[0] is the directory of the script, so this holds only when the script
+# is run from the checkout, not when it is imported from elsewhere
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# subcommand -> (module of the script, help)
+SUBCOMMANDS = {'counts': ('PostCountsToDatabase', "parse an htseq count file and post the counts and htseq qc"),
+               'counts-batch': ('PostCountsBatchToDatabase', "parse and post the htseq count files of a run"),
+               'alignment-log': ('PostAlignmentLogToDatabase', "parse the novoalign and novosort logs of a sample and post the alignment qc"),
+               'alignment-log-batch': ('PostAlignmentLogBatchToDatabase', "parse and post the novoalign and novosort logs of a run"),
+               'marker-coverage': ('PostMarkerCoverageToDatabase', "post the coverage of the NAT and G418 marker CDS"),
+               'genotype-coverage': ('PostGenotypeCoverageToDatabase', "post the coverage of the perturbed loci (and the markers)"),
+               'protein-coding': ('PostProteinCodingTotal', "total the protein coding and other biotype counts of samples and post proteinCodingCounted"),
+               'sample-qc': ('PostSampleQcToDatabase', "collect the qc of a sample and upsert it as one record"),
+               'normalize-counts': ('NormalizeCounts', "calculate the CPM, log2 CPM and TPM of a run's count matrix store"),
+               'gene-coverage': ('GeneCoverageQc', "calculate the fraction covered, depth and 5' to 3' bias of every gene of a sample"),
+               'htseq-annotation': ('HtseqAnnotationQc', "tally the htseq XF tags of a sample's bam per gene and check its strandedness"),
+               'genome-coverage-summary': ('SummarizeGenomeCoverage', "summarize the per base depth of a sample as run length encoded intervals or bins"),
+               'backfill': ('RunBackfill', "re-run the post processing of published samples across a process pool, resuming from checkpoints"),
+               'summarize-metrics': ('SummarizeMetrics', "summarize the stage metrics of a run into percentiles per stage"),
+               'drain-outbox': ('DrainOutbox', "deliver the requests the scripts left in an outbox, and inspect and requeue its dead letters"),
+               'post-cache': ('ManagePostCache', "inspect, evict entries from and compact the post cache"),
+               'benchmark': ('RunBenchmarks', "benchmark the parsing, coverage, posting and startup paths")}
+
+def main(argv):
+
+    # parse cmd line arguments. Everything after the subcommand is left to the subcommand's own parser
+    args = parseArgs(argv)
+
+    module_name, _ = SUBCOMMANDS[args.subcommand]
+    script = importlib.import_module(module_name)
+    script.main(['%s %s' % (os.path.basename(argv[0]), args.subcommand)] + args.subcommand_args)
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]),
+                                     description="Post processing of the rnaseq pipeline. Run a subcommand with --help for its arguments.",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog='subcommands:\n' + '\n'.join('  %-22s%s' % (subcommand, help_text)
+                                                                         for subcommand, (_, help_text) in SUBCOMMANDS.items()))
+    parser.add_argument("subcommand", choices=list(SUBCOMMANDS), metavar='subcommand',
+                        help="one of %s" % ', '.join(SUBCOMMANDS))
+    parser.add_argument("subcommand_args", nargs=argparse.REMAINDER,
+                        help="arguments of the subcommand")
+
+    args = parser.parse_args(argv[1:])
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+"""
+    re-run the python post processing of samples which the pipeline already aligned and counted, from the outputs it
+    published to ${results_dir}/${runDirectory}/{count,logs,align}, across a process pool and without nextflow. Each
+    stage of each sample is checkpointed as it finishes (see utils/BackfillCheckpoint.py), so a backfill which is
+    interrupted or has failures picks up where it stopped when it is run again with the same --checkpoint_dir
+    usage: RunBackfill.py -m fastq_file_list.csv -r /path/to/align_count_results -c /path/to/checkpoints --annotation KN99=KN99_annotation.gff
+                          -cu https://someaddress/Counts/ -u https://someaddress/QualityAssess/
+           RunBackfill.py -m fastq_file_list.csv -r /path/to/align_count_results -c /path/to/checkpoints --stages gene_coverage --no-post
+           RunBackfill.py -c /path/to/checkpoints --status
+    author: chase.mateusiak@gmail.com
+
+    input: the fastq_file_list of main.nf, a csv with the columns runDirectory, fastqFileName, fastqFileNumber, organism
+           and strandedness. The published outputs of a sample are found by the sample name (fastqFileName stripped of
+           path and extensions): count/${sample}_read_count.tsv, logs/${sample}_novoalign.log, logs/${sample}_novosort.log
+           and align/${sample}_sorted.bam and align/${sample}_sorted_aligned_reads_with_annote.bam
+    stages: counts         parse the htseq counts and post them to the counts url
+            sample_qc      the htseq qc and protein coding total, the alignment log metrics and, for organisms with the
+                           markers, the marker coverage, upserted to the qc url as one record (as PostSampleQcToDatabase.py)
+            gene_coverage  the per gene coverage qc of GeneCoverageQc.py, from the bam
+            strandedness   the per gene XF tag tally and strandedness qc of HtseqAnnotationQc.py, from the bam with the
+                           htseq annotation, checked against the strandedness of the manifest
+    output: the outputs of each stage in ${output_dir}/${runDirectory}/
+    database_interaction: post counts, post or put qc
+"""
+
+# standard library imports
+import sys
+import os
+import csv
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from utils.BackfillCheckpoint import DONE, FAILED, MISSING, BackfillCheckpoint, inputFingerprint
+from utils.Manifest import readManifest
+
+# the stages in the order they run for a sample
+STAGES = ('counts', 'sample_qc', 'gene_coverage', 'strandedness')
+# columns of the fastq_file_list which the backfill reads
+MANIFEST_COLUMNS = ('runDirectory', 'fastqFileName', 'fastqFileNumber', 'organism', 'strandedness')
+# organisms whose annotation has the NAT and G418 marker genes
+MARKER_ORGANISMS = ('KN99',)
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+
+    if args.status:
+        with BackfillCheckpoint(args.checkpoint_dir) as checkpoint:
+            printStatus(checkpoint)
+        return
+
+    try:
+        sample_list = readBackfillManifest(args.manifest, args.results_dir)
+    except (OSError, ValueError) as e:
+        sys.exit(e)
+
+    # the settings every stage of every sample shares. A dict so that it pickles to the workers
+    settings = {'stages': args.stages, 'output_dir': args.output_dir, 'checkpoint_dir': args.checkpoint_dir,
+                'annotation_dict': args.annotation_dict,
+                'annotation_cache': args.annotation_cache or os.path.join(args.checkpoint_dir, 'annotation_cache'),
+                'counts_url': args.counts_url if args.post else None, 'qc_url': args.qc_url if args.post else None,
+                'post_cache': args.post_cache, 'force': args.force, 'metrics_dir': args.metrics_dir,
+                'prometheus_dir': args.prometheus_dir}
+
+    # only the samples with a stage to run are sent to the pool
+    with BackfillCheckpoint(args.checkpoint_dir) as checkpoint:
+        if args.redo:
+            for stage in args.stages:
+                checkpoint.reset(stage)
+        pending_list = [(sample, pending_stages) for sample in sample_list
+                        for pending_stages in [pendingStages(checkpoint, sample, settings)] if pending_stages]
+    print('%s of %s samples have stages to run' % (len(pending_list), len(sample_list)))
+
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        futures = {executor.submit(backfillSample, sample, pending_stages, settings): sample for sample, pending_stages in pending_list}
+        for finished, future in enumerate(as_completed(futures), 1):
+            sample = futures[future]
+            try:
+                stage_results = future.result()
+            except Exception as e:
+                # the worker died outside of a stage. The stages it did not record run again next time
+                stage_results = [('worker', FAILED, str(e))]
+            failed = ['%s (%s)' % (stage, message) for stage, status, message in stage_results if status == FAILED]
+            print('[%s/%s] %s %s' % (finished, len(pending_list), sample['sampleName'],
+                                     'failed: ' + '; '.join(failed) if failed else 'ok'), file=sys.stderr if failed else sys.stdout)
+
+    with BackfillCheckpoint(args.checkpoint_dir) as checkpoint:
+        printStatus(checkpoint)
+        failure_list = [failure for failure in checkpoint.failures() if failure.status == FAILED and failure.stage in args.stages]
+    if failure_list:
+        sys.exit('RunBackfillError: %s stages failed. Run again with the same --checkpoint_dir to retry them' % len(failure_list))
+
+def readBackfillManifest(manifest_path, results_dir):
+    """
+        read the samples of a fastq_file_list and find their published outputs
+        usage: sample_list = readBackfillManifest('fastq_file_list.csv', '/path/to/align_count_results')
+        :params manifest_path: path to a csv with the columns in MANIFEST_COLUMNS
+        :params results_dir: the align_count_results directory of the pipeline
+        :throws: ValueError if a column is missing
+        :returns: a list of dicts, one per row, of the manifest columns, sampleName and the paths countFile, novoalignLog,
+                  novosortLog, bamFile and annotatedBamFile (which may not exist)
+    """
+    sample_list = []
+    for row in readManifest(manifest_path, MANIFEST_COLUMNS):
+        sample = {column: row[column] for column in MANIFEST_COLUMNS + ('sampleName',)}
+        sample_name = sample['sampleName']
+        run_dir = os.path.join(results_dir, row['runDirectory'])
+        sample.update({'countFile': os.path.join(run_dir, 'count', '%s_read_count.tsv' % sample_name),
+                       'novoalignLog': os.path.join(run_dir, 'logs', '%s_novoalign.log' % sample_name),
+                       'novosortLog': os.path.join(run_dir, 'logs', '%s_novosort.log' % sample_name),
+                       'bamFile': os.path.join(run_dir, 'align', '%s_sorted.bam' % sample_name),
+                       'annotatedBamFile': os.path.join(run_dir, 'align', '%s_sorted_aligned_reads_with_annote.bam' % sample_name)})
+        sample_list.append(sample)
+
+    return sample_list
+
+def stageInputs(stage, sample, settings):
+    """
+        :params stage: one of STAGES
+        :params sample: a sample dict of readBackfillManifest
+        :params settings: the backfill settings
+        :returns: a tuple (input_paths, fingerprint_settings), the files the stage reads and the settings which change its output
+    """
+    annotation_file = settings['annotation_dict'].get(sample['organism'])
+    if stage == 'counts':
+        return [sample['countFile']], [settings['counts_url']]
+    if stage == 'sample_qc':
+        input_paths = [sample['countFile'], sample['novoalignLog'], sample['novosortLog']]
+        if annotation_file and sample['organism'] in MARKER_ORGANISMS:
+            input_paths.append(sample['bamFile'])
+        return input_paths, [annotation_file, settings['qc_url']]
+    if stage == 'strandedness':
+        return [sample['annotatedBamFile']], [annotation_file, sample['strandedness']]
+    return [sample['bamFile']], [annotation_file]
+
+def missingInputs(stage, sample, settings):
+    """
+        :returns: a list of what a stage of a sample needs and does not have. sample_qc needs any one of its inputs
+    """
+    input_paths, _ = stageInputs(stage, sample, settings)
+    missing = [input_path for input_path in input_paths if not os.path.exists(input_path)]
+    if stage == 'sample_qc':
+        return missing if len(missing) == len(input_paths) else []
+    if stage in ('gene_coverage', 'strandedness') and sample['organism'] not in settings['annotation_dict']:
+        missing.append('an --annotation for %s' % sample['organism'])
+    return missing
+
+def pendingStages(checkpoint, sample, settings):
+    """
+        :returns: the list of (stage, input fingerprint) of the stages of a sample which are not done on its current inputs
+    """
+    pending_stages = []
+    for stage in settings['stages']:
+        input_paths, fingerprint_settings = stageInputs(stage, sample, settings)
+        fingerprint = inputFingerprint(stage, input_paths, *fingerprint_settings)
+        if not checkpoint.isDone(sample['fastqFileNumber'], stage, fingerprint):
+            pending_stages.append((stage, fingerprint))
+    return pending_stages
+
+def backfillSample(sample, pending_stages, settings):
+    """
+        run the pending stages of one sample in a worker, recording each in the checkpoints as it finishes
+        :params sample: a sample dict of readBackfillManifest
+        :params pending_stages: list of (stage, input fingerprint)
+        :params settings: the backfill settings
+        :returns: a list of (stage, status, message)
+    """
+    from utils.StageMetrics import StageMetrics
+
+    output_dir = os.path.join(settings['output_dir'], sample['runDirectory'])
+    os.makedirs(output_dir, exist_ok=True)
+    metrics = StageMetrics('RunBackfill', sample['sampleName'], settings['metrics_dir'], settings['prometheus_dir'])
+    stage_results = []
+    with BackfillCheckpoint(settings['checkpoint_dir']) as checkpoint:
+        for stage, fingerprint in pending_stages:
+            missing = missingInputs(stage, sample, settings)
+            if missing:
+                status, message = MISSING, 'not found: %s' % ', '.join(missing)
+            else:
+                try:
+                    with metrics.stage(stage):
+                        STAGE_FUNCTIONS[stage](sample, output_dir, settings, metrics)
+                    status, message = DONE, ''
+                except Exception as e:
+                    status, message = FAILED, '%s: %s' % (type(e).__name__, e)
+            checkpoint.record(sample['fastqFileNumber'], stage, status, fingerprint, message)
+            stage_results.append((stage, status, message))
+    # a pool worker does not run atexit handlers, so the metrics are written here
+    metrics.write()
+    return stage_results
+
+def countsStage(sample, output_dir, settings, metrics):
+    """
+        parse the htseq counts, write ${sample}_counts.csv and ${sample}_htseq_qc.csv and post the counts
+    """
+    from PostCountsToDatabase import parseCountFile
+
+    count_data, _ = parseCountFile(sample['countFile'], sample['sampleName'], sample['fastqFileNumber'], output_dir)
+    if settings['counts_url']:
+        from utils.DatabaseInteraction import createClient
+        with createClient(settings['post_cache'], settings['force'], metrics) as client:
+            client.post(settings['counts_url'], count_data, record_key=sample['fastqFileNumber'])
+
+def sampleQcStage(sample, output_dir, settings, metrics):
+    """
+        collect the qc of the sample which has published inputs, write ${sample}_sample_qc.csv and upsert it
+    """
+    from PostSampleQcToDatabase import htseqQc
+    from utils.AlignmentLogParser import parseSampleLogs
+
+    annotation_file = settings['annotation_dict'].get(sample['organism'])
+    qc_record = {'fastqFileNumber': sample['fastqFileNumber']}
+    if os.path.exists(sample['countFile']):
+        qc_record.update(htseqQc(sample['countFile'], sample['fastqFileNumber'], annotation_file, settings['annotation_cache']))
+    novoalign_log = sample['novoalignLog'] if os.path.exists(sample['novoalignLog']) else None
+    novosort_log = sample['novosortLog'] if os.path.exists(sample['novosortLog']) else None
+    if novoalign_log or novosort_log:
+        alignment_qc_dict = parseSampleLogs(sample['sampleName'], novoalign_log, novosort_log)
+        qc_record.update({metric: value for metric, value in alignment_qc_dict.items() if metric != 'sampleName'})
+    if annotation_file and sample['organism'] in MARKER_ORGANISMS and os.path.exists(sample['bamFile']):
+        from PostGenotypeCoverageToDatabase import genotypeCoverage
+        qc_record.update(genotypeCoverage(sample['bamFile'], annotation_file, [], 'CDS', True, settings['annotation_cache']))
+
+    with open(os.path.join(output_dir, '%s_sample_qc.csv' % sample['sampleName']), 'w', newline='') as qc_output:
+        writer = csv.DictWriter(qc_output, fieldnames=list(qc_record), lineterminator='\n')
+        writer.writeheader()
+        writer.writerow(qc_record)
+
+    if settings['qc_url']:
+        from utils.DatabaseInteraction import createClient
+        with createClient(settings['post_cache'], settings['force'], metrics) as client:
+            client.postOrPut(settings['qc_url'], sample['fastqFileNumber'], {column: str(value) for column, value in qc_record.items()})
+
+def geneCoverageStage(sample, output_dir, settings, metrics):
+    """
+        the per gene coverage qc of the sample from its bam, written as in GeneCoverageQc.py
+    """
+    from GeneCoverageQc import writeGeneCoverage
+    from utils.AnnotationIndex import loadAnnotationIndex
+    from utils.GeneCoverage import bamDepthChunks, geneCoverage
+
+    feature = 'exon'
+    annotation_index = loadAnnotationIndex(settings['annotation_dict'][sample['organism']], settings['annotation_cache'])
+    gene_rows, gene_body_profile = geneCoverage(annotation_index, feature, bamDepthChunks(sample['bamFile'], annotation_index, feature))
+    writeGeneCoverage(gene_rows, gene_body_profile, sample['sampleName'], feature, output_dir)
+
+def strandednessStage(sample, output_dir, settings, metrics):
+    """
+        the XF tag tally and strandedness qc of the sample, written as in HtseqAnnotationQc.py. The chunks are read in
+        this worker, as the samples are already spread across the pool. Raises if the reads do not support the
+        strandedness of the manifest
+    """
+    from HtseqAnnotationQc import writeHtseqAnnotationQc
+    from utils.AnnotationIndex import loadAnnotationIndex
+    from utils.HtseqAnnotation import analyzeAnnotatedBam, geneTallyRows, strandednessQc
+
+    annotation_index = loadAnnotationIndex(settings['annotation_dict'][sample['organism']], settings['annotation_cache'])
+    tally = analyzeAnnotatedBam(sample['annotatedBamFile'], annotation_index)
+    qc_dict = strandednessQc(tally, sample['strandedness'])
+    writeHtseqAnnotationQc(geneTallyRows(tally, annotation_index), qc_dict, sample['sampleName'], output_dir)
+    if qc_dict['strandednessConsistent'] is False:
+        raise ValueError('counted with strandedness %s but the reads look %s' % (sample['strandedness'], qc_dict['inferredStrandedness']))
+
+# stage -> function(sample, output_dir, settings, metrics) which raises on failure
+STAGE_FUNCTIONS = {'counts': countsStage, 'sample_qc': sampleQcStage, 'gene_coverage': geneCoverageStage,
+                   'strandedness': strandednessStage}
+
+def printStatus(checkpoint):
+    """
+        print the number of samples of each stage in each status, and what is missing or failed
+    """
+    for stage, status, samples in checkpoint.stats():
+        print('%-16s%-10s%8s' % (stage, status, samples))
+    for failure in checkpoint.failures():
+        print('%s\t%s\t%s\t%s' % (failure.fastq_file_number, failure.stage, failure.status, failure.message), file=sys.stderr)
+
+def parseAnnotation(annotation):
+    """
+        :params annotation: ORGANISM=PATH
+        :throws: argparse.ArgumentTypeError if there is no =
+        :returns: a tuple (organism, path)
+    """
+    organism, separator, annotation_path = annotation.partition('=')
+    if not separator or not organism or not annotation_path:
+        raise argparse.ArgumentTypeError('expected ORGANISM=PATH, eg KN99=/path/to/KN99_annotation.gff, not %s' % annotation)
+    return organism, annotation_path
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Re-run the post processing of already published samples across a process pool, resuming from checkpoints.")
+    parser.add_argument("-m", "--manifest",
+                        help="the fastq_file_list csv, with the columns runDirectory, fastqFileName, fastqFileNumber, organism and strandedness")
+    parser.add_argument("-r", "--results_dir",
+                        help="the align_count_results directory to which the pipeline published each runDirectory")
+    parser.add_argument("-c", "--checkpoint_dir", required=True,
+                        help="[REQUIRED] directory of the checkpoints. Use the same directory to resume a backfill")
+    parser.add_argument("-o", "--output_dir", default='.',
+                        help="directory to which to write the outputs, in a directory per runDirectory. Default the current directory")
+    parser.add_argument("--stages", nargs='+', choices=STAGES, default=['counts', 'sample_qc'],
+                        help="stages to run. Default counts sample_qc")
+    parser.add_argument("--annotation", dest='annotations', action='append', type=parseAnnotation, default=[], metavar='ORGANISM=PATH',
+                        help="the annotation of an organism, eg KN99=KN99_annotation.gff. Repeat for each organism. Needed for the "
+                             "protein coding total and marker coverage of sample_qc and for gene_coverage and strandedness")
+    parser.add_argument("--annotation_cache",
+                        help="directory of parsed annotation indexes. Default annotation_cache in the checkpoint directory")
+    parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(),
+                        help="number of worker processes. Default is the number of cpus")
+    parser.add_argument("-cu", "--counts_url",
+                        help="URL to which to post the counts, eg https://someaddress/Counts/")
+    parser.add_argument("-u", "--qc_url",
+                        help="URL to which to post or put the sample qc, eg https://someaddress/QualityAssess/")
+    parser.add_argument("--redo", action='store_true',
+                        help="forget the checkpoints of the --stages and run them for every sample")
+    parser.add_argument("--status", action='store_true',
+                        help="print the checkpoints of the backfill and exit")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+    parser.add_argument("--post_cache",
+                        help="directory of the post cache. If set, payloads which were already sent are skipped and changed qc records are put directly")
+    parser.add_argument("--force", action='store_true',
+                        help="send every payload even if the post cache shows it was already sent")
+    parser.add_argument('--post', dest='post', action='store_true',
+                        help="[DEFAULT TRUE] default behavior is to post to the database. set --no-post to avoid this")
+    parser.add_argument('--no-post', dest='post', action='store_false',
+                        help="See --post. Set --no-post to prevent posting the data to the url")
+
+    parser.set_defaults(post=True)
+    args = parser.parse_args(argv[1:])
+
+    args.annotation_dict = dict(args.annotations)
+    if not args.status:
+        if not (args.manifest and args.results_dir):
+            parser.error("--manifest and --results_dir are required unless --status is set")
+        if args.post and 'counts' in args.stages and not args.counts_url:
+            parser.error("--counts_url is required to post the counts stage unless --no-post is set")
+        if args.post and 'sample_qc' in args.stages and not args.qc_url:
+            parser.error("--qc_url is required to post the sample_qc stage unless --no-post is set")
+        for stage in ('gene_coverage', 'strandedness'):
+            if stage in args.stages and not args.annotation_dict:
+                parser.error("--annotation is required for the %s stage" % stage)
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
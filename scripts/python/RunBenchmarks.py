@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+"""
+    Benchmark the counts parsing, log parsing, coverage and posting paths on synthetic data of a configurable scale,
+    posting to a local stub of the database api (see utils/StubApiServer.py) with a configurable latency and error rate,
+    and the startup time of the per sample subcommands of RnaseqPost.py.
+    Each benchmark is run in a fresh process, so that its peak RSS is its own, and repeated; the median wall time is
+    reported. The results are written as json so that runs on different commits can be compared with --compare
+    usage: RunBenchmarks.py -o benchmark_results.json
+           RunBenchmarks.py --samples 96 --genes 7000 --reads 1000000 --latency 0.02 --error_rate 0.01 -o results.json
+           RunBenchmarks.py -o results.json --compare baseline_results.json --tolerance 0.2
+           RunBenchmarks.py -b startup -o startup_results.json --compare baseline_startup_results.json
+    author: chase.mateusiak@gmail.com
+
+    output: json {'version', 'commit', 'timestamp', 'python', 'platform', 'cpuCount', 'parameters',
+                  'benchmarks': {name: {'wallTime', 'wallTimes', 'cpuTime', 'items', 'unit', 'throughput', 'peakRssMb', ...}}}
+"""
+
+# standard library imports
+import sys
+import os
+import json
+import time
+import random
+import platform
+import argparse
+import resource
+import statistics
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from PostCountsToDatabase import parseCountFile
+from utils.AlignmentLogParser import parseSampleLogs
+from utils.AsyncUploader import AsyncUploader, UploadJob
+from utils.FeatureCoverage import calculateRegionCoverage
+from utils.StubApiServer import StubApiServer
+from utils.SyntheticData import MARKER_GENE_IDS, syntheticGeneIds, writeSyntheticAnnotation, writeSyntheticBam, writeSyntheticRun
+
+# version of the results layout
+RESULTS_VERSION = 1
+# the benchmarks, in the order in which they are run
+BENCHMARKS = ('counts_parsing', 'log_parsing', 'coverage', 'posting', 'startup')
+# the RnaseqPost.py subcommands which nextflow runs once per sample, whose startup is timed by the startup benchmark
+STARTUP_SUBCOMMANDS = ('counts', 'alignment-log', 'marker-coverage', 'genotype-coverage', 'sample-qc')
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+
+    ################################ set name variables ###################################
+    # number of genes whose CDS coverage is measured, in addition to the markers
+    num_coverage_genes = 3
+    #######################################################################################
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+
+        # generate the inputs once. The bams are only written for the first --bam_samples samples
+        print('writing synthetic data to %s' % work_dir, file=sys.stderr)
+        rng = random.Random(args.seed)
+        gene_ids = syntheticGeneIds(args.genes)
+        annotation_path = os.path.join(work_dir, 'annotation.gff')
+        writeSyntheticAnnotation(annotation_path, gene_ids)
+        run_dir = os.path.join(work_dir, 'run')
+        # the startup benchmark needs no inputs
+        num_samples = args.samples if set(args.benchmarks) - {'startup'} else 0
+        sample_names = writeSyntheticRun(run_dir, num_samples, gene_ids, rng)
+        bam_sample_names = sample_names[:args.bam_samples] if 'coverage' in args.benchmarks else []
+        for sample_name in bam_sample_names:
+            writeSyntheticBam(os.path.join(run_dir, '%s_sorted_aligned_reads.bam' % sample_name), gene_ids, args.reads, rng)
+        regions = [(gene_id, 'CDS') for gene_id in gene_ids[:num_coverage_genes] + list(MARKER_GENE_IDS)]
+
+        with StubApiServer(latency=args.latency, error_rate=args.error_rate, seed=args.seed) as server:
+            benchmark_kwargs = {
+                'counts_parsing': {'run_dir': run_dir, 'sample_names': sample_names, 'output_dir': os.path.join(work_dir, 'counts')},
+                'log_parsing': {'run_dir': run_dir, 'sample_names': sample_names},
+                'coverage': {'bam_dir': run_dir, 'sample_names': bam_sample_names,
+                             'annotation_path': annotation_path, 'regions': regions},
+                'posting': {'run_dir': run_dir, 'sample_names': sample_names, 'api_url': server.url,
+                            'concurrency': args.concurrency, 'output_dir': os.path.join(work_dir, 'posting')},
+                'startup': {'subcommands': STARTUP_SUBCOMMANDS, 'runs': args.startup_runs}}
+            benchmark_results = {}
+            for benchmark in BENCHMARKS:
+                if benchmark not in args.benchmarks:
+                    continue
+                print('running %s' % benchmark, file=sys.stderr)
+                benchmark_results[benchmark] = runBenchmark(benchmark, benchmark_kwargs[benchmark], args.repeat,
+                                                            server if benchmark == 'posting' else None)
+
+    results = {'version': RESULTS_VERSION, 'commit': gitCommit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'python': platform.python_version(), 'platform': platform.platform(), 'cpuCount': os.cpu_count(),
+               'parameters': {parameter: getattr(args, parameter) for parameter in
+                              ['samples', 'genes', 'reads', 'bam_samples', 'latency', 'error_rate', 'concurrency', 'repeat',
+                               'startup_runs', 'seed']},
+               'benchmarks': benchmark_results}
+    with open(args.output_file, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+        output_file.write('\n')
+
+    for benchmark, result in benchmark_results.items():
+        print('%-16s%10.3f s%12.1f %s/s%10.1f MB' % (benchmark, result['wallTime'], result['throughput'], result['unit'], result['peakRssMb']))
+
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            regressions = compareResults(json.load(baseline_file), results, args.tolerance)
+        if regressions:
+            sys.exit('RunBenchmarksError: %s slower than %s by more than %s%%' % (', '.join(regressions), args.compare, int(args.tolerance * 100)))
+
+def runBenchmark(benchmark, kwargs, repeat, server=None):
+    """
+        run a benchmark repeat times, each in a fresh process
+        :params benchmark: one of BENCHMARKS
+        :params kwargs: the keyword arguments of the benchmark function
+        :params repeat: number of runs
+        :params server: the StubApiServer the benchmark sends to, if any. It is reset before each run, so that every run
+                        sends the same requests (otherwise the records of the first run turn the posts of the next into
+                        posts and puts), and the requests it answered in each run are added to the result as requestsPerRun
+        :returns: the result dict of the run with the median wall time, with the wall times of every run and the largest peak RSS
+    """
+    run_results = []
+    for _ in range(repeat):
+        if server is not None:
+            server.reset()
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            run_results.append(executor.submit(measure, benchmark, kwargs).result())
+        if server is not None:
+            run_results[-1]['requests'] = sum(server.request_counts.values())
+    run_results.sort(key=lambda run_result: run_result['wallTime'])
+    result = dict(run_results[(len(run_results) - 1) // 2])
+    result['wallTime'] = statistics.median(run_result['wallTime'] for run_result in run_results)
+    result['wallTimes'] = [run_result['wallTime'] for run_result in run_results]
+    result['peakRssMb'] = max(run_result['peakRssMb'] for run_result in run_results)
+    if server is not None:
+        result['requestsPerRun'] = [run_result['requests'] for run_result in run_results]
+    result['throughput'] = result['items'] / result['wallTime'] if result['wallTime'] else 0.0
+    return result
+
+def measure(benchmark, kwargs):
+    """
+        time one run of a benchmark in this process
+        :returns: the dict returned by the benchmark function with wallTime, cpuTime, throughput, baselineRssMb and peakRssMb added
+    """
+    benchmark_function = {'counts_parsing': benchCountsParsing, 'log_parsing': benchLogParsing,
+                          'coverage': benchCoverage, 'posting': benchPosting, 'startup': benchStartup}[benchmark]
+    baseline_rss_mb = peakRssMb()
+    setup = benchmark_function(**kwargs)
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    result = setup()
+    wall_time = time.perf_counter() - start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    result.update({'wallTime': wall_time,
+                   'cpuTime': (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime),
+                   'throughput': result['items'] / wall_time if wall_time else 0.0,
+                   'baselineRssMb': baseline_rss_mb, 'peakRssMb': peakRssMb()})
+    return result
+
+def peakRssMb():
+    """
+        :returns: the peak resident set size of this process in MB. ru_maxrss is in kilobytes on linux and bytes on mac
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else max_rss / 1024.0
+
+# each benchmark does its untimed setup and returns the function which is timed. That function returns a dict with
+# at least items (the number of things processed) and unit (what they are)
+
+def benchCountsParsing(run_dir, sample_names, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+
+    def run():
+        for fastq_file_number, sample_name in enumerate(sample_names, 1):
+            parseCountFile(os.path.join(run_dir, '%s_read_count.tsv' % sample_name), sample_name, fastq_file_number, output_dir)
+        return {'items': len(sample_names), 'unit': 'samples'}
+    return run
+
+def benchLogParsing(run_dir, sample_names):
+    def run():
+        for sample_name in sample_names:
+            parseSampleLogs(sample_name, os.path.join(run_dir, '%s_novoalign.log' % sample_name),
+                            os.path.join(run_dir, '%s_novosort.log' % sample_name))
+        return {'items': len(sample_names), 'unit': 'samples'}
+    return run
+
+def benchCoverage(bam_dir, sample_names, annotation_path, regions):
+    def run():
+        for sample_name in sample_names:
+            calculateRegionCoverage(regions, annotation_path, os.path.join(bam_dir, '%s_sorted_aligned_reads.bam' % sample_name))
+        return {'items': len(sample_names), 'unit': 'samples', 'regions': len(regions)}
+    return run
+
+def benchPosting(run_dir, sample_names, api_url, concurrency, output_dir):
+    # the request bodies are those PostCountsToDatabase.py sends. The qc is posted or put, as PostSampleQcToDatabase.py does
+    os.makedirs(output_dir, exist_ok=True)
+    upload_jobs = []
+    for fastq_file_number, sample_name in enumerate(sample_names, 1):
+        count_data, qc_dict = parseCountFile(os.path.join(run_dir, '%s_read_count.tsv' % sample_name), sample_name,
+                                             fastq_file_number, output_dir)
+        upload_jobs.append(UploadJob(api_url + 'Counts/', count_data))
+        upload_jobs.append(UploadJob(api_url + 'QualityAssess/', qc_dict, 'POST_OR_PUT', fastq_file_number))
+
+    def run():
+        results = AsyncUploader(concurrency=concurrency).uploadAll(upload_jobs)
+        return {'items': len(upload_jobs), 'unit': 'requests', 'failures': sum(1 for result in results if not result.ok),
+                'bytesSent': sum(len(json.dumps(job.data)) for job in upload_jobs)}
+    return run
+
+def benchStartup(subcommands, runs):
+    # each run is a new interpreter which imports the subcommand's script and prints its help
+    cli_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'RnaseqPost.py')
+
+    def run():
+        subcommand_dict = {}
+        for subcommand in subcommands:
+            wall_times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run([sys.executable, cli_path, subcommand, '--help'], stdout=subprocess.DEVNULL, check=True)
+                wall_times.append(time.perf_counter() - start)
+            subcommand_dict[subcommand] = statistics.median(wall_times)
+        return {'items': len(subcommands) * runs, 'unit': 'starts', 'subcommands': subcommand_dict}
+    return run
+
+def compareResults(baseline, results, tolerance):
+    """
+        print the wall time of each benchmark against a baseline run
+        :params baseline: the results dict of an earlier run
+        :params results: the results dict of this run
+        :params tolerance: fraction by which a benchmark may be slower than the baseline before it is a regression
+        :returns: the list of benchmarks which regressed
+    """
+    if baseline.get('parameters') != results['parameters']:
+        print('RunBenchmarksWarning: the baseline was run with different parameters %s' % baseline.get('parameters'), file=sys.stderr)
+    regressions = []
+    for benchmark, result in results['benchmarks'].items():
+        if benchmark not in baseline.get('benchmarks', {}):
+            continue
+        baseline_wall_time = baseline['benchmarks'][benchmark]['wallTime']
+        ratio = result['wallTime'] / baseline_wall_time if baseline_wall_time else float('inf')
+        print('%-16s%10.3f s -> %.3f s (%.2fx)' % (benchmark, baseline_wall_time, result['wallTime'], ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(benchmark)
+    return regressions
+
+def gitCommit():
+    """
+        :returns: the commit of the checkout this script is in, or None if it is not in a git repository
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the parsing, coverage and posting paths on synthetic data.")
+    parser.add_argument("-o", "--output_file", default='benchmark_results.json',
+                        help="path to which to write the results json. Default benchmark_results.json")
+    parser.add_argument("-w", "--work_dir",
+                        help="directory in which to write the synthetic data, and keep it. Default is a temporary directory which is removed")
+    parser.add_argument("-b", "--benchmarks", nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help="benchmarks to run. Default all")
+    parser.add_argument("--samples", type=int, default=24,
+                        help="number of samples of counts and logs. Default 24")
+    parser.add_argument("--genes", type=int, default=7000,
+                        help="number of genes in the annotation and count files. Default 7000")
+    parser.add_argument("--reads", type=int, default=200000,
+                        help="number of reads in each bam. Default 200000")
+    parser.add_argument("--bam_samples", type=int, default=2,
+                        help="number of samples with a bam, for the coverage benchmark. Default 2")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="seconds the stub api waits before each response. Default 0.005")
+    parser.add_argument("--error_rate", type=float, default=0.0,
+                        help="fraction of requests the stub api answers with a 503. Default 0")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="maximum number of requests in flight in the posting benchmark. Default 8")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of runs of each benchmark. The median wall time is reported. Default 3")
+    parser.add_argument("--startup_runs", type=int, default=5,
+                        help="number of starts of each subcommand in the startup benchmark. Default 5")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed of the synthetic data and of the stub api errors. Default 1")
+    parser.add_argument("--compare",
+                        help="results json of an earlier run. Exit with an error if a benchmark is slower by more than --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fraction by which a benchmark may be slower than --compare. Default 0.2")
+
+    args = parser.parse_args(argv[1:])
+
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
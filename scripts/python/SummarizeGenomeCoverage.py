@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+    summarize the per base depth of a sample (the output of GenomeCoverage.sh, or samtools depth piped to stdin) as run
+    length encoded intervals or fixed size bins, reading the depth in chunks so that memory does not grow with the genome
+    usage: SummarizeGenomeCoverage.py -d sample_coverage.bed -n sample -m bins -r 100 -o /path/to/output_dir
+           samtools depth -aa -Q 10 sample.bam | SummarizeGenomeCoverage.py -d - -n sample -m rle --depth_resolution 5
+    author: chase.mateusiak@gmail.com
+
+    output: ${sample}_coverage_rle.bedgraph.gz (chrom, start, end, depth) or ${sample}_coverage_bins.tsv.gz (chrom,
+            start, end, mean, min, max depth) in output_dir, and ${sample}_coverage_summary.json with the genome wide
+            bases, meanDepth, maxDepth, number of intervals and fraction of bases covered at 1, 10 and 30 reads
+"""
+
+# standard library imports
+import sys
+import os
+import json
+import argparse
+
+# extend python path to include utils dir
+sys.path.extend([os.path.join(sys.path[0], 'utils')])
+
+# local imports
+from utils.StageMetrics import StageMetrics
+from utils.CoverageSummary import BinWriter, RleWriter, openText, summarizeDepth
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+    metrics = StageMetrics('SummarizeGenomeCoverage', args.sample_name, args.metrics_dir, args.prometheus_dir)
+
+    ################################ set name variables ###################################
+    extension = '.bedgraph' if args.mode == 'rle' else '.tsv'
+    if not args.no_gzip:
+        extension += '.gz'
+    summary_path = os.path.join(args.output_dir, '%s_coverage_%s%s' % (args.sample_name, args.mode, extension))
+    genome_stats_path = os.path.join(args.output_dir, '%s_coverage_summary.json' % args.sample_name)
+    #######################################################################################
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    depth_file = sys.stdin.buffer if args.depth_file == '-' else open(args.depth_file, 'rb')
+    try:
+        with depth_file, openText(summary_path, 'w') as output_file, metrics.stage('summarize'):
+            writer = RleWriter(output_file, args.depth_resolution) if args.mode == 'rle' else BinWriter(output_file, args.bin_size)
+            genome_stats = summarizeDepth(depth_file, writer, args.chunk_bytes)
+    except ValueError as e:
+        sys.exit(e)
+
+    genome_stats.update({'sample': args.sample_name, 'mode': args.mode,
+                         'resolution': args.depth_resolution if args.mode == 'rle' else args.bin_size})
+    with open(genome_stats_path, 'w') as genome_stats_file:
+        json.dump(genome_stats, genome_stats_file, indent=2)
+    print('%s: %s bases, mean depth %.2f, %s intervals written to %s' % (args.sample_name, genome_stats['bases'],
+                                                                       genome_stats['meanDepth'], genome_stats['intervals'], summary_path))
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Summarize the per base depth of a sample as run length encoded intervals or fixed size bins.")
+    parser.add_argument("-d", "--depth_file", required=True,
+                        help="[REQUIRED] per base depth, chrom, position and depth separated by tabs (the output of GenomeCoverage.sh). - reads stdin")
+    parser.add_argument("-n", "--sample_name", required=True,
+                        help="[REQUIRED] name of the sample, the prefix of the output files")
+    parser.add_argument("-m", "--mode", choices=['rle', 'bins'], default='bins',
+                        help="rle writes runs of bases with the same depth, bins the mean, min and max depth of fixed size bins. Default bins")
+    parser.add_argument("-r", "--bin_size", type=int, default=100,
+                        help="number of bases in a bin in bins mode. Default 100")
+    parser.add_argument("--depth_resolution", type=int, default=1,
+                        help="in rle mode, round depths down to a multiple of this so that runs of similar depth are joined. Default 1, exact")
+    parser.add_argument("--chunk_bytes", type=int, default=1 << 24,
+                        help="about this many bytes of the depth file are read at a time, which bounds the memory used. Default 16777216")
+    parser.add_argument("-o", "--output_dir", default='.',
+                        help="directory to which to write the summary. Default the current directory")
+    parser.add_argument("--no_gzip", action='store_true',
+                        help="write the summary uncompressed")
+    parser.add_argument("--metrics_dir",
+                        help="directory to which to write the time and metrics of each stage as json lines, see utils/StageMetrics.py")
+    parser.add_argument("--prometheus_dir",
+                        help="directory to which to write the time and metrics of each stage as a prometheus textfile")
+
+    args = parser.parse_args(argv[1:])
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
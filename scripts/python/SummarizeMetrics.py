@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+    summarize the stage metrics of a run (the .jsonl files written by the Post* scripts with --metrics_dir, see
+    utils/StageMetrics.py) into the percentiles of each stage of each script
+    usage: SummarizeMetrics.py -d /path/to/run/metrics -o metrics_summary.csv
+    author: chase.mateusiak@gmail.com
+
+    output: a csv with a row per script and stage: script, stage, runs, failed, httpRequests, httpRetries and the
+            p50, p90, p99 and max of wallTime, cpuTime, bytesRead, payloadBytes and httpLatencyMean (the mean latency of
+            the requests of a run of the stage). The wall time percentiles are also printed
+"""
+
+# standard library imports
+import sys
+import os
+import csv
+import glob
+import json
+import argparse
+
+# third party imports
+import numpy as np
+
+def main(argv):
+
+    # parse cmd line arguments
+    args = parseArgs(argv)
+
+    ################################ set name variables ###################################
+    # the percentiles of each metric in the summary
+    percentiles = (50, 90, 99)
+    summary_metrics = ('wallTime', 'cpuTime', 'bytesRead', 'payloadBytes', 'httpLatencyMean')
+    #######################################################################################
+
+    metrics_file_list = sorted(glob.glob(os.path.join(args.metrics_dir, '*.jsonl')))
+    if not metrics_file_list:
+        sys.exit('SummarizeMetricsError: no .jsonl files in %s' % args.metrics_dir)
+    try:
+        stage_list = readStages(metrics_file_list)
+    except ValueError as e:
+        sys.exit(e)
+
+    summary_rows = summarizeStages(stage_list, summary_metrics, percentiles)
+
+    fieldnames = ['script', 'stage', 'runs', 'failed', 'httpRequests', 'httpRetries'] + \
+                 ['%s_%s' % (metric, statistic) for metric in summary_metrics
+                  for statistic in ['p%s' % percentile for percentile in percentiles] + ['max']]
+    with open(args.output_file, 'w', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=fieldnames, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(summary_rows)
+
+    print('%-34s%-16s%8s%8s%12s%12s%12s' % ('script', 'stage', 'runs', 'failed', 'wall p50', 'wall p90', 'wall max'))
+    for row in summary_rows:
+        print('%-34s%-16s%8s%8s%12.3f%12.3f%12.3f' % (row['script'], row['stage'], row['runs'], row['failed'],
+                                                       row['wallTime_p50'], row['wallTime_p90'], row['wallTime_max']))
+
+def readStages(metrics_file_list):
+    """
+        :params metrics_file_list: paths to .jsonl files of stage records
+        :throws: ValueError if a line is not json
+        :returns: a list of the stage dicts in all of the files
+    """
+    stage_list = []
+    for metrics_file_path in metrics_file_list:
+        with open(metrics_file_path, 'r') as metrics_file:
+            for line_number, line in enumerate(metrics_file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    stage_list.append(json.loads(line))
+                except ValueError:
+                    raise ValueError('MetricsFileError: line %s of %s is not json' % (line_number, metrics_file_path))
+    return stage_list
+
+def summarizeStages(stage_list, summary_metrics, percentiles):
+    """
+        group the stage records by script and stage and take the percentiles of each metric
+        :params stage_list: list of stage dicts
+        :params summary_metrics: names of the metrics to summarize. httpLatencyMean is httpLatencyTotal / httpRequests
+        :params percentiles: percentiles to take, eg (50, 90, 99). The max is always taken
+        :returns: a list of dicts, one per (script, stage) sorted by script and stage. A metric which no record of the
+                  stage has is None
+    """
+    group_dict = {}
+    for stage_record in stage_list:
+        if stage_record.get('httpRequests'):
+            stage_record = dict(stage_record, httpLatencyMean=stage_record['httpLatencyTotal'] / stage_record['httpRequests'])
+        group_dict.setdefault((stage_record['script'], stage_record['stage']), []).append(stage_record)
+
+    summary_rows = []
+    for (script, stage), group in sorted(group_dict.items()):
+        row = {'script': script, 'stage': stage, 'runs': len(group),
+               'failed': sum(1 for stage_record in group if stage_record.get('status') != 'ok'),
+               'httpRequests': sum(stage_record.get('httpRequests') or 0 for stage_record in group),
+               'httpRetries': sum(stage_record.get('httpRetries') or 0 for stage_record in group)}
+        for metric in summary_metrics:
+            values = np.asarray([stage_record[metric] for stage_record in group if stage_record.get(metric) is not None], dtype=float)
+            for percentile in percentiles:
+                row['%s_p%s' % (metric, percentile)] = float(np.percentile(values, percentile)) if values.size else None
+            row['%s_max' % metric] = float(values.max()) if values.size else None
+        summary_rows.append(row)
+
+    return summary_rows
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Summarize the stage metrics of a run into percentiles per stage.")
+    parser.add_argument("-d", "--metrics_dir", required=True,
+                        help="[REQUIRED] the --metrics_dir of the Post* scripts of a run")
+    parser.add_argument("-o", "--output_file", default='metrics_summary.csv',
+                        help="path to which to write the summary csv. Default metrics_summary.csv")
+
+    args = parser.parse_args(argv[1:])
+
+    return args
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from utils.AnnotationIndex import loadAnnotationIndex, readAnnotation
+
+GFF = ('##gff-version 3\n'
+       'chr1\tsrc\tregion\t1\t5000\t.\t+\t.\tID=chr1\n'
+       'chr1\tsrc\tgene\t100\t300\t.\t+\t.\tID=CNAG_NAT;Name=nat1\n'
+       'chr1\tsrc\tmRNA\t100\t300\t.\t+\t.\tID=CNAG_NAT-T1;Parent=CNAG_NAT\n'
+       'chr1\tsrc\texon\t100\t300\t.\t+\t.\tID=CNAG_NAT-T1.exon1;Parent=CNAG_NAT-T1\n'
+       'chr1\tsrc\tCDS\t100\t200\t.\t+\t0\tID=CNAG_NAT-T1.cds1;Parent=CNAG_NAT-T1\n'
+       'chr1\tsrc\tCDS\t150\t300\t.\t+\t0\tID=CNAG_NAT-T1.cds2;Parent=CNAG_NAT-T1\n'
+       'chr2\tsrc\tgene\t10\t80\t.\t-\t.\tID=CKF44_R0001\n'
+       'chr2\tsrc\ttRNA\t10\t80\t.\t-\t.\tID=CKF44_R0001-T1;Parent=CKF44_R0001\n'
+       'chr2\tsrc\texon\t10\t80\t.\t-\t.\tID=CKF44_R0001-T1.exon1;Parent=CKF44_R0001-T1\n')
+
+class Test_AnnotationIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.annotation_path = os.path.join(self.tmp_dir.name, 'annotation.gff')
+        with open(self.annotation_path, 'w') as annotation_file:
+            annotation_file.write(GFF)
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_readAnnotation(self):
+        gene_dict, chroms = readAnnotation(self.annotation_path)
+        self.assertEqual(sorted(gene_dict), ['CKF44_R0001', 'CNAG_NAT'])
+        self.assertEqual(chroms, ['chr1', 'chr2'])
+        self.assertEqual(gene_dict['CNAG_NAT']['biotype'], 'protein_coding')
+        self.assertEqual(gene_dict['CKF44_R0001']['biotype'], 'tRNA')
+        self.assertEqual(gene_dict['CKF44_R0001']['strand'], '-')
+
+    def test_loadAnnotationIndex(self):
+        annotation_index = loadAnnotationIndex(self.annotation_path, self.cache_dir)
+        self.assertEqual(annotation_index.regionLength('CNAG_NAT', 'CDS'), 201)
+        self.assertEqual(annotation_index.regionLength('nat1', 'CDS'), 201)
+        self.assertEqual(annotation_index.regionLength('CKF44_R0001', 'CDS'), 0)
+        self.assertEqual(annotation_index.intervals('CKF44_R0001', 'exon'), [('chr2', 9, 80)])
+        self.assertEqual(annotation_index.biotypes, ['tRNA', 'protein_coding'])
+        self.assertIsInstance(annotation_index.featureArrays('CDS')['lengths'], np.memmap)
+        with self.assertRaises(KeyError):
+            annotation_index.regionLength('CNAG_MISSING', 'CDS')
+
+        # the second load finds the same index rather than building another
+        self.assertEqual(loadAnnotationIndex(self.annotation_path, self.cache_dir).index_dir, annotation_index.index_dir)
+        self.assertEqual(len([name for name in os.listdir(self.cache_dir) if name != 'stat']), 1)
+
+if __name__ == '__main__':
+    unittest.main()
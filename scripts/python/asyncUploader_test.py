@@ -0,0 +1,70 @@
+import threading
+import time
+import unittest
+
+from utils.AsyncUploader import AsyncUploader, UploadJob
+from utils.DatabaseInteraction import DatabaseInteractionError
+
+class FakeResponse:
+    status_code = 201
+
+class FakeClient:
+    """ records the peak number of concurrent requests across all FakeClients. fails any url containing 'fail' """
+    lock = threading.Lock()
+    in_flight = 0
+    peak_in_flight = 0
+
+    def request(self, method, url, data):
+        with FakeClient.lock:
+            FakeClient.in_flight += 1
+            FakeClient.peak_in_flight = max(FakeClient.peak_in_flight, FakeClient.in_flight)
+        time.sleep(0.01)
+        with FakeClient.lock:
+            FakeClient.in_flight -= 1
+        if 'fail' in url:
+            raise DatabaseInteractionError('%s %s returned 400' % (method, url), 400)
+        if 'crash' in url:
+            raise RuntimeError('unexpected')
+        return FakeResponse()
+
+    def close(self):
+        pass
+
+class Test_AsyncUploader(unittest.TestCase):
+    def setUp(self):
+        FakeClient.in_flight = 0
+        FakeClient.peak_in_flight = 0
+
+    def test_uploadAll(self):
+        jobs = [UploadJob('http://host/api/Counts/', {'fastqFileNumber': str(i)}) for i in range(20)]
+        jobs[5] = UploadJob('http://host/api/fail/', {'fastqFileNumber': '5'})
+        reported = []
+
+        results = AsyncUploader(concurrency=4, client_factory=FakeClient, on_result=reported.append).uploadAll(jobs)
+
+        # results come back in job order, one per job, and each was reported
+        self.assertEqual([result.job for result in results], jobs)
+        self.assertEqual(len(reported), 20)
+        self.assertEqual([result.ok for result in results].count(False), 1)
+        self.assertFalse(results[5].ok)
+        self.assertEqual(results[5].status_code, 400)
+        self.assertLessEqual(FakeClient.peak_in_flight, 4)
+        self.assertGreater(FakeClient.peak_in_flight, 1)
+
+    def test_unexpected_error(self):
+        # an error other than DatabaseInteractionError fails its job only
+        jobs = [UploadJob('http://host/api/Counts/', {}), UploadJob('http://host/api/crash/', {}), UploadJob('http://host/api/Counts/', {})]
+        results = AsyncUploader(concurrency=2, client_factory=FakeClient).uploadAll(jobs)
+        self.assertEqual([result.ok for result in results], [True, False, True])
+        self.assertEqual((results[1].status_code, results[1].transient), (None, False))
+        self.assertIn('unexpected', results[1].error)
+
+    def test_rate_limit(self):
+        jobs = [('http://host/api/Counts/', {}) for _ in range(5)]
+        start = time.monotonic()
+        AsyncUploader(concurrency=5, requests_per_second=50, client_factory=FakeClient).uploadAll(jobs)
+        # 5 requests at 50 per second can not all start within 80ms
+        self.assertGreaterEqual(time.monotonic() - start, 0.08)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from utils.BiotypeMask import biotypeTotals, loadBiotypeMasks
+from annotationIndex_test import GFF
+
+class Test_BiotypeMask(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.annotation_path = os.path.join(self.tmp_dir.name, 'annotation.gff')
+        with open(self.annotation_path, 'w') as annotation_file:
+            annotation_file.write(GFF)
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_loadBiotypeMasks(self):
+        # CNAG_MISSING is not in the annotation, so it is in no mask. nat1 is an alias of CNAG_NAT
+        gene_ids = ['CKF44_R0001', 'CNAG_MISSING', 'nat1']
+        biotype_list, masks = loadBiotypeMasks(self.annotation_path, self.cache_dir, gene_ids)
+        self.assertEqual(biotype_list, ['protein_coding', 'tRNA'])
+        np.testing.assert_array_equal(masks, [[False, False, True], [True, False, False]])
+
+        # the second load reads the cached masks
+        index_dir = [name for name in os.listdir(self.cache_dir) if name != 'stat'][0]
+        self.assertEqual(len([name for name in os.listdir(os.path.join(self.cache_dir, index_dir)) if name.startswith('biotype_masks_')]), 1)
+        cached_biotype_list, cached_masks = loadBiotypeMasks(self.annotation_path, self.cache_dir, gene_ids)
+        self.assertEqual(cached_biotype_list, biotype_list)
+        np.testing.assert_array_equal(cached_masks, masks)
+
+        # without a cache the masks are the same
+        np.testing.assert_array_equal(loadBiotypeMasks(self.annotation_path, None, gene_ids)[1], masks)
+
+    def test_biotypeTotals(self):
+        masks = np.array([[False, False, True], [True, False, False]])
+        np.testing.assert_array_equal(biotypeTotals([[1, 2, 3], [10, 20, 30]], masks), [[3, 1], [30, 10]])
+        np.testing.assert_array_equal(biotypeTotals([1, 2, 3], masks), [3, 1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils.CountMatrixStore import CountMatrixStore
+
+GENE_IDS = ['CKF44_00001', 'CKF44_00002', 'CNAG_NAT']
+
+def appendSample(store_dir, sample_number):
+    CountMatrixStore(store_dir).append('sample_%s' % sample_number, GENE_IDS, [sample_number, 0, 2 * sample_number])
+
+class Test_CountMatrixStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store_dir = os.path.join(self.tmp_dir.name, 'count_matrix')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_append_read(self):
+        store = CountMatrixStore(self.store_dir)
+        store.append('sample_1', GENE_IDS, [10, 0, 7])
+        store.appendSamples(['sample_2', 'sample_3'], GENE_IDS, [[1, 2], [3, 4], [5, 6]])
+        self.assertEqual(store.sample_names, ['sample_1', 'sample_2', 'sample_3'])
+        self.assertEqual(store.gene_ids, GENE_IDS)
+
+        sample_names, gene_ids, count_matrix = store.read()
+        np.testing.assert_array_equal(count_matrix, [[10, 1, 2], [0, 3, 4], [7, 5, 6]])
+        self.assertEqual(count_matrix.dtype, np.uint32)
+
+        # a subset, in the order requested
+        sample_names, gene_ids, count_matrix = store.read(samples=['sample_3', 'sample_1'], genes=['CNAG_NAT', 'CKF44_00001'])
+        self.assertEqual((sample_names, gene_ids), (['sample_3', 'sample_1'], ['CNAG_NAT', 'CKF44_00001']))
+        np.testing.assert_array_equal(count_matrix, [[6, 7], [2, 10]])
+
+        with self.assertRaises(KeyError):
+            store.read(samples=['sample_4'])
+        with self.assertRaises(ValueError):
+            store.append('sample_4', ['CKF44_00001'], [1])
+        with self.assertRaises(ValueError):
+            store.append('sample_4', GENE_IDS, [-1, 0, 0])
+
+    def test_replace_compact(self):
+        store = CountMatrixStore(self.store_dir)
+        store.append('sample_1', GENE_IDS, [10, 0, 7])
+        store.append('sample_2', GENE_IDS, [1, 1, 1])
+        store.append('sample_1', GENE_IDS, [11, 0, 8])
+        self.assertEqual(store.sample_names, ['sample_2', 'sample_1'])
+        np.testing.assert_array_equal(store.read(samples=['sample_1'])[2], [[11], [0], [8]])
+
+        # two gene rows at a time, so the new chunk is written in two blocks
+        self.assertEqual(store.compact(block_rows=2), 3)
+        np.testing.assert_array_equal(store.read()[2], [[1, 11], [1, 0], [1, 8]])
+        self.assertEqual(store.compact(), 0)
+        # the old chunks are kept for readers which listed them, until they are old enough to remove
+        self.assertEqual(len(os.listdir(store.chunk_dir)), 4)
+        self.assertEqual(store.removeRetiredChunks(), 0)
+        self.assertEqual(store.removeRetiredChunks(retired_chunk_age=0), 3)
+        self.assertEqual(len(os.listdir(store.chunk_dir)), 1)
+        np.testing.assert_array_equal(store.read()[2], [[1, 11], [1, 0], [1, 8]])
+
+    def test_concurrent_append(self):
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            list(executor.map(appendSample, [self.store_dir] * 16, range(16)))
+        store = CountMatrixStore(self.store_dir)
+        self.assertEqual(sorted(store.sample_names), sorted('sample_%s' % i for i in range(16)))
+        sample_names, _, count_matrix = store.read(samples=['sample_%s' % i for i in range(16)])
+        np.testing.assert_array_equal(count_matrix[0], np.arange(16))
+        np.testing.assert_array_equal(count_matrix[2], 2 * np.arange(16))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+from NormalizeCounts import main
+from utils.AnnotationIndex import loadAnnotationIndex
+from utils.CountMatrixStore import CountMatrixStore
+from utils.CountNormalization import geneLengths, normalizeCountMatrix, readNormalized
+from utils.SyntheticData import syntheticGeneIds, writeSyntheticAnnotation
+
+def edgeRCpm(count_matrix, log=False, prior_count=2):
+    """
+        edgeR::cpm.default(y, log=log, prior.count=prior_count) over the whole matrix, line for line
+    """
+    y = count_matrix.astype(np.float64)
+    lib_size = y.sum(axis=0)
+    if log:
+        prior_count_scaled = lib_size / lib_size.mean() * prior_count
+        lib_size = lib_size + 2 * prior_count_scaled
+        return np.log2((y + prior_count_scaled) / (1e-6 * lib_size))
+    return y / (1e-6 * lib_size)
+
+class Test_CountNormalization(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.store = CountMatrixStore(os.path.join(self.tmp_dir.name, 'count_matrix'))
+
+    def test_edger_values(self):
+        # edgeR::cpm(matrix(c(0, 10, 90, 5, 5, 0), 3), log=TRUE) and the same without log
+        self.store.appendSamples(['sample_1', 'sample_2'], ['gene_1', 'gene_2', 'gene_3'], [[0, 5], [10, 5], [90, 0]])
+        output_dir = os.path.join(self.tmp_dir.name, 'normalized')
+        manifest = normalizeCountMatrix(self.store, output_dir, gene_lengths=[1000, 2000, 500])
+        self.assertEqual(manifest['libSizes'], [100.0, 10.0])
+
+        sample_names, gene_ids, cpm = readNormalized(output_dir, 'cpm')
+        self.assertEqual((sample_names, gene_ids), (['sample_1', 'sample_2'], ['gene_1', 'gene_2', 'gene_3']))
+        np.testing.assert_allclose(cpm, [[0, 500000], [100000, 500000], [900000, 0]], rtol=1e-6)
+        # the prior counts are 2 * 100 / 55 and 2 * 10 / 55, eg log2((0 + 3.6364) / (100 + 7.2727) * 1e6) = 15.0489
+        np.testing.assert_allclose(readNormalized(output_dir, 'log2cpm')[2],
+                                   [[15.048926, 18.931569], [16.955816, 18.931569], [19.735426, 15.048926]], rtol=1e-6)
+        # rates per kb: sample_1 0, 5, 180 of 185; sample_2 5, 2.5, 0 of 7.5
+        np.testing.assert_allclose(readNormalized(output_dir, 'tpm')[2],
+                                   [[0, 666666.7], [27027.03, 333333.3], [972973.0, 0]], rtol=1e-6)
+
+    def test_blockwise(self):
+        # many chunks and blocks smaller than the matrix give the same result as the whole matrix at once
+        gene_ids = syntheticGeneIds(103)
+        rng = np.random.default_rng(1)
+        count_matrix = rng.negative_binomial(2, 0.01, size=(len(gene_ids), 7)).astype(np.uint32)
+        count_matrix[5] = 0
+        self.store.appendSamples(['sample_%s' % column for column in range(4)], gene_ids, count_matrix[:, :4])
+        for column in range(4, 7):
+            self.store.append('sample_%s' % column, gene_ids, count_matrix[:, column])
+
+        annotation_path = os.path.join(self.tmp_dir.name, 'annotation.gff')
+        writeSyntheticAnnotation(annotation_path, gene_ids)
+        gene_lengths = geneLengths(loadAnnotationIndex(annotation_path, os.path.join(self.tmp_dir.name, 'cache')), gene_ids)
+
+        output_dir = os.path.join(self.tmp_dir.name, 'normalized')
+        normalizeCountMatrix(self.store, output_dir, gene_lengths=gene_lengths, block_rows=10)
+        np.testing.assert_allclose(readNormalized(output_dir, 'cpm')[2], edgeRCpm(count_matrix), rtol=1e-6)
+        np.testing.assert_allclose(readNormalized(output_dir, 'log2cpm')[2], edgeRCpm(count_matrix, log=True), rtol=1e-6)
+        rate = count_matrix / gene_lengths.reshape(-1, 1)
+        np.testing.assert_allclose(readNormalized(output_dir, 'tpm')[2], rate / rate.sum(axis=0) * 1e6, rtol=1e-6, atol=1e-6)
+
+        # a subset of samples is normalized by its own library sizes
+        normalizeCountMatrix(self.store, output_dir, prior_count=0.5, samples=['sample_6', 'sample_1'], block_rows=16)
+        sample_names, _, log2_cpm = readNormalized(output_dir, 'log2cpm')
+        self.assertEqual(sample_names, ['sample_6', 'sample_1'])
+        np.testing.assert_allclose(log2_cpm, edgeRCpm(count_matrix[:, [6, 1]], log=True, prior_count=0.5), rtol=1e-6)
+        with self.assertRaises(KeyError):
+            readNormalized(output_dir, 'tpm')
+
+        with self.assertRaises(ValueError):
+            geneLengths(loadAnnotationIndex(annotation_path, os.path.join(self.tmp_dir.name, 'cache')), gene_ids + ['CNAG_00000'])
+
+    def test_script(self):
+        gene_ids = syntheticGeneIds(20)
+        py_rng = random.Random(2)
+        self.store.appendSamples(['sample_1', 'sample_2'], gene_ids, [[py_rng.randrange(100) for _ in range(2)] for _ in gene_ids])
+        main(['NormalizeCounts.py', '-d', self.store.store_dir, '--block_rows', '3'])
+        sample_names, gene_ids_read, log2_cpm = readNormalized(os.path.join(self.store.store_dir, 'normalized'), 'log2cpm')
+        self.assertEqual((sample_names, gene_ids_read), (['sample_1', 'sample_2'], gene_ids))
+        np.testing.assert_allclose(log2_cpm, edgeRCpm(self.store.read()[2], log=True), rtol=1e-6)
+
+        with self.assertRaises(SystemExit):
+            main(['NormalizeCounts.py', '-d', os.path.join(self.tmp_dir.name, 'missing')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import gzip
+import io
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from SummarizeGenomeCoverage import main
+from utils.CoverageSummary import BinWriter, RleWriter, readDepthChunks, summarizeDepth
+
+def depthLines(rng):
+    # two chromosomes of long runs, with a gap of unreported positions in the first
+    lines = []
+    for chrom, length in (('chr1', 700), ('chr2', 350)):
+        depth = 0
+        for position in range(1, length + 1):
+            if chrom == 'chr1' and 300 < position <= 320:
+                continue
+            if rng.random() < 0.05:
+                depth = rng.randint(0, 40)
+            lines.append((chrom, position, depth))
+    return lines
+
+def depthFile(lines):
+    return io.BytesIO(''.join('%s\t%s\t%s\n' % line for line in lines).encode('utf-8'))
+
+def naiveRle(lines):
+    runs = []
+    for chrom, position, depth in lines:
+        if runs and runs[-1][0] == chrom and runs[-1][2] == position - 1 and runs[-1][3] == depth:
+            runs[-1][2] = position
+        else:
+            runs.append([chrom, position - 1, position, depth])
+    return ['%s\t%s\t%s\t%s' % tuple(run) for run in runs]
+
+def naiveBins(lines, bin_size):
+    bin_dict = {}
+    for chrom, position, depth in lines:
+        bin_dict.setdefault((chrom, (position - 1) // bin_size), []).append(depth)
+    return ['%s\t%s\t%s\t%.4g\t%s\t%s' % (chrom, bin_number * bin_size, (bin_number + 1) * bin_size,
+                                          sum(depths) / len(depths), min(depths), max(depths))
+            for (chrom, bin_number), depths in bin_dict.items()]
+
+class Test_CoverageSummary(unittest.TestCase):
+    def setUp(self):
+        self.lines = depthLines(random.Random(1))
+
+    def summarize(self, writer_class, chunk_bytes, *args):
+        output_file = io.StringIO()
+        genome_stats = summarizeDepth(depthFile(self.lines), writer_class(output_file, *args), chunk_bytes)
+        return output_file.getvalue().splitlines(), genome_stats
+
+    def test_rle_across_chunks(self):
+        expected = naiveRle(self.lines)
+        # chunk boundaries fall inside runs, at the gap and at the change of chromosome
+        for chunk_bytes in (1, 7, 64, 100000):
+            intervals, genome_stats = self.summarize(RleWriter, chunk_bytes)
+            self.assertEqual(intervals, expected)
+            self.assertEqual(genome_stats['intervals'], len(expected))
+
+    def test_bins_across_chunks(self):
+        for bin_size in (1, 50, 333):
+            expected = naiveBins(self.lines, bin_size)
+            for chunk_bytes in (1, 33, 100000):
+                self.assertEqual(self.summarize(BinWriter, chunk_bytes, bin_size)[0], expected)
+
+    def test_depth_resolution(self):
+        intervals, _ = self.summarize(RleWriter, 13, 10)
+        self.assertEqual(intervals, naiveRle([(chrom, position, depth // 10 * 10) for chrom, position, depth in self.lines]))
+
+    def test_genome_stats(self):
+        _, genome_stats = self.summarize(BinWriter, 100, 100)
+        depths = [depth for _, _, depth in self.lines]
+        self.assertEqual(genome_stats['bases'], len(depths))
+        self.assertAlmostEqual(genome_stats['meanDepth'], sum(depths) / len(depths))
+        self.assertEqual(genome_stats['maxDepth'], max(depths))
+        self.assertAlmostEqual(genome_stats['fractionCovered10'], sum(depth >= 10 for depth in depths) / len(depths))
+
+    def test_blank_lines(self):
+        # a depth file which ends in a blank line, read in any chunk size, reads the same as one which does not
+        for chunk_bytes in (1, 7, 100000):
+            bases = [(chrom, position, depth) for chrom, positions, depths in
+                     readDepthChunks(io.BytesIO(b'chr1\t1\t5\nchr1\t2\t6\n\n'), chunk_bytes)
+                     for position, depth in zip(positions.tolist(), depths.tolist())]
+            self.assertEqual(bases, [('chr1', 1, 5), ('chr1', 2, 6)])
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            list(readDepthChunks(io.BytesIO(b'chr1\t1\t5\nchr1\t2\n')))
+        with self.assertRaises(ValueError):
+            list(readDepthChunks(io.BytesIO(b'chr1\t1\tfive\n')))
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            depth_path = os.path.join(tmp_dir, 'sample_coverage.bed')
+            with open(depth_path, 'wb') as depth_file:
+                depth_file.write(depthFile(self.lines).getvalue())
+            main(['SummarizeGenomeCoverage.py', '-d', depth_path, '-n', 'sample', '-m', 'rle', '--chunk_bytes', '500', '-o', tmp_dir])
+            with gzip.open(os.path.join(tmp_dir, 'sample_coverage_rle.bedgraph.gz'), 'rt') as summary_file:
+                self.assertEqual(summary_file.read().splitlines(), naiveRle(self.lines))
+            with open(os.path.join(tmp_dir, 'sample_coverage_summary.json'), 'r') as genome_stats_file:
+                self.assertEqual(json.load(genome_stats_file)['bases'], len(self.lines))
+
+if __name__ == '__main__':
+    unittest.main()
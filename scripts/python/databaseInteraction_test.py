@@ -0,0 +1,92 @@
+import unittest
+
+import requests
+
+from utils.DatabaseInteraction import DatabaseClient, DatabaseInteractionError
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.reason = 'reason %s' % status_code
+        self.text = ''
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.reason)
+
+class FakeSession:
+    """ returns the queued responses (or raises the queued exceptions) in order and records each request """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def close(self):
+        pass
+
+    def request(self, method, url, data=None, **kwargs):
+        self.requests.append((method, url, kwargs.get('timeout')))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+class Test_DatabaseClient(unittest.TestCase):
+    def client(self, responses, **kwargs):
+        session = FakeSession(responses)
+        client = DatabaseClient(session=session, **kwargs)
+        client.sleeps = []
+        client._sleep = client.sleeps.append
+        return client, session
+
+    def test_retry_then_success(self):
+        client, session = self.client([requests.ConnectionError('refused'), FakeResponse(503), FakeResponse(201)],
+                                      backoff_factor=1, backoff_max=1.5)
+        response = client.post('http://host/api/Counts/', {'fastqFileNumber': '1'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(session.requests), 3)
+        # backoff doubles and is capped at backoff_max
+        self.assertEqual(client.sleeps, [1, 1.5])
+        self.assertEqual(session.requests[0][2], client.timeout)
+
+    def test_retries_exhausted(self):
+        client, session = self.client([FakeResponse(500)] * 3, max_retries=2)
+        with self.assertRaises(DatabaseInteractionError) as context:
+            client.post('http://host/api/Counts/', {})
+        self.assertEqual(context.exception.status_code, 500)
+        self.assertEqual(len(session.requests), 3)
+
+    def test_client_error_not_retried(self):
+        client, session = self.client([FakeResponse(404)])
+        with self.assertRaises(DatabaseInteractionError) as context:
+            client.post('http://host/api/Counts/', {})
+        self.assertEqual(context.exception.status_code, 404)
+        self.assertEqual(len(session.requests), 1)
+
+    def test_request_errors_not_retried(self):
+        # an invalid url fails at once, wrapped so that callers need only catch DatabaseInteractionError
+        client, session = self.client([requests.exceptions.MissingSchema('no scheme')])
+        with self.assertRaises(DatabaseInteractionError) as context:
+            client.post('http//host/api/Counts/', {})
+        self.assertFalse(context.exception.transient)
+        self.assertEqual(len(session.requests), 1)
+
+        # a post which timed out may have created the record, so it is not retried, now or later. A put is
+        client, session = self.client([requests.ReadTimeout('read timed out')])
+        with self.assertRaises(DatabaseInteractionError) as context:
+            client.post('http://host/api/Counts/', {})
+        self.assertFalse(context.exception.transient)
+        self.assertEqual(len(session.requests), 1)
+        client, session = self.client([requests.ReadTimeout('read timed out'), FakeResponse(200)])
+        self.assertEqual(client.put('http://host/api/QualityAssess/7/', {}).status_code, 200)
+
+    def test_postOrPut(self):
+        client, session = self.client([FakeResponse(400), FakeResponse(200)])
+        client.postOrPut('http://host/api/QualityAssess/', 7, {})
+        self.assertEqual([(method, url) for method, url, _ in session.requests],
+                         [('POST', 'http://host/api/QualityAssess/'), ('PUT', 'http://host/api/QualityAssess/7/')])
+
+if __name__ == '__main__':
+    unittest.main()
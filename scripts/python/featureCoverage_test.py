@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+
+import pysam
+
+from utils.FeatureCoverage import calculateFeatureCoverage, calculateRegionCoverage, mergeIntervals, readFeatureIntervals, readRegionIntervals
+
+# CNAG_NAT has two overlapping CDS (100-200 and 150-300, 1 based) and CNAG_NAT2 would match CNAG_NAT with grep
+GFF = ('##gff-version 3\n'
+       'chr1\tsrc\tgene\t100\t300\t.\t+\t.\tID=CNAG_NAT\n'
+       'chr1\tsrc\tmRNA\t100\t300\t.\t+\t.\tID=CNAG_NAT-T1;Parent=CNAG_NAT\n'
+       'chr1\tsrc\tCDS\t100\t200\t.\t+\t0\tID=CNAG_NAT-T1.cds1;Parent=CNAG_NAT-T1\n'
+       'chr1\tsrc\tCDS\t150\t300\t.\t+\t0\tID=CNAG_NAT-T1.cds2;Parent=CNAG_NAT-T1\n'
+       'chr1\tsrc\tgene\t1000\t1099\t.\t-\t.\tID=CNAG_NAT2\n'
+       'chr1\tsrc\tCDS\t1000\t1099\t.\t-\t0\tID=CNAG_NAT2-T1.cds;Parent=CNAG_NAT2\n'
+       'chr2\tsrc\tCDS\t1\t100\t.\t+\t0\tgene_id "CNAG_G418"; transcript_id "CNAG_G418-T1";\n')
+
+def writeBam(bam_path, reads):
+    """ reads are (chrom index, 0 based start, length, mapq, flag) """
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'chr1', 'LN': 5000}, {'SN': 'chr2', 'LN': 5000}]}
+    with pysam.AlignmentFile(bam_path, 'wb', header=header) as bam_file:
+        for index, (reference_id, start, length, mapq, flag) in enumerate(sorted(reads)):
+            read = pysam.AlignedSegment()
+            read.query_name = 'read%s' % index
+            read.query_sequence = 'A' * length
+            read.flag = flag
+            read.reference_id = reference_id
+            read.reference_start = start
+            read.mapping_quality = mapq
+            read.cigartuples = [(0, length)]
+            read.query_qualities = pysam.qualitystring_to_array('I' * length)
+            bam_file.write(read)
+    pysam.index(bam_path)
+
+class Test_FeatureCoverage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.annotation_path = os.path.join(self.tmp_dir.name, 'annotation.gff')
+        with open(self.annotation_path, 'w') as annotation_file:
+            annotation_file.write(GFF)
+        self.bam_path = os.path.join(self.tmp_dir.name, 'sample.bam')
+        writeBam(self.bam_path, [(0, 99, 50, 60, 0),      # covers 50 of the 201 NAT bases
+                                 (0, 199, 50, 5, 0),      # mapq below 10, not counted
+                                 (0, 249, 50, 60, 1024),  # duplicate, not counted
+                                 (0, 999, 100, 60, 16),   # all of CNAG_NAT2
+                                 (1, 0, 25, 60, 0)])      # 25 of the 100 G418 bases
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_mergeIntervals(self):
+        self.assertEqual(mergeIntervals([('chr1', 10, 20), ('chr1', 0, 10), ('chr2', 5, 6), ('chr1', 30, 40)]),
+                         [('chr1', 0, 20), ('chr1', 30, 40), ('chr2', 5, 6)])
+
+    def test_readFeatureIntervals(self):
+        interval_dict = readFeatureIntervals(self.annotation_path, 'CDS', ['CNAG_NAT', 'CNAG_G418', 'CNAG_MISSING'])
+        self.assertEqual(interval_dict, {'CNAG_NAT': [('chr1', 99, 300)], 'CNAG_G418': [('chr2', 0, 100)], 'CNAG_MISSING': []})
+
+    def test_readRegionIntervals(self):
+        region_dict = readRegionIntervals(self.annotation_path, [('CNAG_NAT', 'CDS'), ('CNAG_NAT', 'mRNA'), ('CNAG_G418', 'mRNA')])
+        self.assertEqual(region_dict, {('CNAG_NAT', 'CDS'): [('chr1', 99, 300)], ('CNAG_NAT', 'mRNA'): [('chr1', 99, 300)],
+                                       ('CNAG_G418', 'mRNA'): []})
+
+    def test_calculateRegionCoverage(self):
+        regions = [('CNAG_NAT', 'CDS'), ('CNAG_NAT2', 'gene'), ('CNAG_G418', 'CDS')]
+        coverage_dict = calculateRegionCoverage(regions, self.annotation_path, self.bam_path)
+        self.assertEqual(set(coverage_dict), set(regions))
+        self.assertAlmostEqual(coverage_dict[('CNAG_NAT', 'CDS')], 50 / 201.0)
+        self.assertAlmostEqual(coverage_dict[('CNAG_NAT2', 'gene')], 1.0)
+        self.assertAlmostEqual(coverage_dict[('CNAG_G418', 'CDS')], 0.25)
+        self.assertEqual(calculateRegionCoverage(regions, self.annotation_path, self.bam_path,
+                                                 annotation_cache_dir=os.path.join(self.tmp_dir.name, 'cache')), coverage_dict)
+
+    def test_calculateFeatureCoverage(self):
+        coverage_dict = calculateFeatureCoverage('CDS', ['CNAG_NAT', 'CNAG_G418', 'CNAG_NAT2'], self.annotation_path, self.bam_path)
+        self.assertAlmostEqual(coverage_dict['CNAG_NAT'], 50 / 201.0)
+        self.assertAlmostEqual(coverage_dict['CNAG_G418'], 0.25)
+        self.assertAlmostEqual(coverage_dict['CNAG_NAT2'], 1.0)
+
+        # the same, with the intervals looked up in a cached annotation index
+        coverage_dict = calculateFeatureCoverage('CDS', ['CNAG_NAT', 'CNAG_NAT2'], self.annotation_path, self.bam_path,
+                                                 annotation_cache_dir=os.path.join(self.tmp_dir.name, 'cache'))
+        self.assertAlmostEqual(coverage_dict['CNAG_NAT'], 50 / 201.0)
+        self.assertAlmostEqual(coverage_dict['CNAG_NAT2'], 1.0)
+
+        # the mapq threshold and a region size passed directly
+        coverage_dict = calculateFeatureCoverage('CDS', ['CNAG_NAT'], self.annotation_path, self.bam_path,
+                                                 {'CNAG_NAT': 400}, min_mapq=0)
+        self.assertAlmostEqual(coverage_dict['CNAG_NAT'], 100 / 400.0)
+
+        with self.assertRaises(ValueError):
+            calculateFeatureCoverage('CDS', ['CNAG_MISSING'], self.annotation_path, self.bam_path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import io
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+import pysam
+
+from featureCoverage_test import writeBam
+from GeneCoverageQc import main
+from utils.AnnotationIndex import loadAnnotationIndex
+from utils.CoverageSummary import readDepthChunks
+from utils.FeatureCoverage import windowDepth
+from utils.GeneCoverage import bamDepthChunks, geneCoverage, geneCoverageMetrics
+
+# a two exon gene, a gene on the minus strand, a gene with no reads and a gene with no exons
+GFF = ('##gff-version 3\n'
+       'chr1\tsrc\tgene\t101\t1400\t.\t+\t.\tID=CKF44_00001\n'
+       'chr1\tsrc\tmRNA\t101\t1400\t.\t+\t.\tID=CKF44_00001-T1;Parent=CKF44_00001\n'
+       'chr1\tsrc\texon\t101\t600\t.\t+\t.\tID=CKF44_00001-T1.exon1;Parent=CKF44_00001-T1\n'
+       'chr1\tsrc\texon\t901\t1400\t.\t+\t.\tID=CKF44_00001-T1.exon2;Parent=CKF44_00001-T1\n'
+       'chr1\tsrc\tgene\t1201\t2200\t.\t-\t.\tID=CKF44_00002\n'
+       'chr1\tsrc\texon\t1201\t2200\t.\t-\t.\tID=CKF44_00002-T1.exon1;Parent=CKF44_00002\n'
+       'chr1\tsrc\tgene\t4001\t4500\t.\t+\t.\tID=CKF44_00003\n'
+       'chr1\tsrc\texon\t4001\t4500\t.\t+\t.\tID=CKF44_00003-T1.exon1;Parent=CKF44_00003\n'
+       'chr2\tsrc\tgene\t201\t1000\t.\t-\t.\tID=CKF44_00004\n'
+       'chr2\tsrc\texon\t201\t1000\t.\t-\t.\tID=CKF44_00004-T1.exon1;Parent=CKF44_00004\n'
+       'chr2\tsrc\tgene\t3001\t3100\t.\t+\t.\tID=CKF44_00005\n')
+
+class Test_GeneCoverage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.annotation_path = self.path('annotation.gff')
+        with open(self.annotation_path, 'w') as annotation_file:
+            annotation_file.write(GFF)
+        self.annotation_index = loadAnnotationIndex(self.annotation_path, self.path('cache'))
+
+        # reads pile up towards the 3' end of CKF44_00001 and are spread over chr2
+        rng = random.Random(1)
+        reads = [(0, rng.randint(100 + position // 3, 1300), 75, 60, 0) for position in range(600)]
+        reads += [(1, rng.randint(0, 4000), 75, 60, 0) for _ in range(300)]
+        self.bam_path = self.path('sample.bam')
+        writeBam(self.bam_path, reads)
+        self.depth_dict = {}
+        with pysam.AlignmentFile(self.bam_path, 'rb') as bam_file:
+            for chrom in ('chr1', 'chr2'):
+                self.depth_dict[chrom] = windowDepth(bam_file, chrom, 0, 5000, 10)
+        self.depth_bytes = ''.join('%s\t%s\t%s\n' % (chrom, position + 1, depth) for chrom, depths in self.depth_dict.items()
+                                   for position, depth in enumerate(depths.tolist())).encode('utf-8')
+
+    def path(self, file_name):
+        return os.path.join(self.tmp_dir.name, file_name)
+
+    def naiveMetrics(self, gene_id):
+        gene_depth = np.concatenate([self.depth_dict[chrom][start:end] for chrom, start, end in self.annotation_index.intervals(gene_id, 'exon')])
+        if self.annotation_index.strands[self.annotation_index.genePosition(gene_id)] == '-':
+            gene_depth = gene_depth[::-1]
+        return geneCoverageMetrics(gene_depth)[0]
+
+    def assertMatchesNaive(self, gene_rows):
+        self.assertEqual([row['geneId'] for row in gene_rows], ['CKF44_00001', 'CKF44_00002', 'CKF44_00003', 'CKF44_00004'])
+        for row in gene_rows:
+            for metric, value in self.naiveMetrics(row['geneId']).items():
+                self.assertEqual(row[metric], value, '%s %s' % (row['geneId'], metric))
+
+    def test_depth_file_across_chunks(self):
+        # chunk boundaries fall inside exons, between the exons of a gene and inside genes which overlap
+        for chunk_bytes in (1000, 7777, 1 << 20):
+            gene_rows, gene_body_profile = geneCoverage(self.annotation_index, 'exon', readDepthChunks(io.BytesIO(self.depth_bytes), chunk_bytes))
+            self.assertMatchesNaive(gene_rows)
+        self.assertEqual(len(gene_body_profile), 100)
+
+    def test_bam(self):
+        gene_rows, _ = geneCoverage(self.annotation_index, 'exon', bamDepthChunks(self.bam_path, self.annotation_index, 'exon', window_size=333))
+        self.assertMatchesNaive(gene_rows)
+        row_dict = {row['geneId']: row for row in gene_rows}
+        self.assertGreater(row_dict['CKF44_00001']['threePrimeBias'], 1)
+        self.assertEqual(row_dict['CKF44_00003']['fractionCovered'], 0)
+        self.assertIsNone(row_dict['CKF44_00003']['threePrimeBias'])
+
+    def test_main(self):
+        with open(self.path('sample_coverage.bed'), 'wb') as depth_file:
+            depth_file.write(self.depth_bytes)
+        main(['GeneCoverageQc.py', '-d', self.path('sample_coverage.bed'), '-a', self.annotation_path, '-n', 'sample', '-o', self.tmp_dir.name])
+        with open(self.path('sample_gene_coverage.tsv'), 'r') as gene_coverage_file:
+            lines = gene_coverage_file.read().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[3].startswith('CKF44_00003\t+\t'))
+        self.assertTrue(lines[3].endswith('\tNA'))
+        with open(self.path('sample_gene_coverage_summary.json'), 'r') as summary_file:
+            summary = json.load(summary_file)
+        self.assertEqual((summary['genes'], summary['genesCovered']), (4, 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import time
+import unittest
+
+from utils.CountPayload import geneIndexId
+from utils.GeneIndexCache import GeneIndexCache, parseAttributes, readCountVector, readGeneIds, writeCountVector
+
+GTF = ('#comment\n'
+       'chr1\tsrc\tgene\t1\t100\t.\t+\t.\tgene_id "CKF44_00002";\n'
+       'chr1\tsrc\texon\t1\t50\t.\t+\t.\tgene_id "CKF44_00002"; transcript_id "CKF44_00002-t1"; gene "CKF44_00002";\n'
+       'chr1\tsrc\texon\t60\t100\t.\t+\t.\tgene_id "CKF44_00002"; transcript_id "CKF44_00002-t1"; gene "CKF44_00002";\n'
+       'chr2\tsrc\texon\t1\t50\t.\t-\t.\tgene_id "CKF44_00001"; transcript_id "CKF44_00001-t1"; gene "CKF44_00001";\n')
+
+class Test_GeneIndexCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        self.annotation_path = self.writeAnnotation('annotation.gtf', GTF)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def writeAnnotation(self, file_name, text):
+        annotation_path = os.path.join(self.tmp_dir.name, file_name)
+        with open(annotation_path, 'w') as annotation_file:
+            annotation_file.write(text)
+        return annotation_path
+
+    def test_parseAttributes(self):
+        self.assertEqual(parseAttributes('gene_id "A"; note "x=y";'), {'gene_id': 'A', 'note': 'x=y'})
+        self.assertEqual(parseAttributes('ID=A-T1;Parent=A;Name=a%3Bb'), {'ID': 'A-T1', 'Parent': 'A', 'Name': 'a;b'})
+
+    def test_getOrCreate(self):
+        cache = GeneIndexCache(self.cache_dir)
+        manifest = cache.getOrCreate(self.annotation_path)
+        self.assertEqual(manifest['geneIds'], readGeneIds(self.annotation_path))
+        self.assertEqual(manifest['geneIds'], ['CKF44_00001', 'CKF44_00002'])
+        self.assertEqual(manifest['geneIndex'], geneIndexId(['CKF44_00001', 'CKF44_00002']))
+
+        # a copy of the annotation at another path is found by its content hash
+        copy_path = self.writeAnnotation('copy.gtf', GTF)
+        self.assertEqual(GeneIndexCache(self.cache_dir).getOrCreate(copy_path), manifest)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, 'manifests'))), 1)
+
+    def test_evict(self):
+        cache = GeneIndexCache(self.cache_dir, max_entries=2)
+        manifests = []
+        for i in range(3):
+            annotation_path = self.writeAnnotation('annotation_%s.gtf' % i, GTF.replace('CKF44_00001', 'CKF44_1000%s' % i))
+            manifests.append(cache.getOrCreate(annotation_path))
+            # make sure the modification times differ
+            time.sleep(0.01)
+        self.assertIsNone(cache.getManifest(manifests[0]['geneIndex']))
+        self.assertIsNotNone(cache.getManifest(manifests[2]['geneIndex']))
+
+    def test_count_vector(self):
+        cache = GeneIndexCache(self.cache_dir)
+        manifest = cache.getOrCreate(self.annotation_path)
+        count_vector_path = os.path.join(self.tmp_dir.name, 'sample_counts.json')
+        writeCountVector(count_vector_path, 'sample', manifest['geneIndex'], [3, 4])
+        self.assertEqual(readCountVector(count_vector_path, cache), ('sample', ['CKF44_00001', 'CKF44_00002'], [3, 4]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import json
+import os
+import tempfile
+import unittest
+
+import pysam
+
+from geneCoverage_test import GFF
+from HtseqAnnotationQc import main
+from utils.AnnotationIndex import loadAnnotationIndex
+from utils.HtseqAnnotation import analyzeAnnotatedBam, geneTallyRows, inferStrandedness, strandednessQc
+
+# (chrom index, 0 based start, flag, mapq, XF tag) of a reverse stranded library against GFF
+READS = [(0, 150, 16, 60, 'CKF44_00001'),
+         (0, 300, 16, 60, 'CKF44_00001'),
+         (0, 500, 0, 60, '__no_feature'),                               # sense, so htseq -s reverse did not count it
+         (0, 950, 16, 60, 'CKF44_00001'),                               # crosses the first chunk boundary
+         (0, 1300, 16, 60, '__ambiguous[CKF44_00001+CKF44_00002]'),     # in both genes, no strand
+         (0, 1800, 0, 60, 'CKF44_00002'),
+         (0, 2100, 0, 5, '__too_low_aQual'),
+         (0, 3000, 0, 60, '__no_feature'),                              # intergenic, no strand
+         (0, 4200, 16, 60, 'CKF44_00003'),
+         (0, 4200, 16 | 256, 60, '__alignment_not_unique'),             # secondary, not counted
+         (0, 4300, 16 | 1 | 64, 60, 'CKF44_00003'),                     # first of a pair
+         (0, 4400, 1 | 128, 60, 'CKF44_00003'),                         # second of the pair, not counted
+         (1, 500, 0, 60, 'CKF44_00004'),
+         (1, 600, 1024, 60, 'CKF44_00004'),                             # duplicate, counted but no strand
+         (1, 4000, 0, 60, None),                                        # no XF tag
+         (-1, -1, 4, 0, '__not_aligned')]
+
+def writeAnnotatedBam(bam_path, reads, read_length=75):
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'chr1', 'LN': 5000}, {'SN': 'chr2', 'LN': 5000}]}
+    with pysam.AlignmentFile(bam_path, 'wb', header=header) as bam_file:
+        # unplaced reads sort last
+        for index, (reference_id, start, flag, mapq, feature) in enumerate(sorted(reads, key=lambda read: (read[0] < 0, read[:3]))):
+            read = pysam.AlignedSegment()
+            read.query_name = 'read%s' % index
+            read.query_sequence = 'A' * read_length
+            read.flag = flag
+            read.reference_id = reference_id
+            read.reference_start = start
+            read.mapping_quality = mapq
+            if reference_id >= 0:
+                read.cigartuples = [(0, read_length)]
+            read.query_qualities = pysam.qualitystring_to_array('I' * read_length)
+            if feature:
+                read.set_tag('XF', feature)
+            bam_file.write(read)
+    pysam.index(bam_path)
+
+class Test_HtseqAnnotation(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.annotation_path = self.path('annotation.gff')
+        with open(self.annotation_path, 'w') as annotation_file:
+            annotation_file.write(GFF)
+        self.annotation_index = loadAnnotationIndex(self.annotation_path, self.path('cache'))
+        self.bam_path = self.path('sample_sorted_aligned_reads_with_annote.bam')
+
+    def path(self, file_name):
+        return os.path.join(self.tmp_dir.name, file_name)
+
+    def test_tally(self):
+        writeAnnotatedBam(self.bam_path, READS)
+        # chunks smaller than a chromosome, across a pool, give the tally of one pass over the whole bam
+        tally = analyzeAnnotatedBam(self.bam_path, self.annotation_index, chunk_size=1000, processes=2)
+        self.assertEqual(tally, analyzeAnnotatedBam(self.bam_path, self.annotation_index, chunk_size=1 << 20))
+
+        self.assertEqual(tally['categories'], {'assigned': 8, 'ambiguous': 1, 'noFeature': 2, 'tooLowAqual': 1,
+                                               'notAligned': 1, 'untagged': 1})
+        self.assertEqual(geneTallyRows(tally, self.annotation_index),
+                         [{'geneId': 'CKF44_00001', 'strand': '+', 'assigned': 3, 'ambiguous': 1, 'noFeature': 1},
+                          {'geneId': 'CKF44_00002', 'strand': '-', 'assigned': 1, 'ambiguous': 1, 'noFeature': 0},
+                          {'geneId': 'CKF44_00003', 'strand': '+', 'assigned': 2, 'ambiguous': 0, 'noFeature': 0},
+                          {'geneId': 'CKF44_00004', 'strand': '-', 'assigned': 2, 'ambiguous': 0, 'noFeature': 0},
+                          {'geneId': 'CKF44_00005', 'strand': '+', 'assigned': 0, 'ambiguous': 0, 'noFeature': 0}])
+        self.assertEqual((tally['sense'], tally['antisense']), (1, 7))
+
+        qc_dict = strandednessQc(tally, 'reverse', min_reads=8)
+        self.assertEqual((qc_dict['senseFraction'], qc_dict['inferredStrandedness'], qc_dict['strandednessConsistent']),
+                         (0.125, 'reverse', True))
+        self.assertFalse(strandednessQc(tally, 'yes', min_reads=8)['strandednessConsistent'])
+        # too few reads to say
+        self.assertIsNone(strandednessQc(tally, 'yes')['strandednessConsistent'])
+        self.assertEqual([inferStrandedness(*reads) for reads in [(90, 10), (45, 55), (10, 90), (10, 10)]],
+                         ['yes', 'no', 'reverse', None])
+
+    def test_script(self):
+        # a forward stranded library counted as reverse
+        writeAnnotatedBam(self.bam_path, [(0, 4000 + start, 0, 60, 'CKF44_00003') for start in range(150)])
+        args = ['HtseqAnnotationQc.py', '-b', self.bam_path, '-a', self.annotation_path, '-n', 'sample', '-s', 'reverse',
+                '-p', '1', '-o', self.path('output')]
+        main(args)
+        with open(self.path('output/sample_strandedness.json'), 'r') as strandedness_file:
+            qc_dict = json.load(strandedness_file)
+        self.assertEqual((qc_dict['sample'], qc_dict['assigned'], qc_dict['sense'], qc_dict['inferredStrandedness']),
+                         ('sample', 150, 150, 'yes'))
+        self.assertFalse(qc_dict['strandednessConsistent'])
+        with open(self.path('output/sample_htseq_annotation.tsv'), 'r') as gene_tally_file:
+            self.assertEqual(gene_tally_file.readlines()[3], 'CKF44_00003\t+\t150\t0\t0\n')
+
+        with self.assertRaises(SystemExit):
+            main(args + ['--strict'])
+
+if __name__ == '__main__':
+    unittest.main()
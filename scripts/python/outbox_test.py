@@ -0,0 +1,134 @@
+import os
+import socket
+import tempfile
+import unittest
+from functools import partial
+
+import requests
+
+from databaseInteraction_test import FakeResponse, FakeSession
+from DrainOutbox import main as drainMain
+from postAlignmentLogToDatabase_test import NOVOALIGN_LOG
+from PostAlignmentLogToDatabase import main as postAlignmentLogMain
+from utils.DatabaseInteraction import DatabaseClient
+from utils.Outbox import Outbox, drainOutbox, enqueueJobs
+from utils.StubApiServer import StubApiServer
+
+def unusedPort():
+    with socket.socket() as unused_socket:
+        unused_socket.bind(('127.0.0.1', 0))
+        return unused_socket.getsockname()[1]
+
+class Test_Outbox(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.outbox_dir = os.path.join(self.tmp_dir.name, 'outbox')
+        # no retries in the client, so that an outage is seen at once
+        self.client_factory = partial(DatabaseClient, max_retries=0)
+
+    def test_drain(self):
+        log_path = os.path.join(self.tmp_dir.name, 'sample_1_novoalign.log')
+        with open(log_path, 'w') as log_file:
+            log_file.write(NOVOALIGN_LOG)
+        with StubApiServer() as server:
+            # the qc record is enqueued twice, eg by a rerun, and nothing is sent until the drain
+            for _ in range(2):
+                postAlignmentLogMain(['PostAlignmentLogToDatabase.py', '-l', log_path, '-n', 'sample_1', '-i', '1',
+                                      '-o', self.tmp_dir.name, '-u', server.url + 'QualityAssess/', '--outbox', self.outbox_dir])
+            enqueueJobs(self.outbox_dir, [(server.url + 'Counts/', {'fastqFileNumber': 1, 'CKF44_00001': 10}, 'POST', 1)])
+            self.assertEqual(sum(server.request_counts.values()), 0)
+
+            with Outbox(self.outbox_dir) as outbox:
+                self.assertEqual(outbox.stats(), [(server.url + 'Counts/', 1, 0, 0), (server.url + 'QualityAssess/', 2, 0, 0)])
+                summary = drainOutbox(outbox, self.client_factory, batch_size=10)
+                self.assertEqual(outbox.stats(), [])
+        # the second update of the record waits for the first, so it is a put
+        self.assertEqual(summary, {'delivered': 3, 'retried': 0, 'deadLettered': 0, 'batches': 2, 'outage': False})
+        self.assertEqual(server.request_counts, {('POST', 'Counts', 201): 1, ('POST', 'QualityAssess', 201): 1,
+                                                 ('POST', 'QualityAssess', 400): 1, ('PUT', 'QualityAssess', 200): 1})
+
+    def test_dead_letters(self):
+        with StubApiServer() as server, Outbox(self.outbox_dir) as outbox:
+            # a put to a record which does not exist is rejected, and is not retried
+            outbox.enqueue(server.url + 'QualityAssess/7/', {'fastqFileNumber': 7}, 'PUT')
+            with self.assertRaises(SystemExit):
+                drainMain(['DrainOutbox.py', '-d', self.outbox_dir, 'drain'])
+            self.assertEqual([(dead_letter.status_code, dead_letter.attempts) for dead_letter in outbox.deadLetters()], [(404, 1)])
+            self.assertEqual(drainOutbox(outbox, self.client_factory)['batches'], 0)
+
+            # once the record exists, the dead letter is requeued and delivered
+            outbox.enqueue(server.url + 'QualityAssess/', {'fastqFileNumber': 7})
+            drainOutbox(outbox, self.client_factory)
+            self.assertEqual(outbox.requeueDeadLetters(), 1)
+            drainMain(['DrainOutbox.py', '-d', self.outbox_dir, 'drain'])
+            self.assertEqual(outbox.stats(), [])
+        self.assertEqual(server.request_counts[('PUT', 'QualityAssess', 200)], 1)
+
+    def test_bad_message(self):
+        with StubApiServer() as server, Outbox(self.outbox_dir) as outbox:
+            outbox.enqueueMany([(server.url + 'Counts/', {'fastqFileNumber': 1}, 'POST', 1),
+                                ('http//typo/Counts/', {'fastqFileNumber': 2}, 'POST', 2)])
+            # the good message is delivered once, and the bad one is dead lettered rather than stalling the outbox
+            summary = drainOutbox(outbox, self.client_factory)
+            self.assertEqual((summary['delivered'], summary['retried'], summary['deadLettered']), (1, 0, 1))
+            self.assertEqual(drainOutbox(outbox, self.client_factory)['batches'], 0)
+            dead_letter, = outbox.deadLetters()
+            self.assertEqual((dead_letter.url, dead_letter.status_code), ('http//typo/Counts/', None))
+        self.assertEqual(server.request_counts, {('POST', 'Counts', 201): 1})
+
+    def test_backpressure_and_timeouts(self):
+        # one request at a time, so the fake session answers the messages in order
+        session = FakeSession([FakeResponse(429), FakeResponse(408), requests.ReadTimeout('read timed out')])
+        with Outbox(self.outbox_dir) as outbox:
+            outbox.enqueueMany([('http://host/api/QualityAssess/1/', {}, 'PUT'), ('http://host/api/QualityAssess/2/', {}, 'PUT'),
+                                ('http://host/api/Counts/', {'fastqFileNumber': 3}, 'POST', 3)])
+            summary = drainOutbox(outbox, partial(DatabaseClient, session=session, max_retries=0), concurrency=1)
+            # a 429 or 408 asks for the request later. A post which timed out may have created the record, so it is
+            # dead lettered to be checked rather than sent again
+            self.assertEqual((summary['retried'], summary['deadLettered'], summary['outage']), (2, 1, False))
+            self.assertEqual(outbox.stats(), [('http://host/api/Counts/', 0, 0, 1), ('http://host/api/QualityAssess/1/', 1, 0, 0),
+                                              ('http://host/api/QualityAssess/2/', 1, 0, 0)])
+            self.assertIn('timed out', outbox.deadLetters()[0].error)
+            self.assertEqual(outbox.claim(10), [])
+
+    def test_dead_letter_holds_record(self):
+        with StubApiServer() as server, Outbox(self.outbox_dir) as outbox:
+            url = server.url + 'QualityAssess/'
+            DatabaseClient().post(url, {'fastqFileNumber': 7, 'natCoverage': 0})
+            # the post of the record is rejected. Its later update waits for it rather than overtake it
+            outbox.enqueue(url, {'fastqFileNumber': 7, 'natCoverage': 1}, 'POST', 7)
+            outbox.enqueue(url, {'fastqFileNumber': 7, 'natCoverage': 2}, 'POST_OR_PUT', 7)
+            summary = drainOutbox(outbox, self.client_factory)
+            self.assertEqual((summary['delivered'], summary['deadLettered']), (0, 1))
+            self.assertEqual(outbox.stats(), [(url, 1, 0, 1)])
+
+            # once the record is removed and the dead letter requeued, the updates arrive in order
+            del server.records[('QualityAssess', '7')]
+            outbox.requeueDeadLetters()
+            self.assertEqual(drainOutbox(outbox, self.client_factory)['delivered'], 2)
+        self.assertEqual(server.records[('QualityAssess', '7')], b'fastqFileNumber=7&natCoverage=2')
+
+    def test_outage(self):
+        url = 'http://127.0.0.1:%s/api/Counts/' % unusedPort()
+        with Outbox(self.outbox_dir) as outbox:
+            outbox.enqueueMany([(url, {'fastqFileNumber': number}) for number in range(5)])
+
+            # a drain which dies leaves its claimed messages to be claimed again once the lease runs out
+            self.assertEqual(len(outbox.claim(3, lease_seconds=300)), 3)
+            self.assertEqual(outbox.stats(), [(url, 5, 3, 0)])
+            self.assertEqual(len(outbox.claim(10, lease_seconds=0)), 2)
+            self.assertEqual(len(outbox.claim(10, lease_seconds=0)), 2)
+
+            # with the api down, the drain stops after one batch, and the messages wait out their retry delay
+            summary = drainOutbox(outbox, self.client_factory, batch_size=1, lease_seconds=0)
+            self.assertEqual(summary, {'delivered': 0, 'retried': 1, 'deadLettered': 0, 'batches': 1, 'outage': True})
+            self.assertEqual(outbox.stats(), [(url, 5, 3, 0)])
+            with outbox.transaction():
+                outbox.connection.execute('UPDATE messages SET lease_until = NULL, next_attempt_at = 0')
+            summary = drainOutbox(outbox, self.client_factory, max_attempts=2)
+            self.assertEqual((summary['retried'], summary['deadLettered']), (4, 1))
+            self.assertEqual(outbox.deadLetters()[0].status_code, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+from utils.AlignmentLogParser import findSampleLogs, parseNovoalignLog, parseNovosortLog, parseSampleLogs
+
+NOVOALIGN_LOG = ('# novoalign (V3.09.00 - Build Jan  1 2020 @ 00:00:00) - A short read aligner with qualities.\n'
+                 '#     Read Sequences:    35003\n'
+                 '#            Aligned:    24723\n'
+                 '#   Unique Alignment:    22737\n'
+                 '#   Gapped Alignment:       94\n'
+                 '#     Quality Filter:        0\n'
+                 '# Homopolymer Filter:       47\n'
+                 '#       Multi Mapped:     1986\n'
+                 '#   No Mapping Found:    10233\n'
+                 '#       Elapsed Time: 12.345 (sec.)\n')
+
+NOVOSORT_LOG = ('# novosort (V3.09.00)\n'
+                '#     Proper Pairs       0\n'
+                '#     Unpaired Reads     24723\n'
+                '#     Duplicate Proper Pairs     0\n'
+                '#     Duplicate Unpaired Reads     1234\n')
+
+class Test_AlignmentLogParser(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.novoalign_log = self.writeLog('sample_1_novoalign.log', NOVOALIGN_LOG)
+        self.novosort_log = self.writeLog('sample_1_novosort.log', NOVOSORT_LOG)
+        self.writeLog('sample_2_novoalign.log', NOVOALIGN_LOG)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def writeLog(self, file_name, text):
+        log_path = os.path.join(self.tmp_dir.name, file_name)
+        with open(log_path, 'w') as log_file:
+            log_file.write(text)
+        return log_path
+
+    def test_parseNovoalignLog(self):
+        # read length, which is missing, is set to 0
+        self.assertEqual(parseNovoalignLog(self.novoalign_log),
+                         {'librarySize': 35003, 'uniqueAlignment': 22737, 'multiMap': 1986, 'noMap': 10233,
+                          'homopolymerFilter': 47, 'readLengthFilter': 0})
+
+    def test_parseNovosortLog(self):
+        self.assertEqual(parseNovosortLog(self.novosort_log),
+                         {'properPairs': 0, 'unpairedReads': 24723, 'duplicateProperPairs': 0, 'duplicateUnpairedReads': 1234})
+
+    def test_findSampleLogs(self):
+        sample_log_list = findSampleLogs(self.tmp_dir.name)
+        self.assertEqual(sample_log_list, [('sample_1', self.novoalign_log, self.novosort_log),
+                                           ('sample_2', os.path.join(self.tmp_dir.name, 'sample_2_novoalign.log'), None)])
+        row = parseSampleLogs(*sample_log_list[0])
+        self.assertEqual(row['sampleName'], 'sample_1')
+        self.assertEqual(row['librarySize'], 35003)
+        self.assertEqual(row['duplicateUnpairedReads'], 1234)
+
+if __name__ == '__main__':
+    unittest.main()
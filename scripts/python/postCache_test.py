@@ -0,0 +1,88 @@
+import os
+import tempfile
+import time
+import unittest
+
+from databaseInteraction_test import FakeResponse, FakeSession
+from utils.DatabaseInteraction import DatabaseClient, DatabaseInteractionError
+from utils.PostCache import PostCache, payloadHash
+
+URL = 'http://host/api/QualityAssess/'
+
+class Test_PostCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def client(self, responses, **kwargs):
+        session = FakeSession(responses)
+        client = DatabaseClient(session=session, post_cache=PostCache(self.tmp_dir.name), **kwargs)
+        client._sleep = lambda seconds: None
+        self.addCleanup(client.close)
+        return client, session
+
+    def methods(self, session):
+        return [(method, url) for method, url, _ in session.requests]
+
+    def test_payloadHash_ignores_key_order(self):
+        self.assertEqual(payloadHash({'a': 1, 'b': 2}), payloadHash({'b': 2, 'a': 1}))
+        self.assertNotEqual(payloadHash({'a': 1}), payloadHash({'a': 2}))
+
+    def test_unchanged_payload_skipped(self):
+        client, session = self.client([FakeResponse(201)])
+        client.postOrPut(URL, 7, {'fastqFileNumber': 7, 'natCoverage': 0.9})
+        response = client.postOrPut(URL, 7, {'natCoverage': 0.9, 'fastqFileNumber': 7})
+        self.assertTrue(response.from_cache)
+        self.assertEqual(len(session.requests), 1)
+
+    def test_changed_payload_put_directly(self):
+        client, session = self.client([FakeResponse(201), FakeResponse(200)])
+        client.postOrPut(URL, 7, {'fastqFileNumber': 7, 'natCoverage': 0.9})
+        client.postOrPut(URL, 7, {'fastqFileNumber': 7, 'natCoverage': 0.5})
+        self.assertEqual(self.methods(session), [('POST', URL), ('PUT', URL + '7/')])
+        self.assertEqual(client.post_cache.lookup(URL, 7).payload_hash, payloadHash({'fastqFileNumber': 7, 'natCoverage': 0.5}))
+
+    def test_changed_post_refused(self):
+        # a changed payload of a record which was posted, eg the counts of a re-counted sample, is not posted as a second record
+        counts_url = 'http://host/api/Counts/'
+        client, session = self.client([FakeResponse(201)])
+        client.post(counts_url, {'fastqFileNumber': 7, 'rawCounts': '[1, 2]'}, record_key=7)
+        with self.assertRaisesRegex(DatabaseInteractionError, 'already posted') as context:
+            client.post(counts_url, {'fastqFileNumber': 7, 'rawCounts': '[1, 3]'}, record_key=7)
+        self.assertFalse(context.exception.transient)
+        self.assertEqual(self.methods(session), [('POST', counts_url)])
+
+    def test_put_of_deleted_record_falls_back_to_post(self):
+        client, session = self.client([FakeResponse(201), FakeResponse(404), FakeResponse(201)])
+        client.postOrPut(URL, 7, {'natCoverage': 0.9})
+        client.postOrPut(URL, 7, {'natCoverage': 0.5})
+        self.assertEqual(self.methods(session), [('POST', URL), ('PUT', URL + '7/'), ('POST', URL)])
+
+    def test_failure_not_recorded(self):
+        client, session = self.client([FakeResponse(500)] * 4 + [FakeResponse(201)])
+        with self.assertRaises(DatabaseInteractionError):
+            client.post(URL, {'natCoverage': 0.9}, record_key=7)
+        self.assertIsNone(client.post_cache.lookup(URL, 7))
+        client.post(URL, {'natCoverage': 0.9}, record_key=7)
+        self.assertEqual(client.post_cache.lookup(URL, 7).method, 'POST')
+
+    def test_force(self):
+        client, session = self.client([FakeResponse(201), FakeResponse(201)], force=True)
+        client.post(URL, {'natCoverage': 0.9}, record_key=7)
+        client.post(URL, {'natCoverage': 0.9}, record_key=7)
+        self.assertEqual(len(session.requests), 2)
+
+    def test_evict(self):
+        with PostCache(self.tmp_dir.name) as post_cache:
+            post_cache.record(URL, 1, 'hash', 'POST', 201)
+            post_cache.record('http://host/api/Counts/', 1, 'hash', 'POST', 201)
+            post_cache.connection.execute('UPDATE posts SET updated_at = ? WHERE record_key = ? AND endpoint = ?',
+                                          (time.time() - 3600, '1', URL))
+            self.assertEqual(post_cache.evict(older_than=60), 1)
+            self.assertEqual([endpoint for endpoint, _, _ in post_cache.stats()], ['http://host/api/Counts/'])
+            self.assertEqual(post_cache.evict(endpoint='http://host/api/Counts/'), 1)
+            post_cache.compact()
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, 'post_cache.sqlite')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import csv
+import os
+import random
+import tempfile
+import unittest
+
+from PostCountsBatchToDatabase import main, readManifest
+from utils.StubApiServer import StubApiServer
+from utils.SyntheticData import syntheticGeneIds, writeSyntheticHtseqCounts
+
+class Test_PostCountsBatchToDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.count_dir = self.path('count')
+        os.makedirs(self.count_dir)
+        rng = random.Random(1)
+        for sample_number in (1, 2, 3):
+            writeSyntheticHtseqCounts(os.path.join(self.count_dir, 'sample_%s_read_count.tsv' % sample_number),
+                                      syntheticGeneIds(20), rng)
+        # sample_2's count file is cut off mid row
+        with open(os.path.join(self.count_dir, 'sample_2_read_count.tsv'), 'a') as count_file:
+            count_file.write('CKF44_00021\n')
+
+    def path(self, file_name):
+        return os.path.join(self.tmp_dir.name, file_name)
+
+    def writeManifest(self, rows, fieldnames=('fastqFileName', 'fastqFileNumber')):
+        manifest_path = self.path('fastq_file_list.csv')
+        with open(manifest_path, 'w', newline='') as manifest:
+            writer = csv.writer(manifest)
+            writer.writerow(fieldnames)
+            writer.writerows(rows)
+        return manifest_path
+
+    def test_readManifest(self):
+        manifest_path = self.writeManifest([['/lts/sample_1.fastq.gz', '1', '/elsewhere/sample_1_read_count.tsv'],
+                                            ['/lts/sample_2.fastq.gz', '2', '']],
+                                           ('fastqFileName', 'fastqFileNumber', 'countFile'))
+        self.assertEqual(readManifest(manifest_path, self.count_dir, '_read_count.tsv'),
+                         [('/elsewhere/sample_1_read_count.tsv', 'sample_1', '1'),
+                          (os.path.join(self.count_dir, 'sample_2_read_count.tsv'), 'sample_2', '2')])
+        # a row without a countFile needs the count directory
+        with self.assertRaisesRegex(ValueError, 'row 3 of .* has no countFile'):
+            readManifest(manifest_path, None, '_read_count.tsv')
+
+    def test_main(self):
+        manifest_path = self.writeManifest([['/lts/sample_%s.fastq.gz' % number, str(number)] for number in (1, 2, 3)])
+        with StubApiServer() as server:
+            # the bad sample fails the batch, after every other sample is parsed and posted
+            with self.assertRaisesRegex(SystemExit, '1 of 3 samples failed to parse, 0 requests failed'):
+                main(['PostCountsBatchToDatabase.py', '-m', manifest_path, '-d', self.count_dir, '-o', self.path('output'),
+                      '-p', '2', '-cu', server.url + 'Counts/', '-qu', server.url + 'QualityAssess/'])
+        self.assertEqual(server.request_counts, {('POST', 'Counts', 201): 2, ('POST', 'QualityAssess', 201): 2})
+        for sample_name in ('sample_1', 'sample_3'):
+            self.assertTrue(os.path.exists(os.path.join(self.path('output'), '%s_htseq_qc.csv' % sample_name)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,71 @@
+import importlib.util
+import os
+import tempfile
 import unittest
 
-import PostCountsToDatabase
+from utils.CountPayload import decodeCounts, encodeCounts, geneIndexId
+from utils.HtseqCountParser import parseHtseqCounts
+
+HTSEQ_OUTPUT = ("CKF44_00001\t10\n"
+                "CKF44_00002\t0\n"
+                "CNAG_NAT\t7\n"
+                "__no_feature\t101\n"
+                "__ambiguous\t3\n"
+                "__too_low_aQual\t0\n"
+                "__not_aligned\t12\n"
+                "__alignment_not_unique\t40\n")
 
 class Test_PostCountsToDatabase(unittest.TestCase):
-    def test_main(self):
-        args = {'count_file': os.path,
-                'sample_name': ,
-                'fastq_file_number': ,
-                'counts_url': ,
-                'qc_url': ,
-                'post': True}
-        PostCountsToDatabase.main([])
\ No newline at end of file
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.count_file = os.path.join(self.tmp_dir.name, 'sample_read_count.tsv')
+        with open(self.count_file, 'w') as count_file:
+            count_file.write(HTSEQ_OUTPUT)
+        self.counts_csv = os.path.join(self.tmp_dir.name, 'sample_counts.csv')
+        self.qc_csv = os.path.join(self.tmp_dir.name, 'sample_htseq_qc.csv')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_parseHtseqCounts(self):
+        gene_counts, htseq_qc_rows, gene_index, gene_ids = parseHtseqCounts(self.count_file, 'sample', self.counts_csv, self.qc_csv)
+
+        self.assertEqual(gene_counts, [10, 0, 7])
+        self.assertEqual(gene_ids, ['CKF44_00001', 'CKF44_00002', 'CNAG_NAT'])
+        self.assertEqual(gene_index, geneIndexId(['CKF44_00001', 'CKF44_00002', 'CNAG_NAT']))
+        self.assertEqual(htseq_qc_rows, [('__no_feature', 101), ('__ambiguous', 3), ('__too_low_aQual', 0),
+                                         ('__not_aligned', 12), ('__alignment_not_unique', 40)])
+
+        with open(self.counts_csv) as counts_csv:
+            self.assertEqual(counts_csv.read(), "gene_id,sample\nCKF44_00001,10\nCKF44_00002,0\nCNAG_NAT,7\n")
+        with open(self.qc_csv) as qc_csv:
+            self.assertEqual(qc_csv.readline(), "gene_id,sample\n")
+            self.assertEqual(len(qc_csv.readlines()), 5)
+
+    def test_parseHtseqCounts_malformed(self):
+        with open(self.count_file, 'a') as count_file:
+            count_file.write("CKF44_00003\tnot_a_number\n")
+        with self.assertRaises(ValueError):
+            parseHtseqCounts(self.count_file, 'sample', self.counts_csv, self.qc_csv)
+
+    def test_packed_payload(self):
+        gene_counts = [10, 0, 7, 2**32 - 1]
+        payload = encodeCounts(gene_counts, 'gene_index')
+        self.assertEqual(payload['countsEncoding'], 'uint32le+gzip')
+        self.assertEqual(payload['numGenes'], '4')
+        self.assertEqual(decodeCounts(payload), gene_counts)
+
+        payload['countsChecksum'] = '0' * 64
+        with self.assertRaises(ValueError):
+            decodeCounts(payload)
+        with self.assertRaises(ValueError):
+            encodeCounts([-1], 'gene_index')
+
+    @unittest.skipIf(importlib.util.find_spec('zstandard'), 'zstandard is installed')
+    def test_zstd_not_installed(self):
+        # the zstd extra is optional, so asking for it without the package is an input error, not a crash
+        with self.assertRaisesRegex(ValueError, 'requires the zstandard package'):
+            encodeCounts([10], 'gene_index', 'zstd')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+
+from featureCoverage_test import GFF, writeBam
+from PostGenotypeCoverageToDatabase import genotypeCoverage, parseArgs as parseGenotypeArgs
+from PostMarkerCoverageToDatabase import parseArgs as parseMarkerArgs
+
+class Test_PostCoverageToDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.annotation_path = os.path.join(self.tmp_dir.name, 'annotation.gff')
+        with open(self.annotation_path, 'w') as annotation_file:
+            annotation_file.write(GFF)
+        self.bam_path = os.path.join(self.tmp_dir.name, 'sample.bam')
+        writeBam(self.bam_path, [(0, 99, 50, 60, 0),   # 50 of the 201 NAT bases
+                                 (0, 119, 50, 60, 0),  # 20 more, and 30 at depth 2
+                                 (0, 199, 50, 5, 0),   # mapq 5, counted only below the default --min_mapq
+                                 (1, 0, 25, 60, 0)])   # 25 of the 100 G418 bases
+
+    def test_genotypeCoverage(self):
+        self.assertEqual(genotypeCoverage(self.bam_path, self.annotation_path, [], 'CDS', True),
+                         {'natCoverage': 70 / 201.0, 'g418Coverage': 0.25})
+        self.assertEqual(genotypeCoverage(self.bam_path, self.annotation_path, ['CNAG_NAT'], 'CDS', False, min_mapq=0),
+                         {'genotype1Coverage': 120 / 201.0})
+        self.assertEqual(genotypeCoverage(self.bam_path, self.annotation_path, ['CNAG_NAT'], 'CDS', True, min_depth=2),
+                         {'genotype1Coverage': 30 / 201.0, 'natCoverage': 30 / 201.0, 'g418Coverage': 0.0})
+
+    def test_parseArgs(self):
+        argv = ['-b', self.bam_path, '-a', self.annotation_path, '-i', '1', '-u', 'url']
+        for parseArgs, script_argv in ((parseMarkerArgs, ['PostMarkerCoverageToDatabase.py'] + argv),
+                                       (parseGenotypeArgs, ['PostGenotypeCoverageToDatabase.py', '-l', 'CNAG_NAT'] + argv)):
+            args = parseArgs(script_argv)
+            self.assertEqual((args.min_depth, args.min_mapq), (1, 10))
+            args = parseArgs(script_argv + ['--min_depth', '5', '--min_mapq', '0'])
+            self.assertEqual((args.min_depth, args.min_mapq), (5, 0))
+
+if __name__ == '__main__':
+    unittest.main()
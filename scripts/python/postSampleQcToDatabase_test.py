@@ -0,0 +1,61 @@
+import csv
+import os
+import tempfile
+import unittest
+
+from PostSampleQcToDatabase import htseqQc, main
+from featureCoverage_test import GFF, writeBam
+from postAlignmentLogToDatabase_test import NOVOALIGN_LOG
+from postCountsToDatabase_test import HTSEQ_OUTPUT
+
+class Test_PostSampleQcToDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.count_file = self.writeInput('sample_read_count.tsv', HTSEQ_OUTPUT)
+        self.novoalign_log = self.writeInput('sample_novoalign.log', NOVOALIGN_LOG)
+        self.annotation_file = self.writeInput('annotation.gff', GFF)
+        self.bam_file = os.path.join(self.tmp_dir.name, 'sample.bam')
+        writeBam(self.bam_file, [(0, 99, 50, 60, 0), (1, 0, 25, 60, 0)])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def writeInput(self, file_name, text):
+        input_path = os.path.join(self.tmp_dir.name, file_name)
+        with open(input_path, 'w') as input_file:
+            input_file.write(text)
+        return input_path
+
+    def test_htseqQc(self):
+        self.assertEqual(htseqQc(self.count_file, 1),
+                         {'fastqFileNumber': '1', 'noFeature': 101, 'ambiguous': 3, 'tooLowAqual': 0, 'notAligned': 12,
+                          'alignmentNotUnique': 40})
+        # of the genes in the count file, only CNAG_NAT is a protein coding gene in the annotation
+        self.assertEqual(htseqQc(self.count_file, 1, self.annotation_file)['proteinCodingCounted'], 7)
+
+    def test_main(self):
+        main(['PostSampleQcToDatabase.py', '-n', 'sample', '-i', '1', '-c', self.count_file, '-l', self.novoalign_log,
+              '-b', self.bam_file, '-a', self.annotation_file, '--locus', 'CNAG_NAT2', '--markers',
+              '-o', self.tmp_dir.name, '--no-post'])
+        with open(os.path.join(self.tmp_dir.name, 'sample_sample_qc.csv'), newline='') as qc_csv:
+            qc_record = list(csv.DictReader(qc_csv))
+        self.assertEqual(len(qc_record), 1)
+        self.assertEqual(qc_record[0]['fastqFileNumber'], '1')
+        self.assertEqual(qc_record[0]['proteinCodingCounted'], '7')
+        self.assertEqual(qc_record[0]['librarySize'], '35003')
+        self.assertEqual(float(qc_record[0]['genotype1Coverage']), 0.0)
+        self.assertAlmostEqual(float(qc_record[0]['natCoverage']), 50 / 201.0)
+        self.assertAlmostEqual(float(qc_record[0]['g418Coverage']), 0.25)
+
+    def test_main_input_errors(self):
+        # an annotation which can not be read is an input error rather than a traceback
+        with self.assertRaisesRegex(SystemExit, 'PostSampleQcToDatabaseError: could not read input'):
+            main(['PostSampleQcToDatabase.py', '-n', 'sample', '-i', '1', '-c', self.count_file,
+                  '-a', os.path.join(self.tmp_dir.name, 'missing.gff'), '-o', self.tmp_dir.name, '--no-post'])
+        # the coverage of the loci and markers needs the bam, rather than being left out of the record
+        with self.assertRaises(SystemExit):
+            main(['PostSampleQcToDatabase.py', '-n', 'sample', '-i', '1', '-c', self.count_file, '-a', self.annotation_file,
+                  '--markers', '-o', self.tmp_dir.name, '--no-post'])
+
+if __name__ == '__main__':
+    unittest.main()
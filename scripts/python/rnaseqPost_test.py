@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from postCountsToDatabase_test import HTSEQ_OUTPUT
+from RnaseqPost import SUBCOMMANDS, main
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+class Test_RnaseqPost(unittest.TestCase):
+    def test_subcommand_modules_exist(self):
+        for module_name, _ in SUBCOMMANDS.values():
+            self.assertTrue(os.path.exists(os.path.join(SCRIPT_DIR, module_name + '.py')), module_name)
+
+    def test_counts_without_http_or_numpy(self):
+        # the per sample counts path, without posting, must not import the heavy dependencies
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            count_file = os.path.join(tmp_dir, 'sample_read_count.tsv')
+            with open(count_file, 'w') as count_file_handle:
+                count_file_handle.write(HTSEQ_OUTPUT)
+            check = ('import sys; sys.argv = ["RnaseqPost.py", "counts", "-c", %r, "-n", "sample", "-i", "1", "-cu", "url", "--no-post"]; '
+                     'import RnaseqPost; RnaseqPost.main(sys.argv); '
+                     'print(",".join(module for module in ("requests", "numpy", "pysam", "pandas", "asyncio") if module in sys.modules))' % count_file)
+            result = subprocess.run([sys.executable, '-c', check], cwd=tmp_dir, env=dict(os.environ, PYTHONPATH=SCRIPT_DIR),
+                                    capture_output=True, text=True, check=True)
+            self.assertEqual(result.stdout.strip(), '')
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'sample_counts.csv')))
+
+    def test_unknown_subcommand(self):
+        with self.assertRaises(SystemExit):
+            main(['RnaseqPost.py', 'not-a-subcommand'])
+
+if __name__ == '__main__':
+    unittest.main()
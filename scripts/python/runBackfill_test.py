@@ -0,0 +1,114 @@
+import csv
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from RunBackfill import main
+from utils.BackfillCheckpoint import DONE, FAILED, MISSING, BackfillCheckpoint
+from utils.StubApiServer import StubApiServer
+from utils.SyntheticData import (syntheticGeneIds, writeSyntheticAnnotation, writeSyntheticBam, writeSyntheticHtseqCounts,
+                                 writeSyntheticNovoalignLog, writeSyntheticNovosortLog)
+
+class Test_RunBackfill(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.results_dir = self.path('results')
+        self.checkpoint_dir = self.path('checkpoints')
+        self.gene_ids = syntheticGeneIds(50)
+        self.annotation_path = self.path('annotation.gff')
+        writeSyntheticAnnotation(self.annotation_path, self.gene_ids)
+
+        # three samples of one run, published as the pipeline publishes them. sample_3 was never counted
+        rng = random.Random(1)
+        for directory in ('count', 'logs', 'align'):
+            os.makedirs(os.path.join(self.results_dir, 'run_1', directory))
+        with open(self.path('fastq_file_list.csv'), 'w', newline='') as manifest:
+            writer = csv.writer(manifest)
+            writer.writerow(['runDirectory', 'fastqFileName', 'fastqFileNumber', 'organism', 'strandedness'])
+            for sample_number in (1, 2, 3):
+                sample_name = 'sample_%s' % sample_number
+                writer.writerow(['run_1', '/lts/run_1/%s.fastq.gz' % sample_name, sample_number, 'KN99', 'reverse'])
+                if sample_number != 3:
+                    writeSyntheticHtseqCounts(self.runPath('count', '%s_read_count.tsv' % sample_name), self.gene_ids, rng)
+                writeSyntheticNovoalignLog(self.runPath('logs', '%s_novoalign.log' % sample_name), rng)
+                writeSyntheticNovosortLog(self.runPath('logs', '%s_novosort.log' % sample_name), rng)
+                writeSyntheticBam(self.runPath('align', '%s_sorted.bam' % sample_name), self.gene_ids, 200, rng)
+
+    def path(self, file_name):
+        return os.path.join(self.tmp_dir.name, file_name)
+
+    def runPath(self, directory, file_name):
+        return os.path.join(self.results_dir, 'run_1', directory, file_name)
+
+    def backfill(self, server, *extra_args):
+        main(['RunBackfill.py', '-m', self.path('fastq_file_list.csv'), '-r', self.results_dir, '-c', self.checkpoint_dir,
+              '-o', self.path('output'), '-p', '2', '--annotation', 'KN99=%s' % self.annotation_path,
+              '-cu', server.url + 'Counts/', '-u', server.url + 'QualityAssess/'] + list(extra_args))
+
+    def checkpoints(self):
+        with BackfillCheckpoint(self.checkpoint_dir) as checkpoint:
+            return {(number, stage): checkpoint.lookup(number, stage).status
+                    for number in ('1', '2', '3') for stage in ('counts', 'sample_qc')}
+
+    def test_resume(self):
+        # sample_1's counts are truncated, so its counts and qc fail. sample_3's counts are missing, but its logs and bam make a qc record
+        count_path = self.runPath('count', 'sample_1_read_count.tsv')
+        with open(count_path, 'r') as count_file:
+            count_lines = count_file.readlines()
+        with open(count_path, 'w') as count_file:
+            count_file.writelines(count_lines[:10] + ['CKF44_00011\n'])
+        with StubApiServer() as server:
+            with self.assertRaises(SystemExit):
+                self.backfill(server)
+            self.assertEqual(self.checkpoints(), {('1', 'counts'): FAILED, ('1', 'sample_qc'): FAILED, ('2', 'counts'): DONE,
+                                                  ('2', 'sample_qc'): DONE, ('3', 'counts'): MISSING, ('3', 'sample_qc'): DONE})
+            with open(os.path.join(self.path('output'), 'run_1', 'sample_2_sample_qc.csv'), 'r') as qc_file:
+                qc_record = next(csv.DictReader(qc_file))
+            self.assertIn('natCoverage', qc_record)
+            self.assertIn('proteinCodingCounted', qc_record)
+
+            # the retry runs only what failed, once the count file is fixed
+            with open(count_path, 'w') as count_file:
+                count_file.writelines(count_lines)
+            self.backfill(server)
+            self.assertEqual(server.request_counts[('POST', 'Counts', 201)], 2)
+            self.assertEqual(server.request_counts[('POST', 'QualityAssess', 201)], 3)
+            self.assertEqual(self.checkpoints()[('1', 'counts')], DONE)
+
+            # nothing runs again until an input changes. Publishing sample_3's counts runs its counts and qc
+            self.backfill(server)
+            self.assertEqual(sum(server.request_counts.values()), 5)
+            writeSyntheticHtseqCounts(self.runPath('count', 'sample_3_read_count.tsv'), self.gene_ids, random.Random(3))
+            self.backfill(server)
+        self.assertEqual(server.request_counts[('POST', 'Counts', 201)], 3)
+        self.assertEqual(server.request_counts[('POST', 'QualityAssess', 400)], 1)
+        self.assertEqual(server.request_counts[('PUT', 'QualityAssess', 200)], 1)
+        self.assertEqual(self.checkpoints()[('3', 'counts')], DONE)
+
+    def test_gene_coverage(self):
+        with StubApiServer() as server:
+            self.backfill(server, '--stages', 'gene_coverage', '--no-post')
+        self.assertTrue(os.path.exists(os.path.join(self.path('output'), 'run_1', 'sample_2_gene_coverage.tsv')))
+        with BackfillCheckpoint(self.checkpoint_dir) as checkpoint:
+            self.assertEqual(checkpoint.stats(), [('gene_coverage', DONE, 3)])
+
+    def test_strandedness(self):
+        # the synthetic reads are on either strand, so a library listed as reverse fails. sample_3 has no annotated bam
+        for sample_name in ('sample_1', 'sample_2'):
+            for suffix in ('', '.bai'):
+                shutil.copy(self.runPath('align', '%s_sorted.bam%s' % (sample_name, suffix)),
+                            self.runPath('align', '%s_sorted_aligned_reads_with_annote.bam%s' % (sample_name, suffix)))
+        with StubApiServer() as server:
+            with self.assertRaises(SystemExit):
+                self.backfill(server, '--stages', 'strandedness', '--no-post')
+        with open(os.path.join(self.path('output'), 'run_1', 'sample_1_strandedness.json'), 'r') as strandedness_file:
+            self.assertEqual(json.load(strandedness_file)['inferredStrandedness'], 'no')
+        with BackfillCheckpoint(self.checkpoint_dir) as checkpoint:
+            self.assertEqual(checkpoint.stats(), [('strandedness', FAILED, 2), ('strandedness', MISSING, 1)])
+
+if __name__ == '__main__':
+    unittest.main()
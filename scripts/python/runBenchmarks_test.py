@@ -0,0 +1,98 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from RunBenchmarks import BENCHMARKS, main
+from utils.AlignmentLogParser import parseSampleLogs
+from utils.DatabaseInteraction import DatabaseClient, DatabaseInteractionError
+from utils.FeatureCoverage import calculateRegionCoverage
+from utils.HtseqCountParser import parseHtseqCounts
+from utils.StubApiServer import StubApiServer
+from utils.SyntheticData import (MARKER_GENE_IDS, syntheticGeneIds, writeSyntheticAnnotation, writeSyntheticBam,
+                                 writeSyntheticHtseqCounts, writeSyntheticNovoalignLog)
+
+class Test_SyntheticData(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.gene_ids = syntheticGeneIds(600)
+
+    def path(self, file_name):
+        return os.path.join(self.tmp_dir.name, file_name)
+
+    def test_counts_and_logs_parse(self):
+        total = writeSyntheticHtseqCounts(self.path('sample_read_count.tsv'), self.gene_ids, random.Random(1))
+        gene_counts, htseq_qc_rows, _, gene_ids = parseHtseqCounts(self.path('sample_read_count.tsv'), 'sample', None, self.path('qc.csv'))
+        self.assertEqual(gene_ids, self.gene_ids)
+        self.assertEqual(sum(gene_counts), total)
+        self.assertEqual(len(htseq_qc_rows), 5)
+
+        writeSyntheticNovoalignLog(self.path('sample_novoalign.log'), random.Random(1), library_size=1000)
+        row = parseSampleLogs('sample', self.path('sample_novoalign.log'))
+        self.assertEqual(row['librarySize'], 1000)
+        self.assertEqual(row['uniqueAlignment'] + row['multiMap'] + row['noMap'] + row['homopolymerFilter'], 1000)
+
+    def test_bam_covers_annotation(self):
+        # 600 genes and the markers span two chromosomes
+        writeSyntheticAnnotation(self.path('annotation.gff'), self.gene_ids)
+        writeSyntheticBam(self.path('sample.bam'), self.gene_ids, 2000, random.Random(1))
+        coverage_dict = calculateRegionCoverage([(gene_id, 'CDS') for gene_id in MARKER_GENE_IDS],
+                                                self.path('annotation.gff'), self.path('sample.bam'))
+        for coverage in coverage_dict.values():
+            self.assertTrue(0 <= coverage <= 1)
+
+class Test_StubApiServer(unittest.TestCase):
+    def test_post_or_put(self):
+        with StubApiServer() as server, DatabaseClient(max_retries=0) as client:
+            self.assertEqual(client.post(server.url + 'Counts/', {'fastqFileNumber': 1}).status_code, 201)
+            client.postOrPut(server.url + 'QualityAssess/', 1, {'fastqFileNumber': 1, 'natCoverage': 0.5})
+            client.postOrPut(server.url + 'QualityAssess/', 1, {'fastqFileNumber': 1, 'natCoverage': 0.9})
+            with self.assertRaises(DatabaseInteractionError) as context:
+                client.put(server.url + 'QualityAssess/2/', {'fastqFileNumber': 2})
+            self.assertEqual(context.exception.status_code, 404)
+        self.assertEqual(server.request_counts[('POST', 'QualityAssess', 400)], 1)
+        self.assertEqual(server.request_counts[('PUT', 'QualityAssess', 200)], 1)
+        self.assertEqual(len(server.records), 2)
+
+    def test_error_rate(self):
+        with StubApiServer(error_rate=1.0) as server, DatabaseClient(max_retries=1, backoff_factor=0) as client:
+            with self.assertRaises(DatabaseInteractionError) as context:
+                client.post(server.url + 'Counts/', {'fastqFileNumber': 1})
+        self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(server.request_counts[('POST', 'Counts', 503)], 2)
+
+class Test_RunBenchmarks(unittest.TestCase):
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'results.json')
+            arguments = ['RunBenchmarks.py', '-o', output_path, '--samples', '2', '--genes', '100', '--reads', '200',
+                         '--bam_samples', '1', '--latency', '0', '--repeat', '1', '--startup_runs', '1']
+            main(arguments)
+            with open(output_path, 'r') as output_file:
+                results = json.load(output_file)
+            self.assertEqual(list(results['benchmarks']), list(BENCHMARKS))
+            self.assertEqual(results['benchmarks']['posting']['items'], 4)
+            self.assertEqual(results['benchmarks']['posting']['failures'], 0)
+            self.assertEqual(results['benchmarks']['posting']['requestsPerRun'], [4])
+
+            # every run of the posting benchmark sends the same requests, a post of the counts and of the qc per sample
+            main(['RunBenchmarks.py', '-o', os.path.join(tmp_dir, 'posting.json'), '--samples', '2', '--genes', '100',
+                  '-b', 'posting', '--latency', '0', '--repeat', '3'])
+            with open(os.path.join(tmp_dir, 'posting.json'), 'r') as output_file:
+                self.assertEqual(json.load(output_file)['benchmarks']['posting']['requestsPerRun'], [4, 4, 4])
+            for result in results['benchmarks'].values():
+                self.assertGreater(result['wallTime'], 0)
+                self.assertGreater(result['peakRssMb'], 0)
+
+            # comparing against a much faster baseline is a regression
+            for result in results['benchmarks'].values():
+                result['wallTime'] /= 100
+            with open(os.path.join(tmp_dir, 'baseline.json'), 'w') as baseline_file:
+                json.dump(results, baseline_file)
+            with self.assertRaises(SystemExit):
+                main(arguments + ['-b', 'log_parsing', '--compare', os.path.join(tmp_dir, 'baseline.json')])
+
+if __name__ == '__main__':
+    unittest.main()
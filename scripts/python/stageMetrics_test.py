@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+from databaseInteraction_test import FakeResponse, FakeSession
+from SummarizeMetrics import readStages, summarizeStages
+from utils.DatabaseInteraction import DatabaseClient
+from utils.StageMetrics import StageMetrics
+
+class FakeRequest:
+    def __init__(self, body):
+        self.body = body
+
+class Test_StageMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.metrics_dir = os.path.join(self.tmp_dir.name, 'metrics')
+        self.prometheus_dir = os.path.join(self.tmp_dir.name, 'prometheus')
+
+    def test_stages(self):
+        metrics = StageMetrics('PostCountsToDatabase', 'sample_1', self.metrics_dir, self.prometheus_dir)
+        with metrics.stage('parse') as stage_record:
+            with open(__file__, 'r') as this_file:
+                this_file.read()
+        with self.assertRaises(SystemExit):
+            with metrics.stage('post'):
+                raise SystemExit('failed')
+        metrics.write()
+        # a second write (eg at exit) does not duplicate the records
+        metrics.write()
+
+        self.assertGreaterEqual(stage_record['wallTime'], 0)
+        self.assertGreaterEqual(stage_record['bytesRead'], os.path.getsize(__file__))
+        stage_list = readStages([os.path.join(self.metrics_dir, 'PostCountsToDatabase_sample_1.jsonl')])
+        self.assertEqual([(stage['stage'], stage['status']) for stage in stage_list if stage['stage'] != 'startup'],
+                         [('parse', 'ok'), ('post', 'SystemExit')])
+        with open(os.path.join(self.prometheus_dir, 'PostCountsToDatabase_sample_1.prom'), 'r') as prometheus_file:
+            prometheus_text = prometheus_file.read()
+        self.assertIn('rnaseq_stage_wall_seconds{script="PostCountsToDatabase",sample="sample_1",stage="parse",status="ok"}', prometheus_text)
+
+    def test_requests_recorded(self):
+        metrics = StageMetrics('PostSampleQcToDatabase', 'sample_1')
+        response = FakeResponse(201)
+        response.request = FakeRequest('fastqFileNumber=1')
+        client = DatabaseClient(session=FakeSession([FakeResponse(503), response]), metrics=metrics)
+        client._sleep = lambda seconds: None
+        with metrics.stage('post') as stage_record:
+            client.post('http://host/api/QualityAssess/', {'fastqFileNumber': 1})
+        self.assertEqual((stage_record['httpRequests'], stage_record['httpRetries'], stage_record['httpErrors']), (2, 1, 1))
+        self.assertEqual(stage_record['payloadBytes'], len('fastqFileNumber=1'))
+        self.assertFalse(metrics.enabled)
+
+    def test_summarizeStages(self):
+        stage_list = [{'script': 'PostCountsToDatabase', 'stage': 'post', 'status': 'ok', 'wallTime': wall_time,
+                       'httpRequests': 2, 'httpRetries': 0, 'httpLatencyTotal': wall_time} for wall_time in range(1, 101)]
+        stage_list[0]['status'] = 'DatabaseInteractionError'
+        row, = summarizeStages(stage_list, ('wallTime', 'httpLatencyMean', 'bytesRead'), (50, 90))
+        self.assertEqual((row['runs'], row['failed'], row['httpRequests']), (100, 1, 200))
+        self.assertAlmostEqual(row['wallTime_p50'], 50.5)
+        self.assertAlmostEqual(row['wallTime_max'], 100)
+        self.assertAlmostEqual(row['httpLatencyMean_p50'], 25.25)
+        self.assertIsNone(row['bytesRead_p90'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+    single pass parsers for the novoalign and novosort logs. Each log type has a table of (metric, line label); the
+    labels are compiled into one anchored pattern with a named group per metric, so each line of the log is matched once
+    and the log is streamed rather than read into memory
+    usage: alignment_qc_dict = parseNovoalignLog('sample_novoalign.log')
+           sample_log_list = findSampleLogs('/path/to/run/logs')
+    author: chase.mateusiak@gmail.com
+    output: {'librarySize': 35003, 'uniqueAlignment': 22737, 'multiMap': 1986, 'noMap': 10233, 'homopolymerFilter': 47, 'readLengthFilter': 0}
+"""
+
+# standard library imports
+import sys
+import os
+import re
+import glob
+
+# the summary lines at the end of a novoalign log, eg '#      Read Sequences:    35003'
+NOVOALIGN_METRICS = (('librarySize', r'Read Sequences'),
+                     ('uniqueAlignment', r'Unique Alignment'),
+                     ('multiMap', r'Multi Mapped'),
+                     ('noMap', r'No Mapping Found'),
+                     ('homopolymerFilter', r'Homopolymer Filter'),
+                     ('readLengthFilter', r'Read Length'))
+# the duplicate marking summary of novosort --markDuplicates, eg '#     Duplicate Unpaired Reads    1234'
+NOVOSORT_METRICS = (('properPairs', r'Proper Pairs'),
+                    ('unpairedReads', r'Unpaired Reads'),
+                    ('duplicateProperPairs', r'Duplicate Proper Pairs'),
+                    ('duplicateUnpairedReads', r'Duplicate Unpaired Reads'))
+# suffixes of the logs published to ${run_directory}/logs by the novoalign process
+NOVOALIGN_LOG_SUFFIX = '_novoalign.log'
+NOVOSORT_LOG_SUFFIX = '_novosort.log'
+
+def compileMetricPattern(metric_table):
+    """
+        compile a table of (metric, label) into one pattern matching a line '# label: 123' (the # and : are optional)
+        with the value captured in a group named for the metric
+        :params metric_table: tuple of (metric name, label regex)
+        :returns: a compiled regex
+    """
+    alternatives = '|'.join(r'%s\s*:?\s*(?P<%s>\d+)' % (label, metric) for metric, label in metric_table)
+    return re.compile(r'#?\s*(?:%s)\b' % alternatives)
+
+NOVOALIGN_PATTERN = compileMetricPattern(NOVOALIGN_METRICS)
+NOVOSORT_PATTERN = compileMetricPattern(NOVOSORT_METRICS)
+
+def parseLog(log_file_path, metric_pattern, metric_names):
+    """
+        extract every metric from a log in one pass over its lines. The first value of a metric in the log is kept
+        :params log_file_path: path to the log
+        :params metric_pattern: compiled pattern from compileMetricPattern
+        :params metric_names: names of the metrics in the pattern, in output order
+        :returns: a dictionary of metric name to int. Metrics not found in the log are set to 0, with a message to stderr
+    """
+    metric_dict = {}
+    with open(log_file_path, 'r') as log_file:
+        for line in log_file:
+            match = metric_pattern.match(line)
+            if match and match.lastgroup not in metric_dict:
+                metric_dict[match.lastgroup] = int(match.group(match.lastgroup))
+
+    for metric in metric_names:
+        if metric not in metric_dict:
+            print('No %s in %s. Value set to 0' % (metric, log_file_path), file=sys.stderr)
+    return {metric: metric_dict.get(metric, 0) for metric in metric_names}
+
+def parseNovoalignLog(log_file_path):
+    """
+        parse the alignment summary out of a novoalign log
+        usage: alignment_qc_dict = parseNovoalignLog('sample_novoalign.log')
+        :params log_file_path: the filepath to a novoalign alignment log
+        :returns: a dictionary of the metrics in NOVOALIGN_METRICS
+    """
+    return parseLog(log_file_path, NOVOALIGN_PATTERN, [metric for metric, _ in NOVOALIGN_METRICS])
+
+def parseNovosortLog(log_file_path):
+    """
+        parse the duplicate marking summary out of a novosort log
+        usage: sort_qc_dict = parseNovosortLog('sample_novosort.log')
+        :params log_file_path: the filepath to a novosort log
+        :returns: a dictionary of the metrics in NOVOSORT_METRICS
+    """
+    return parseLog(log_file_path, NOVOSORT_PATTERN, [metric for metric, _ in NOVOSORT_METRICS])
+
+def parseSampleLogs(sample_name, novoalign_log_path=None, novosort_log_path=None):
+    """
+        parse the novoalign and (if present) novosort logs of one sample into one row
+        :params sample_name: name of the sample, eg the fastq simple name
+        :params novoalign_log_path: path to ${sample_name}_novoalign.log, or None
+        :params novosort_log_path: path to ${sample_name}_novosort.log, or None
+        :returns: a dictionary with sampleName and the metrics of each log given
+    """
+    row = {'sampleName': sample_name}
+    if novoalign_log_path:
+        row.update(parseNovoalignLog(novoalign_log_path))
+    if novosort_log_path:
+        row.update(parseNovosortLog(novosort_log_path))
+    return row
+
+def findSampleLogs(log_dir):
+    """
+        pair the novoalign and novosort logs in a log directory by sample name
+        :params log_dir: a run's logs directory, eg ${align_count_results}/${run_directory}/logs
+        :returns: a list of (sample_name, novoalign_log_path or None, novosort_log_path or None), sorted by sample name
+    """
+    log_dict = {}
+    for position, suffix in enumerate([NOVOALIGN_LOG_SUFFIX, NOVOSORT_LOG_SUFFIX]):
+        for log_path in glob.glob(os.path.join(log_dir, '*' + suffix)):
+            sample_name = os.path.basename(log_path)[:-len(suffix)]
+            log_dict.setdefault(sample_name, [None, None])[position] = log_path
+    return [(sample_name, *log_dict[sample_name]) for sample_name in sorted(log_dict)]
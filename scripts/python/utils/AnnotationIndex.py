@@ -0,0 +1,284 @@
+"""
+    parsed annotation interval index. A gtf or gff3 is parsed once into, for each feature type, the merged intervals
+    of every gene (as numpy arrays in CSR layout: the intervals of gene i are rows offsets[i]:offsets[i+1]) along with
+    the gene ids, strands and biotypes. The index is stored as .npy files in a directory named by the content hash of
+    the annotation, and the arrays are memory mapped the first time a feature type is used, so per sample steps can
+    look up a region length in O(1) instead of re-parsing the annotation
+    usage: annotation_index = loadAnnotationIndex('KN99_annotation.gff', '/path/to/cache')
+           annotation_index.regionLength('CNAG_NAT', 'CDS')
+           annotation_index.intervals('CNAG_NAT', 'CDS')
+    author: chase.mateusiak@gmail.com
+
+    layout of an index directory ${cache_dir}/${annotation_hash}.v${INDEX_VERSION}/:
+        meta.json                    {'annotationHash', 'chroms', 'geneIds', 'strands', 'biotypes', 'aliases', 'featureTypes'}
+        and, for each feature type, uncompressed arrays so that they can be memory mapped:
+        ${feature_type}_chroms.npy   int32 index into chroms of each interval
+        ${feature_type}_starts.npy   int64 0 based start of each interval
+        ${feature_type}_ends.npy     int64 end (exclusive) of each interval
+        ${feature_type}_offsets.npy  int64, length number of genes + 1
+        ${feature_type}_lengths.npy  int64 number of bases in the merged intervals of each gene
+        biotype_masks_${gene_index}.npy  bool biotypes x genes, added by utils/BiotypeMask.py for each count vector gene order
+"""
+
+# standard library imports
+import json
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+
+# third party imports
+import numpy as np
+
+# local imports
+from .GeneIndexCache import cacheKey, fileContentHash, parseAttributes, readJson, writeJsonAtomic
+
+# attributes which hold the biotype of a gene or transcript
+BIOTYPE_ATTRIBUTES = ('gene_biotype', 'biotype', 'gene_type', 'transcript_biotype', 'transcript_type')
+# attributes, besides the gene id itself, by which a gene may be looked up
+ALIAS_ATTRIBUTES = ('gene_id', 'gene', 'locus_tag', 'Name')
+# feature types which imply the biotype of a gene which does not state one
+FEATURE_TYPE_BIOTYPES = (('CDS', 'protein_coding'), ('rRNA', 'rRNA'), ('tRNA', 'tRNA'), ('snRNA', 'snRNA'),
+                         ('snoRNA', 'snoRNA'), ('ncRNA', 'ncRNA'), ('lnc_RNA', 'ncRNA'))
+# features which describe a sequence rather than a gene
+SEQUENCE_FEATURE_TYPES = ('region', 'chromosome', 'contig', 'supercontig')
+# version of the on disk layout. Bump this if the layout changes so that old indexes are rebuilt
+INDEX_VERSION = 1
+
+class AnnotationIndex:
+    """
+        an index directory written by buildAnnotationIndex(). Use loadAnnotationIndex() to find or build one
+        :params index_dir: path to the index directory
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as meta_file:
+            meta = json.load(meta_file)
+        self.annotation_hash = meta['annotationHash']
+        self.chroms = meta['chroms']
+        self.gene_ids = meta['geneIds']
+        self.strands = meta['strands']
+        self.biotypes = meta['biotypes']
+        self.feature_types = meta['featureTypes']
+        self._position_dict = {gene_id: position for position, gene_id in enumerate(self.gene_ids)}
+        for alias, position in meta['aliases'].items():
+            self._position_dict.setdefault(alias, position)
+        # feature type -> dict of memory mapped arrays, filled in as feature types are used
+        self._array_dict = {}
+
+    def genePosition(self, gene_id):
+        """
+            :params gene_id: gene id, or an alias of it (gene_id, gene, locus_tag or Name attribute)
+            :throws: KeyError if the gene is not in the annotation
+            :returns: the position of the gene in gene_ids
+        """
+        try:
+            return self._position_dict[gene_id]
+        except KeyError:
+            raise KeyError('AnnotationIndexError: %s is not a gene in the annotation' % gene_id)
+
+    def featureArrays(self, feature_type):
+        """
+            :params feature_type: eg CDS or exon
+            :throws: KeyError if the annotation has no features of the type
+            :returns: dict with the memory mapped arrays chroms, starts, ends, offsets and lengths
+        """
+        if feature_type not in self._array_dict:
+            if feature_type not in self.feature_types:
+                raise KeyError('AnnotationIndexError: the annotation has no %s features' % feature_type)
+            self._array_dict[feature_type] = {name: np.load(os.path.join(self.index_dir, '%s_%s.npy' % (feature_type, name)), mmap_mode='r')
+                                              for name in ['chroms', 'starts', 'ends', 'offsets', 'lengths']}
+        return self._array_dict[feature_type]
+
+    def regionLength(self, gene_id, feature_type):
+        """
+            :params gene_id: gene id or alias
+            :params feature_type: eg CDS
+            :throws: KeyError if the gene or feature type is not in the annotation
+            :returns: the number of bases in the merged features of the type in the gene
+        """
+        return int(self.featureArrays(feature_type)['lengths'][self.genePosition(gene_id)])
+
+    def intervals(self, gene_id, feature_type):
+        """
+            :params gene_id: gene id or alias
+            :params feature_type: eg CDS
+            :throws: KeyError if the gene or feature type is not in the annotation
+            :returns: list of merged (chrom, start, end), 0 based and half open
+        """
+        feature_arrays = self.featureArrays(feature_type)
+        position = self.genePosition(gene_id)
+        first, last = feature_arrays['offsets'][position], feature_arrays['offsets'][position + 1]
+        return [(self.chroms[chrom], int(start), int(end)) for chrom, start, end in
+                zip(feature_arrays['chroms'][first:last], feature_arrays['starts'][first:last], feature_arrays['ends'][first:last])]
+
+    def intervalDict(self, gene_ids, feature_type):
+        """
+            :returns: dict of gene id to intervals(gene_id, feature_type)
+        """
+        return {gene_id: self.intervals(gene_id, feature_type) for gene_id in gene_ids}
+
+def ancestors(parents, parent_dict):
+    """
+        :params parents: the Parent ids of a feature
+        :params parent_dict: map of feature ID to its Parent ids
+        :returns: the set of the parents and all of their ancestors
+    """
+    ancestor_set = set()
+    to_visit = list(parents)
+    while to_visit:
+        feature_id = to_visit.pop()
+        if feature_id in ancestor_set:
+            continue
+        ancestor_set.add(feature_id)
+        to_visit.extend(parent_dict.get(feature_id, []))
+    return ancestor_set
+
+def mergeIntervals(interval_list):
+    """
+        merge overlapping and book-ended intervals, as bedtools merge
+        :params interval_list: list of (chrom, start, end)
+        :returns: sorted list of merged (chrom, start, end)
+    """
+    merged_list = []
+    for chrom, start, end in sorted(interval_list):
+        if merged_list and merged_list[-1][0] == chrom and start <= merged_list[-1][2]:
+            merged_list[-1] = (chrom, merged_list[-1][1], max(end, merged_list[-1][2]))
+        else:
+            merged_list.append((chrom, start, end))
+    return merged_list
+
+def readAnnotation(annotation_path):
+    """
+        parse a gtf or gff3 into the features of each gene. In a gtf the gene of a feature is its gene_id. In a gff3
+        it is the top most ancestor, following Parent
+        :params annotation_path: path to a gtf or gff3
+        :returns: a tuple (gene_dict, chroms) where gene_dict is gene id -> {'strand', 'biotype', 'aliases', 'features':
+                  {feature_type: [(chrom, start, end), ...]}} and chroms is the list of chromosomes in order of appearance
+    """
+    parent_dict = {}
+    feature_list = []
+    chrom_dict = {}
+    with open(annotation_path, 'r') as annotation_file:
+        for line in annotation_file:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) < 9:
+                continue
+            attribute_dict = parseAttributes(fields[8])
+            if 'ID' in attribute_dict and 'Parent' in attribute_dict:
+                parent_dict[attribute_dict['ID']] = attribute_dict['Parent'].split(',')
+            chrom_dict.setdefault(fields[0], len(chrom_dict))
+            feature_list.append((fields[0], fields[2], int(fields[3]) - 1, int(fields[4]), fields[6], attribute_dict))
+
+    gene_dict = defaultdict(lambda: {'strand': '.', 'biotype': None, 'aliases': set(), 'features': defaultdict(list)})
+    for chrom, feature_type, start, end, strand, attribute_dict in feature_list:
+        if 'gene_id' in attribute_dict:
+            gene_id_list = [attribute_dict['gene_id']]
+        elif 'Parent' in attribute_dict:
+            # the roots of the Parent chain are the ones with no parent of their own
+            gene_id_list = [ancestor for ancestor in ancestors(attribute_dict['Parent'].split(','), parent_dict) if ancestor not in parent_dict]
+        elif 'ID' in attribute_dict and feature_type not in SEQUENCE_FEATURE_TYPES:
+            gene_id_list = [attribute_dict['ID']]
+        else:
+            continue
+        for gene_id in gene_id_list:
+            gene = gene_dict[gene_id]
+            gene['features'][feature_type].append((chrom, start, end))
+            if gene['strand'] == '.':
+                gene['strand'] = strand
+            if gene['biotype'] is None:
+                gene['biotype'] = next((attribute_dict[attribute] for attribute in BIOTYPE_ATTRIBUTES if attribute in attribute_dict), None)
+            # only the gene feature (or, in a gtf, any feature) names the gene
+            if feature_type == 'gene' or 'gene_id' in attribute_dict:
+                gene['aliases'].update(attribute_dict[attribute] for attribute in ALIAS_ATTRIBUTES if attribute in attribute_dict)
+
+    for gene in gene_dict.values():
+        if gene['biotype'] is None:
+            gene['biotype'] = next((biotype for feature_type, biotype in FEATURE_TYPE_BIOTYPES if feature_type in gene['features']), 'unknown')
+
+    return dict(gene_dict), list(chrom_dict)
+
+def buildAnnotationIndex(annotation_path, index_dir, annotation_hash=None):
+    """
+        parse an annotation and write its index to index_dir. The index is written to a temporary directory which is
+        renamed to index_dir, so a concurrent reader never sees a partial index
+        :params annotation_path: path to a gtf or gff3
+        :params index_dir: path of the index directory to create
+        :params annotation_hash: content hash of the annotation, if already known
+        :returns: the AnnotationIndex
+    """
+    annotation_hash = annotation_hash or fileContentHash(annotation_path)
+    gene_dict, chroms = readAnnotation(annotation_path)
+    chrom_position_dict = {chrom: position for position, chrom in enumerate(chroms)}
+    gene_ids = sorted(gene_dict)
+    feature_types = sorted({feature_type for gene in gene_dict.values() for feature_type in gene['features']})
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(index_dir), prefix='.tmp_index_')
+    try:
+        for feature_type in feature_types:
+            chrom_list, start_list, end_list, offsets, lengths = [], [], [], [0], []
+            for gene_id in gene_ids:
+                merged_list = mergeIntervals(gene_dict[gene_id]['features'].get(feature_type, []))
+                chrom_list.extend(chrom_position_dict[chrom] for chrom, _, _ in merged_list)
+                start_list.extend(start for _, start, _ in merged_list)
+                end_list.extend(end for _, _, end in merged_list)
+                offsets.append(offsets[-1] + len(merged_list))
+                lengths.append(sum(end - start for _, start, end in merged_list))
+            for name, values, dtype in [('chroms', chrom_list, np.int32), ('starts', start_list, np.int64), ('ends', end_list, np.int64),
+                                        ('offsets', offsets, np.int64), ('lengths', lengths, np.int64)]:
+                np.save(os.path.join(tmp_dir, '%s_%s.npy' % (feature_type, name)), np.asarray(values, dtype=dtype))
+
+        aliases = {alias: position for position, gene_id in enumerate(gene_ids)
+                   for alias in gene_dict[gene_id]['aliases'] if alias != gene_id}
+        meta = {'version': INDEX_VERSION, 'annotationHash': annotation_hash, 'chroms': chroms, 'geneIds': gene_ids,
+                'strands': [gene_dict[gene_id]['strand'] for gene_id in gene_ids],
+                'biotypes': [gene_dict[gene_id]['biotype'] for gene_id in gene_ids],
+                'aliases': aliases, 'featureTypes': feature_types}
+        writeJsonAtomic(os.path.join(tmp_dir, 'meta.json'), meta)
+        try:
+            os.rename(tmp_dir, index_dir)
+        except OSError:
+            # another process built the same index first
+            if not os.path.exists(os.path.join(index_dir, 'meta.json')):
+                raise
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return AnnotationIndex(index_dir)
+
+def indexDirName(annotation_hash):
+    """
+        :returns: the name of the index directory of an annotation, which includes the layout version
+    """
+    return '%s.v%s' % (annotation_hash, INDEX_VERSION)
+
+def loadAnnotationIndex(annotation_path, cache_dir):
+    """
+        find the index of an annotation in cache_dir, building it if it does not exist. As in GeneIndexCache, an
+        annotation whose path, size and modification time are unchanged is not re-hashed
+        usage: annotation_index = loadAnnotationIndex('KN99_annotation.gff', '/path/to/cache')
+        :params annotation_path: path to a gtf or gff3
+        :params cache_dir: directory which holds the indexes. Created if it does not exist
+        :returns: the AnnotationIndex
+    """
+    os.makedirs(os.path.join(cache_dir, 'stat'), exist_ok=True)
+    annotation_stat = os.stat(annotation_path)
+    stat_path = os.path.join(cache_dir, 'stat', cacheKey(os.path.realpath(annotation_path), annotation_stat.st_size,
+                                                         annotation_stat.st_mtime_ns, INDEX_VERSION) + '.json')
+    alias = readJson(stat_path)
+    if alias is not None and os.path.exists(os.path.join(cache_dir, indexDirName(alias['annotationHash']), 'meta.json')):
+        return AnnotationIndex(os.path.join(cache_dir, indexDirName(alias['annotationHash'])))
+
+    annotation_hash = fileContentHash(annotation_path)
+    index_dir = os.path.join(cache_dir, indexDirName(annotation_hash))
+    if os.path.exists(os.path.join(index_dir, 'meta.json')):
+        annotation_index = AnnotationIndex(index_dir)
+    else:
+        annotation_index = buildAnnotationIndex(annotation_path, index_dir, annotation_hash)
+    writeJsonAtomic(stat_path, {'annotationHash': annotation_hash})
+
+    return annotation_index
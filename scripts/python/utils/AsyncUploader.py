@@ -0,0 +1,172 @@
+"""
+    asyncio upload engine for the database api. Jobs are (url, data) pairs, optionally with a method, which are sent
+    with at most `concurrency` requests in flight and, optionally, at most `requests_per_second` requests per host.
+    The requests themselves are sent by a DatabaseClient (one per worker thread) so that the pooling, timeouts and
+    retries are the same as for a single post
+    usage: results = AsyncUploader(concurrency=8).uploadAll([UploadJob(counts_url, count_data), UploadJob(qc_url, qc_dict)])
+    author: chase.mateusiak@gmail.com
+"""
+
+# standard library imports
+import asyncio
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+# local imports
+from .DatabaseInteraction import DatabaseClient, DatabaseInteractionError
+
+# method is one of POST, PUT or POST_OR_PUT. primary_key_value is the id put to by POST_OR_PUT (see DatabaseClient.postOrPut()),
+# and the key of the record in the client's post cache for POST and POST_OR_PUT
+UploadJob = namedtuple('UploadJob', ['url', 'data', 'method', 'primary_key_value'], defaults=['POST', None])
+# ok is True if the request succeeded. status_code is None if no response was received. elapsed is in seconds.
+# cached is True if the payload was already sent and the request was skipped. transient is True if a failed request may
+# succeed if it is sent again later (see DatabaseInteractionError)
+UploadResult = namedtuple('UploadResult', ['job', 'ok', 'status_code', 'error', 'elapsed', 'cached', 'transient'],
+                          defaults=[False, False])
+
+class HostRateLimiter:
+    """
+        spaces out requests to a single host so that no more than requests_per_second start in any second
+        :params requests_per_second: maximum request rate to the host
+    """
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        """
+            sleep until the next request to this host is allowed to start
+        """
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class AsyncUploader:
+    """
+        upload many jobs concurrently
+        usage: uploader = AsyncUploader(concurrency=8, requests_per_second=20)
+               results = uploader.uploadAll(jobs)
+        :params concurrency: maximum number of requests in flight
+        :params requests_per_second: maximum rate of requests per host. Default None does not limit the rate
+        :params client_factory: callable which returns a DatabaseClient. One client is created per worker thread
+        :params on_result: optional callable which is passed each UploadResult as soon as the request finishes
+    """
+    def __init__(self, concurrency=8, requests_per_second=None, client_factory=DatabaseClient, on_result=None):
+        if concurrency < 1:
+            raise ValueError('AsyncUploaderError: concurrency must be at least 1')
+        self.concurrency = concurrency
+        self.requests_per_second = requests_per_second
+        self.client_factory = client_factory
+        self.on_result = on_result
+        self._thread_local = threading.local()
+        self._clients = []
+        self._clients_lock = threading.Lock()
+        self._rate_limiters = {}
+
+    def uploadAll(self, jobs):
+        """
+            upload every job and wait for all of them to finish
+            :params jobs: an iterable of UploadJob (or (url, data) tuples)
+            :returns: a list of UploadResult in the same order as jobs
+        """
+        return asyncio.run(self.uploadJobs(jobs))
+
+    async def uploadJobs(self, jobs):
+        """
+            coroutine version of uploadAll()
+        """
+        job_queue = asyncio.Queue()
+        for index, job in enumerate(jobs):
+            job_queue.put_nowait((index, job))
+        job_queue.put_nowait(None)
+        results = await self.run(job_queue)
+        return [result for index, result in sorted(results, key=lambda indexed_result: indexed_result[0])]
+
+    async def run(self, job_queue):
+        """
+            consume (key, job) items from an asyncio.Queue until a None is taken off of it. Producers may keep
+            adding jobs while the upload is running, and put None on the queue when they are done
+            :params job_queue: asyncio.Queue of (key, UploadJob) tuples, terminated by None. key is any value used to match up the results
+            :returns: a list of (key, UploadResult) in the order in which the requests finished
+        """
+        results = []
+        # rate limiters hold asyncio locks, which belong to the running event loop
+        self._rate_limiters = {}
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            workers = [asyncio.ensure_future(self._worker(job_queue, executor, results)) for _ in range(self.concurrency)]
+            await asyncio.gather(*workers)
+        finally:
+            executor.shutdown(wait=True)
+            self.close()
+        return results
+
+    def close(self):
+        """
+            close the clients created by the worker threads
+        """
+        with self._clients_lock:
+            for client in self._clients:
+                client.close()
+            self._clients = []
+        self._thread_local = threading.local()
+
+    async def _worker(self, job_queue, executor, results):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await job_queue.get()
+            if item is None:
+                # put the sentinel back so that the other workers stop too
+                job_queue.put_nowait(None)
+                return
+            key, job = item
+            job = UploadJob(*job)
+            rate_limiter = self._rateLimiter(job.url)
+            if rate_limiter is not None:
+                await rate_limiter.wait()
+            result = await loop.run_in_executor(executor, self._send, job)
+            results.append((key, result))
+            if self.on_result is not None:
+                self.on_result(result)
+
+    def _rateLimiter(self, url):
+        if self.requests_per_second is None:
+            return None
+        host = urlparse(url).netloc
+        if host not in self._rate_limiters:
+            self._rate_limiters[host] = HostRateLimiter(self.requests_per_second)
+        return self._rate_limiters[host]
+
+    def _client(self):
+        # requests sessions are not guaranteed to be thread safe, so each worker thread gets its own client
+        client = getattr(self._thread_local, 'client', None)
+        if client is None:
+            client = self.client_factory()
+            self._thread_local.client = client
+            with self._clients_lock:
+                self._clients.append(client)
+        return client
+
+    def _send(self, job):
+        client = self._client()
+        start = time.monotonic()
+        try:
+            if job.method == 'POST_OR_PUT':
+                response = client.postOrPut(job.url, job.primary_key_value, job.data)
+            elif job.method == 'POST' and job.primary_key_value is not None:
+                response = client.post(job.url, job.data, record_key=job.primary_key_value)
+            else:
+                response = client.request(job.method, job.url, job.data)
+        except DatabaseInteractionError as e:
+            return UploadResult(job, False, e.status_code, str(e), time.monotonic() - start, transient=e.transient)
+        except Exception as e:
+            # eg a payload which can not be encoded. One bad job must not lose the results of the others
+            return UploadResult(job, False, None, '%s %s failed: %r' % (job.method, job.url, e), time.monotonic() - start)
+        return UploadResult(job, True, response.status_code, None, time.monotonic() - start, getattr(response, 'from_cache', False))
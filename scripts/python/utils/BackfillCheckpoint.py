@@ -0,0 +1,130 @@
+"""
+    per sample, per stage checkpoints of a backfill (see RunBackfill.py), so that an interrupted or partly failed
+    backfill re-runs only the stages which did not finish. Each (fastqFileNumber, stage) has the status of its last
+    attempt and the fingerprint of the inputs it ran on. A stage is done only if its status is done and its inputs are
+    unchanged, so re-publishing an artifact re-runs the stages which read it
+    usage: with BackfillCheckpoint('/path/to/checkpoints') as checkpoint:
+               if not checkpoint.isDone(1, 'counts', input_fingerprint):
+                   ...
+                   checkpoint.record(1, 'counts', DONE, input_fingerprint)
+    author: chase.mateusiak@gmail.com
+
+    the checkpoints are one sqlite database, ${checkpoint_dir}/backfill_checkpoint.sqlite, in WAL mode so that the
+    worker processes of a backfill can each record their stages as they finish
+"""
+
+# standard library imports
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+# local imports
+from .GeneIndexCache import cacheKey
+
+# name of the database file in the checkpoint directory
+CHECKPOINT_FILE_NAME = 'backfill_checkpoint.sqlite'
+# status of a stage. Only done stages are skipped on the next run
+DONE = 'done'
+FAILED = 'failed'
+MISSING = 'missing'
+
+# a row of the checkpoints. updated_at is seconds since the epoch
+Checkpoint = namedtuple('Checkpoint', ['fastq_file_number', 'stage', 'status', 'input_fingerprint', 'message', 'updated_at'])
+
+def inputFingerprint(stage, input_paths, *settings):
+    """
+        :params stage: name of the stage
+        :params input_paths: the files the stage reads. A path which does not exist is part of the fingerprint as such
+        :params settings: anything else which changes the output of the stage, eg the annotation or whether it posts
+        :returns: a hash of the stage, the path, size and modification time of each input, and the settings
+    """
+    key_fields = [stage]
+    for input_path in input_paths:
+        try:
+            input_stat = os.stat(input_path)
+            key_fields.extend([os.path.realpath(input_path), input_stat.st_size, input_stat.st_mtime_ns])
+        except OSError:
+            key_fields.extend([input_path, None, None])
+    return cacheKey(*(key_fields + list(settings)))
+
+class BackfillCheckpoint:
+    """
+        sqlite backed checkpoints of a backfill. Open one per process
+        :params checkpoint_dir: directory which holds the checkpoint database. Created if it does not exist
+        :params timeout: seconds to wait for another process's write lock
+    """
+    def __init__(self, checkpoint_dir, timeout=30):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.checkpoint_path = os.path.join(checkpoint_dir, CHECKPOINT_FILE_NAME)
+        self.connection = sqlite3.connect(self.checkpoint_path, timeout=timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoints ('
+                                'fastq_file_number TEXT NOT NULL, stage TEXT NOT NULL, status TEXT NOT NULL, '
+                                'input_fingerprint TEXT, message TEXT, updated_at REAL NOT NULL, '
+                                'PRIMARY KEY (fastq_file_number, stage))')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, fastq_file_number, stage):
+        """
+            :returns: the Checkpoint of the last attempt of the stage of the sample, or None if it has not been attempted
+        """
+        row = self.connection.execute('SELECT fastq_file_number, stage, status, input_fingerprint, message, updated_at '
+                                      'FROM checkpoints WHERE fastq_file_number = ? AND stage = ?',
+                                      (str(fastq_file_number), stage)).fetchone()
+        return Checkpoint(*row) if row else None
+
+    def isDone(self, fastq_file_number, stage, input_fingerprint):
+        """
+            :returns: True if the stage of the sample finished on inputs with this fingerprint
+        """
+        checkpoint = self.lookup(fastq_file_number, stage)
+        return checkpoint is not None and checkpoint.status == DONE and checkpoint.input_fingerprint == input_fingerprint
+
+    def record(self, fastq_file_number, stage, status, input_fingerprint=None, message=''):
+        """
+            record an attempt of a stage of a sample, replacing the last
+            :params status: one of DONE, FAILED or MISSING (an input was not found)
+            :params message: the error, or what was missing
+        """
+        self.connection.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?)',
+                                (str(fastq_file_number), stage, status, input_fingerprint, message, time.time()))
+
+    def reset(self, stage=None, status=None):
+        """
+            delete checkpoints, so that the stages run again on the next backfill
+            :params stage: only delete checkpoints of this stage. Default all stages
+            :params status: only delete checkpoints with this status. Default any status
+            :returns: the number of checkpoints deleted
+        """
+        clauses, parameters = [], []
+        if stage is not None:
+            clauses.append('stage = ?')
+            parameters.append(stage)
+        if status is not None:
+            clauses.append('status = ?')
+            parameters.append(status)
+        where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+        return self.connection.execute('DELETE FROM checkpoints' + where, parameters).rowcount
+
+    def stats(self):
+        """
+            :returns: a list of (stage, status, number of samples) tuples
+        """
+        return self.connection.execute('SELECT stage, status, COUNT(*) FROM checkpoints GROUP BY stage, status ORDER BY stage, status').fetchall()
+
+    def failures(self):
+        """
+            :returns: a list of the Checkpoints which are not done
+        """
+        return [Checkpoint(*row) for row in self.connection.execute(
+            'SELECT fastq_file_number, stage, status, input_fingerprint, message, updated_at FROM checkpoints '
+            'WHERE status != ? ORDER BY stage, fastq_file_number', (DONE,))]
@@ -0,0 +1,85 @@
+"""
+    biotype masks aligned to a count vector. The biotype of each gene comes from the annotation (its gene_biotype, biotype
+    or gene_type attribute, or else the type of its features, see AnnotationIndex.readAnnotation()), so protein coding,
+    rRNA, tRNA, ncRNA etc. totals are correct for any organism rather than for the gene id prefix of one. The masks are a
+    boolean matrix (biotypes x genes) cached in the annotation's index directory, keyed by the geneIndex of the count
+    vector, and the totals of every sample in a run are one matrix product
+    usage: biotype_list, masks = loadBiotypeMasks('KN99_annotation.gff', '/path/to/cache', gene_ids)
+           biotype_totals = biotypeTotals(count_matrix, masks)
+    author: chase.mateusiak@gmail.com
+"""
+
+# standard library imports
+import os
+import tempfile
+
+# third party imports
+import numpy as np
+
+# local imports
+from .AnnotationIndex import loadAnnotationIndex
+from .CountPayload import geneIndexId
+
+# biotype of the genes summed into proteinCodingCounted
+PROTEIN_CODING_BIOTYPE = 'protein_coding'
+
+def biotypeMasks(annotation_index, gene_ids):
+    """
+        one boolean mask per biotype over the genes of a count vector
+        :params annotation_index: an AnnotationIndex
+        :params gene_ids: gene ids of the count vector, in order. Genes which are not in the annotation are in no mask
+        :returns: a tuple (biotype_list, masks). biotype_list is the sorted biotypes of the annotation and masks is a
+                  bool array of shape (len(biotype_list), len(gene_ids))
+    """
+    biotype_list = sorted(set(annotation_index.biotypes))
+    biotype_position_dict = {biotype: position for position, biotype in enumerate(biotype_list)}
+    masks = np.zeros((len(biotype_list), len(gene_ids)), dtype=bool)
+    for column, gene_id in enumerate(gene_ids):
+        try:
+            position = annotation_index.genePosition(gene_id)
+        except KeyError:
+            continue
+        masks[biotype_position_dict[annotation_index.biotypes[position]], column] = True
+    return biotype_list, masks
+
+def loadBiotypeMasks(annotation_path, cache_dir, gene_ids):
+    """
+        find the biotype masks of a count vector's genes in the annotation's index, building and caching them if needed
+        usage: biotype_list, masks = loadBiotypeMasks('KN99_annotation.gff', '/path/to/cache', gene_ids)
+        :params annotation_path: path to a gtf or gff3
+        :params cache_dir: directory of annotation indexes (see AnnotationIndex.loadAnnotationIndex()). If None, the
+                           index is built in a temporary directory and nothing is cached
+        :params gene_ids: gene ids of the count vector, in order
+        :returns: a tuple (biotype_list, masks), see biotypeMasks()
+    """
+    if cache_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            return loadBiotypeMasks(annotation_path, tmp_dir, gene_ids)
+
+    annotation_index = loadAnnotationIndex(annotation_path, cache_dir)
+    biotype_list = sorted(set(annotation_index.biotypes))
+    mask_path = os.path.join(annotation_index.index_dir, 'biotype_masks_%s.npy' % geneIndexId(gene_ids))
+    if os.path.exists(mask_path):
+        return biotype_list, np.load(mask_path)
+
+    biotype_list, masks = biotypeMasks(annotation_index, gene_ids)
+    # write to a temporary file and rename, so a concurrent reader never sees a partial mask
+    fd, tmp_path = tempfile.mkstemp(dir=annotation_index.index_dir, prefix='.tmp_masks_', suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            np.save(tmp_file, masks)
+        os.replace(tmp_path, mask_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return biotype_list, masks
+
+def biotypeTotals(count_matrix, masks):
+    """
+        the total counts of each biotype in each sample
+        usage: biotype_totals = biotypeTotals([[10, 0, 7], [1, 2, 3]], masks)
+        :params count_matrix: array like of shape (samples, genes), or a single count vector
+        :params masks: bool array of shape (biotypes, genes) from biotypeMasks() or loadBiotypeMasks()
+        :returns: int64 array of shape (samples, biotypes), or (biotypes,) for a single count vector
+    """
+    return np.asarray(count_matrix, dtype=np.int64) @ masks.T.astype(np.int64)
@@ -0,0 +1,306 @@
+"""
+    run level genes x samples count matrix store. Each htseq task appends its sample as it finishes, rather than every
+    downstream step re-reading and joining the per sample _counts.csv files. The matrix is kept as uint32 .npy chunks
+    (genes x samples in the chunk) which are memory mapped when read, so a subset of samples only touches the chunks
+    holding them and a subset of genes only the pages of those rows
+    usage: CountMatrixStore('/path/to/run/count_matrix').append('sample_1', gene_ids, gene_counts)
+           sample_names, gene_ids, count_matrix = CountMatrixStore('/path/to/run/count_matrix').read(samples=['sample_1'])
+    author: chase.mateusiak@gmail.com
+
+    layout of a store directory:
+        genes.json           {'geneIndex', 'geneIds'}, written by the first append
+        manifest.json        {'version', 'chunks': {chunk file: number of columns}, 'samples': {sample name: [chunk file, column]},
+                              'retired': {chunk file: time it was compacted away}}
+        chunks/*.npy         uint32 arrays of shape (genes, columns)
+        .lock                held (fcntl.flock) while the manifest is read, modified and replaced
+    Chunks are written under a unique name and renamed into place before the manifest which lists them is replaced, so a
+    reader only ever sees complete chunks and a complete manifest. A sample which is appended again is moved to the new
+    chunk; its old column is dropped by compact(). The chunks compact() replaces are retired rather than removed, since a
+    reader may have listed them in the manifest it read and not yet opened them, and are removed by a later compact()
+    (or removeRetiredChunks()) once they are older than RETIRED_CHUNK_AGE
+"""
+
+# standard library imports
+import fcntl
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+# third party imports
+import numpy as np
+
+# local imports
+from .CountPayload import MAX_COUNT, geneIndexId
+from .GeneIndexCache import readJson, writeJsonAtomic
+
+# version of the on disk layout
+STORE_VERSION = 1
+# dtype of the stored counts, the same as the packed count payload
+COUNT_DTYPE = np.uint32
+# bytes of counts compact() holds in memory at a time
+COMPACT_BLOCK_BYTES = 64 << 20
+# seconds a retired chunk is kept for the readers which may still open it
+RETIRED_CHUNK_AGE = 3600
+
+class CountMatrixStore:
+    """
+        a run's count matrix store. Safe to append to from many processes at once on a filesystem which supports flock
+        :params store_dir: path to the store directory. Created if it does not exist
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.chunk_dir = os.path.join(store_dir, 'chunks')
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        self._genes = None
+
+    @contextmanager
+    def lock(self):
+        """
+            hold the store's exclusive lock. Appends and compaction take it; readers do not need it
+        """
+        with open(os.path.join(self.store_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def manifest(self):
+        """
+            :returns: the current manifest (an empty one if nothing has been appended)
+        """
+        return readJson(os.path.join(self.store_dir, 'manifest.json')) or {'version': STORE_VERSION, 'chunks': {}, 'samples': {}}
+
+    @property
+    def gene_ids(self):
+        """
+            :returns: the gene ids of the rows of the matrix, or [] if nothing has been appended
+        """
+        return self._readGenes()['geneIds']
+
+    @property
+    def sample_names(self):
+        """
+            :returns: the names of the samples in the store, in the order in which they were (last) appended
+        """
+        return list(self.manifest()['samples'])
+
+    def _readGenes(self):
+        if self._genes is None:
+            self._genes = readJson(os.path.join(self.store_dir, 'genes.json'))
+        return self._genes or {'geneIndex': None, 'geneIds': []}
+
+    def append(self, sample_name, gene_ids, gene_counts):
+        """
+            add (or replace) one sample
+            usage: store.append('sample_1', gene_ids, gene_counts)
+            :params sample_name: name of the sample, eg the fastq simple name
+            :params gene_ids: gene ids of gene_counts, in order. Must be the same as those already in the store
+            :params gene_counts: list of non-negative ints
+            :throws: ValueError if the genes differ from those in the store or a count does not fit in a uint32
+        """
+        self.appendSamples([sample_name], gene_ids, np.asarray(gene_counts).reshape(-1, 1))
+
+    def appendSamples(self, sample_names, gene_ids, count_matrix):
+        """
+            add (or replace) many samples as one chunk
+            :params sample_names: names of the samples, one per column of count_matrix
+            :params gene_ids: gene ids of the rows of count_matrix
+            :params count_matrix: array like of shape (genes, samples)
+            :throws: ValueError if the genes differ from those in the store or a count does not fit in a uint32
+        """
+        count_matrix = np.asarray(count_matrix)
+        if count_matrix.shape != (len(gene_ids), len(sample_names)):
+            raise ValueError('CountMatrixStoreError: count matrix of shape %s does not match %s genes and %s samples'
+                             % (count_matrix.shape, len(gene_ids), len(sample_names)))
+        if count_matrix.size and (count_matrix.min() < 0 or count_matrix.max() > MAX_COUNT):
+            raise ValueError('CountMatrixStoreError: counts must be between 0 and %s' % MAX_COUNT)
+        gene_index = geneIndexId(gene_ids)
+
+        # write the chunk outside of the lock. It is not visible to readers until the manifest lists it
+        chunk_file = self._writeChunk(count_matrix.astype(COUNT_DTYPE))
+        try:
+            with self.lock():
+                self._genes = None
+                genes = self._readGenes()
+                if genes['geneIndex'] is None:
+                    writeJsonAtomic(os.path.join(self.store_dir, 'genes.json'), {'geneIndex': gene_index, 'geneIds': list(gene_ids)})
+                    self._genes = None
+                elif genes['geneIndex'] != gene_index:
+                    raise ValueError('CountMatrixStoreError: the genes of %s are not those of the store %s' % (', '.join(sample_names), self.store_dir))
+                manifest = self.manifest()
+                manifest['chunks'][chunk_file] = len(sample_names)
+                for column, sample_name in enumerate(sample_names):
+                    # re-inserting moves a replaced sample to the end
+                    manifest['samples'].pop(sample_name, None)
+                    manifest['samples'][sample_name] = [chunk_file, column]
+                writeJsonAtomic(os.path.join(self.store_dir, 'manifest.json'), manifest)
+        except BaseException:
+            os.remove(os.path.join(self.chunk_dir, chunk_file))
+            raise
+
+    def _writeChunk(self, chunk):
+        """
+            write a chunk to a temporary file and rename it to a unique name
+            :returns: the chunk file name
+        """
+        chunk_file = '%s.npy' % uuid.uuid4().hex
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=self.chunk_dir, prefix='.tmp_chunk_', suffix='.npy')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as tmp_file:
+                np.save(tmp_file, chunk)
+            os.replace(tmp_path, os.path.join(self.chunk_dir, chunk_file))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return chunk_file
+
+    def _writeChunkBlocks(self, shape, blocks):
+        """
+            write a chunk a block of rows at a time, through a memory map, to a temporary file and rename it to a unique name
+            :params shape: (genes, columns) of the chunk
+            :params blocks: iterable of (row_start, count_block), eg readBlocks()
+            :returns: the chunk file name
+        """
+        chunk_file = '%s.npy' % uuid.uuid4().hex
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=self.chunk_dir, prefix='.tmp_chunk_', suffix='.npy')
+        os.close(file_descriptor)
+        try:
+            chunk = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=COUNT_DTYPE, shape=shape)
+            for row_start, count_block in blocks:
+                chunk[row_start:row_start + len(count_block)] = count_block
+            chunk.flush()
+            del chunk
+            os.replace(tmp_path, os.path.join(self.chunk_dir, chunk_file))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return chunk_file
+
+    def read(self, samples=None, genes=None):
+        """
+            read a subset of the matrix. Only the chunks with the requested samples are opened, and they are memory
+            mapped so only the requested gene rows are read from disk
+            usage: sample_names, gene_ids, count_matrix = store.read(samples=['sample_1'], genes=['CKF44_00001'])
+            :params samples: sample names, in the order wanted. Default all samples in append order
+            :params genes: gene ids, in the order wanted. Default all genes
+            :throws: KeyError if a sample or gene is not in the store
+            :returns: a tuple (sample_names, gene_ids, count_matrix) where count_matrix is a uint32 array (genes x samples)
+        """
+        manifest = self.manifest()
+        all_gene_ids = self.gene_ids
+        sample_names = list(manifest['samples']) if samples is None else list(samples)
+        gene_ids = all_gene_ids if genes is None else list(genes)
+        gene_position_dict = {gene_id: position for position, gene_id in enumerate(all_gene_ids)}
+        try:
+            rows = np.asarray([gene_position_dict[gene_id] for gene_id in gene_ids], dtype=np.int64)
+        except KeyError as e:
+            raise KeyError('CountMatrixStoreError: gene %s is not in %s' % (e.args[0], self.store_dir))
+
+        count_matrix = np.zeros((len(gene_ids), len(sample_names)), dtype=COUNT_DTYPE)
+        for chunk, positions, columns in self._chunkColumns(manifest, sample_names):
+            count_matrix[:, positions] = chunk[rows][:, columns]
+
+        return sample_names, gene_ids, count_matrix
+
+    def readBlocks(self, block_rows, samples=None):
+        """
+            read the whole matrix a block of gene rows at a time, so that memory holds only block_rows x samples counts.
+            Each chunk is memory mapped once and only the rows of the block are read from it
+            usage: for row_start, count_block in store.readBlocks(10000): ...
+            :params block_rows: number of gene rows in a block
+            :params samples: sample names, in the order wanted. Default all samples in append order
+            :throws: KeyError if a sample is not in the store
+            :returns: a generator of (row_start, count_block) where count_block is a uint32 array (block genes x samples)
+        """
+        manifest = self.manifest()
+        sample_names = list(manifest['samples']) if samples is None else list(samples)
+        chunk_list = self._chunkColumns(manifest, sample_names)
+
+        num_genes = len(self.gene_ids)
+        for row_start in range(0, num_genes, block_rows):
+            row_end = min(row_start + block_rows, num_genes)
+            count_block = np.zeros((row_end - row_start, len(sample_names)), dtype=COUNT_DTYPE)
+            for chunk, positions, columns in chunk_list:
+                count_block[:, positions] = chunk[row_start:row_end, columns]
+            yield row_start, count_block
+
+    def _chunkColumns(self, manifest, sample_names):
+        """
+            group the requested samples by chunk so each chunk is opened once
+            :throws: KeyError if a sample is not in the store
+            :returns: a list of (memory mapped chunk, positions in sample_names, columns in the chunk)
+        """
+        chunk_column_dict = {}
+        for position, sample_name in enumerate(sample_names):
+            if sample_name not in manifest['samples']:
+                raise KeyError('CountMatrixStoreError: sample %s is not in %s' % (sample_name, self.store_dir))
+            chunk_file, column = manifest['samples'][sample_name]
+            chunk_column_dict.setdefault(chunk_file, []).append((position, column))
+        return [(np.load(os.path.join(self.chunk_dir, chunk_file), mmap_mode='r'),
+                 [position for position, _ in position_column_list], [column for _, column in position_column_list])
+                for chunk_file, position_column_list in chunk_column_dict.items()]
+
+    def compact(self, block_rows=None, retired_chunk_age=RETIRED_CHUNK_AGE):
+        """
+            rewrite all of the samples into one chunk, a block of gene rows at a time, dropping replaced columns. The old
+            chunks are retired, to be removed once they are older than retired_chunk_age, so readers may keep using the
+            store. Appends wait on the lock for the compaction, so run it when a run's appends are done
+            :params block_rows: number of gene rows read and written at a time. Default keeps a block within COMPACT_BLOCK_BYTES
+            :params retired_chunk_age: see removeRetiredChunks()
+            :returns: the number of chunks retired
+        """
+        with self.lock():
+            manifest = self.manifest()
+            retired_dict = manifest.get('retired', {})
+            if len(manifest['chunks']) <= 1 and sum(manifest['chunks'].values()) == len(manifest['samples']):
+                retired_dict = self._removeRetiredChunks(retired_dict, retired_chunk_age)
+                if retired_dict != manifest.get('retired', {}):
+                    manifest['retired'] = retired_dict
+                    writeJsonAtomic(os.path.join(self.store_dir, 'manifest.json'), manifest)
+                return 0
+            sample_names = list(manifest['samples'])
+            if block_rows is None:
+                block_rows = max(1, COMPACT_BLOCK_BYTES // (np.dtype(COUNT_DTYPE).itemsize * max(1, len(sample_names))))
+            chunk_file = self._writeChunkBlocks((len(self.gene_ids), len(sample_names)), self.readBlocks(block_rows, sample_names))
+            retired_at = time.time()
+            retired_dict = self._removeRetiredChunks(retired_dict, retired_chunk_age)
+            retired_dict.update({old_chunk_file: retired_at for old_chunk_file in manifest['chunks']})
+            compacted_manifest = {'version': STORE_VERSION, 'chunks': {chunk_file: len(sample_names)},
+                                  'samples': {sample_name: [chunk_file, column] for column, sample_name in enumerate(sample_names)},
+                                  'retired': retired_dict}
+            writeJsonAtomic(os.path.join(self.store_dir, 'manifest.json'), compacted_manifest)
+        return len(manifest['chunks'])
+
+    def removeRetiredChunks(self, retired_chunk_age=RETIRED_CHUNK_AGE):
+        """
+            remove the chunks compact() retired more than retired_chunk_age seconds ago
+            :params retired_chunk_age: seconds a retired chunk is kept. It should be longer than a read takes to open its chunks
+            :returns: the number of chunk files removed
+        """
+        with self.lock():
+            manifest = self.manifest()
+            retired_dict = manifest.get('retired', {})
+            kept_dict = self._removeRetiredChunks(retired_dict, retired_chunk_age)
+            if len(kept_dict) != len(retired_dict):
+                manifest['retired'] = kept_dict
+                writeJsonAtomic(os.path.join(self.store_dir, 'manifest.json'), manifest)
+        return len(retired_dict) - len(kept_dict)
+
+    def _removeRetiredChunks(self, retired_dict, retired_chunk_age):
+        """
+            remove the retired chunks older than retired_chunk_age. Call with the lock held
+            :returns: the retired dict of the chunks which are kept
+        """
+        now = time.time()
+        kept_dict = {}
+        for chunk_file, retired_at in retired_dict.items():
+            if now - retired_at < retired_chunk_age:
+                kept_dict[chunk_file] = retired_at
+            elif os.path.exists(os.path.join(self.chunk_dir, chunk_file)):
+                os.remove(os.path.join(self.chunk_dir, chunk_file))
+        return kept_dict
@@ -0,0 +1,183 @@
+"""
+    library sizes, CPM, log2 CPM and TPM of a run's count matrix store (see utils/CountMatrixStore.py), in place of
+    re-reading every _counts.csv in R. The matrix is read a block of gene rows at a time: one pass totals the library
+    size (and, for TPM, the length normalized total) of each sample, and a second normalizes each block and writes it
+    into memory mapped .npy files, so memory holds one block whatever the size of the run. CPM and log2 CPM are those of
+    edgeR::cpm() without normalization factors, the normalization done in R before
+    usage: manifest = normalizeCountMatrix(CountMatrixStore('/path/to/run/count_matrix'), '/path/to/run/normalized', prior_count=2)
+           sample_names, gene_ids, log2_cpm = readNormalized('/path/to/run/normalized', 'log2cpm')
+    author: chase.mateusiak@gmail.com
+
+    layout of an output directory:
+        normalization.json   {'version', 'geneIndex', 'geneIds', 'samples', 'libSizes', 'priorCount', 'measures': {measure: file}}
+        cpm.npy, log2cpm.npy and, given gene lengths, tpm.npy, float32 arrays of shape (genes, samples)
+    the arrays are written under temporary names and renamed into place before normalization.json is replaced
+"""
+
+# standard library imports
+import os
+import tempfile
+
+# third party imports
+import numpy as np
+
+# local imports
+from .CountPayload import geneIndexId
+from .GeneIndexCache import readJson, writeJsonAtomic
+
+# version of the on disk layout
+NORMALIZATION_VERSION = 1
+# dtype of the normalized matrices
+NORMALIZED_DTYPE = np.float32
+# bytes of float64 values per block of gene rows, which bounds the memory used
+BLOCK_BYTES = 64 << 20
+# edgeR::cpm() default
+DEFAULT_PRIOR_COUNT = 2
+
+def cpm(counts, lib_sizes):
+    """
+        counts per million, as edgeR::cpm(y, lib.size=lib_sizes)
+        :params counts: array (genes x samples)
+        :params lib_sizes: library size of each sample
+        :returns: float64 array (genes x samples)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return counts / (np.asarray(lib_sizes, dtype=np.float64) * 1e-6)
+
+def log2Cpm(counts, lib_sizes, prior_count=DEFAULT_PRIOR_COUNT):
+    """
+        log2 counts per million, as edgeR::cpm(y, lib.size=lib_sizes, log=TRUE, prior.count=prior_count): the prior
+        count is scaled by each library size relative to the mean library size, added to every count and twice to the
+        library size
+        :params counts: array (genes x samples)
+        :params lib_sizes: library size of each sample, over all genes (not only those in counts)
+        :params prior_count: average count added to each count to avoid log of 0
+        :returns: float64 array (genes x samples)
+    """
+    lib_sizes = np.asarray(lib_sizes, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prior_counts = prior_count * lib_sizes / lib_sizes.mean()
+        return np.log2((counts + prior_counts) / ((lib_sizes + 2 * prior_counts) * 1e-6))
+
+def tpm(counts, gene_lengths, rate_totals):
+    """
+        transcripts per million: each count divided by the length of its gene, as a fraction of the sample's total
+        :params counts: array (genes x samples)
+        :params gene_lengths: length of each gene (row) of counts
+        :params rate_totals: sum over all genes of count / length of each sample, see libraryTotals
+        :returns: float64 array (genes x samples)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return counts / np.asarray(gene_lengths, dtype=np.float64).reshape(-1, 1) / np.asarray(rate_totals) * 1e6
+
+def defaultBlockRows(num_samples):
+    """
+        :returns: the number of gene rows per block which keeps a float64 block within BLOCK_BYTES
+    """
+    return max(1, BLOCK_BYTES // (8 * max(1, num_samples)))
+
+def libraryTotals(store, sample_names, block_rows, gene_lengths=None):
+    """
+        one blockwise pass over the count matrix
+        :params store: a CountMatrixStore
+        :params sample_names: samples to total
+        :params block_rows: number of gene rows read at a time
+        :params gene_lengths: length of each gene of the store, or None
+        :returns: a tuple (lib_sizes, rate_totals). rate_totals is the sum of count / length of each sample, or None
+                  without gene_lengths
+    """
+    lib_sizes = np.zeros(len(sample_names), dtype=np.float64)
+    rate_totals = None if gene_lengths is None else np.zeros(len(sample_names), dtype=np.float64)
+    for row_start, count_block in store.readBlocks(block_rows, sample_names):
+        lib_sizes += count_block.sum(axis=0, dtype=np.float64)
+        if gene_lengths is not None:
+            rate_totals += (count_block / gene_lengths[row_start:row_start + len(count_block)].reshape(-1, 1)).sum(axis=0)
+    return lib_sizes, rate_totals
+
+def geneLengths(annotation_index, gene_ids, feature_type='exon'):
+    """
+        :params annotation_index: an AnnotationIndex
+        :params gene_ids: gene ids, eg the rows of a count matrix store
+        :params feature_type: the feature type whose merged length is the length of a gene. Default exon, as htseq counts
+        :throws: ValueError if a gene is not in the annotation or has no bases of the feature type
+        :returns: float64 array of the length of each gene
+    """
+    try:
+        gene_lengths = np.asarray([annotation_index.regionLength(gene_id, feature_type) for gene_id in gene_ids], dtype=np.float64)
+    except KeyError as e:
+        raise ValueError('CountNormalizationError: %s' % e.args[0])
+    if not gene_lengths.all():
+        raise ValueError('CountNormalizationError: %s genes, eg %s, have no %s features so have no length for TPM'
+                         % (np.count_nonzero(gene_lengths == 0), gene_ids[int(np.argmin(gene_lengths))], feature_type))
+    return gene_lengths
+
+def normalizeCountMatrix(store, output_dir, prior_count=DEFAULT_PRIOR_COUNT, gene_lengths=None, samples=None, block_rows=None):
+    """
+        write the CPM, log2 CPM and, given gene lengths, TPM of a count matrix store
+        usage: manifest = normalizeCountMatrix(store, '/path/to/run/normalized', gene_lengths=geneLengths(annotation_index, store.gene_ids))
+        :params store: a CountMatrixStore
+        :params output_dir: directory to which to write the matrices. Created if it does not exist
+        :params prior_count: prior count of log2 CPM. Default 2, as edgeR
+        :params gene_lengths: length of each gene of the store, eg from geneLengths(). If None, TPM is not written
+        :params samples: sample names, in the order wanted. Default all samples in append order
+        :params block_rows: number of gene rows normalized at a time. Default defaultBlockRows()
+        :throws: ValueError if the store is empty or gene_lengths does not have a length for each gene
+        :returns: the manifest written to normalization.json
+    """
+    gene_ids = store.gene_ids
+    sample_names = store.sample_names if samples is None else list(samples)
+    if not gene_ids or not sample_names:
+        raise ValueError('CountNormalizationError: the count matrix store %s is empty' % store.store_dir)
+    if gene_lengths is not None:
+        gene_lengths = np.asarray(gene_lengths, dtype=np.float64)
+        if gene_lengths.shape != (len(gene_ids),):
+            raise ValueError('CountNormalizationError: %s gene lengths for %s genes' % (len(gene_lengths), len(gene_ids)))
+    block_rows = block_rows or defaultBlockRows(len(sample_names))
+    os.makedirs(output_dir, exist_ok=True)
+
+    lib_sizes, rate_totals = libraryTotals(store, sample_names, block_rows, gene_lengths)
+
+    measure_functions = {'cpm': lambda count_block, row_start: cpm(count_block, lib_sizes),
+                         'log2cpm': lambda count_block, row_start: log2Cpm(count_block, lib_sizes, prior_count)}
+    if gene_lengths is not None:
+        measure_functions['tpm'] = lambda count_block, row_start: tpm(count_block, gene_lengths[row_start:row_start + len(count_block)], rate_totals)
+
+    # each matrix is written to a temporary file and renamed into place once every block is written
+    tmp_path_dict = {}
+    try:
+        output_dict = {}
+        for measure in measure_functions:
+            file_descriptor, tmp_path_dict[measure] = tempfile.mkstemp(dir=output_dir, prefix='.tmp_%s_' % measure, suffix='.npy')
+            os.close(file_descriptor)
+            output_dict[measure] = np.lib.format.open_memmap(tmp_path_dict[measure], mode='w+', dtype=NORMALIZED_DTYPE,
+                                                             shape=(len(gene_ids), len(sample_names)))
+        for row_start, count_block in store.readBlocks(block_rows, sample_names):
+            for measure, measure_function in measure_functions.items():
+                output_dict[measure][row_start:row_start + len(count_block)] = measure_function(count_block, row_start)
+        for measure, output in output_dict.items():
+            output.flush()
+            del output
+            os.replace(tmp_path_dict[measure], os.path.join(output_dir, '%s.npy' % measure))
+    except BaseException:
+        for tmp_path in tmp_path_dict.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+    manifest = {'version': NORMALIZATION_VERSION, 'geneIndex': geneIndexId(gene_ids), 'geneIds': gene_ids,
+                'samples': sample_names, 'libSizes': lib_sizes.tolist(), 'priorCount': prior_count,
+                'measures': {measure: '%s.npy' % measure for measure in measure_functions}}
+    writeJsonAtomic(os.path.join(output_dir, 'normalization.json'), manifest)
+    return manifest
+
+def readNormalized(output_dir, measure):
+    """
+        :params output_dir: the output directory of normalizeCountMatrix()
+        :params measure: one of cpm, log2cpm or tpm
+        :throws: KeyError if the measure was not written
+        :returns: a tuple (sample_names, gene_ids, matrix) where matrix is a memory mapped float32 array (genes x samples)
+    """
+    manifest = readJson(os.path.join(output_dir, 'normalization.json')) or {'measures': {}}
+    if measure not in manifest['measures']:
+        raise KeyError('CountNormalizationError: %s has no %s' % (output_dir, measure))
+    return manifest['samples'], manifest['geneIds'], np.load(os.path.join(output_dir, manifest['measures'][measure]), mmap_mode='r')
@@ -0,0 +1,134 @@
+"""
+    compact encoding of a count vector for the database payload. The counts are packed as little-endian uint32,
+    compressed with gzip (or zstd, if the zstandard package is installed) and base64 encoded so that they still fit
+    in a form field. The payload states the gene order it refers to (geneIndex, a hash of the ordered gene ids)
+    and carries a checksum of the packed counts
+    usage: payload = encodeCounts(gene_counts, geneIndexId(gene_ids))
+           gene_counts = decodeCounts(payload)
+    author: chase.mateusiak@gmail.com
+"""
+
+# standard library imports
+import base64
+import gzip
+import hashlib
+import struct
+
+# the packed count encodings which may be requested
+COMPRESSION_TYPES = ('gzip', 'zstd')
+# largest count which can be packed as a uint32
+MAX_COUNT = 2**32 - 1
+
+def geneIndexId(gene_ids):
+    """
+        identifier of an ordered list of gene ids. Two count vectors with the same geneIndex are in the same gene order
+        usage: gene_index = geneIndexId(['CKF44_00001', 'CKF44_00002'])
+        :params gene_ids: iterable of gene ids, in the order of the count vector
+        :returns: sha256 hex digest of the gene ids, each followed by a newline
+    """
+    gene_index_digest = hashlib.sha256()
+    for gene_id in gene_ids:
+        updateGeneIndexDigest(gene_index_digest, gene_id)
+    return gene_index_digest.hexdigest()
+
+def updateGeneIndexDigest(gene_index_digest, gene_id):
+    """
+        add the next gene id to a geneIndex digest. Use this to compute geneIndexId() while streaming the gene ids
+        :params gene_index_digest: a hashlib.sha256() object
+        :params gene_id: the next gene id in count vector order
+    """
+    gene_index_digest.update(gene_id.encode('utf-8') + b'\n')
+
+def packCounts(gene_counts):
+    """
+        pack a count vector as little-endian uint32
+        :params gene_counts: list of non-negative ints
+        :throws: ValueError if a count is negative or larger than MAX_COUNT
+        :returns: bytes, 4 per count
+    """
+    try:
+        return struct.pack('<%dI' % len(gene_counts), *gene_counts)
+    except struct.error:
+        raise ValueError('CountPayloadError: counts must be integers between 0 and %s' % MAX_COUNT)
+
+def unpackCounts(packed_bytes):
+    """
+        inverse of packCounts()
+        :params packed_bytes: little-endian uint32 bytes
+        :throws: ValueError if the number of bytes is not a multiple of 4
+        :returns: a list of ints
+    """
+    if len(packed_bytes) % 4:
+        raise ValueError('CountPayloadError: packed counts are not a whole number of uint32')
+    return list(struct.unpack('<%dI' % (len(packed_bytes) // 4), packed_bytes))
+
+def _zstandard():
+    """
+        :throws: ValueError if the zstandard package, the optional zstd extra, is not installed
+        :returns: the zstandard module
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('CountPayloadError: zstd compression requires the zstandard package')
+    return zstandard
+
+def compress(packed_bytes, compression):
+    """
+        :params packed_bytes: bytes to compress
+        :params compression: one of COMPRESSION_TYPES
+        :throws: ValueError if the compression is not recognized, or is zstd and zstandard is not installed
+        :returns: the compressed bytes
+    """
+    if compression == 'gzip':
+        # mtime=0 so that the same counts always give the same payload
+        return gzip.compress(packed_bytes, mtime=0)
+    if compression == 'zstd':
+        return _zstandard().ZstdCompressor().compress(packed_bytes)
+    raise ValueError('CountPayloadError: compression must be one of %s' % ', '.join(COMPRESSION_TYPES))
+
+def decompress(compressed_bytes, compression):
+    """
+        inverse of compress()
+    """
+    if compression == 'gzip':
+        return gzip.decompress(compressed_bytes)
+    if compression == 'zstd':
+        return _zstandard().ZstdDecompressor().decompress(compressed_bytes)
+    raise ValueError('CountPayloadError: compression must be one of %s' % ', '.join(COMPRESSION_TYPES))
+
+def encodeCounts(gene_counts, gene_index, compression='gzip'):
+    """
+        create the packed count fields of a Counts payload
+        usage: count_data.update(encodeCounts(gene_counts, geneIndexId(gene_ids)))
+        :params gene_counts: list of non-negative ints in gene index order
+        :params gene_index: the geneIndexId() of the gene ids the counts are ordered by
+        :params compression: one of COMPRESSION_TYPES. Default gzip
+        :throws: ValueError if a count can not be packed or the compression is not recognized
+        :returns: a dict with the fields rawCounts (base64), countsEncoding, countsChecksum (sha256 of the packed counts), geneIndex and numGenes
+    """
+    packed_bytes = packCounts(gene_counts)
+    return {'rawCounts': base64.b64encode(compress(packed_bytes, compression)).decode('ascii'),
+            'countsEncoding': 'uint32le+%s' % compression,
+            'countsChecksum': hashlib.sha256(packed_bytes).hexdigest(),
+            'geneIndex': gene_index,
+            'numGenes': str(len(packed_bytes) // 4)}
+
+def decodeCounts(payload):
+    """
+        inverse of encodeCounts(). This is what the server needs to do to read a packed payload
+        usage: gene_counts = decodeCounts(count_data)
+        :params payload: a dict with at least the fields produced by encodeCounts()
+        :throws: ValueError if the encoding is not recognized, or the checksum or number of genes does not match
+        :returns: the list of counts
+    """
+    encoding = payload['countsEncoding']
+    if not encoding.startswith('uint32le+'):
+        raise ValueError('CountPayloadError: unrecognized countsEncoding %s' % encoding)
+    packed_bytes = decompress(base64.b64decode(payload['rawCounts']), encoding[len('uint32le+'):])
+    if hashlib.sha256(packed_bytes).hexdigest() != payload['countsChecksum']:
+        raise ValueError('CountPayloadError: countsChecksum does not match the decoded counts')
+    gene_counts = unpackCounts(packed_bytes)
+    if len(gene_counts) != int(payload['numGenes']):
+        raise ValueError('CountPayloadError: expected %s genes, decoded %s' % (payload['numGenes'], len(gene_counts)))
+    return gene_counts
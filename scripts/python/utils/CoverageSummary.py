@@ -0,0 +1,184 @@
+"""
+    streaming summary of a per base depth file (the chrom, 1 based position, depth lines of samtools depth, as written by
+    scripts/bash/GenomeCoverage.sh). The file is read in chunks of whole lines which are parsed into numpy arrays, and
+    summarized either as run length encoded intervals of equal depth or as fixed size bins with the mean, min and max
+    depth. Only one chunk and the interval or bin which spans the chunk boundary are held in memory, so the memory used
+    does not depend on the size of the genome
+    usage: with open('sample_coverage.bed', 'rb') as depth_file, open('sample_coverage_rle.bedgraph', 'w') as output_file:
+               genome_stats = summarizeDepth(depth_file, RleWriter(output_file))
+    author: chase.mateusiak@gmail.com
+
+    output: rle is bedgraph, chrom, 0 based start, end and depth of each run of bases with the same depth
+            bins is chrom, 0 based start, end, mean, min and max depth of each bin of bin_size bases
+"""
+
+# standard library imports
+import gzip
+
+# third party imports
+import numpy as np
+
+# bytes parsed at a time, about a million lines
+DEFAULT_CHUNK_BYTES = 1 << 24
+# depths at which the fraction of the genome covered is reported by summarizeDepth()
+DEPTH_THRESHOLDS = (1, 10, 30)
+
+def openText(path, mode='r'):
+    """
+        open a text file, gzipped if path ends in .gz
+    """
+    return gzip.open(path, mode + 't') if path.endswith('.gz') else open(path, mode)
+
+def readDepthChunks(depth_file, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+        parse a depth file into chunks of consecutive positions on one chromosome
+        :params depth_file: a depth file opened in binary mode
+        :params chunk_bytes: about this many bytes are read and parsed at a time, always ending on a whole line
+        :throws: ValueError if a line does not have three columns or a position or depth is not an integer
+        :returns: a generator of (chrom, positions, depths). positions are 1 based int64, depths int64
+    """
+    while True:
+        block = depth_file.read(chunk_bytes)
+        if not block:
+            return
+        if not block.endswith(b'\n'):
+            block += depth_file.readline()
+        fields = block.split()
+        num_lines = block.count(b'\n') + (not block.endswith(b'\n'))
+        if len(fields) != 3 * num_lines:
+            # blank lines, eg at the end of the file, are skipped. They are rare, so only then are the lines counted one by one
+            num_lines = sum(1 for line in block.splitlines() if line.strip())
+            if len(fields) != 3 * num_lines:
+                raise ValueError('CoverageSummaryError: every line of a depth file must have three columns, chrom, position and depth')
+            if not num_lines:
+                continue
+        try:
+            positions = np.fromiter(map(int, fields[1::3]), dtype=np.int64, count=num_lines)
+            depths = np.fromiter(map(int, fields[2::3]), dtype=np.int64, count=num_lines)
+        except ValueError:
+            raise ValueError('CoverageSummaryError: the position and depth of a depth file must be integers')
+        chrom_list = fields[0::3]
+        # a chunk is usually all one chromosome. Otherwise it is cut wherever the chromosome changes
+        if chrom_list.count(chrom_list[0]) == num_lines:
+            boundaries = [0, num_lines]
+        else:
+            chroms = np.array(chrom_list)
+            boundaries = [0] + (np.flatnonzero(chroms[1:] != chroms[:-1]) + 1).tolist() + [num_lines]
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            yield chrom_list[start].decode('utf-8'), positions[start:end], depths[start:end]
+
+class RleWriter:
+    """
+        write runs of contiguous bases with the same depth as bedgraph
+        :params output_file: a text file
+        :params depth_resolution: depths are rounded down to a multiple of this before the runs are found, eg 5 joins
+                                  neighbouring bases with depths 10 to 14 into one run of depth 10. Default 1 is exact
+    """
+    def __init__(self, output_file, depth_resolution=1):
+        self.output_file = output_file
+        self.depth_resolution = depth_resolution
+        # the last run, which may continue in the next chunk: [chrom, start, end, depth]
+        self.open_run = None
+        self.num_intervals = 0
+
+    def add(self, chrom, positions, depths):
+        if self.depth_resolution > 1:
+            depths = depths // self.depth_resolution * self.depth_resolution
+        starts = positions - 1
+        # a run breaks where the depth changes or a position is skipped
+        breaks = np.flatnonzero((depths[1:] != depths[:-1]) | (positions[1:] != positions[:-1] + 1)) + 1
+        run_starts = np.concatenate(([0], breaks))
+        run_ends = np.concatenate((breaks, [len(positions)]))
+        run_list = list(zip(starts[run_starts].tolist(), (starts[run_ends - 1] + 1).tolist(), depths[run_starts].tolist()))
+
+        first_start, first_end, first_depth = run_list[0]
+        if self.open_run is not None and self.open_run[0] == chrom and self.open_run[2] == first_start and self.open_run[3] == first_depth:
+            self.open_run[2] = first_end
+            run_list = run_list[1:]
+        for start, end, depth in run_list:
+            self._flush()
+            self.open_run = [chrom, start, end, depth]
+
+    def _flush(self):
+        if self.open_run is not None:
+            self.output_file.write('%s\t%s\t%s\t%s\n' % tuple(self.open_run))
+            self.num_intervals += 1
+            self.open_run = None
+
+    def close(self):
+        self._flush()
+
+class BinWriter:
+    """
+        write the mean, min and max depth of fixed size bins. Only the positions in the depth file count, so run
+        samtools depth with -aa (as GenomeCoverage.sh does) for bases with no reads to count as 0
+        :params output_file: a text file
+        :params bin_size: number of bases in a bin. Bins start at 0 on each chromosome
+    """
+    def __init__(self, output_file, bin_size):
+        if bin_size < 1:
+            raise ValueError('CoverageSummaryError: bin_size must be at least 1')
+        self.output_file = output_file
+        self.bin_size = bin_size
+        # the last bin, which may continue in the next chunk: [chrom, bin, depth sum, min, max, number of positions]
+        self.open_bin = None
+        self.num_intervals = 0
+
+    def add(self, chrom, positions, depths):
+        bins = (positions - 1) // self.bin_size
+        bin_starts = np.concatenate(([0], np.flatnonzero(bins[1:] != bins[:-1]) + 1))
+        bin_list = list(zip(bins[bin_starts].tolist(), np.add.reduceat(depths, bin_starts).tolist(),
+                            np.minimum.reduceat(depths, bin_starts).tolist(), np.maximum.reduceat(depths, bin_starts).tolist(),
+                            np.diff(np.concatenate((bin_starts, [len(positions)]))).tolist()))
+
+        first_bin, depth_sum, depth_min, depth_max, count = bin_list[0]
+        if self.open_bin is not None and self.open_bin[0] == chrom and self.open_bin[1] == first_bin:
+            self.open_bin[2] += depth_sum
+            self.open_bin[3] = min(self.open_bin[3], depth_min)
+            self.open_bin[4] = max(self.open_bin[4], depth_max)
+            self.open_bin[5] += count
+            bin_list = bin_list[1:]
+        for bin_number, depth_sum, depth_min, depth_max, count in bin_list:
+            self._flush()
+            self.open_bin = [chrom, bin_number, depth_sum, depth_min, depth_max, count]
+
+    def _flush(self):
+        if self.open_bin is not None:
+            chrom, bin_number, depth_sum, depth_min, depth_max, count = self.open_bin
+            self.output_file.write('%s\t%s\t%s\t%.4g\t%s\t%s\n' % (chrom, bin_number * self.bin_size, (bin_number + 1) * self.bin_size,
+                                                                   depth_sum / count, depth_min, depth_max))
+            self.num_intervals += 1
+            self.open_bin = None
+
+    def close(self):
+        self._flush()
+
+def summarizeDepth(depth_file, writer, chunk_bytes=DEFAULT_CHUNK_BYTES, depth_thresholds=DEPTH_THRESHOLDS):
+    """
+        stream a depth file through a writer and total the genome wide depth
+        :params depth_file: a depth file opened in binary mode
+        :params writer: a RleWriter or BinWriter. It is closed when the file has been read
+        :params chunk_bytes: about this many bytes are parsed at a time
+        :params depth_thresholds: depths at which to report the fraction of bases covered
+        :throws: ValueError if the depth file is malformed
+        :returns: a dict with bases, meanDepth, maxDepth, intervals (the number written) and fractionCovered${threshold}
+                  for each threshold
+    """
+    bases = 0
+    depth_sum = 0
+    max_depth = 0
+    covered_bases = np.zeros(len(depth_thresholds), dtype=np.int64)
+    thresholds = np.asarray(depth_thresholds)
+    for chrom, positions, depths in readDepthChunks(depth_file, chunk_bytes):
+        bases += len(depths)
+        depth_sum += int(depths.sum())
+        max_depth = max(max_depth, int(depths.max()))
+        covered_bases += (depths[:, np.newaxis] >= thresholds).sum(axis=0)
+        writer.add(chrom, positions, depths)
+    writer.close()
+
+    genome_stats = {'bases': bases, 'meanDepth': depth_sum / bases if bases else 0.0, 'maxDepth': max_depth,
+                    'intervals': writer.num_intervals}
+    for threshold, covered in zip(depth_thresholds, covered_bases.tolist()):
+        genome_stats['fractionCovered%s' % threshold] = covered / bases if bases else 0.0
+    return genome_stats
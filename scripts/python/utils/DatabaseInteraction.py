@@ -1,15 +1,259 @@
+"""
+    http client for the database api. A DatabaseClient keeps a pool of keep-alive connections to the api host,
+    applies a timeout to every request and retries 5xx responses and connection errors with bounded exponential backoff
+    usage: client = DatabaseClient()
+           client.post('http://13.59.167.2/api/Counts/', data)
+           client.postOrPut('http://13.59.167.2/api/QualityAssess/', fastq_file_number, data)
+    With a PostCache (see utils/PostCache.py), a payload which was already sent successfully is not sent again
+    author: chase.mateusiak@gmail.com
+"""
+
+# standard library imports
+import time
+
+# third party imports
 import requests
-from urllib.request import HTTPError
+from requests.adapters import HTTPAdapter
+
+# local imports
+from .PostCache import CachedResponse, PostCache, payloadHash
+
+# responses which are worth retrying. Anything else in the 4xx/5xx range is returned to the caller immediately
+RETRY_STATUS_CODES = frozenset([500, 502, 503, 504])
+# 4xx responses which ask the client to come back later (request timeout, too many requests) rather than reject the request
+BACKPRESSURE_STATUS_CODES = frozenset([408, 429])
+
+class DatabaseInteractionError(Exception):
+    """
+        raised when a request to the database fails, either because retries were exhausted or because the
+        server returned an error status which is not retried
+        :params status_code: the http status code of the last response, or None if no response was received
+        :params transient: whether the same request may safely be sent again later, eg after an outage. Default True if
+                           no response was received, the response was a 5xx or one of BACKPRESSURE_STATUS_CODES, and
+                           False for any other 4xx
+    """
+    def __init__(self, message, status_code=None, transient=None):
+        super().__init__(message)
+        self.status_code = status_code
+        if transient is None:
+            transient = status_code is None or status_code >= 500 or status_code in BACKPRESSURE_STATUS_CODES
+        self.transient = transient
+
+class DatabaseClient:
+    """
+        reusable http client with connection pooling, timeouts and retries
+        usage: with DatabaseClient(timeout=(5, 60), max_retries=3) as client: client.post(url, data)
+        :params timeout: (connect, read) timeout in seconds applied to every request
+        :params max_retries: number of times to retry a request after a 5xx response or a connection error
+        :params backoff_factor: the nth retry waits backoff_factor * 2**(n-1) seconds
+        :params backoff_max: upper bound, in seconds, on the wait between retries
+        :params pool_maxsize: number of keep-alive connections to hold open per host
+        :params session: a requests.Session to use. Default creates a new one
+        :params post_cache: a PostCache. If set, post() with a record_key and postOrPut() skip payloads which were already
+                            sent, postOrPut() puts changed payloads of existing records without first trying a post,
+                            and post() refuses changed payloads of records it already posted. The client closes the
+                            cache when it is closed
+        :params force: if True, send every payload even if it is in the post_cache (successful requests are still recorded)
+        :params metrics: a StageMetrics (see utils/StageMetrics.py). If set, the latency, payload bytes and retries of
+                         every attempt are added to its open stage
+    """
+    def __init__(self, timeout=(5, 60), max_retries=3, backoff_factor=0.5, backoff_max=30, pool_maxsize=10, session=None,
+                 post_cache=None, force=False, metrics=None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.session = session if session is not None else requests.Session()
+        # retries are handled in request() so that the backoff is bounded and the same for status codes and connection errors
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # sleep is an attribute so that tests can skip the backoff
+        self._sleep = time.sleep
+        self.post_cache = post_cache
+        self.force = force
+        self.metrics = metrics
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+            close the pooled connections, and the post cache if there is one
+        """
+        self.session.close()
+        if self.post_cache is not None:
+            self.post_cache.close()
+
+    def backoff(self, retry_number):
+        """
+            :params retry_number: the number of the retry which is about to happen, starting at 1
+            :returns: the number of seconds to wait before the retry
+        """
+        return min(self.backoff_factor * (2 ** (retry_number - 1)), self.backoff_max)
+
+    def request(self, method, url, data=None, **kwargs):
+        """
+            send a request, retrying 5xx responses and connection errors. A read timeout is retried too, except for a
+            POST: the server may have created the record before the timeout, so a retry could create it twice
+            usage: response = client.request('POST', url, data)
+            :params method: http verb, eg 'POST'
+            :params url: complete url of the endpoint
+            :params data: the body of the request
+            :params kwargs: passed to requests.Session.request
+            :throws: DatabaseInteractionError if the request fails after max_retries retries or returns a status which is not retried
+            :returns: the requests.Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self._sleep(self.backoff(attempt))
+            request_start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, data=data, **kwargs)
+            except requests.ReadTimeout as e:
+                self._recordRequest(request_start, attempt, None)
+                if method.upper() == 'POST':
+                    raise DatabaseInteractionError('%s %s timed out waiting for the response, and is not retried in case '
+                                                   'the record was created: %s' % (method, url, e), transient=False)
+                error = DatabaseInteractionError('%s %s failed: %s' % (method, url, e))
+                continue
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._recordRequest(request_start, attempt, None)
+                error = DatabaseInteractionError('%s %s failed: %s' % (method, url, e))
+                continue
+            except requests.RequestException as e:
+                # eg an invalid url, or a response which broke off. Neither is helped by a retry
+                self._recordRequest(request_start, attempt, None)
+                raise DatabaseInteractionError('%s %s failed: %s' % (method, url, e), transient=False)
+            self._recordRequest(request_start, attempt, response)
+            if response.status_code in RETRY_STATUS_CODES:
+                error = DatabaseInteractionError('%s %s returned %s %s' % (method, url, response.status_code, response.reason),
+                                                 response.status_code)
+                continue
+            try:
+                response.raise_for_status()
+            except requests.HTTPError:
+                raise DatabaseInteractionError('%s %s returned %s %s' % (method, url, response.status_code, response.reason),
+                                               response.status_code)
+            return response
+
+        raise DatabaseInteractionError('%s after %s retries' % (error, self.max_retries), error.status_code)
+
+    def _recordRequest(self, request_start, attempt, response):
+        """
+            add an attempt to the metrics, if there are metrics. The payload bytes are the length of the encoded body sent
+        """
+        if self.metrics is None:
+            return
+        prepared_request = getattr(response, 'request', None)
+        body = getattr(prepared_request, 'body', None) or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.metrics.recordRequest(time.perf_counter() - request_start, retry=attempt > 0, payload_bytes=len(body),
+                                   error=response is None or response.status_code >= 400)
+
+    def post(self, url, data, record_key=None, **kwargs):
+        """
+            post data to url. See request()
+            :params record_key: key of the record in the post cache, eg the fastqFileNumber. If None, the cache is not used
+            :throws: DatabaseInteractionError if the request fails, or, unless force, the record was already posted with a
+                     different payload
+            :returns: the requests.Response, or a CachedResponse if the same payload was already posted
+        """
+        if self.post_cache is None or record_key is None:
+            return self.request('POST', url, data, **kwargs)
+        payload_hash = payloadHash(data)
+        cache_entry = self.post_cache.lookup(url, record_key)
+        if cache_entry is not None and not self.force:
+            if cache_entry.payload_hash == payload_hash:
+                return CachedResponse(cache_entry.status_code, cache_entry.response)
+            # a second post would create a second record, eg a second Counts row of the fastqFileNumber
+            raise DatabaseInteractionError('%s was already posted to %s with a different payload. Remove the old record '
+                                           'and post it again with --force' % (record_key, url), transient=False)
+        response = self.request('POST', url, data, **kwargs)
+        self.post_cache.record(url, record_key, payload_hash, 'POST', response.status_code, response.text)
+        return response
+
+    def put(self, url, data, **kwargs):
+        """
+            put data to url. See request()
+        """
+        return self.request('PUT', url, data, **kwargs)
+
+    def postOrPut(self, url, primary_key_value, data, **kwargs):
+        """
+            post data to url. If the server rejects the post (eg the record already exists), put it to url/primary_key_value/ instead.
+            With a post cache, a payload which was already sent is skipped, and a changed payload of a record which was
+            already sent is put straight away (falling back to a post if the record no longer exists)
+            usage: client.postOrPut('http://13.59.167.2/api/QualityAssess/', 1, {'fastqFileNumber': 1, 'natCoverage': 0.9})
+            :params url: url of the endpoint, no id, eg http://13.59.167.2/api/QualityAssess/
+            :params primary_key_value: id of the record to put to, eg the fastqFileNumber
+            :params data: the body of the request
+            :throws: DatabaseInteractionError if both the post and the put fail, or the post fails for a reason other than a 4xx response
+            :returns: the requests.Response, or a CachedResponse if the same payload was already sent
+        """
+        put_url = url + str(primary_key_value) + '/'
+        cache_entry = None
+        if self.post_cache is not None:
+            payload_hash = payloadHash(data)
+            cache_entry = self.post_cache.lookup(url, primary_key_value)
+            if cache_entry is not None and cache_entry.payload_hash == payload_hash and not self.force:
+                return CachedResponse(cache_entry.status_code, cache_entry.response)
+
+        method, response = None, None
+        if cache_entry is not None:
+            # the record exists, so the post would be rejected
+            try:
+                method, response = 'PUT', self.put(put_url, data, **kwargs)
+            except DatabaseInteractionError as e:
+                if e.status_code != 404:
+                    raise
+        if response is None:
+            try:
+                method, response = 'POST', self.post(url, data, **kwargs)
+            except DatabaseInteractionError as e:
+                # only a rejection by the server means the record may already exist
+                if e.status_code is None or e.transient:
+                    raise
+                method, response = 'PUT', self.put(put_url, data, **kwargs)
+
+        if self.post_cache is not None:
+            self.post_cache.record(url, primary_key_value, payload_hash, method, response.status_code, response.text)
+        return response
+
+def createClient(post_cache_dir=None, force=False, metrics=None):
+    """
+        create a DatabaseClient with its own connection to the post cache in post_cache_dir, if one is given. Pass
+        functools.partial(createClient, post_cache_dir, force, metrics) as the client_factory of an AsyncUploader
+        usage: with createClient(args.post_cache, args.force, metrics) as client: client.postOrPut(url, fastq_file_number, data)
+        :params post_cache_dir: directory of the post cache, or None to send every payload
+        :params force: see DatabaseClient
+        :params metrics: see DatabaseClient
+        :returns: a DatabaseClient
+    """
+    return DatabaseClient(post_cache=PostCache(post_cache_dir) if post_cache_dir else None, force=force, metrics=metrics)
+
+# shared by postData so that repeated calls in one process reuse connections
+_default_client = None
+
+def getDefaultClient():
+    """
+        :returns: a DatabaseClient shared by every caller in this process
+    """
+    global _default_client
+    if _default_client is None:
+        _default_client = DatabaseClient()
+    return _default_client
 
 def postData(url, data, **kwargs):
     """
         post data to url
         :params url: url to the site (this should be complete, eg to update counts http://13.59.167.2/api/Counts) NOTE: pass this url, no id, etc, and use the kwargs option for a put
         :params data: the body of the request
-        :throws: HTTPError
+        :throws: DatabaseInteractionError
     """
-    try:
-        r = requests.post(url, data=data)
-        r.raise_for_status()
-    except HTTPError:
-        raise Exception(r.reason)
\ No newline at end of file
+    return getDefaultClient().post(url, data, **kwargs)
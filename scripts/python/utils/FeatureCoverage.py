@@ -0,0 +1,211 @@
+"""
+    in-process coverage of annotation features. This replaces the grep | gff2bed | samtools depth | wc pipelines:
+    the annotation is read once for all requested genes, gene ids are matched exactly (not as substrings), and the
+    bam is read through its index only over the requested intervals. Depth is computed with array arithmetic over
+    each fetched window and, like samtools depth, does not count unmapped, secondary, qc fail or duplicate reads
+    usage: coverage_dict = calculateFeatureCoverage('CDS', ['CNAG_NAT', 'CNAG_G418'], annotation_path, bam_path)
+    author: chase.mateusiak@gmail.com
+"""
+
+# standard library imports
+from collections import defaultdict
+
+# third party imports
+import numpy as np
+import pysam
+
+# local imports
+from .AnnotationIndex import ancestors, loadAnnotationIndex, mergeIntervals
+from .GeneIndexCache import parseAttributes
+
+# attributes which name the gene a feature belongs to directly (gtf and gff3)
+GENE_ATTRIBUTES = ('gene_id', 'gene', 'locus_tag')
+# reads with any of these flags are not counted (the samtools depth default): unmapped, secondary, qc fail, duplicate
+EXCLUDED_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+# intervals closer than this are fetched from the bam in one window
+FETCH_WINDOW_GAP = 1000
+
+def readFeatureIntervals(annotation_path, feature, gene_ids):
+    """
+        the merged intervals of the features of a given type in each of the given genes. A feature belongs to a gene if
+        its gene_id, gene or locus_tag attribute, its ID, or the ID of any of its ancestors (following Parent) is exactly the gene id
+        usage: intervals_dict = readFeatureIntervals('annotation.gff', 'CDS', ['CNAG_NAT'])
+        :params annotation_path: path to a gtf or gff3
+        :params feature: feature type (3rd column), eg CDS or exon
+        :params gene_ids: iterable of gene ids
+        :returns: a dict of gene id to a list of (chrom, start, end) merged intervals, 0 based and half open (as bed).
+                  Genes with no features of the type have an empty list
+    """
+    region_dict = readRegionIntervals(annotation_path, [(gene_id, feature) for gene_id in gene_ids])
+    return {gene_id: interval_list for (gene_id, _), interval_list in region_dict.items()}
+
+def readRegionIntervals(annotation_path, regions):
+    """
+        as readFeatureIntervals, but for any mix of genes and feature types, in one pass over the annotation
+        usage: region_dict = readRegionIntervals('annotation.gff', [('CKF44_00001', 'CDS'), ('CKF44_00002', 'exon')])
+        :params annotation_path: path to a gtf or gff3
+        :params regions: iterable of (gene id, feature type)
+        :returns: a dict of (gene id, feature type) to a list of merged (chrom, start, end) intervals, 0 based and half open
+    """
+    region_set = set(regions)
+    gene_id_set = {gene_id for gene_id, _ in region_set}
+    feature_set = {feature for _, feature in region_set}
+    # ID -> Parent of every feature, to walk from eg a CDS to its gene in a gff3
+    parent_dict = {}
+    # (feature type, gene ids named directly on the feature, parents, chrom, start, end) of features of a requested type
+    candidate_list = []
+    with open(annotation_path, 'r') as annotation_file:
+        for line in annotation_file:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) < 9:
+                continue
+            attribute_dict = parseAttributes(fields[8])
+            if 'ID' in attribute_dict and 'Parent' in attribute_dict:
+                parent_dict[attribute_dict['ID']] = attribute_dict['Parent'].split(',')
+            if fields[2] not in feature_set:
+                continue
+            direct_ids = {attribute_dict[attribute] for attribute in GENE_ATTRIBUTES + ('ID',) if attribute in attribute_dict}
+            parents = attribute_dict['Parent'].split(',') if 'Parent' in attribute_dict else []
+            candidate_list.append((fields[2], direct_ids, parents, fields[0], int(fields[3]) - 1, int(fields[4])))
+
+    region_dict = {region: [] for region in region_set}
+    for feature, direct_ids, parents, chrom, start, end in candidate_list:
+        for gene_id in (direct_ids | ancestors(parents, parent_dict)) & gene_id_set:
+            if (gene_id, feature) in region_dict:
+                region_dict[(gene_id, feature)].append((chrom, start, end))
+
+    return {region: mergeIntervals(interval_list) for region, interval_list in region_dict.items()}
+
+def intervalLength(interval_list):
+    """
+        :params interval_list: list of merged (chrom, start, end)
+        :returns: the number of bases in the intervals
+    """
+    return sum(end - start for _, start, end in interval_list)
+
+def countCoveredBases(bam_path, interval_dict, min_depth=1, min_mapq=10):
+    """
+        for each named set of intervals, count the bases with depth >= min_depth counting only reads with mapping
+        quality >= min_mapq. All of the intervals are read from the bam in one indexed pass: intervals on the same
+        chromosome which are close together are fetched as a single window
+        usage: covered_dict = countCoveredBases('sample_sorted.bam', {'CNAG_NAT': [('CP022321.1', 100, 706)]})
+        :params bam_path: path to a sorted, indexed bam
+        :params interval_dict: dict of name to a list of merged (chrom, start, end) intervals
+        :params min_depth: minimum depth for a base to count as covered. Default 1
+        :params min_mapq: minimum mapping quality of a read to be counted. Default 10 (as samtools depth -Q 10)
+        :returns: a dict of name to the number of covered bases
+    """
+    covered_dict = {name: 0 for name in interval_dict}
+    # group the intervals by chromosome, remembering which name each belongs to
+    chrom_dict = defaultdict(list)
+    for name, interval_list in interval_dict.items():
+        for chrom, start, end in interval_list:
+            chrom_dict[chrom].append((start, end, name))
+
+    with pysam.AlignmentFile(bam_path, 'rb') as bam_file:
+        for chrom, chrom_interval_list in chrom_dict.items():
+            chrom_interval_list.sort()
+            for window_start, window_end, window_interval_list in fetchWindows(chrom_interval_list):
+                depth = windowDepth(bam_file, chrom, window_start, window_end, min_mapq)
+                for start, end, name in window_interval_list:
+                    covered_dict[name] += int(np.count_nonzero(depth[start - window_start:end - window_start] >= min_depth))
+
+    return covered_dict
+
+def fetchWindows(sorted_interval_list):
+    """
+        group sorted intervals on one chromosome into windows of intervals no more than FETCH_WINDOW_GAP apart
+        :params sorted_interval_list: list of (start, end, name) sorted by start
+        :returns: a list of (window_start, window_end, interval_list)
+    """
+    window_list = []
+    for start, end, name in sorted_interval_list:
+        if window_list and start <= window_list[-1][1] + FETCH_WINDOW_GAP:
+            window_list[-1][1] = max(end, window_list[-1][1])
+            window_list[-1][2].append((start, end, name))
+        else:
+            window_list.append([start, end, [(start, end, name)]])
+    return [tuple(window) for window in window_list]
+
+def windowDepth(bam_file, chrom, window_start, window_end, min_mapq):
+    """
+        per base depth over a window. Each aligned block of each read adds +1 at its start and -1 at its end in a
+        difference array, which is summed once at the end. Deletions and skipped regions (N) are not counted
+        :params bam_file: an open pysam.AlignmentFile
+        :params chrom: chromosome name
+        :params window_start: 0 based start of the window
+        :params window_end: end of the window (exclusive)
+        :params min_mapq: minimum mapping quality of a read to be counted
+        :returns: numpy array of length window_end - window_start
+    """
+    window_length = window_end - window_start
+    block_starts = []
+    block_ends = []
+    for read in bam_file.fetch(chrom, window_start, window_end):
+        if read.flag & EXCLUDED_FLAGS or read.mapping_quality < min_mapq:
+            continue
+        for block_start, block_end in read.get_blocks():
+            block_starts.append(block_start)
+            block_ends.append(block_end)
+    block_starts = np.clip(np.asarray(block_starts, dtype=np.int64) - window_start, 0, window_length)
+    block_ends = np.clip(np.asarray(block_ends, dtype=np.int64) - window_start, 0, window_length)
+    depth_change = np.bincount(block_starts, minlength=window_length + 1) - np.bincount(block_ends, minlength=window_length + 1)
+    return np.cumsum(depth_change[:window_length])
+
+def calculateFeatureCoverage(feature, gene_ids, annotation_path, bam_path, num_bases_dict=None, min_depth=1, min_mapq=10,
+                             annotation_cache_dir=None):
+    """
+        Calculate the fraction of a given feature (regions summed, so all CDS in a gene, eg) of each gene covered by min_depth or more reads
+        usage: coverage_dict = calculateFeatureCoverage('CDS', ['CNAG_NAT', 'CNAG_G418'], annotation_path, bam_path)
+        :params feature: annotation feature over which to take percentage, eg all exons in gene, or all CDS
+        :params gene_ids: genes in the annotation file
+        :params annotation_path: path to annotation file
+        :params bam_path: a sorted, indexed alignment file (.bam)
+        :params num_bases_dict: optional dict of gene id to the number of bases in the region, overriding the merged length from the annotation
+        :params min_depth: minimum depth for a base to count as covered. Default 1
+        :params min_mapq: minimum mapping quality of a read to be counted. Default 10
+        :params annotation_cache_dir: if set, the intervals and region sizes are looked up in the cached AnnotationIndex
+                                      of the annotation (see utils/AnnotationIndex.py) rather than parsed from the annotation
+        :throws: ValueError if a gene has no features of the type in the annotation
+        :returns: a dict of gene id to the fraction of bases in the (summed over the number of features in the gene) feature region covered
+    """
+    num_bases_dict = {(gene_id, feature): num_bases for gene_id, num_bases in (num_bases_dict or {}).items()}
+    coverage_dict = calculateRegionCoverage([(gene_id, feature) for gene_id in gene_ids], annotation_path, bam_path,
+                                            num_bases_dict, min_depth, min_mapq, annotation_cache_dir)
+
+    return {gene_id: coverage for (gene_id, _), coverage in coverage_dict.items()}
+
+def calculateRegionCoverage(regions, annotation_path, bam_path, num_bases_dict=None, min_depth=1, min_mapq=10,
+                            annotation_cache_dir=None):
+    """
+        Calculate the fraction covered by min_depth or more reads of any number of (gene, feature type) regions, eg the CDS
+        of each perturbed locus and of the resistance markers, reading the annotation once and the bam in one indexed pass
+        usage: coverage_dict = calculateRegionCoverage([('CKF44_00001', 'CDS'), ('CNAG_NAT', 'CDS')], annotation_path, bam_path)
+        :params regions: iterable of (gene id, feature type)
+        :params annotation_path: path to annotation file
+        :params bam_path: a sorted, indexed alignment file (.bam)
+        :params num_bases_dict: optional dict of (gene id, feature type) to the number of bases in the region, overriding the merged length from the annotation
+        :params min_depth: minimum depth for a base to count as covered. Default 1
+        :params min_mapq: minimum mapping quality of a read to be counted. Default 10
+        :params annotation_cache_dir: see calculateFeatureCoverage
+        :throws: ValueError if a gene has no features of the type in the annotation
+        :returns: a dict of (gene id, feature type) to the fraction of bases in the region covered
+    """
+    if annotation_cache_dir:
+        try:
+            annotation_index = loadAnnotationIndex(annotation_path, annotation_cache_dir)
+            interval_dict = {(gene_id, feature): annotation_index.intervals(gene_id, feature) for gene_id, feature in set(regions)}
+        except KeyError as e:
+            raise ValueError('FeatureCoverageError: %s' % e.args[0])
+    else:
+        interval_dict = readRegionIntervals(annotation_path, regions)
+    for (gene_id, feature), interval_list in interval_dict.items():
+        if not interval_list:
+            raise ValueError('FeatureCoverageError: no %s features of %s in %s' % (feature, gene_id, annotation_path))
+    covered_dict = countCoveredBases(bam_path, interval_dict, min_depth, min_mapq)
+    num_bases_dict = num_bases_dict or {}
+
+    return {region: covered_dict[region] / float(num_bases_dict.get(region) or intervalLength(interval_dict[region]))
+            for region in interval_dict}
@@ -0,0 +1,225 @@
+"""
+    coverage qc of every gene in one sorted sweep. The merged feature intervals (eg exons) of every gene come from the
+    cached AnnotationIndex, sorted by chromosome and start, and the depth comes in chunks of consecutive positions on one
+    chromosome, either from a per base depth file (see CoverageSummary.readDepthChunks) or from the bam through its index
+    (bamDepthChunks). Each chunk is copied into the depth vector of the genes it overlaps, and a gene is summarized and
+    its vector freed as soon as the sweep passes its last base, so memory holds one chunk and the genes open across it
+    usage: annotation_index = loadAnnotationIndex('KN99_annotation.gff', '/path/to/cache')
+           with open('sample_coverage.bed', 'rb') as depth_file:
+               gene_rows, gene_body_profile = geneCoverage(annotation_index, 'exon', readDepthChunks(depth_file))
+    author: chase.mateusiak@gmail.com
+"""
+
+# third party imports
+import numpy as np
+
+# the first and last fraction of a gene body over which the 5' and 3' depth are taken
+END_FRACTION = 0.2
+# number of bins of the gene body profile
+PROFILE_BINS = 100
+# bases of depth computed at a time from the bam
+BAM_WINDOW_SIZE = 1 << 20
+
+def geneCoverageMetrics(depth, min_depth=1, end_fraction=END_FRACTION, profile_bins=PROFILE_BINS):
+    """
+        :params depth: depth of each base of a gene, 5' to 3'
+        :params min_depth: minimum depth for a base to count as covered
+        :params end_fraction: fraction of the gene at each end over which the 5' and 3' depth are averaged
+        :params profile_bins: number of bins of the gene body profile
+        :returns: a tuple (metrics, profile). metrics is a dict of length, fractionCovered, meanDepth, medianDepth,
+                  fivePrimeDepth, threePrimeDepth and threePrimeBias (threePrimeDepth / fivePrimeDepth, None if the 5'
+                  end has no reads). profile is the mean depth of profile_bins equal bins of the gene, 5' to 3', or None
+                  if the gene is shorter than profile_bins
+    """
+    length = len(depth)
+    end_length = max(1, int(length * end_fraction))
+    five_prime_depth = float(depth[:end_length].mean())
+    three_prime_depth = float(depth[-end_length:].mean())
+    metrics = {'length': length, 'fractionCovered': np.count_nonzero(depth >= min_depth) / length,
+               'meanDepth': float(depth.mean()), 'medianDepth': float(np.median(depth)),
+               'fivePrimeDepth': five_prime_depth, 'threePrimeDepth': three_prime_depth,
+               'threePrimeBias': three_prime_depth / five_prime_depth if five_prime_depth else None}
+    profile = None
+    if length >= profile_bins:
+        bin_starts = np.arange(profile_bins) * length // profile_bins
+        profile = np.add.reduceat(depth, bin_starts) / np.diff(np.append(bin_starts, length))
+    return metrics, profile
+
+class GeneCoverageSweep:
+    """
+        join chunks of per base depth with the merged intervals of a feature type of every gene in the annotation.
+        Positions which are not in any chunk have depth 0
+        :params annotation_index: an AnnotationIndex
+        :params feature_type: eg exon or CDS
+        :params min_depth: see geneCoverageMetrics
+        :params end_fraction: see geneCoverageMetrics
+        :params profile_bins: see geneCoverageMetrics
+        :throws: KeyError if the annotation has no features of the type
+    """
+    def __init__(self, annotation_index, feature_type, min_depth=1, end_fraction=END_FRACTION, profile_bins=PROFILE_BINS):
+        self.annotation_index = annotation_index
+        self.min_depth = min_depth
+        self.end_fraction = end_fraction
+        self.profile_bins = profile_bins
+
+        feature_arrays = annotation_index.featureArrays(feature_type)
+        offsets = np.asarray(feature_arrays['offsets'])
+        starts = np.asarray(feature_arrays['starts'])
+        ends = np.asarray(feature_arrays['ends'])
+        chroms = np.asarray(feature_arrays['chroms'])
+        self.gene_lengths = np.asarray(feature_arrays['lengths'])
+        interval_genes = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        # position of the first base of each interval in the concatenated bases of its gene
+        interval_lengths = ends - starts
+        cumulative_lengths = np.cumsum(interval_lengths) - interval_lengths
+        gene_offsets = cumulative_lengths - np.append(cumulative_lengths, 0)[offsets[:-1]][interval_genes]
+
+        # the sweep finishes a gene once it passes gene_ends on gene_chroms. A gene on more than one chromosome (-1)
+        # is finished at the end
+        self.gene_chroms = np.full(len(self.gene_lengths), -1, dtype=np.int64)
+        self.gene_ends = np.zeros(len(self.gene_lengths), dtype=np.int64)
+        has_intervals = np.flatnonzero(np.diff(offsets))
+        if has_intervals.size:
+            first_chroms = np.minimum.reduceat(chroms, offsets[has_intervals])
+            self.gene_chroms[has_intervals] = np.where(first_chroms == np.maximum.reduceat(chroms, offsets[has_intervals]), first_chroms, -1)
+            self.gene_ends[has_intervals] = np.maximum.reduceat(ends, offsets[has_intervals])
+
+        # chrom name -> (chrom index, starts, ends, genes, gene offsets, longest interval), intervals sorted by start
+        self.chrom_dict = {}
+        order = np.lexsort((starts, chroms))
+        chrom_boundaries = np.flatnonzero(np.diff(chroms[order])) + 1
+        for chrom_order in np.split(order, chrom_boundaries):
+            if chrom_order.size:
+                chrom = int(chroms[chrom_order[0]])
+                self.chrom_dict[annotation_index.chroms[chrom]] = (chrom, starts[chrom_order], ends[chrom_order], interval_genes[chrom_order],
+                                                                   gene_offsets[chrom_order], int(interval_lengths[chrom_order].max()))
+
+        self.current_chrom = None
+        # gene -> depth vector of the genes the sweep is in
+        self.open_genes = {}
+        # gene -> metrics of the finished genes
+        self.metrics_dict = {}
+        self.profile_sum = np.zeros(profile_bins)
+        self.profile_genes = 0
+
+    def add(self, chrom, positions, depths):
+        """
+            :params chrom: chromosome name. Chromosomes not in the annotation are skipped
+            :params positions: sorted 1 based positions, each after the positions of the previous chunk of the chromosome
+            :params depths: depth at each position
+        """
+        if chrom != self.current_chrom:
+            self._finishChrom()
+            self.current_chrom = chrom
+        if chrom not in self.chrom_dict or not len(positions):
+            return
+        chrom_index, starts, ends, genes, gene_offsets, longest_interval = self.chrom_dict[chrom]
+        positions = positions - 1
+        chunk_start, chunk_end = int(positions[0]), int(positions[-1]) + 1
+        contiguous = chunk_end - chunk_start == len(positions)
+
+        first = np.searchsorted(starts, chunk_start - longest_interval)
+        last = np.searchsorted(starts, chunk_end)
+        for start, end, gene, gene_offset in zip(starts[first:last].tolist(), ends[first:last].tolist(),
+                                                 genes[first:last].tolist(), gene_offsets[first:last].tolist()):
+            if end <= chunk_start:
+                continue
+            gene_depth = self.open_genes.get(gene)
+            if gene_depth is None:
+                gene_depth = self.open_genes[gene] = np.zeros(int(self.gene_lengths[gene]), dtype=np.int64)
+            overlap_start, overlap_end = max(start, chunk_start), min(end, chunk_end)
+            if contiguous:
+                gene_depth[overlap_start - start + gene_offset:overlap_end - start + gene_offset] = depths[overlap_start - chunk_start:overlap_end - chunk_start]
+            else:
+                first_base, last_base = np.searchsorted(positions, [overlap_start, overlap_end])
+                gene_depth[positions[first_base:last_base] - start + gene_offset] = depths[first_base:last_base]
+
+        for gene in [gene for gene in self.open_genes if self.gene_chroms[gene] == chrom_index and self.gene_ends[gene] <= chunk_end]:
+            self._finishGene(gene)
+
+    def _finishChrom(self):
+        if self.current_chrom in self.chrom_dict:
+            chrom_index = self.chrom_dict[self.current_chrom][0]
+            for gene in [gene for gene in self.open_genes if self.gene_chroms[gene] == chrom_index]:
+                self._finishGene(gene)
+
+    def _finishGene(self, gene):
+        gene_depth = self.open_genes.pop(gene)
+        if self.annotation_index.strands[gene] == '-':
+            gene_depth = gene_depth[::-1]
+        metrics, profile = geneCoverageMetrics(gene_depth, self.min_depth, self.end_fraction, self.profile_bins)
+        self.metrics_dict[gene] = metrics
+        # each gene adds its profile relative to its own mean, so that deeply covered genes do not dominate
+        if profile is not None and metrics['meanDepth'] > 0:
+            self.profile_sum += profile / metrics['meanDepth']
+            self.profile_genes += 1
+
+    def finish(self):
+        """
+            finish the genes still open, and those the depth never reached (which have depth 0)
+            :returns: a tuple (gene_rows, gene_body_profile). gene_rows is a list of dicts, one per gene with bases of
+                      the feature type, in annotation index order, of geneId, strand, biotype and the metrics of
+                      geneCoverageMetrics. gene_body_profile is the mean over the covered genes of the depth of each
+                      profile bin relative to the gene's mean depth, 5' to 3'
+        """
+        self._finishChrom()
+        for gene in list(self.open_genes):
+            self._finishGene(gene)
+        for gene in np.flatnonzero(self.gene_lengths).tolist():
+            if gene not in self.metrics_dict:
+                self.open_genes[gene] = np.zeros(int(self.gene_lengths[gene]), dtype=np.int64)
+                self._finishGene(gene)
+
+        gene_rows = [dict({'geneId': self.annotation_index.gene_ids[gene], 'strand': self.annotation_index.strands[gene],
+                           'biotype': self.annotation_index.biotypes[gene]}, **self.metrics_dict[gene])
+                     for gene in sorted(self.metrics_dict)]
+        gene_body_profile = (self.profile_sum / self.profile_genes).tolist() if self.profile_genes else None
+        return gene_rows, gene_body_profile
+
+def geneCoverage(annotation_index, feature_type, depth_chunks, min_depth=1, end_fraction=END_FRACTION, profile_bins=PROFILE_BINS):
+    """
+        sweep chunks of depth over the genes of an annotation
+        :params annotation_index: an AnnotationIndex
+        :params feature_type: eg exon or CDS
+        :params depth_chunks: iterable of (chrom, 1 based positions, depths), see CoverageSummary.readDepthChunks and bamDepthChunks
+        :params min_depth: see geneCoverageMetrics
+        :params end_fraction: see geneCoverageMetrics
+        :params profile_bins: see geneCoverageMetrics
+        :throws: KeyError if the annotation has no features of the type
+        :returns: see GeneCoverageSweep.finish
+    """
+    sweep = GeneCoverageSweep(annotation_index, feature_type, min_depth, end_fraction, profile_bins)
+    for chrom, positions, depths in depth_chunks:
+        sweep.add(chrom, positions, depths)
+    return sweep.finish()
+
+def bamDepthChunks(bam_path, annotation_index, feature_type, min_mapq=10, window_size=BAM_WINDOW_SIZE):
+    """
+        the depth over the features of a type of every gene, read from the bam through its index. Features close
+        together are read as one window (as FeatureCoverage.countCoveredBases), split into windows of at most window_size
+        :params bam_path: a sorted, indexed bam
+        :params annotation_index: an AnnotationIndex
+        :params feature_type: eg exon or CDS
+        :params min_mapq: minimum mapping quality of a read to be counted. Default 10 (as samtools depth -Q 10)
+        :params window_size: maximum number of bases of depth computed at a time
+        :throws: KeyError if the annotation has no features of the type
+        :returns: a generator of (chrom, 1 based positions, depths) in annotation chromosome order
+    """
+    # imported here so that a sweep over a depth file does not need pysam
+    import pysam
+    from .FeatureCoverage import fetchWindows, windowDepth
+
+    feature_arrays = annotation_index.featureArrays(feature_type)
+    chroms = np.asarray(feature_arrays['chroms'])
+    starts = np.asarray(feature_arrays['starts'])
+    ends = np.asarray(feature_arrays['ends'])
+    with pysam.AlignmentFile(bam_path, 'rb') as bam_file:
+        for chrom_index, chrom in enumerate(annotation_index.chroms):
+            chrom_intervals = np.flatnonzero(chroms == chrom_index)
+            if not chrom_intervals.size or chrom not in bam_file.references:
+                continue
+            sorted_interval_list = sorted(zip(starts[chrom_intervals].tolist(), ends[chrom_intervals].tolist(), [None] * chrom_intervals.size))
+            for window_start, window_end, _ in fetchWindows(sorted_interval_list):
+                for chunk_start in range(window_start, window_end, window_size):
+                    chunk_end = min(chunk_start + window_size, window_end)
+                    yield chrom, np.arange(chunk_start + 1, chunk_end + 1), windowDepth(bam_file, chrom, chunk_start, chunk_end, min_mapq)
@@ -0,0 +1,229 @@
+"""
+    cache of gene index manifests. A manifest is the ordered list of gene ids that htseq-count reports for an
+    annotation, stored once under the geneIndex (see CountPayload.geneIndexId()) so that count outputs and payloads
+    only need to carry the count vector and the geneIndex. Manifests are found by the content hash of the annotation
+    file and the least recently used manifests are evicted when the cache holds more than max_entries
+    usage: cache = GeneIndexCache('/path/to/cache')
+           manifest = cache.getOrCreate('/path/to/KN99_annotation.gtf')
+           manifest['geneIndex'], manifest['geneIds']
+    author: chase.mateusiak@gmail.com
+
+    layout of the cache directory:
+        manifests/${geneIndex}.json          {'geneIndex': ..., 'annotationHash': ..., 'geneIds': [...]}
+        annotations/${key}.json              {'annotationHash': ..., 'geneIndex': ...}, keyed by the annotation content
+                                             hash, feature type and id attribute
+        stat/${key}.json                     the same, keyed by the path, size and mtime of the annotation so that
+                                             an unchanged annotation does not need to be re-hashed
+"""
+
+# standard library imports
+import hashlib
+import json
+import os
+import tempfile
+from urllib.parse import unquote
+
+# local imports
+from .CountPayload import geneIndexId
+
+def fileContentHash(file_path, block_size=1 << 20):
+    """
+        :params file_path: path to a file
+        :params block_size: number of bytes to read at a time
+        :returns: sha256 hex digest of the file contents
+    """
+    content_digest = hashlib.sha256()
+    with open(file_path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_size), b''):
+            content_digest.update(block)
+    return content_digest.hexdigest()
+
+def parseAttributes(attribute_field):
+    """
+        parse the 9th column of a gtf (gene_id "CKF44_00001"; transcript_id "...") or gff3 (ID=...;Parent=...) line
+        :params attribute_field: the attribute column
+        :returns: a dict of attribute name to value
+    """
+    attribute_dict = {}
+    for attribute in attribute_field.strip().split(';'):
+        attribute = attribute.strip()
+        if not attribute:
+            continue
+        name, separator, value = attribute.partition('=')
+        # gff3 attribute names do not contain spaces. gtf attributes are separated from their value by a space
+        if separator and ' ' not in name.strip():
+            attribute_dict.setdefault(name.strip(), unquote(value.strip()))
+        else:
+            name, _, value = attribute.partition(' ')
+            attribute_dict.setdefault(name, value.strip().strip('"'))
+    return attribute_dict
+
+def readGeneIds(annotation_path, feature_type='exon', id_attribute='gene'):
+    """
+        the gene ids htseq-count reports for an annotation: the unique values of id_attribute over the features of
+        feature_type, sorted. These are the same arguments as -t and -i in RunHtseqCounts.sh
+        :params annotation_path: path to a gtf or gff3
+        :params feature_type: the feature type (3rd column) counted by htseq, eg exon
+        :params id_attribute: the attribute which identifies the gene, eg gene or gene_id
+        :throws: ValueError if a feature of feature_type does not have id_attribute
+        :returns: a sorted list of gene ids
+    """
+    gene_ids = set()
+    with open(annotation_path, 'r') as annotation_file:
+        for line_number, line in enumerate(annotation_file, start=1):
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) < 9 or fields[2] != feature_type:
+                continue
+            try:
+                gene_ids.add(parseAttributes(fields[8])[id_attribute])
+            except KeyError:
+                raise ValueError('GeneIndexCacheError: line %s of %s has no %s attribute' % (line_number, annotation_path, id_attribute))
+    return sorted(gene_ids)
+
+def cacheKey(*key_fields):
+    """
+        :params key_fields: values which together identify a cache entry
+        :returns: sha256 hex digest of the tab joined key_fields
+    """
+    return hashlib.sha256('\t'.join(str(key_field) for key_field in key_fields).encode('utf-8')).hexdigest()
+
+def writeJsonAtomic(output_path, data):
+    """
+        write json to a temporary file in the same directory and rename it over output_path, so that a concurrent
+        reader never sees a partial file
+    """
+    output_dir = os.path.dirname(output_path)
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as tmp_file:
+            json.dump(data, tmp_file)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def readJson(input_path):
+    """
+        :returns: the parsed json, or None if the file does not exist or is not valid json
+    """
+    try:
+        with open(input_path, 'r') as input_file:
+            return json.load(input_file)
+    except (OSError, ValueError):
+        return None
+
+class GeneIndexCache:
+    """
+        on disk cache of gene index manifests with least recently used eviction
+        :params cache_dir: directory in which to store the manifests. Created if it does not exist
+        :params max_entries: maximum number of manifests to keep
+    """
+    def __init__(self, cache_dir, max_entries=32):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        for subdirectory in ['manifests', 'annotations', 'stat']:
+            os.makedirs(os.path.join(cache_dir, subdirectory), exist_ok=True)
+
+    def manifestPath(self, gene_index):
+        return os.path.join(self.cache_dir, 'manifests', gene_index + '.json')
+
+    def getManifest(self, gene_index):
+        """
+            :params gene_index: geneIndex of the manifest
+            :returns: the manifest, or None if it is not in the cache
+        """
+        manifest_path = self.manifestPath(gene_index)
+        manifest = readJson(manifest_path)
+        if manifest is not None:
+            # the modification time is the recency used for eviction
+            try:
+                os.utime(manifest_path)
+            except OSError:
+                pass
+        return manifest
+
+    def getOrCreate(self, annotation_path, feature_type='exon', id_attribute='gene'):
+        """
+            find the manifest for an annotation, creating it from the annotation if it is not cached
+            :params annotation_path: path to a gtf or gff3
+            :params feature_type: see readGeneIds()
+            :params id_attribute: see readGeneIds()
+            :throws: ValueError, see readGeneIds()
+            :returns: the manifest dict with keys geneIndex, annotationHash and geneIds
+        """
+        # the annotation is only re-hashed if its path, size or modification time changed
+        annotation_stat = os.stat(annotation_path)
+        stat_path = os.path.join(self.cache_dir, 'stat', cacheKey(os.path.realpath(annotation_path), annotation_stat.st_size,
+                                                                  annotation_stat.st_mtime_ns, feature_type, id_attribute) + '.json')
+        alias = readJson(stat_path)
+        manifest = self.getManifest(alias['geneIndex']) if alias is not None else None
+        if manifest is not None:
+            return manifest
+
+        annotation_hash = fileContentHash(annotation_path)
+        alias_path = os.path.join(self.cache_dir, 'annotations', cacheKey(annotation_hash, feature_type, id_attribute) + '.json')
+        alias = readJson(alias_path)
+        manifest = self.getManifest(alias['geneIndex']) if alias is not None else None
+        if manifest is None:
+            gene_ids = readGeneIds(annotation_path, feature_type, id_attribute)
+            manifest = {'geneIndex': geneIndexId(gene_ids), 'annotationHash': annotation_hash, 'geneIds': gene_ids}
+            writeJsonAtomic(self.manifestPath(manifest['geneIndex']), manifest)
+            alias = {'annotationHash': annotation_hash, 'geneIndex': manifest['geneIndex']}
+            writeJsonAtomic(alias_path, alias)
+            self.evict()
+        writeJsonAtomic(stat_path, alias)
+
+        return manifest
+
+    def evict(self):
+        """
+            remove the least recently used manifests until at most max_entries remain
+            :returns: the list of geneIndex evicted
+        """
+        manifest_dir = os.path.join(self.cache_dir, 'manifests')
+        manifest_list = []
+        for file_name in os.listdir(manifest_dir):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                manifest_list.append((os.stat(os.path.join(manifest_dir, file_name)).st_mtime_ns, file_name))
+            except OSError:
+                continue
+        evicted = []
+        manifest_list.sort(reverse=True)
+        for _, file_name in manifest_list[self.max_entries:]:
+            try:
+                os.remove(os.path.join(manifest_dir, file_name))
+            except OSError:
+                continue
+            evicted.append(file_name[:-len('.json')])
+        return evicted
+
+def writeCountVector(output_path, sample_name, gene_index, gene_counts):
+    """
+        write the counts of a sample without the gene ids. The gene ids are in the manifest of gene_index
+        :params output_path: path to the output, eg ${sample_name}_counts.json
+        :params sample_name: name of the sample
+        :params gene_index: geneIndex of the manifest the counts are ordered by
+        :params gene_counts: list of counts
+    """
+    with open(output_path, 'w') as output_file:
+        json.dump({'sampleName': sample_name, 'geneIndex': gene_index, 'counts': gene_counts}, output_file)
+
+def readCountVector(input_path, gene_index_cache):
+    """
+        inverse of writeCountVector()
+        :params input_path: path to a count vector written by writeCountVector()
+        :params gene_index_cache: the GeneIndexCache which holds the manifest
+        :throws: KeyError if the manifest is not in the cache
+        :returns: a tuple (sample_name, gene_ids, gene_counts)
+    """
+    with open(input_path, 'r') as input_file:
+        count_vector = json.load(input_file)
+    manifest = gene_index_cache.getManifest(count_vector['geneIndex'])
+    if manifest is None:
+        raise KeyError('GeneIndexCacheError: manifest %s is not in %s' % (count_vector['geneIndex'], gene_index_cache.cache_dir))
+    return count_vector['sampleName'], manifest['geneIds'], count_vector['counts']
@@ -0,0 +1,252 @@
+"""
+    read the XF tags which htseq-count -o writes and AppendHtseqAnnotationsToBam.sh appends to the sorted bam
+    (${sample}_sorted_aligned_reads_with_annote.bam), so that the assignment of every read can be checked without
+    re-running htseq. The bam is split by its index into chunks of the genome which are read in a process pool, each
+    tallying per gene assigned, ambiguous and no feature reads and whether each read is on the strand of the gene it
+    starts in. The chunk tallies are then summed
+    usage: annotation_index = loadAnnotationIndex('KN99_annotation.gff', '/path/to/cache')
+           tally = analyzeAnnotatedBam('sample_sorted_aligned_reads_with_annote.bam', annotation_index, processes=8)
+           strandedness_qc = strandednessQc(tally, 'reverse')
+    author: chase.mateusiak@gmail.com
+
+    the XF tag is a gene id for a read counted to that gene, __ambiguous[gene+gene...] for a read which overlaps more
+    than one gene (each listed gene is tallied), or one of the other htseq qc rows, eg __no_feature. A pair is counted
+    once, by its first read, as htseq counts it. Secondary and supplementary alignments are not counted
+"""
+
+# standard library imports
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+# third party imports
+import numpy as np
+
+# local imports
+from .AnnotationIndex import AnnotationIndex
+from .HtseqCountParser import QC_COLUMN_DICT
+
+# bases of the genome in a chunk
+DEFAULT_CHUNK_SIZE = 1 << 21
+# reads with any of these flags are not counted: secondary, supplementary
+SKIPPED_FLAGS = 0x100 | 0x800
+# reads with any of these flags, or below the min mapq, do not count towards the strand statistics: unmapped, qc fail, duplicate
+STRAND_EXCLUDED_FLAGS = 0x4 | 0x200 | 0x400
+# prefix of the XF tag of a read which overlaps more than one gene
+AMBIGUOUS_PREFIX = '__ambiguous['
+# fraction of sense (or antisense) reads over which a library is called stranded (or reverse)
+STRANDED_FRACTION = 0.8
+# fewest reads in unambiguous genes to infer the strandedness from
+MIN_STRAND_READS = 100
+
+def emptyTally():
+    """
+        :returns: a tally with no reads. categories counts the reads of each XF category, keyed as QC_COLUMN_DICT
+                  plus assigned and untagged
+    """
+    return {'categories': Counter(), 'assigned': Counter(), 'ambiguous': Counter(), 'noFeature': Counter(),
+            'sense': 0, 'antisense': 0}
+
+def mergeTallies(tally_list):
+    """
+        :params tally_list: iterable of tallies, eg of each chunk
+        :returns: the sum of the tallies
+    """
+    merged_tally = emptyTally()
+    for tally in tally_list:
+        for key in ('categories', 'assigned', 'ambiguous', 'noFeature'):
+            merged_tally[key].update(tally[key])
+        merged_tally['sense'] += tally['sense']
+        merged_tally['antisense'] += tally['antisense']
+    return merged_tally
+
+def bamChunks(bam_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        split the chromosomes with reads into chunks, from the bam index
+        :params bam_path: a sorted, indexed bam
+        :params chunk_size: bases of the genome in a chunk
+        :returns: a list of (chrom, start, end), 0 based and half open. Reads with no position are the chunk ('*', 0, 0)
+    """
+    import pysam
+
+    chunk_list = []
+    with pysam.AlignmentFile(bam_path, 'rb') as bam_file:
+        for index_stats in bam_file.get_index_statistics():
+            if index_stats.total:
+                chrom_length = bam_file.get_reference_length(index_stats.contig)
+                chunk_list.extend((index_stats.contig, start, min(start + chunk_size, chrom_length))
+                                  for start in range(0, chrom_length, chunk_size))
+        if bam_file.nocoordinate:
+            chunk_list.append(('*', 0, 0))
+    return chunk_list
+
+@lru_cache(maxsize=4)
+def _intervalGenes(index_dir, feature_type):
+    """
+        the annotation index of a worker, and the gene of each interval of the feature type, loaded once per process
+        :returns: a tuple (annotation_index, interval_genes)
+    """
+    annotation_index = AnnotationIndex(index_dir)
+    offsets = np.asarray(annotation_index.featureArrays(feature_type)['offsets'])
+    return annotation_index, np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+def windowGenes(annotation_index, interval_genes, feature_type, chrom, start, end):
+    """
+        the gene at each base of a window, from the running sums of the intervals which open and close in it
+        :params annotation_index: an AnnotationIndex
+        :params interval_genes: the gene of each interval of the feature type
+        :params feature_type: eg exon
+        :params chrom: chromosome of the window
+        :params start: 0 based start of the window
+        :params end: end (exclusive) of the window
+        :returns: int64 array of the position in gene_ids of the gene at each base, -1 where there is no gene and -2
+                  where the features of more than one gene overlap
+    """
+    if chrom not in annotation_index.chroms:
+        return np.full(end - start, -1, dtype=np.int64)
+    feature_arrays = annotation_index.featureArrays(feature_type)
+    starts = np.asarray(feature_arrays['starts'])
+    ends = np.asarray(feature_arrays['ends'])
+    in_window = (np.asarray(feature_arrays['chroms']) == annotation_index.chroms.index(chrom)) & (ends > start) & (starts < end)
+    interval_starts = np.clip(starts[in_window] - start, 0, end - start)
+    interval_ends = np.clip(ends[in_window] - start, 0, end - start)
+    genes = interval_genes[in_window] + 1
+
+    # the number of intervals, and the sum of their genes + 1, open at each base
+    depth = np.zeros(end - start + 1, dtype=np.int64)
+    gene_sum = np.zeros(end - start + 1, dtype=np.int64)
+    np.add.at(depth, interval_starts, 1)
+    np.add.at(depth, interval_ends, -1)
+    np.add.at(gene_sum, interval_starts, genes)
+    np.add.at(gene_sum, interval_ends, -genes)
+    depth = np.cumsum(depth[:-1])
+    return np.where(depth == 1, np.cumsum(gene_sum[:-1]) - 1, np.where(depth == 0, -1, -2))
+
+def analyzeChunk(bam_path, index_dir, feature_type, min_mapq, chunk):
+    """
+        tally the reads which start in a chunk. Run in a pool worker. Of a pair only read 1 is tallied, for the XF tags
+        and the strand alike, so the strand statistics are those of read 1 and of single end reads
+        :params bam_path: a sorted, indexed bam with XF tags
+        :params index_dir: the index_dir of an AnnotationIndex
+        :params feature_type: the feature type htseq counted, eg exon
+        :params min_mapq: minimum mapping quality of a read to count towards the strand statistics
+        :params chunk: a (chrom, start, end) of bamChunks()
+        :returns: a tally, see emptyTally()
+    """
+    import pysam
+
+    annotation_index, interval_genes = _intervalGenes(index_dir, feature_type)
+    chrom, start, end = chunk
+    gene_ids = annotation_index.gene_ids
+    gene_strand_reverse = [strand == '-' for strand in annotation_index.strands]
+    window_genes = windowGenes(annotation_index, interval_genes, feature_type, chrom, start, end) if chrom != '*' else None
+
+    tally = emptyTally()
+    categories, assigned, ambiguous, no_feature = tally['categories'], tally['assigned'], tally['ambiguous'], tally['noFeature']
+    sense = antisense = 0
+    with pysam.AlignmentFile(bam_path, 'rb') as bam_file:
+        for read in (bam_file.fetch('*') if chrom == '*' else bam_file.fetch(chrom, start, end)):
+            flag = read.flag
+            # a read which overlaps the chunk's start is counted by the chunk in which it starts. Read 2 of a pair is
+            # skipped, even where read 1 is unmapped or below min_mapq
+            if flag & SKIPPED_FLAGS or (flag & 0x1 and flag & 0x80) or (window_genes is not None and read.reference_start < start):
+                continue
+            gene = -1
+            if window_genes is not None and not flag & STRAND_EXCLUDED_FLAGS and read.mapping_quality >= min_mapq:
+                gene = window_genes[read.reference_start - start]
+                if gene >= 0:
+                    # read 1 (or a single end read), so the strand of the fragment is that of the read
+                    if bool(flag & 0x10) == gene_strand_reverse[gene]:
+                        sense += 1
+                    else:
+                        antisense += 1
+            if not read.has_tag('XF'):
+                categories['untagged'] += 1
+                continue
+            feature = read.get_tag('XF')
+            if not feature.startswith('__'):
+                categories['assigned'] += 1
+                assigned[feature] += 1
+            elif feature.startswith(AMBIGUOUS_PREFIX):
+                categories['ambiguous'] += 1
+                ambiguous.update(feature[len(AMBIGUOUS_PREFIX):-1].split('+'))
+            else:
+                categories[QC_COLUMN_DICT.get(feature, feature)] += 1
+                if feature == '__no_feature' and gene >= 0:
+                    no_feature[gene_ids[gene]] += 1
+    tally['sense'], tally['antisense'] = sense, antisense
+    return tally
+
+def analyzeAnnotatedBam(bam_path, annotation_index, feature_type='exon', min_mapq=10, chunk_size=DEFAULT_CHUNK_SIZE, processes=1):
+    """
+        tally the XF tags and strand of every read of a bam, a chunk of the genome per task
+        usage: tally = analyzeAnnotatedBam('sample_sorted_aligned_reads_with_annote.bam', annotation_index, processes=8)
+        :params bam_path: a sorted, indexed bam with XF tags
+        :params annotation_index: the AnnotationIndex of the annotation htseq counted against
+        :params feature_type: the feature type htseq counted (-t). Default exon
+        :params min_mapq: minimum mapping quality of a read to count towards the strand statistics. Default 10
+        :params chunk_size: bases of the genome in a chunk
+        :params processes: number of worker processes. Default 1 reads the chunks in this process
+        :throws: KeyError if the annotation has no features of the type
+        :returns: a tally, see emptyTally()
+    """
+    # fail before starting a pool if the feature type is not in the annotation
+    annotation_index.featureArrays(feature_type)
+    chunk_list = bamChunks(bam_path, chunk_size)
+    chunk_arguments = ([bam_path] * len(chunk_list), [annotation_index.index_dir] * len(chunk_list),
+                       [feature_type] * len(chunk_list), [min_mapq] * len(chunk_list), chunk_list)
+    if processes <= 1:
+        return mergeTallies(map(analyzeChunk, *chunk_arguments))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return mergeTallies(executor.map(analyzeChunk, *chunk_arguments))
+
+def geneTallyRows(tally, annotation_index):
+    """
+        :params tally: a tally of analyzeAnnotatedBam()
+        :params annotation_index: the AnnotationIndex of the tally
+        :returns: a list of dicts of geneId, strand, assigned, ambiguous and noFeature, a row per gene of the annotation in
+                  index order, then any gene of an XF tag which is not in the annotation
+    """
+    gene_ids = list(annotation_index.gene_ids)
+    strands = list(annotation_index.strands)
+    gene_id_set = set(gene_ids)
+    extra_gene_ids = sorted((set(tally['assigned']) | set(tally['ambiguous'])) - gene_id_set)
+    return [{'geneId': gene_id, 'strand': strand, 'assigned': tally['assigned'][gene_id],
+             'ambiguous': tally['ambiguous'][gene_id], 'noFeature': tally['noFeature'][gene_id]}
+            for gene_id, strand in zip(gene_ids + extra_gene_ids, strands + ['.'] * len(extra_gene_ids))]
+
+def inferStrandedness(sense, antisense, stranded_fraction=STRANDED_FRACTION, min_reads=MIN_STRAND_READS):
+    """
+        :params sense: number of reads on the strand of the gene they start in
+        :params antisense: number of reads on the other strand
+        :params stranded_fraction: fraction of sense (antisense) reads at or over which the library is yes (reverse)
+        :params min_reads: fewest reads to infer from
+        :returns: the htseq-count -s setting which the reads support, yes, reverse or no, or None if there are too few reads
+    """
+    if sense + antisense < min_reads:
+        return None
+    sense_fraction = sense / (sense + antisense)
+    if sense_fraction >= stranded_fraction:
+        return 'yes'
+    if 1 - sense_fraction >= stranded_fraction:
+        return 'reverse'
+    return 'no'
+
+def strandednessQc(tally, strandedness=None, stranded_fraction=STRANDED_FRACTION, min_reads=MIN_STRAND_READS):
+    """
+        :params tally: a tally of analyzeAnnotatedBam()
+        :params strandedness: the -s setting htseq was run with, yes, reverse or no. Default None does not check it
+        :params stranded_fraction: see inferStrandedness
+        :params min_reads: see inferStrandedness
+        :returns: a dict of the read categories, sense, antisense, senseFraction, inferredStrandedness, strandedness and
+                  strandednessConsistent (None if either strandedness is not known)
+    """
+    sense, antisense = tally['sense'], tally['antisense']
+    inferred_strandedness = inferStrandedness(sense, antisense, stranded_fraction, min_reads)
+    qc_dict = {category: tally['categories'][category] for category in ['assigned'] + list(QC_COLUMN_DICT.values()) + ['untagged']}
+    qc_dict.update({category: count for category, count in tally['categories'].items() if category not in qc_dict})
+    qc_dict.update({'sense': sense, 'antisense': antisense,
+                    'senseFraction': sense / (sense + antisense) if sense + antisense else None,
+                    'inferredStrandedness': inferred_strandedness, 'strandedness': strandedness,
+                    'strandednessConsistent': inferred_strandedness == strandedness if inferred_strandedness and strandedness else None})
+    return qc_dict
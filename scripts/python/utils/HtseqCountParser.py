@@ -0,0 +1,107 @@
+"""
+    streaming parser for htseq-count output (two tab separated columns, first locus, second count).
+    The gene rows come first, followed by a handful of rows which start with __ and contain qc metrics
+    usage: gene_counts, htseq_qc_rows, gene_index, gene_ids = parseHtseqCounts('sample_read_count.tsv', 'sample', 'sample_counts.csv', 'sample_htseq_qc.csv')
+    author: chase.mateusiak@gmail.com
+"""
+
+# standard library imports
+import csv
+import hashlib
+import os
+
+# local imports
+from .CountPayload import updateGeneIndexDigest
+
+# name for the first of the two columns in the htseq output
+HTSEQ_OUTPUT_FIRST_COL_NAME = "gene_id"
+# the htseq identifier of qc metric rows (bottom of first column)
+QC_METRIC_IDENTIFIER = "__"
+# map of the htseq qc metrics to their QualityAssess columns
+QC_COLUMN_DICT = {'__no_feature': 'noFeature', '__ambiguous': 'ambiguous',
+                  '__too_low_aQual': 'tooLowAqual', '__not_aligned': 'notAligned',
+                  '__alignment_not_unique': 'alignmentNotUnique'}
+
+
+def parseHtseqCounts(count_file_path, sample_name, counts_output_path, qc_output_path):
+    """
+        read the htseq-count output a single time. Gene rows are written to counts_output_path as they are read,
+        qc rows (those starting with __) are written to qc_output_path. No dataframe is built -- the only things
+        held in memory are the vectors of counts and gene ids, which are needed for the database payload and count matrix
+        usage: gene_counts, htseq_qc_rows, gene_index, gene_ids = parseHtseqCounts(count_file_path, sample_name, 'sample_counts.csv', 'sample_htseq_qc.csv')
+        :params count_file_path: path to the htseq-count output (eg ${sample_name}_read_count.tsv)
+        :params sample_name: used as the heading of the count column in both output csvs
+        :params counts_output_path: path to which to write the gene counts csv (columns gene_id,sample_name). If None,
+                                    the gene counts are not written (eg because they are written as a count vector)
+        :params qc_output_path: path to which to write the htseq qc csv (columns gene_id,sample_name)
+        :throws: ValueError if a line does not have exactly two columns or the count is not an integer
+        :returns: a tuple (gene_counts, htseq_qc_rows, gene_index, gene_ids). gene_counts is a list of ints in file order,
+                  htseq_qc_rows is a list of (qc_metric, count) tuples, eg ('__no_feature', 101), gene_index
+                  identifies the gene order of gene_counts (see CountPayload.geneIndexId()) and gene_ids are the genes of gene_counts
+    """
+    gene_counts = []
+    gene_ids = []
+    htseq_qc_rows = []
+    gene_index_digest = hashlib.sha256()
+    header = [HTSEQ_OUTPUT_FIRST_COL_NAME, sample_name]
+
+    with open(count_file_path, 'r') as count_file, \
+            open(counts_output_path or os.devnull, 'w', newline='') as counts_output, \
+            open(qc_output_path, 'w', newline='') as qc_output:
+        # lineterminator matches the pandas to_csv output this replaces
+        counts_writer = csv.writer(counts_output, lineterminator='\n')
+        qc_writer = csv.writer(qc_output, lineterminator='\n')
+        counts_writer.writerow(header)
+        qc_writer.writerow(header)
+
+        for locus, count in readHtseqLines(count_file, count_file_path):
+            # qc rows go to the qc file, everything else is a gene
+            if locus.startswith(QC_METRIC_IDENTIFIER):
+                qc_writer.writerow([locus, count])
+                htseq_qc_rows.append((locus, count))
+            else:
+                if counts_output_path:
+                    counts_writer.writerow([locus, count])
+                gene_counts.append(count)
+                gene_ids.append(locus)
+                updateGeneIndexDigest(gene_index_digest, locus)
+
+    return gene_counts, htseq_qc_rows, gene_index_digest.hexdigest(), gene_ids
+
+
+def readHtseqLines(count_file, count_file_path):
+    """
+        iterate over the (locus, count) rows of open htseq-count output, skipping blank lines
+        usage: for locus, count in readHtseqLines(count_file, count_file_path): ...
+        :params count_file: an open htseq-count output file
+        :params count_file_path: path to the file, used in error messages
+        :throws: ValueError if a line does not have exactly two columns or the count is not an integer
+        :returns: a generator of (locus, count) tuples in file order, qc rows included
+    """
+    for line_number, line in enumerate(count_file, start=1):
+        line = line.rstrip('\r\n')
+        # skip blank lines (eg a trailing newline)
+        if not line:
+            continue
+        yield parseHtseqLine(line, count_file_path, line_number)
+
+def parseHtseqLine(line, count_file_path, line_number):
+    """
+        split a single line of htseq-count output into locus and count
+        :params line: a line from the htseq output with the newline stripped
+        :params count_file_path: path to the file, used in the error message
+        :params line_number: line number, used in the error message
+        :throws: ValueError if the line does not have two columns or the count is not an integer
+        :returns: a tuple (locus, count) where count is an int
+    """
+    fields = line.split('\t')
+    if len(fields) != 2:
+        raise ValueError('HtseqCountParsingError: line %s of %s does not have two tab separated columns'
+                         % (line_number, count_file_path))
+    try:
+        count = int(fields[1])
+    except ValueError:
+        raise ValueError('HtseqCountParsingError: line %s of %s has a non integer count: %s'
+                         % (line_number, count_file_path, fields[1]))
+
+    return fields[0], count
@@ -0,0 +1,38 @@
+"""
+    read a run manifest, eg the fastq_file_list csv main.nf is run with, and name its samples as the pipeline names them
+    usage: for row in readManifest('fastq_file_list.csv'): fastq_file_number_dict[row['sampleName']] = row['fastqFileNumber']
+    author: chase.mateusiak@gmail.com
+"""
+
+# standard library imports
+import csv
+import os
+
+# the columns every manifest must have
+REQUIRED_COLUMNS = ('fastqFileName', 'fastqFileNumber')
+
+def simpleName(file_path):
+    """
+        strip the path and all extensions from a file path, the same as nextflow getSimpleName()
+        usage: simpleName('/path/to/sample_1.fastq.gz') returns 'sample_1'
+        :params file_path: path to a file
+        :returns: the basename up to the first .
+    """
+    return os.path.basename(file_path).split('.')[0]
+
+def readManifest(manifest_path, columns=REQUIRED_COLUMNS):
+    """
+        read the rows of a manifest csv
+        usage: sample_list = readManifest('fastq_file_list.csv', ['fastqFileName', 'fastqFileNumber', 'organism'])
+        :params manifest_path: path to the manifest
+        :params columns: the columns the manifest must have. Default fastqFileName and fastqFileNumber
+        :throws: ValueError if one of columns is missing
+        :returns: a list of dicts, one per row, of every column of the manifest and sampleName, the simpleName() of the
+                  fastqFileName
+    """
+    with open(manifest_path, 'r', newline='') as manifest:
+        reader = csv.DictReader(manifest)
+        for column in columns:
+            if column not in (reader.fieldnames or []):
+                raise ValueError('ManifestError: %s is missing column %s' % (manifest_path, column))
+        return [dict(row, sampleName=simpleName(row['fastqFileName'])) for row in reader]
@@ -0,0 +1,280 @@
+"""
+    durable local outbox of requests to the database, so that a Post* script hands its payloads off in one local write
+    and finishes whether or not the api is up. The payloads are delivered later, by DrainOutbox.py, in batches with
+    bounded concurrency, retried with backoff while the api is down, and moved to a dead letter table if the api
+    rejects them or they run out of attempts
+    usage: enqueueJobs('/path/to/outbox', [(counts_url, count_data, 'POST', fastq_file_number)])
+           with Outbox('/path/to/outbox') as outbox: summary = drainOutbox(outbox, client_factory)
+    author: chase.mateusiak@gmail.com
+
+    the outbox is one sqlite database, ${outbox_dir}/outbox.sqlite, in WAL mode so that many tasks can enqueue, and many
+    drains deliver, at once. Delivery is at least once: a claimed message is leased, not removed, and is deleted only
+    after the api accepts it, so a drain which dies mid batch leaves its messages to be claimed again when the lease
+    runs out. A drain claims only the oldest message of each (url, primary_key_value), and none of a record which has a
+    dead letter until it is requeued, so the updates of a record are delivered in the order they were enqueued
+"""
+
+# standard library imports
+import json
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+# name of the database file in the outbox directory
+OUTBOX_FILE_NAME = 'outbox.sqlite'
+# seconds a drain holds the messages it claimed before another drain may claim them
+DEFAULT_LEASE_SECONDS = 300
+# attempts of a message before it is dead lettered
+DEFAULT_MAX_ATTEMPTS = 10
+# the nth failed attempt waits min(RETRY_DELAY * 2**(n-1), MAX_RETRY_DELAY) seconds before the next
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+
+# a message of the outbox. data is the request body, method and primary_key_value are as UploadJob (see
+# utils/AsyncUploader.py). enqueued_at is seconds since the epoch
+OutboxMessage = namedtuple('OutboxMessage', ['id', 'url', 'method', 'primary_key_value', 'data', 'enqueued_at', 'attempts'])
+# a row of the dead letter table. status_code is None if no response was received
+DeadLetter = namedtuple('DeadLetter', ['id', 'url', 'method', 'primary_key_value', 'data', 'enqueued_at', 'attempts',
+                                       'status_code', 'error', 'failed_at'])
+
+MESSAGE_COLUMNS = 'id, url, method, primary_key_value, data, enqueued_at, attempts'
+
+def retryDelay(attempts):
+    """
+        :params attempts: the number of failed attempts of a message
+        :returns: seconds to wait before the next attempt
+    """
+    return min(RETRY_DELAY * 2 ** (max(attempts, 1) - 1), MAX_RETRY_DELAY)
+
+class Outbox:
+    """
+        sqlite backed outbox. Open one per process
+        :params outbox_dir: directory which holds the outbox database. Created if it does not exist
+        :params timeout: seconds to wait for another process's write lock
+    """
+    def __init__(self, outbox_dir, timeout=30):
+        os.makedirs(outbox_dir, exist_ok=True)
+        self.outbox_path = os.path.join(outbox_dir, OUTBOX_FILE_NAME)
+        self.connection = sqlite3.connect(self.outbox_path, timeout=timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, method TEXT NOT NULL, '
+                                'primary_key_value TEXT, data TEXT NOT NULL, enqueued_at REAL NOT NULL, '
+                                'attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL, lease_until REAL, '
+                                'last_error TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS messages_record ON messages (url, primary_key_value, id)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS dead_letters ('
+                                'id INTEGER PRIMARY KEY, url TEXT NOT NULL, method TEXT NOT NULL, primary_key_value TEXT, '
+                                'data TEXT NOT NULL, enqueued_at REAL NOT NULL, attempts INTEGER NOT NULL, '
+                                'status_code INTEGER, error TEXT, failed_at REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS dead_letters_record ON dead_letters (url, primary_key_value)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+            hold the write lock for the with block, and commit it (or roll it back if it raises)
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def enqueue(self, url, data, method='POST', primary_key_value=None):
+        """
+            add a request to the outbox
+            usage: outbox.enqueue(qc_url, qc_dict, 'POST_OR_PUT', fastq_file_number)
+            :params url: url of the endpoint
+            :params data: the body of the request, a json serializable dict
+            :params method: one of POST, PUT or POST_OR_PUT, see UploadJob in utils/AsyncUploader.py
+            :params primary_key_value: the id put to by POST_OR_PUT, and the key of the record in the post cache
+            :returns: the id of the message
+        """
+        now = time.time()
+        return self.connection.execute('INSERT INTO messages (url, method, primary_key_value, data, enqueued_at, next_attempt_at) '
+                                       'VALUES (?, ?, ?, ?, ?, ?)',
+                                       (url, method, None if primary_key_value is None else str(primary_key_value),
+                                        json.dumps(data, default=str), now, now)).lastrowid
+
+    def enqueueMany(self, jobs):
+        """
+            add many requests in one transaction
+            :params jobs: iterable of (url, data, method, primary_key_value) tuples, eg UploadJobs. method and
+                          primary_key_value may be left off, as enqueue()
+            :returns: the list of message ids
+        """
+        with self.transaction():
+            return [self.enqueue(*job) for job in jobs]
+
+    def claim(self, batch_size, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+            lease up to batch_size messages which are due, oldest first. Only the oldest message of a record is due, and
+            none while the record has a dead letter, which would otherwise overwrite the later updates once requeued
+            :params batch_size: most messages to claim
+            :params lease_seconds: seconds before the messages may be claimed again if they are neither acked nor retried
+            :returns: a list of OutboxMessage
+        """
+        now = time.time()
+        with self.transaction():
+            rows = self.connection.execute(
+                'SELECT %s FROM messages AS message WHERE next_attempt_at <= ? AND (lease_until IS NULL OR lease_until < ?) '
+                'AND (primary_key_value IS NULL OR id = (SELECT MIN(id) FROM messages AS earlier '
+                'WHERE earlier.url = message.url AND earlier.primary_key_value = message.primary_key_value) '
+                'AND NOT EXISTS (SELECT 1 FROM dead_letters AS dead '
+                'WHERE dead.url = message.url AND dead.primary_key_value = message.primary_key_value)) '
+                'ORDER BY id LIMIT ?' % MESSAGE_COLUMNS, (now, now, batch_size)).fetchall()
+            self.connection.executemany('UPDATE messages SET lease_until = ? WHERE id = ?', [(now + lease_seconds, row[0]) for row in rows])
+        return [OutboxMessage(*row[:4], json.loads(row[4]), *row[5:]) for row in rows]
+
+    def ack(self, message_ids):
+        """
+            delete messages which were delivered
+            :params message_ids: iterable of message ids
+        """
+        with self.transaction():
+            self.connection.executemany('DELETE FROM messages WHERE id = ?', [(message_id,) for message_id in message_ids])
+
+    def retry(self, message, error, status_code=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+            record a failed attempt of a message, and release it to be claimed again after retryDelay(). A message which
+            has had max_attempts attempts is dead lettered instead
+            :params message: the OutboxMessage
+            :params error: the error of the attempt
+            :params status_code: the status code of the response, or None if no response was received
+            :params max_attempts: attempts before the message is dead lettered
+            :returns: True if the message will be retried, False if it was dead lettered
+        """
+        attempts = message.attempts + 1
+        if attempts >= max_attempts:
+            self.deadLetter(message._replace(attempts=attempts), error, status_code)
+            return False
+        self.connection.execute('UPDATE messages SET attempts = ?, next_attempt_at = ?, lease_until = NULL, last_error = ? WHERE id = ?',
+                                (attempts, time.time() + retryDelay(attempts), error, message.id))
+        return True
+
+    def deadLetter(self, message, error, status_code=None):
+        """
+            move a message which cannot be delivered, eg which the api rejected, to the dead letter table
+            :params message: the OutboxMessage
+            :params error: the error of the last attempt
+            :params status_code: the status code of the last response, or None if no response was received
+        """
+        with self.transaction():
+            self.connection.execute('INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (message.id, message.url, message.method, message.primary_key_value,
+                                     json.dumps(message.data, default=str), message.enqueued_at, message.attempts,
+                                     status_code, error, time.time()))
+            self.connection.execute('DELETE FROM messages WHERE id = ?', (message.id,))
+
+    def deadLetters(self, url=None):
+        """
+            :params url: only the dead letters of this url. Default all
+            :returns: a list of DeadLetter, oldest first
+        """
+        where, parameters = (' WHERE url = ?', (url,)) if url is not None else ('', ())
+        return [DeadLetter(*row[:4], json.loads(row[4]), *row[5:]) for row in self.connection.execute(
+            'SELECT %s, status_code, error, failed_at FROM dead_letters%s ORDER BY id' % (MESSAGE_COLUMNS, where), parameters)]
+
+    def requeueDeadLetters(self, url=None):
+        """
+            move dead letters back to the outbox, with their attempts reset, eg once the api is fixed. They keep their
+            ids, so they are delivered in their original order
+            :params url: only the dead letters of this url. Default all
+            :returns: the number of messages requeued
+        """
+        where, parameters = (' WHERE url = ?', (url,)) if url is not None else ('', ())
+        with self.transaction():
+            self.connection.execute('INSERT INTO messages (id, url, method, primary_key_value, data, enqueued_at, attempts, next_attempt_at) '
+                                    'SELECT id, url, method, primary_key_value, data, enqueued_at, 0, ? FROM dead_letters%s' % where,
+                                    (time.time(),) + parameters)
+            return self.connection.execute('DELETE FROM dead_letters%s' % where, parameters).rowcount
+
+    def stats(self):
+        """
+            :returns: a list of (url, pending messages, of which leased, dead letters) tuples
+        """
+        now = time.time()
+        rows = self.connection.execute('SELECT url, SUM(pending), SUM(leased), SUM(dead) FROM ('
+                                       'SELECT url, 1 AS pending, lease_until >= ? AS leased, 0 AS dead FROM messages '
+                                       'UNION ALL SELECT url, 0, 0, 1 FROM dead_letters) GROUP BY url ORDER BY url', (now,)).fetchall()
+        return [(url, pending, leased or 0, dead) for url, pending, leased, dead in rows]
+
+def enqueueJobs(outbox_dir, jobs):
+    """
+        open the outbox and add requests to it, for a script which posts to the outbox rather than to the api
+        usage: enqueueJobs(args.outbox, [(args.url, data, 'POST_OR_PUT', args.fastq_file_number)])
+        :params outbox_dir: directory of the outbox
+        :params jobs: see Outbox.enqueueMany()
+        :returns: the list of message ids
+    """
+    with Outbox(outbox_dir) as outbox:
+        return outbox.enqueueMany(jobs)
+
+def drainOutbox(outbox, client_factory, batch_size=100, concurrency=8, requests_per_second=None,
+                max_attempts=DEFAULT_MAX_ATTEMPTS, lease_seconds=DEFAULT_LEASE_SECONDS, max_batches=None):
+    """
+        deliver the due messages of the outbox a batch at a time, with at most concurrency requests in flight (and, if
+        set, at most requests_per_second per host). A message the api accepts is deleted, and one which gets no
+        response, a 5xx, a 408 or a 429 is retried later. If every message of a batch fails that way the api is taken to
+        be down (or to be asking for fewer requests), and the drain stops rather than claim more. A message which can not
+        succeed (any other 4xx, or an invalid url) is dead lettered, as is a post whose response timed out: it may have
+        created the record, so it is left to be checked rather than sent again
+        usage: summary = drainOutbox(outbox, partial(createClient, post_cache_dir, False, metrics))
+        :params outbox: an Outbox
+        :params client_factory: callable which returns a DatabaseClient, see AsyncUploader
+        :params batch_size: messages claimed at a time
+        :params concurrency: see AsyncUploader
+        :params requests_per_second: see AsyncUploader
+        :params max_attempts: see Outbox.retry()
+        :params lease_seconds: see Outbox.claim(). Should be longer than a batch takes to send
+        :params max_batches: stop after this many batches. Default drains until no message is due
+        :returns: a dict of the number of messages delivered, retried and deadLettered, the number of batches, and
+                  whether the drain stopped on an outage
+    """
+    # imported here so that scripts which only enqueue do not load requests and asyncio
+    from .AsyncUploader import AsyncUploader, UploadJob
+
+    summary = {'delivered': 0, 'retried': 0, 'deadLettered': 0, 'batches': 0, 'outage': False}
+    while max_batches is None or summary['batches'] < max_batches:
+        message_list = outbox.claim(batch_size, lease_seconds)
+        if not message_list:
+            break
+        summary['batches'] += 1
+        uploader = AsyncUploader(concurrency=concurrency, requests_per_second=requests_per_second, client_factory=client_factory)
+        upload_results = uploader.uploadAll([UploadJob(message.url, message.data, message.method, message.primary_key_value)
+                                             for message in message_list])
+        # the delivered messages are acked first, so that nothing which happens to the failures sends them again
+        delivered_ids = [message.id for message, result in zip(message_list, upload_results) if result.ok]
+        outbox.ack(delivered_ids)
+        summary['delivered'] += len(delivered_ids)
+        transient_failures = 0
+        for message, result in zip(message_list, upload_results):
+            if result.ok:
+                continue
+            if result.transient:
+                transient_failures += 1
+                if outbox.retry(message, result.error, result.status_code, max_attempts):
+                    summary['retried'] += 1
+                else:
+                    summary['deadLettered'] += 1
+            else:
+                # eg a 4xx or an invalid url, which would fail the same way again, or a post which timed out
+                outbox.deadLetter(message._replace(attempts=message.attempts + 1), result.error, result.status_code)
+                summary['deadLettered'] += 1
+        if transient_failures == len(message_list):
+            summary['outage'] = True
+            break
+    return summary
@@ -0,0 +1,117 @@
+"""
+    content addressed record of what has been sent to the database, so that re-running a sample (nextflow -resume, a
+    backfill) does not re-send a payload the database already has. Each (endpoint, record key) has the hash of the last
+    payload which was sent successfully and the server's response. A DatabaseClient with a PostCache skips a payload whose
+    hash is unchanged, and sends a changed payload for a record which already exists straight to PUT
+    usage: with DatabaseClient(post_cache=PostCache('/path/to/cache')) as client: client.postOrPut(url, fastq_file_number, data)
+    author: chase.mateusiak@gmail.com
+
+    the cache is one sqlite database, ${cache_dir}/post_cache.sqlite, in WAL mode so that many processes can use it at once
+"""
+
+# standard library imports
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+# name of the database file in the cache directory
+CACHE_FILE_NAME = 'post_cache.sqlite'
+# the stored response body is truncated to this many characters
+MAX_RESPONSE_LENGTH = 4096
+
+# a row of the cache. updated_at is seconds since the epoch
+PostCacheEntry = namedtuple('PostCacheEntry', ['endpoint', 'record_key', 'payload_hash', 'method', 'status_code', 'response', 'updated_at'])
+# returned by a DatabaseClient in place of a requests.Response when a request is skipped
+CachedResponse = namedtuple('CachedResponse', ['status_code', 'text', 'from_cache'], defaults=[True])
+
+def payloadHash(data):
+    """
+        :params data: the body of a request, a json serializable dict
+        :returns: sha256 hex digest of the body serialized with sorted keys, so the hash does not depend on key order
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')).hexdigest()
+
+class PostCache:
+    """
+        sqlite backed cache of successful requests. One instance should be used by one thread at a time; give each
+        DatabaseClient its own
+        :params cache_dir: directory which holds the cache database. Created if it does not exist
+        :params timeout: seconds to wait for another process's write lock
+    """
+    def __init__(self, cache_dir, timeout=30):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_path = os.path.join(cache_dir, CACHE_FILE_NAME)
+        # the connection may be closed from a thread other than the one which used it, eg by AsyncUploader.close()
+        self.connection = sqlite3.connect(self.cache_path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS posts ('
+                                'endpoint TEXT NOT NULL, record_key TEXT NOT NULL, payload_hash TEXT NOT NULL, '
+                                'method TEXT NOT NULL, status_code INTEGER, response TEXT, updated_at REAL NOT NULL, '
+                                'PRIMARY KEY (endpoint, record_key))')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, endpoint, record_key):
+        """
+            :params endpoint: url of the endpoint, eg http://13.59.167.2/api/QualityAssess/
+            :params record_key: the record's key, eg the fastqFileNumber
+            :returns: the PostCacheEntry, or None if nothing has been sent for the record
+        """
+        row = self.connection.execute('SELECT endpoint, record_key, payload_hash, method, status_code, response, updated_at '
+                                      'FROM posts WHERE endpoint = ? AND record_key = ?', (endpoint, str(record_key))).fetchone()
+        return PostCacheEntry(*row) if row else None
+
+    def record(self, endpoint, record_key, payload_hash, method, status_code, response=''):
+        """
+            record a successful request, replacing any earlier entry for the record
+            :params endpoint: url of the endpoint
+            :params record_key: the record's key
+            :params payload_hash: payloadHash() of the body sent
+            :params method: the http verb which succeeded
+            :params status_code: the response status code
+            :params response: the response body, truncated to MAX_RESPONSE_LENGTH
+        """
+        self.connection.execute('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (endpoint, str(record_key), payload_hash, method, status_code,
+                                 (response or '')[:MAX_RESPONSE_LENGTH], time.time()))
+
+    def evict(self, older_than=None, endpoint=None):
+        """
+            delete entries, so that the records are sent again on the next run
+            usage: cache.evict(older_than=30 * 24 * 3600)
+            :params older_than: only delete entries last updated more than this many seconds ago. Default all
+            :params endpoint: only delete entries of this endpoint. Default all endpoints
+            :returns: the number of entries deleted
+        """
+        clauses, parameters = [], []
+        if older_than is not None:
+            clauses.append('updated_at < ?')
+            parameters.append(time.time() - older_than)
+        if endpoint is not None:
+            clauses.append('endpoint = ?')
+            parameters.append(endpoint)
+        where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+        return self.connection.execute('DELETE FROM posts' + where, parameters).rowcount
+
+    def compact(self):
+        """
+            checkpoint the write ahead log and rebuild the database file to reclaim the space of deleted entries
+        """
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.connection.execute('VACUUM')
+
+    def stats(self):
+        """
+            :returns: a list of (endpoint, number of entries, last updated) tuples
+        """
+        return self.connection.execute('SELECT endpoint, COUNT(*), MAX(updated_at) FROM posts GROUP BY endpoint ORDER BY endpoint').fetchall()
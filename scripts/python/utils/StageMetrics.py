@@ -0,0 +1,194 @@
+"""
+    per stage timing and metrics of the Post* scripts, so that a slow run can be broken down into startup (imports),
+    parsing, coverage, serialization and waiting on the api. Each stage records its wall and cpu time, the bytes the
+    process read and, through a DatabaseClient created with the metrics (see DatabaseInteraction.createClient()), the
+    number, payload bytes, latency and retries of the requests made while it was open
+    usage: metrics = StageMetrics('PostCountsToDatabase', 'sample_1', metrics_dir='/path/to/run/metrics')
+           with metrics.stage('parse'):
+               ...
+    author: chase.mateusiak@gmail.com
+
+    output: the stages are written when the process exits (so a run which fails is recorded too) as json lines,
+            ${metrics_dir}/${script}_${sample}.jsonl, one line per stage:
+            {'script', 'sample', 'stage', 'status', 'start', 'wallTime', 'cpuTime', 'bytesRead', 'httpRequests',
+             'httpRetries', 'httpErrors', 'payloadBytes', 'httpLatencyTotal', 'httpLatencyMax', 'pid', 'host'}
+            and optionally as a prometheus textfile (for the node_exporter textfile collector), ${prometheus_dir}/${script}_${sample}.prom
+            SummarizeMetrics.py summarizes a directory of .jsonl files into percentiles per stage
+"""
+
+# standard library imports
+import atexit
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# the metrics of a stage written to the prometheus textfile, and their help text
+PROMETHEUS_METRICS = (('wallTime', 'rnaseq_stage_wall_seconds', 'wall time of the stage'),
+                      ('cpuTime', 'rnaseq_stage_cpu_seconds', 'cpu time (user and system, all threads) of the stage'),
+                      ('bytesRead', 'rnaseq_stage_read_bytes', 'bytes read by the process during the stage'),
+                      ('payloadBytes', 'rnaseq_stage_payload_bytes', 'bytes of request bodies sent during the stage'),
+                      ('httpRequests', 'rnaseq_stage_http_requests', 'http requests (including retries) sent during the stage'),
+                      ('httpRetries', 'rnaseq_stage_http_retries', 'http requests which were retries'),
+                      ('httpLatencyTotal', 'rnaseq_stage_http_latency_seconds_sum', 'total latency of the http requests of the stage'))
+# name of the stage which measures the time from the start of the process to the creation of the StageMetrics
+STARTUP_STAGE = 'startup'
+
+def processBytesRead():
+    """
+        :returns: the bytes read by this process so far (rchar of /proc/self/io), or None where that is not available
+    """
+    try:
+        with open('/proc/self/io', 'r') as io_file:
+            for line in io_file:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def processAge():
+    """
+        :returns: seconds since this process started (from /proc), or None where that is not available
+    """
+    try:
+        with open('/proc/self/stat', 'r') as stat_file:
+            # the command may contain spaces, so split after its closing parenthesis. starttime is field 22
+            start_ticks = int(stat_file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return max(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 0.0)
+
+class StageMetrics:
+    """
+        the stages of one script run. If neither metrics_dir nor prometheus_dir is set, stages are still timed but
+        nothing is written
+        :params script: name of the script, eg PostCountsToDatabase
+        :params sample_name: name of the sample, or of the batch for the batch scripts. Default is the process id
+        :params metrics_dir: directory in which to write the json lines. Created if it does not exist
+        :params prometheus_dir: directory in which to write the prometheus textfile. Created if it does not exist
+    """
+    def __init__(self, script, sample_name=None, metrics_dir=None, prometheus_dir=None):
+        self.script = script
+        self.sample_name = str(sample_name) if sample_name is not None else str(os.getpid())
+        self.metrics_dir = metrics_dir
+        self.prometheus_dir = prometheus_dir
+        self.stages = []
+        self.open_stages = []
+        # requests are recorded from the uploader's worker threads
+        self.lock = threading.Lock()
+        self.written = False
+        process_age = processAge()
+        if process_age is not None:
+            self.stages.append(self._newStage(STARTUP_STAGE, time.time() - process_age))
+            self.stages[0].update({'wallTime': process_age, 'cpuTime': time.process_time(), 'bytesRead': processBytesRead()})
+        if metrics_dir or prometheus_dir:
+            atexit.register(self.write)
+
+    @property
+    def enabled(self):
+        return bool(self.metrics_dir or self.prometheus_dir)
+
+    def _newStage(self, stage_name, start):
+        return {'script': self.script, 'sample': self.sample_name, 'stage': stage_name, 'status': 'ok', 'start': start,
+                'wallTime': None, 'cpuTime': None, 'bytesRead': None, 'httpRequests': 0, 'httpRetries': 0, 'httpErrors': 0,
+                'payloadBytes': 0, 'httpLatencyTotal': 0.0, 'httpLatencyMax': 0.0, 'pid': os.getpid(), 'host': socket.gethostname()}
+
+    @contextmanager
+    def stage(self, stage_name):
+        """
+            time the code in the with block as a stage. If it raises (including sys.exit()), the status of the stage is
+            the name of the exception
+            usage: with metrics.stage('post'): client.postOrPut(url, fastq_file_number, data)
+            :params stage_name: name of the stage, eg parse
+            :returns: the stage dict, to which other counts may be added
+        """
+        stage_record = self._newStage(stage_name, time.time())
+        bytes_read_start = processBytesRead()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        with self.lock:
+            self.open_stages.append(stage_record)
+            self.stages.append(stage_record)
+        try:
+            yield stage_record
+        except BaseException as e:
+            stage_record['status'] = type(e).__name__
+            raise
+        finally:
+            stage_record['wallTime'] = time.perf_counter() - wall_start
+            stage_record['cpuTime'] = time.process_time() - cpu_start
+            bytes_read_end = processBytesRead()
+            if bytes_read_start is not None and bytes_read_end is not None:
+                stage_record['bytesRead'] = bytes_read_end - bytes_read_start
+            with self.lock:
+                self.open_stages.remove(stage_record)
+
+    def recordRequest(self, latency, retry=False, payload_bytes=0, error=False):
+        """
+            add a request to the innermost open stage. Called by a DatabaseClient for each attempt of each request
+            :params latency: seconds from sending the request to receiving the response (or the error)
+            :params retry: True if the request is a retry of a failed attempt
+            :params payload_bytes: length of the request body
+            :params error: True if no response was received or the response is an error
+        """
+        with self.lock:
+            if not self.open_stages:
+                return
+            stage_record = self.open_stages[-1]
+            stage_record['httpRequests'] += 1
+            stage_record['httpRetries'] += int(retry)
+            stage_record['httpErrors'] += int(error)
+            stage_record['payloadBytes'] += payload_bytes
+            stage_record['httpLatencyTotal'] += latency
+            stage_record['httpLatencyMax'] = max(stage_record['httpLatencyMax'], latency)
+
+    def write(self):
+        """
+            write the stages to the metrics_dir and prometheus_dir given. Called at exit; later calls do nothing
+        """
+        if self.written or not self.enabled:
+            return
+        self.written = True
+        file_name = '%s_%s' % (self.script, re.sub(r'[^\w.-]', '_', self.sample_name))
+        with self.lock:
+            stages = [dict(stage_record) for stage_record in self.stages]
+        if self.metrics_dir:
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            # append, so that a task which nextflow retries keeps the record of its failed attempt
+            with open(os.path.join(self.metrics_dir, file_name + '.jsonl'), 'a') as metrics_file:
+                for stage_record in stages:
+                    metrics_file.write(json.dumps(stage_record) + '\n')
+        if self.prometheus_dir:
+            writePrometheusTextfile(os.path.join(self.prometheus_dir, file_name + '.prom'), stages)
+
+def writePrometheusTextfile(prometheus_path, stages):
+    """
+        write the stages as prometheus gauges, labelled by script, sample and stage. The file is written to a temporary
+        file and renamed, as the textfile collector requires
+        :params prometheus_path: path of the .prom file
+        :params stages: list of stage dicts
+    """
+    lines = []
+    for field, metric_name, help_text in PROMETHEUS_METRICS:
+        lines.append('# HELP %s %s' % (metric_name, help_text))
+        lines.append('# TYPE %s gauge' % metric_name)
+        for stage_record in stages:
+            if stage_record.get(field) is None:
+                continue
+            labels = ','.join('%s="%s"' % (label, str(stage_record[key]).replace('\\', '\\\\').replace('"', '\\"'))
+                              for label, key in (('script', 'script'), ('sample', 'sample'), ('stage', 'stage'), ('status', 'status')))
+            lines.append('%s{%s} %s' % (metric_name, labels, stage_record[field]))
+
+    prometheus_dir = os.path.dirname(prometheus_path) or '.'
+    os.makedirs(prometheus_dir, exist_ok=True)
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=prometheus_dir, prefix='.tmp_', suffix='.prom')
+    with os.fdopen(file_descriptor, 'w') as prometheus_file:
+        prometheus_file.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, prometheus_path)
@@ -0,0 +1,138 @@
+"""
+    local stand in for the database api, for the benchmarks (see RunBenchmarks.py) and tests. It imitates the Counts
+    endpoint (POST only) and the QualityAssess endpoint (POST, which is rejected with a 400 if the record exists, and
+    PUT to QualityAssess/${fastqFileNumber}/, which is a 404 if it does not), with a configurable latency and rate of 503s
+    usage: with StubApiServer(latency=0.05, error_rate=0.01) as server:
+               DatabaseClient().postOrPut(server.url + 'QualityAssess/', 1, {'fastqFileNumber': 1})
+    author: chase.mateusiak@gmail.com
+"""
+
+# standard library imports
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# the endpoints served, under /api/
+COUNTS_ENDPOINT = 'Counts'
+QUALITY_ASSESS_ENDPOINT = 'QualityAssess'
+
+class StubApiServer:
+    """
+        threaded http server on localhost, started by start() or by entering it as a context manager
+        :params latency: seconds each request waits before it is answered
+        :params error_rate: fraction of requests, chosen at random, which are answered with a 503
+        :params port: port to listen on. Default 0 picks a free port
+        :params seed: seed of the random choice of failed requests
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, port=0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.rng = random.Random(seed)
+        # records are (endpoint, fastqFileNumber) -> last body. request_counts is (method, endpoint, status code) -> count
+        self.records = {}
+        self.request_counts = Counter()
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        self.http_server = ThreadingHTTPServer(('127.0.0.1', port), self._handlerClass())
+        self.http_server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+            :returns: the api root, eg http://127.0.0.1:45678/api/. Append the endpoint, eg url + 'Counts/'
+        """
+        return 'http://127.0.0.1:%s/api/' % self.http_server.server_address[1]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        self.thread.join()
+
+    def reset(self):
+        """
+            forget the records and request counts, and restart the random choice of failed requests, so that the next
+            run of the same requests is answered the same way
+        """
+        with self.lock:
+            self.records = {}
+            self.request_counts = Counter()
+            self.bytes_received = 0
+            self.rng = random.Random(self.seed)
+
+    def respond(self, method, path, body):
+        """
+            the answer of the stub api to a request
+            :params method: http verb
+            :params path: the request path, eg /api/QualityAssess/1/
+            :params body: the request body, as bytes
+            :returns: the response status code
+        """
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        endpoint = parts[1] if len(parts) > 1 and parts[0] == 'api' else None
+        record_key = parts[2] if len(parts) > 2 else None
+        with self.lock:
+            self.bytes_received += len(body)
+            if endpoint not in (COUNTS_ENDPOINT, QUALITY_ASSESS_ENDPOINT) or len(parts) > 3:
+                status_code = 404
+            elif self.error_rate and self.rng.random() < self.error_rate:
+                status_code = 503
+            elif method == 'POST' and record_key is None:
+                fastq_file_number = parse_qs(body.decode('utf-8')).get('fastqFileNumber', [None])[0]
+                if endpoint == QUALITY_ASSESS_ENDPOINT and (endpoint, fastq_file_number) in self.records:
+                    status_code = 400
+                else:
+                    self.records[(endpoint, fastq_file_number)] = body
+                    status_code = 201
+            elif method == 'PUT' and endpoint == QUALITY_ASSESS_ENDPOINT and record_key is not None:
+                if (endpoint, record_key) in self.records:
+                    self.records[(endpoint, record_key)] = body
+                    status_code = 200
+                else:
+                    status_code = 404
+            else:
+                status_code = 405
+            self.request_counts[(method, endpoint, status_code)] += 1
+        return status_code
+
+    def _handlerClass(self):
+        server = self
+
+        class StubApiHandler(BaseHTTPRequestHandler):
+            # keep-alive, so that the benchmarks measure the client's connection pooling
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if server.latency:
+                    time.sleep(server.latency)
+                status_code = server.respond(self.command, self.path, body)
+                response_body = b'{}'
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response_body)))
+                self.end_headers()
+                self.wfile.write(response_body)
+
+            do_POST = handle_request
+            do_PUT = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        return StubApiHandler
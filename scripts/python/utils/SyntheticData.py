@@ -0,0 +1,188 @@
+"""
+    synthetic inputs of the size of a real run, for the benchmarks (see RunBenchmarks.py). Every generator takes a
+    random.Random so that the same seed writes the same files
+    usage: gene_ids = syntheticGeneIds(7000)
+           writeSyntheticAnnotation('annotation.gff', gene_ids)
+           writeSyntheticHtseqCounts('sample_read_count.tsv', gene_ids, random.Random(1))
+    author: chase.mateusiak@gmail.com
+
+    the annotation lays the genes out one after another on chromosomes of CHROM_LENGTH bases, each a gene, mRNA, exon
+    and CDS of GENE_LENGTH bases followed by GENE_SPACING intergenic bases. The resistance markers CNAG_NAT and CNAG_G418
+    are appended to the last chromosome
+"""
+
+# standard library imports
+import os
+
+# third party imports
+import pysam
+
+# local imports
+from .HtseqCountParser import QC_COLUMN_DICT
+
+# layout of the synthetic genome
+GENE_LENGTH = 1500
+GENE_SPACING = 500
+CHROM_LENGTH = 1000000
+# ids of the genes drawn by syntheticGeneIds, and of the markers which PostGenotypeCoverageToDatabase.py looks up
+GENE_ID_FORMAT = 'CKF44_%05d'
+MARKER_GENE_IDS = ('CNAG_NAT', 'CNAG_G418')
+
+def syntheticGeneIds(num_genes):
+    """
+        :params num_genes: number of genes
+        :returns: a list of num_genes gene ids, eg ['CKF44_00001', 'CKF44_00002', ...]
+    """
+    return [GENE_ID_FORMAT % gene_number for gene_number in range(1, num_genes + 1)]
+
+def geneLayout(gene_ids):
+    """
+        the position of each gene (and marker) of the synthetic genome
+        :params gene_ids: the gene ids, without the markers
+        :returns: a tuple (layout, chrom_lengths). layout is a list of (gene id, chrom, 0 based start, end) and chrom_lengths
+                  is a list of (chrom, length)
+    """
+    genes_per_chrom = CHROM_LENGTH // (GENE_LENGTH + GENE_SPACING)
+    layout = []
+    for position, gene_id in enumerate(list(gene_ids) + list(MARKER_GENE_IDS)):
+        start = (position % genes_per_chrom) * (GENE_LENGTH + GENE_SPACING) + GENE_SPACING
+        layout.append((gene_id, 'chr%s' % (position // genes_per_chrom + 1), start, start + GENE_LENGTH))
+    num_chroms = (len(layout) - 1) // genes_per_chrom + 1
+    chrom_lengths = [('chr%s' % chrom_number, CHROM_LENGTH) for chrom_number in range(1, num_chroms + 1)]
+    return layout, chrom_lengths
+
+def writeSyntheticAnnotation(annotation_path, gene_ids):
+    """
+        write a gff3 with a gene, mRNA, exon and CDS for each gene and marker (see geneLayout())
+        :params annotation_path: path to which to write the gff
+        :params gene_ids: the gene ids, without the markers
+    """
+    layout, _ = geneLayout(gene_ids)
+    with open(annotation_path, 'w') as annotation_file:
+        annotation_file.write('##gff-version 3\n')
+        for gene_id, chrom, start, end in layout:
+            row = '%s\tsynthetic\t%%s\t%s\t%s\t.\t+\t%%s\t%%s\n' % (chrom, start + 1, end)
+            annotation_file.write(row % ('gene', '.', 'ID=%s;biotype=protein_coding' % gene_id))
+            annotation_file.write(row % ('mRNA', '.', 'ID=%s-T1;Parent=%s' % (gene_id, gene_id)))
+            annotation_file.write(row % ('exon', '.', 'ID=%s-T1.exon1;Parent=%s-T1' % (gene_id, gene_id)))
+            annotation_file.write(row % ('CDS', '0', 'ID=%s-T1.cds1;Parent=%s-T1' % (gene_id, gene_id)))
+
+def writeSyntheticHtseqCounts(count_file_path, gene_ids, rng, max_count=5000):
+    """
+        write htseq-count output, a row per gene followed by the qc rows
+        :params count_file_path: path to which to write the counts
+        :params gene_ids: the gene ids, in order
+        :params rng: a random.Random
+        :params max_count: counts are drawn uniformly from 0 to max_count
+        :returns: the total of the gene counts
+    """
+    total = 0
+    with open(count_file_path, 'w') as count_file:
+        for gene_id in gene_ids:
+            count = rng.randint(0, max_count)
+            total += count
+            count_file.write('%s\t%s\n' % (gene_id, count))
+        for qc_metric in QC_COLUMN_DICT:
+            count_file.write('%s\t%s\n' % (qc_metric, rng.randint(0, max_count * 10)))
+    return total
+
+def writeSyntheticNovoalignLog(log_path, rng, library_size=None):
+    """
+        write the summary of a novoalign log (the lines parsed by AlignmentLogParser.parseNovoalignLog())
+        :params log_path: path to which to write the log
+        :params rng: a random.Random
+        :params library_size: number of reads. Default draws one between one and ten million
+    """
+    library_size = library_size or rng.randint(1000000, 10000000)
+    unique_alignment = int(library_size * rng.uniform(0.6, 0.9))
+    multi_map = int((library_size - unique_alignment) * rng.uniform(0.1, 0.5))
+    homopolymer_filter = rng.randint(0, library_size // 1000)
+    no_map = library_size - unique_alignment - multi_map - homopolymer_filter
+    with open(log_path, 'w') as log_file:
+        log_file.write('# novoalign (V3.09.00 - Build Jan  1 2020 @ 00:00:00) - A short read aligner with qualities.\n'
+                       '# Interpreting input files as Illumina FASTQ, Cassava Pipeline 1.8.\n')
+        log_file.write('#     Read Sequences: %10d\n' % library_size)
+        log_file.write('#            Aligned: %10d\n' % (unique_alignment + multi_map))
+        log_file.write('#   Unique Alignment: %10d\n' % unique_alignment)
+        # every read is long enough, so the read length filter is 0
+        log_file.write('#        Read Length: %10d\n' % 0)
+        log_file.write('#   Gapped Alignment: %10d\n' % rng.randint(0, 1000))
+        log_file.write('#     Quality Filter: %10d\n' % 0)
+        log_file.write('# Homopolymer Filter: %10d\n' % homopolymer_filter)
+        log_file.write('#       Multi Mapped: %10d\n' % multi_map)
+        log_file.write('#   No Mapping Found: %10d\n' % no_map)
+        log_file.write('#       Elapsed Time: %.3f (sec.)\n' % rng.uniform(100, 1000))
+
+def writeSyntheticNovosortLog(log_path, rng):
+    """
+        write the duplicate summary of a novosort --markDuplicates log
+        :params log_path: path to which to write the log
+        :params rng: a random.Random
+    """
+    unpaired_reads = rng.randint(1000000, 10000000)
+    with open(log_path, 'w') as log_file:
+        log_file.write('# novosort (V3.09.00)\n')
+        log_file.write('#     Proper Pairs       0\n')
+        log_file.write('#     Unpaired Reads     %s\n' % unpaired_reads)
+        log_file.write('#     Duplicate Proper Pairs     0\n')
+        log_file.write('#     Duplicate Unpaired Reads     %s\n' % int(unpaired_reads * rng.uniform(0.05, 0.3)))
+
+def writeSyntheticBam(bam_path, gene_ids, num_reads, rng, read_length=75, min_mapq=10):
+    """
+        write a sorted, indexed bam of single end reads placed uniformly at random in the genes and markers of the
+        synthetic annotation. About one in ten reads has a mapping quality below min_mapq
+        :params bam_path: path to which to write the bam. The index is written beside it
+        :params gene_ids: the gene ids of the annotation, without the markers
+        :params num_reads: number of reads
+        :params rng: a random.Random
+        :params read_length: length of each read
+        :params min_mapq: see above
+    """
+    layout, chrom_lengths = geneLayout(gene_ids)
+    chrom_position_dict = {chrom: position for position, (chrom, _) in enumerate(chrom_lengths)}
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': length} for chrom, length in chrom_lengths]}
+    reads = []
+    for _ in range(num_reads):
+        _, chrom, start, end = layout[rng.randrange(len(layout))]
+        reads.append((chrom_position_dict[chrom], rng.randint(start, end - read_length),
+                      rng.randint(0, min_mapq - 1) if rng.random() < 0.1 else 60, 16 if rng.random() < 0.5 else 0))
+    reads.sort()
+
+    query_sequence = 'A' * read_length
+    query_qualities = pysam.qualitystring_to_array('I' * read_length)
+    with pysam.AlignmentFile(bam_path, 'wb', header=header) as bam_file:
+        for read_number, (reference_id, start, mapq, flag) in enumerate(reads):
+            read = pysam.AlignedSegment()
+            read.query_name = 'read%s' % read_number
+            read.query_sequence = query_sequence
+            read.flag = flag
+            read.reference_id = reference_id
+            read.reference_start = start
+            read.mapping_quality = mapq
+            read.cigartuples = [(0, read_length)]
+            read.query_qualities = query_qualities
+            bam_file.write(read)
+    pysam.index(bam_path)
+
+def writeSyntheticRun(run_dir, num_samples, gene_ids, rng, num_reads=0):
+    """
+        write the htseq counts, novoalign and novosort logs (and, if num_reads, a bam) of num_samples samples, named
+        as the pipeline names them: ${sample_name}_read_count.tsv, ${sample_name}_novoalign.log, ${sample_name}_novosort.log
+        and ${sample_name}_sorted_aligned_reads.bam
+        :params run_dir: directory in which to write the files. Created if it does not exist
+        :params num_samples: number of samples
+        :params gene_ids: the gene ids of the annotation
+        :params rng: a random.Random
+        :params num_reads: number of reads in each bam. Default 0 writes no bams
+        :returns: the list of sample names
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    sample_names = ['sample_%s' % sample_number for sample_number in range(1, num_samples + 1)]
+    for sample_name in sample_names:
+        writeSyntheticHtseqCounts(os.path.join(run_dir, '%s_read_count.tsv' % sample_name), gene_ids, rng)
+        writeSyntheticNovoalignLog(os.path.join(run_dir, '%s_novoalign.log' % sample_name), rng)
+        writeSyntheticNovosortLog(os.path.join(run_dir, '%s_novosort.log' % sample_name), rng)
+        if num_reads:
+            writeSyntheticBam(os.path.join(run_dir, '%s_sorted_aligned_reads.bam' % sample_name), gene_ids, num_reads, rng)
+    return sample_names